@@ -1,4 +1,8 @@
 # rpi_server_project/config.py
+import os
+
+# このファイルが置かれているディレクトリ (プロジェクトルート)
+BASE_DIR = os.path.dirname(os.path.abspath(__file__))
 
 # --- 接続先の中央サーバー設定 ---
 # ポート8000ではなく、標準のHTTPSポート(443)を使用
@@ -9,6 +13,9 @@ CENTRAL_SERVER_URLS = [
     "http://54.236.101.217:8000",  # 3. 旧サーバー (予備・移行期間用)
     "https://sotsusotsu.com",
 ]
+# 検証用のスタブ中央サーバーなどに向ける場合は、環境変数 FIELD_CENTRAL_SERVER_URLS にカンマ区切りで指定
+if os.environ.get("FIELD_CENTRAL_SERVER_URLS"):
+    CENTRAL_SERVER_URLS = os.environ["FIELD_CENTRAL_SERVER_URLS"].split(",")
 
 # SSL証明書の検証を行うかどうか
 # IPアドレスでアクセスする場合や自己署名証明書の場合は False に設定
@@ -20,6 +27,17 @@ API_BASE_PATH = "/api/"
 # APIキー（将来のセキュリティ拡張用。今はダミー）
 API_KEY = "dummy-secret-key-for-rpi-01"
 
+# async ビュー (炊き出し確認・チャット) から中央サーバーへ同時に張る接続数の上限
+CENTRAL_ASYNC_MAX_CONNECTIONS = 20
+
+# 中央サーバーへの送信がこの回数連続で失敗したら、しばらく送信をやめてすぐにオフライン表示にする
+CENTRAL_BREAKER_FAILURE_THRESHOLD = 5
+# 送信をやめている時間 (秒)。明けたら1件だけ試しに送り、成功すれば元に戻す
+CENTRAL_BREAKER_COOLDOWN_SECONDS = 30
+
+# 中央サーバーから取得したチャットのグループ・履歴を、オフライン時の表示用に保持する時間 (秒)
+CENTRAL_FALLBACK_CACHE_SECONDS = 6 * 3600
+
 
 # --- このデバイス（ラズベリーパイ）自体の設定 ---
 
@@ -30,10 +48,312 @@ SHELTER_ID = "SHELTER_001"
 
 # このデバイスを識別するための一意なID
 # 複数台のラズパイを同じ避難所で使う場合などを想定し、ユニークな名前を付けます。
-DEVICE_ID = "RPi_Shelter_A_01"
+# (1台のPCで複数のインスタンスを動かして試す場合は、環境変数 FIELD_DEVICE_ID で上書きできます)
+DEVICE_ID = os.environ.get("FIELD_DEVICE_ID", "RPi_Shelter_A_01")
+
+
+# --- 同じ避難所内のラズパイ同士の同期 (LAN) の設定 ---
+
+# 同じ SHELTER_ID を持つ他のラズパイのURL (例: "http://192.168.10.12:8000")
+# 入口ごとにラズパイを置く場合、お互いのチェックイン記録を中央サーバーを経由せずに共有する
+# (環境変数 FIELD_PEER_URLS にカンマ区切りで指定することもできます)
+PEER_URLS = [url for url in os.environ.get("FIELD_PEER_URLS", "").split(",") if url]
+
+# ラズパイ同士の通信で使う共有キー。同じ避難所のラズパイ全てで同じ値にする
+# (初期値のままでは、ピアのAPI (/peer/checkins/) はチェックイン記録を返さない)
+PEER_SHARED_KEY = "dummy-peer-shared-key"
+
+# 他のラズパイから新しい記録を取得する間隔（秒）
+PEER_SYNC_INTERVAL_SECONDS = 2
+
+# 取得済みの位置 (カーソル) より少し前から取り直す秒数
+# 書き込みの順序が前後しても取りこぼさないため (IDで重複は除かれる)
+PEER_CURSOR_OVERLAP_SECONDS = 5
+
+# 1回の問い合わせで受け取る最大件数
+PEER_BATCH_SIZE = 500
 
 
 # --- アプリケーションの動作設定 ---
 
 # QRコードを連続でスキャンする際のクールダウンタイム（秒）
-QR_SCAN_COOLDOWN_SECONDS = 5
\ No newline at end of file
+QR_SCAN_COOLDOWN_SECONDS = 5
+
+# チェックイン記録のグループコミットを使うか
+# True にすると、スキャン結果はまずジャーナルファイルに追記され (同時に来たスキャンと
+# まとめて1回の fsync)、SQLiteへは一定間隔・一定件数ごとに一括で書き込まれる
+CHECKIN_GROUP_COMMIT = False
+
+# ジャーナルからSQLiteへ書き出す間隔（ミリ秒）と、間隔を待たずに書き出す件数
+CHECKIN_FLUSH_INTERVAL_MS = 50
+CHECKIN_FLUSH_MAX_EVENTS = 100
+
+# 中央サーバーのマスタデータにも仮登録にも無いログインIDをスキャンした場合の扱い
+#   'reject' : 記録せずにエラーを表示する (読み取りミスや他のQRコードをその場で弾く)
+#   'warn'   : 記録はするが、警告を表示する (マスタデータが古い可能性がある運用向け)
+CHECKIN_UNKNOWN_USER_POLICY = 'warn'
+
+# ログインIDインデックスが、他のプロセスによるマスタデータ更新を確認する間隔（秒）
+USER_INDEX_STAMP_CHECK_SECONDS = 5
+
+# QRコードが無い避難者を氏名で探すときに、画面に出す候補の最大件数
+NAME_SEARCH_LIMIT = 20
+
+# 管理画面で、未同期データの同期エラーを内容ごとに集計した結果を使い回す秒数
+# (集計は未同期の行全体の GROUP BY なので、一覧を開くたびには行わない)
+ADMIN_ERROR_GROUPS_CACHE_SECONDS = 30
+
+
+# --- パスワードのハッシュの設定 (field_app/hashers.py) ---
+
+# ログイン時のパスワードの確認方式
+#   'auto'   : argon2-cffi が入っていれば argon2、無ければ pbkdf2
+#   'argon2' : メモリを使う (総当たりに強い) ハッシュ。CPU時間を抑えられる (argon2-cffi が必要)
+#   'pbkdf2' : Django 標準の方式を、反復回数だけこの端末向けにしたもの
+# 中央サーバーから取り込んだ別の方式・強さのハッシュも確認でき、ログインに成功した時にこの方式で作り直す
+# (ただし 'pbkdf2' では、この端末の設定より反復回数の多いハッシュは作り直さない)
+PASSWORD_HASHER = 'auto'
+
+# argon2 の強さ (OWASP の推奨値: 19 MiB・2回・並列1。ラズパイ3のメモリでも同時ログインに耐える)
+PASSWORD_ARGON2_MEMORY_KIB = 19456
+PASSWORD_ARGON2_TIME_COST = 2
+PASSWORD_ARGON2_PARALLELISM = 1
+
+# pbkdf2 の反復回数 (OWASP の推奨の下限。Django 5.2 の標準は 1,000,000)
+PASSWORD_PBKDF2_ITERATIONS = 600_000
+
+
+# --- 中央サーバーへのアップロードの設定 ---
+
+# 未同期レコードを同時に送信する数
+# (各レコードのUUIDを冪等キーとして送るため、並列・再送しても二重登録にはならない)
+SYNC_CONCURRENCY = 4
+
+# 1件あたりのタイムアウト（秒）と、タイムアウト・一時的なエラー時の再送回数
+SYNC_REQUEST_TIMEOUT_SECONDS = 5
+SYNC_RETRIES = 2
+
+# 未同期の行をDBから読み込む件数 (古い順にこの件数ずつ読むので、未同期が何件あってもメモリ使用量は一定)
+SYNC_READ_CHUNK_SIZE = 200
+
+# 同期の進み具合を共有ファイルへ書き出す間隔（ミリ秒）と、画面側がファイルの更新を確認する間隔（秒）
+SYNC_PROGRESS_WRITE_INTERVAL_MS = 500
+SYNC_PROGRESS_POLL_SECONDS = 0.5
+
+# 進み具合の更新がこの秒数途絶えたら、同期は止まったものとみなす (プロセスが落ちた場合など)
+SYNC_PROGRESS_STALE_SECONDS = 120
+
+# 進み具合の配信 (Server-Sent Events) の接続を、同期が行われていない状態でこの秒数続けたら一度閉じる
+# (ブラウザは SYNC_PROGRESS_RETRY_MS 後に自動で繋ぎ直す。ASGI のみ。WSGI ではスレッドを占有しないよう、
+#  同期が行われていなければ現在の状態を1回送ってすぐに閉じる)
+SYNC_PROGRESS_IDLE_SECONDS = 30
+SYNC_PROGRESS_RETRY_MS = 10000
+
+
+# --- 送信の優先度 (レーン) と帯域の上限 (field_app/sync_lanes.py) ---
+
+# 中央サーバーとの回線で使ってよい帯域 (バイト/秒)。None なら上限を設けず、優先度の順に送ることだけ行う
+# (従量課金・衛星回線などで設定する。例: 128kbps の回線なら 16 * 1024)
+SYNC_LINK_BYTES_PER_SECOND = None
+
+# 各レーンが使ってよい帯域の割合 (SYNC_LINK_BYTES_PER_SECOND に対して。None ならそのレーンは上限なし)
+#   critical      : 食料が「本日分で尽きる」の現場レポート
+#   registrations : 新規ユーザーの仮登録
+#   checkins      : 避難所のチェックイン記録
+#   bulk          : その他の現場レポート・炊き出しの受け取り記録・チャットの画像の取得
+SYNC_LANE_SHARES = {'critical': None, 'registrations': None, 'checkins': 0.6, 'bulk': 0.25}
+
+# 一度にまとめて送れる量 (各レーンの帯域の何秒分か)。送信が止まっていた後の最初の送信は待たせない
+SYNC_LANE_BURST_SECONDS = 2
+
+# 低いレーンを送っている間に、上のレーンに新しい記録が増えていないか確かめる間隔（秒）
+SYNC_LANE_CHECK_SECONDS = 2
+
+
+# --- 未送信の現場レポートの間引き ---
+
+# 未送信の現場レポートがこの件数を超えたら (長時間の通信断の後など)、
+# 時間帯ごとに最新の1件だけを送信し、残りは「間引き済み」として送らない
+REPORT_COALESCE_THRESHOLD = 50
+
+# 間引きの時間帯の幅（分）
+REPORT_COALESCE_BUCKET_MINUTES = 30
+
+# 代表として送るレポートに、その時間帯の避難者数・医療ニーズの最小値・最大値を付けるか
+REPORT_COALESCE_STATS = True
+
+
+# --- 炊き出しの受け取り可否の事前確認 ---
+
+# 配布の予定時刻 (この端末の現地時刻、"HH:MM")。空にすると事前確認を行わない
+DISTRIBUTION_TIMES = ['07:00', '12:00', '18:00']
+
+# 予定時刻の何分前に、入所中の全員の受け取り可否を中央サーバーへまとめて問い合わせるか
+DISTRIBUTION_PREWARM_LEAD_MINUTES = 30
+
+# 事前確認の結果を使う期間（秒）。過ぎた人はスキャンのたびに中央サーバーへ問い合わせる
+DISTRIBUTION_ELIGIBILITY_TTL_SECONDS = 3 * 3600
+
+# 事前確認の1回の問い合わせに含める人数と、受け取りの記録を1回でまとめて送る件数
+DISTRIBUTION_PREWARM_BATCH_SIZE = 500
+DISTRIBUTION_RECORD_BATCH_SIZE = 200
+
+
+# --- 定期実行 (スケジューラ) の設定 ---
+
+# web サーバーのプロセス内で、同期・マスタデータ取得・疎通確認を定期的に実行するか
+# (cron で sync_data を動かす運用にする場合は False。環境変数 FIELD_SCHEDULER_ENABLED=0 でも無効にできる)
+SCHEDULER_ENABLED = os.environ.get("FIELD_SCHEDULER_ENABLED", "1") != "0"
+
+# 同期の基本間隔（秒）。未同期件数が増えている間は最短 SCHEDULER_SYNC_MIN_INTERVAL_SECONDS まで縮める
+SCHEDULER_SYNC_INTERVAL_SECONDS = 60
+SCHEDULER_SYNC_MIN_INTERVAL_SECONDS = 10
+
+# マスタデータ（ユーザー・配布品目）の取得間隔（秒）
+SCHEDULER_MASTER_INTERVAL_SECONDS = 3600
+
+# 中央サーバーへの疎通確認の間隔（秒）
+SCHEDULER_HEALTH_INTERVAL_SECONDS = 30
+
+# 炊き出しの事前確認を行う時間帯かを確認する間隔（秒）
+SCHEDULER_PREWARM_CHECK_SECONDS = 60
+
+# 保持期間を過ぎた同期済みレコードのアーカイブ (と incremental vacuum) の間隔（秒）
+SCHEDULER_ARCHIVE_INTERVAL_SECONDS = 3600
+
+# 中央サーバーに繋がらない間、間隔を倍々に延ばしていく上限（秒）
+SCHEDULER_MAX_INTERVAL_SECONDS = 900
+
+# 実行間隔に加える揺らぎの割合 (0.2 なら ±20%)。多数のラズパイが同じ秒に問い合わせないようにする
+SCHEDULER_JITTER_RATIO = 0.2
+
+
+# --- 変更通知 (中央サーバーからのプッシュ) の設定 ---
+
+# スケジューラと一緒に、中央サーバーの変更通知 (/api/changes/ のロングポーリング) を受け取るか
+# (受け取っている間は、ユーザー・配布品目の変更があった時だけ差分を取り直す)
+CHANGE_FEED_ENABLED = True
+
+# 1回の問い合わせで、変更が無いときに中央サーバーに待ってもらう最大秒数
+CHANGE_FEED_WAIT_SECONDS = 25
+
+# 通知が途切れたとき、再接続を試みるまでの最初の待ち時間（秒）。失敗が続くと倍々に延ばす
+CHANGE_FEED_RETRY_SECONDS = 5
+
+# 通知が途切れている間のマスタデータの取得間隔（秒）。受信中は SCHEDULER_MASTER_INTERVAL_SECONDS (取りこぼし対策)
+CHANGE_FEED_FALLBACK_POLL_SECONDS = 300
+
+
+# --- チャットの画像のキャッシュの設定 ---
+
+# 中央サーバーから取得したチャットの画像 (原寸・サムネイル) を置いておく合計サイズの上限 (バイト)
+# 超えたら最近使われていないものから消す
+CHAT_MEDIA_CACHE_MAX_BYTES = 200 * 1024 * 1024
+
+# 取得する画像1枚の上限 (バイト) と、取得のタイムアウト（秒）
+CHAT_MEDIA_MAX_IMAGE_BYTES = 10 * 1024 * 1024
+CHAT_MEDIA_FETCH_TIMEOUT_SECONDS = 20
+
+# 履歴の一覧に出すサムネイルの最大の幅・高さ (ピクセル)。サムネイルは Pillow が入っている場合のみ作る
+CHAT_MEDIA_THUMBNAIL_SIZE = 320
+
+# ラズパイが中継する、中央サーバー上の画像のパス
+CHAT_MEDIA_PATH_PREFIXES = ['/media/']
+
+# タブレットのブラウザに画像をキャッシュさせる秒数 (中央サーバーの画像は作成後に変わらない前提)
+CHAT_MEDIA_BROWSER_MAX_AGE_SECONDS = 7 * 24 * 3600
+
+
+# --- 実行時に生成されるファイルの置き場所 ---
+
+# 実行時に生成される状態ファイルの置き場所
+# (1台のPCで複数のインスタンスを動かす場合は、環境変数 FIELD_RUN_DIR でインスタンスごとに分けます。
+#  スケジューラのロックファイルもこの中にあるため、同じ置き場所ではスケジューラが1つしか動きません)
+RUN_DIR = os.environ.get("FIELD_RUN_DIR", os.path.join(BASE_DIR, 'run'))
+
+# チェックイン記録のジャーナル (グループコミット用) の置き場所
+CHECKIN_JOURNAL_DIR = os.path.join(RUN_DIR, 'checkin_journal')
+
+# マスタデータの更新時刻を他のプロセスに知らせるスタンプファイル
+USER_INDEX_STAMP_PATH = os.path.join(RUN_DIR, 'master_data.stamp')
+
+# スケジューラの実行状態 (画面表示用) と、実行するプロセスを1つに絞るためのロックファイル
+SCHEDULER_STATE_PATH = os.path.join(RUN_DIR, 'scheduler.json')
+SCHEDULER_LOCK_PATH = os.path.join(RUN_DIR, 'scheduler.lock')
+
+# 同期の進み具合 (ホーム画面の進捗バー用)
+SYNC_PROGRESS_PATH = os.path.join(RUN_DIR, 'sync_progress.json')
+
+# チャットの画像のキャッシュの置き場所
+CHAT_MEDIA_CACHE_DIR = os.path.join(RUN_DIR, 'chat_media')
+
+
+# --- 同期済みデータの保持・アーカイブの設定 ---
+
+# 同期済みレコードの圧縮アーカイブ (日付別の gzip JSONL) の置き場所
+ARCHIVE_DIR = os.path.join(BASE_DIR, 'archive')
+
+# 同期済みのチェックイン記録・現場レポートをデータベースに残しておく日数
+ARCHIVE_RETENTION_DAYS = 3
+
+# アーカイブ時に1回のトランザクションで削除する件数
+ARCHIVE_BATCH_SIZE = 500
+
+# 1回のアーカイブ処理の後に解放する最大ページ数 (incremental vacuum)
+ARCHIVE_VACUUM_PAGES = 2000
+
+
+# --- USBメモリでのデータ持ち出し (バンドル) の設定 ---
+
+# バンドルの署名鍵。同じ運用単位のラズパイ全てで同じ値にしておく
+# (初期値のままでは、バンドルの書き出し・取り込みはできない)
+BUNDLE_SIGNING_KEY = "dummy-bundle-signing-key"
+
+# バンドルの書き出し・取り込みで一度に扱う件数
+BUNDLE_CHUNK_SIZE = 2000
+
+
+# --- 監視 (メトリクス) の設定 ---
+
+# 管理コマンド (sync_data など) が書き出すメトリクスのスナップショットの置き場所
+METRICS_SNAPSHOT_DIR = os.path.join(RUN_DIR, 'metrics')
+
+# 未同期件数をDBから数え直す間隔（秒）。その間はプロセス内のカウンタで加算する
+METRICS_BACKLOG_REFRESH_SECONDS = 60
+
+# /metrics へのアクセスを許可する接続元IP。空の場合は制限しない
+METRICS_ALLOWED_IPS = []
+
+
+# --- リクエストの計測 (プロファイリング) の設定 ---
+
+# 管理者が ?_profile=1 を付けて開いたページの計測結果の置き場所と、残しておく件数 (古いものから消す)
+PROFILING_DIR = os.path.join(RUN_DIR, 'profiles')
+PROFILING_MAX_REPORTS = 50
+
+# 処理中のスタックを記録する間隔（ミリ秒）
+PROFILING_SAMPLE_INTERVAL_MS = 5
+
+# 1リクエストで記録するSQLの最大件数 (これを超えた分は、件数と合計時間だけを数える)
+PROFILING_MAX_QUERIES = 2000
+
+
+# --- ログの設定 ---
+
+# ログファイルの置き場所 (SDカードの寿命が気になる場合は tmpfs や USBメモリを指定)
+LOG_DIR = os.path.join(BASE_DIR, 'logs')
+
+# ログレベル (DEBUG / INFO / WARNING / ERROR)
+LOG_LEVEL = 'INFO'
+
+# リクエストごと・レコードごとに出るデバッグログ (チャットの送受信内容など) を出力するか
+# 本番運用では False にしておくと、これらのログは生成すらされない
+LOG_HOT_PATH_DEBUG = False
+
+# RAM上にためておくログの件数と、まとめてファイルへ書き出す間隔（秒）
+LOG_BUFFER_CAPACITY = 200
+LOG_FLUSH_INTERVAL_SECONDS = 30
+
+# ログファイル1つあたりの最大サイズ（バイト）と、残しておく世代数
+LOG_MAX_BYTES = 5 * 1024 * 1024
+LOG_BACKUP_COUNT = 3
@@ -1,5 +1,18 @@
-from django.contrib import admin
+from django.contrib import admin, messages
 from django.contrib.auth.admin import UserAdmin
+from django.core.cache import cache
+from django.core.exceptions import PermissionDenied
+from django.core.paginator import Paginator
+from django.db import connections
+from django.db.models import Count, Q
+from django.shortcuts import redirect
+from django.template.response import TemplateResponse
+from django.urls import path, reverse
+from django.utils.dateparse import parse_datetime
+from django.utils.functional import cached_property
+
+import config
+from . import tasks
 from .models import User, UnsyncedCheckin, UnsyncedFieldReport, UnsyncedUserRegistration
 
 
@@ -25,7 +38,230 @@ class FieldUserAdmin(UserAdmin):
 # Userモデルを登録
 admin.site.register(User, FieldUserAdmin)
 
-# ついでに、デバッグ用に他の未同期データモデルも登録しておくと便利です
-admin.site.register(UnsyncedCheckin)
-admin.site.register(UnsyncedFieldReport)
-admin.site.register(UnsyncedUserRegistration)
\ No newline at end of file
+
+# =========================================================
+# 未同期データの管理画面 (同期の運用コンソール)
+# =========================================================
+class EstimatedCountPaginator(Paginator):
+    """
+    大きなテーブルでも COUNT(*) で全件を数えないページネータ。
+    - 絞り込みなし: rowid の最大値 - 最小値 (古い行はアーカイブで先頭から消えるため、ほぼ件数になる)
+    - 絞り込みあり: ESTIMATE_CAP 件までだけ数え、それ以上は ESTIMATE_CAP 件として扱う
+      (それより先は、エラー別の画面の「次へ」(キーセット方式) で辿る)
+    """
+    ESTIMATE_CAP = 10000
+
+    @cached_property
+    def count(self):
+        queryset = self.object_list
+        connection = connections[queryset.db]
+        if not queryset.query.where and connection.vendor == 'sqlite':
+            with connection.cursor() as cursor:
+                cursor.execute(f'SELECT MAX(rowid) - MIN(rowid) + 1 FROM {connection.ops.quote_name(queryset.model._meta.db_table)}')
+                return cursor.fetchone()[0] or 0
+        return queryset.order_by()[:self.ESTIMATE_CAP].count()
+
+
+class SyncErrorFilter(admin.SimpleListFilter):
+    """未同期の行を、同期エラーの内容ごとにまとめて件数付きで絞り込むフィルタ"""
+    title = '同期エラー'
+    parameter_name = 'sync_error'
+    max_groups = 20
+
+    def __init__(self, request, params, model, model_admin):
+        self.error_field = model_admin.error_field
+        super().__init__(request, params, model, model_admin)
+
+    def lookups(self, request, model_admin):
+        return [(error, f'{error[:60]} ({count}件)')
+                for error, count in model_admin.error_groups()[:self.max_groups]]
+
+    def queryset(self, request, queryset):
+        if self.value():
+            return queryset.filter(**{self.error_field: self.value()})
+        return queryset
+
+
+class SyncQueueAdmin(admin.ModelAdmin):
+    """
+    未同期データ (中央サーバーへの送信待ち) の管理画面の共通部分。
+    - 一覧の件数は EstimatedCountPaginator で見積もる (全件の COUNT をしない)
+    - 一括操作はどれも、選択した行に対する UPDATE 1文で行う
+    - エラー別の画面 (errors/) で、失敗をエラー内容ごとにまとめて確認・一括操作できる
+    - エラー内容ごとの件数は ADMIN_ERROR_GROUPS_CACHE_SECONDS の間使い回す (一括操作をしたら集計し直す)
+    """
+    paginator = EstimatedCountPaginator
+    show_full_result_count = False
+    change_list_template = 'admin/field_app/sync_change_list.html'
+    list_per_page = 100
+    time_field = 'timestamp'
+    error_field = None  # 同期エラーを保存するフィールド (無いモデルは None)
+    retry_updates = None  # 「今すぐ再送」で行う更新 (エラーを消して送信待ちに戻す)
+    errors_page_size = 50
+
+    def get_list_filter(self, request):
+        filters = ['is_synced', (self.time_field, admin.DateFieldListFilter)]
+        if self.error_field:
+            filters.append(SyncErrorFilter)
+        return filters
+
+    # -----------------------------------------------------
+    # 一括操作
+    # -----------------------------------------------------
+    def get_actions(self, request):
+        actions = super().get_actions(request)
+        if self.retry_updates is None:
+            actions.pop('retry_now', None)
+        return actions
+
+    @admin.action(description='選択した行を今すぐ再送する')
+    def retry_now(self, request, queryset):
+        updated = queryset.update(**self.retry_updates)
+        self.forget_error_groups()
+        tasks.request_sync()
+        self.message_user(request, f'{updated}件を送信待ちに戻し、同期を開始しました。', messages.SUCCESS)
+
+    def _error_groups_key(self):
+        return f'admin:sync_error_groups:{self.opts.label_lower}'
+
+    def error_groups(self):
+        """未同期の行の同期エラーを内容ごとにまとめ、件数の多い順に (エラー, 件数) を返す"""
+        def count_groups():
+            return list(self.model.objects.filter(is_synced=False)
+                        .exclude(**{f'{self.error_field}__isnull': True}).exclude(**{self.error_field: ''})
+                        .values_list(self.error_field).annotate(count=Count('pk')).order_by('-count'))
+        return cache.get_or_set(self._error_groups_key(), count_groups, config.ADMIN_ERROR_GROUPS_CACHE_SECONDS)
+
+    def forget_error_groups(self):
+        """一括操作の結果がすぐに件数へ反映されるよう、集計を捨てる"""
+        if self.error_field:
+            cache.delete(self._error_groups_key())
+
+    # -----------------------------------------------------
+    # エラー別の画面
+    # -----------------------------------------------------
+    def get_urls(self):
+        urls = super().get_urls()
+        if not self.error_field:
+            return urls
+        info = self.opts.app_label, self.opts.model_name
+        return [
+            path('errors/', self.admin_site.admin_view(self.errors_view), name='%s_%s_errors' % info),
+        ] + urls
+
+    def changelist_view(self, request, extra_context=None):
+        extra_context = extra_context or {}
+        if self.error_field:
+            extra_context['errors_url'] = reverse(
+                f'admin:{self.opts.app_label}_{self.opts.model_name}_errors', current_app=self.admin_site.name)
+        return super().changelist_view(request, extra_context)
+
+    def errors_view(self, request):
+        # admin_view はスタッフかどうかしか確認しないので、このモデルを見る権限を確かめる
+        if not self.has_view_or_change_permission(request):
+            raise PermissionDenied
+        if request.method == 'POST':
+            if not self.has_change_permission(request):
+                raise PermissionDenied
+            return self.errors_bulk_update(request)
+
+        selected = request.GET.get('error')
+        context = {
+            **self.admin_site.each_context(request),
+            'opts': self.opts,
+            'title': f'{self.opts.verbose_name} の同期エラー',
+            'groups': self.error_groups(),
+            'groups_cache_seconds': config.ADMIN_ERROR_GROUPS_CACHE_SECONDS,
+            'selected': selected,
+            'group_actions': self.group_actions(),
+        }
+        if selected:
+            rows, next_cursor = self.keyset_page(selected, request.GET.get('before'))
+            context.update(rows=rows, next_cursor=next_cursor)
+        return TemplateResponse(request, 'admin/field_app/sync_errors.html', context)
+
+    def group_actions(self):
+        """エラー別の画面で、エラー内容ごとに行える一括操作 (名前, 表示名)"""
+        choices = [('retry_now', '今すぐ再送')]
+        if 'sync_attempts' in {f.name for f in self.opts.fields}:
+            choices.append(('reset_attempts', '試行回数をリセット'))
+        return choices
+
+    def errors_bulk_update(self, request):
+        error = request.POST.get('error', '')
+        action = request.POST.get('action')
+        queryset = self.model.objects.filter(is_synced=False, **{self.error_field: error})
+        if action == 'retry_now':
+            updated = queryset.update(**self.retry_updates)
+            tasks.request_sync()
+        elif action == 'reset_attempts' and action in dict(self.group_actions()):
+            updated = queryset.update(sync_attempts=0)
+        else:
+            self.message_user(request, '不明な操作です。', messages.ERROR)
+            return redirect(request.path)
+        self.forget_error_groups()
+        self.message_user(request, f'「{error[:60]}」の {updated}件を更新しました。', messages.SUCCESS)
+        return redirect(request.path)
+
+    def keyset_page(self, error, before):
+        """
+        エラー内容が error の未同期の行を、新しい順に errors_page_size 件ずつ返す。
+        OFFSET を使わず、前のページの最後の行 (日時, id) より古い行を索引で引く (キーセット方式)。
+        """
+        queryset = (self.model.objects.filter(is_synced=False, **{self.error_field: error})
+                    .order_by(f'-{self.time_field}', '-pk'))
+        if before:
+            timestamp, _, pk = before.partition('|')
+            timestamp = parse_datetime(timestamp)
+            if timestamp is not None and pk:
+                queryset = queryset.filter(
+                    Q(**{f'{self.time_field}__lt': timestamp}) | Q(**{self.time_field: timestamp, 'pk__lt': pk}))
+        rows = list(queryset[:self.errors_page_size + 1])
+        next_cursor = None
+        if len(rows) > self.errors_page_size:
+            rows = rows[:self.errors_page_size]
+            last = rows[-1]
+            next_cursor = f'{getattr(last, self.time_field).isoformat()}|{last.pk}'
+        return rows, next_cursor
+
+
+@admin.register(UnsyncedCheckin)
+class UnsyncedCheckinAdmin(SyncQueueAdmin):
+    list_display = ('timestamp', 'username', 'checkin_type', 'shelter_id', 'device_id', 'is_synced',
+                    'sync_attempts', 'last_sync_error')
+    search_fields = ('username',)
+    error_field = 'last_sync_error'
+    retry_updates = {'last_sync_error': None}
+    actions = ['retry_now', 'reset_attempts']
+
+    @admin.action(description='選択した行の同期試行回数をリセットする')
+    def reset_attempts(self, request, queryset):
+        updated = queryset.update(sync_attempts=0)
+        self.message_user(request, f'{updated}件の試行回数をリセットしました。', messages.SUCCESS)
+
+
+@admin.register(UnsyncedFieldReport)
+class UnsyncedFieldReportAdmin(SyncQueueAdmin):
+    list_display = ('timestamp', 'shelter_id', 'current_evacuees', 'medical_needs', 'food_stock', 'is_synced',
+                    'is_superseded', 'coalesced_count')
+    actions = ['mark_superseded']
+
+    def get_list_filter(self, request):
+        return super().get_list_filter(request) + ['is_superseded']
+
+    @admin.action(description='選択した行を間引き済みにする (送信しない)')
+    def mark_superseded(self, request, queryset):
+        updated = queryset.filter(is_synced=False).update(is_superseded=True, is_synced=True)
+        self.message_user(request, f'{updated}件を間引き済みにしました。', messages.SUCCESS)
+
+
+@admin.register(UnsyncedUserRegistration)
+class UnsyncedUserRegistrationAdmin(SyncQueueAdmin):
+    list_display = ('created_at', 'username', 'full_name', 'is_synced', 'sync_error')
+    search_fields = ('username', 'full_name')
+    exclude = ('password',)
+    time_field = 'created_at'
+    error_field = 'sync_error'
+    # 同期エラーのある仮登録は、エラーが消えるまで送信対象にならない (sync_data 参照)
+    retry_updates = {'sync_error': None}
+    actions = ['retry_now']
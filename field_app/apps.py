@@ -2,4 +2,8 @@ from django.apps import AppConfig
 
 class FieldAppConfig(AppConfig):
     default_auto_field = 'django.db.models.BigAutoField'
-    name = 'field_app'
\ No newline at end of file
+    name = 'field_app'
+
+    def ready(self):
+        # シグナルハンドラを登録する
+        from . import signals  # noqa: F401
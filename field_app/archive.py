@@ -0,0 +1,164 @@
+# field_app/archive.py
+"""
+同期済みレコードの保持期間管理とアーカイブ。
+
+中央サーバーへの送信が済んだ UnsyncedCheckin / UnsyncedFieldReport は、
+そのままにしておくとテーブルが際限なく大きくなり、一覧表示や COUNT が遅くなる。
+保持期間 (config.ARCHIVE_RETENTION_DAYS) を過ぎた同期済みレコードは、
+日付ごとの gzip 圧縮 JSONL ファイル (追記専用) に移してからSQLiteから削除する。
+
+    ARCHIVE_DIR/checkins/2026-10-01.jsonl.gz
+    ARCHIVE_DIR/reports/2026-10-01.jsonl.gz
+
+gzip は複数のメンバーを連結しても1つのファイルとして読めるため、
+バッチごとに追記モードで書き足している。監査などで過去の記録が必要な場合は
+search() で検索できる。
+"""
+import datetime
+import gzip
+import json
+import logging
+import os
+
+from django.core.serializers.json import DjangoJSONEncoder
+from django.db import connection, transaction
+from django.utils import timezone
+
+import config
+from .models import UnsyncedCheckin, UnsyncedFieldReport
+
+logger = logging.getLogger('field_app.archive')
+
+# アーカイブの種類 -> 対象モデル
+ARCHIVED_MODELS = {
+    'checkins': UnsyncedCheckin,
+    'reports': UnsyncedFieldReport,
+}
+
+# PRAGMA auto_vacuum の値 (0 = NONE, 1 = FULL, 2 = INCREMENTAL)
+AUTO_VACUUM_INCREMENTAL = 2
+
+
+def _segment_path(kind, day):
+    return os.path.join(config.ARCHIVE_DIR, kind, f'{day.isoformat()}.jsonl.gz')
+
+
+def _append_segment(kind, day, rows):
+    path = _segment_path(kind, day)
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path, 'ab') as raw:
+        with gzip.GzipFile(fileobj=raw, mode='ab') as gz:
+            for row in rows:
+                gz.write(json.dumps(row, cls=DjangoJSONEncoder, ensure_ascii=False).encode('utf-8') + b'\n')
+        raw.flush()
+        # SQLiteから削除する前に、アーカイブが確実にディスクへ書かれている必要がある
+        os.fsync(raw.fileno())
+
+
+def archive_synced(retention_days=None, batch_size=None):
+    """
+    保持期間を過ぎた同期済みレコードをアーカイブへ移し、SQLiteから削除する。
+    種類ごとの移動件数を返す。
+    """
+    retention_days = config.ARCHIVE_RETENTION_DAYS if retention_days is None else retention_days
+    batch_size = batch_size or config.ARCHIVE_BATCH_SIZE
+    cutoff = timezone.now() - datetime.timedelta(days=retention_days)
+
+    moved = {}
+    for kind, model in ARCHIVED_MODELS.items():
+        moved[kind] = 0
+        queryset = model.objects.filter(is_synced=True, timestamp__lt=cutoff).order_by('timestamp')
+        while True:
+            rows = list(queryset.values()[:batch_size])
+            if not rows:
+                break
+
+            by_day = {}
+            for row in rows:
+                day = timezone.localtime(row['timestamp']).date()
+                by_day.setdefault(day, []).append(row)
+            for day, day_rows in by_day.items():
+                _append_segment(kind, day, day_rows)
+
+            # 削除の直前に落ちた場合は、次回同じ行がもう一度アーカイブされる (search() 側で重複を除く)
+            with transaction.atomic():
+                model.objects.filter(pk__in=[row['id'] for row in rows]).delete()
+            moved[kind] += len(rows)
+
+        if moved[kind]:
+            logger.info('%s: %d 件をアーカイブしました', kind, moved[kind])
+    return moved
+
+
+def incremental_vacuum(pages=None):
+    """
+    削除で空いたページを少しずつOSに返す (最大 pages ページ)。解放したら True を返す。
+    PRAGMA incremental_vacuum しか実行しないため、DB全体を書き直すフル VACUUM は起きない。
+    auto_vacuum が INCREMENTAL になっていないDBでは何もしない
+    (切り替えは `manage.py enable_incremental_vacuum` で一度だけ行う)。
+    """
+    if connection.vendor != 'sqlite':
+        return False
+    pages = pages or config.ARCHIVE_VACUUM_PAGES
+    with connection.cursor() as cursor:
+        cursor.execute('PRAGMA auto_vacuum')
+        if cursor.fetchone()[0] != AUTO_VACUUM_INCREMENTAL:
+            logger.warning('auto_vacuum が INCREMENTAL ではないため、空き領域を解放しません '
+                           '(manage.py enable_incremental_vacuum を一度実行してください)')
+            return False
+        cursor.execute(f'PRAGMA incremental_vacuum({int(pages)})')
+        cursor.fetchall()
+    return True
+
+
+def enable_incremental_vacuum():
+    """
+    auto_vacuum を INCREMENTAL に切り替える (既に切り替え済みなら何もしない)。
+    既存のDBでは切り替えにフル VACUUM が必要で、その間はDB全体がロックされ、
+    DBと同じくらいの空きディスクも使う。避難所の受付をしていない時間に、保守作業として一度だけ行う。
+    切り替えたら True を返す。
+    """
+    if connection.vendor != 'sqlite':
+        return False
+    with connection.cursor() as cursor:
+        cursor.execute('PRAGMA auto_vacuum')
+        if cursor.fetchone()[0] == AUTO_VACUUM_INCREMENTAL:
+            return False
+        logger.info('auto_vacuum を INCREMENTAL に切り替えます (フル VACUUM を実行)')
+        cursor.execute('PRAGMA auto_vacuum = INCREMENTAL')
+        cursor.execute('VACUUM')
+    return True
+
+
+def _parse_day(name):
+    try:
+        return datetime.date.fromisoformat(name[:-len('.jsonl.gz')])
+    except ValueError:
+        return None
+
+
+def search(kind, date_from=None, date_to=None, **filters):
+    """
+    アーカイブから条件に合うレコードを古い順に返すジェネレータ。
+    date_from / date_to は datetime.date (両端を含む)、filters は完全一致の条件
+    (例: search('checkins', username='taro'))。
+    """
+    directory = os.path.join(config.ARCHIVE_DIR, kind)
+    if not os.path.isdir(directory):
+        return
+
+    seen_ids = set()
+    for name in sorted(os.listdir(directory)):
+        day = _parse_day(name) if name.endswith('.jsonl.gz') else None
+        if day is None:
+            continue
+        if (date_from and day < date_from) or (date_to and day > date_to):
+            continue
+        with gzip.open(os.path.join(directory, name), 'rt', encoding='utf-8') as f:
+            for line in f:
+                row = json.loads(line)
+                if row['id'] in seen_ids:
+                    continue
+                if all(str(row.get(key)) == str(value) for key, value in filters.items()):
+                    seen_ids.add(row['id'])
+                    yield row
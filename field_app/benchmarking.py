@@ -0,0 +1,39 @@
+# field_app/benchmarking.py
+"""ベンチマーク用の管理コマンド (bench_*) で共通して使う小さな道具"""
+import os
+import shutil
+import tempfile
+from contextlib import contextmanager
+
+from django.conf import settings
+from django.db import connections
+from django.test.utils import override_settings
+
+
+@contextmanager
+def scratch_database():
+    """
+    本番の db.sqlite3 を汚さないよう、一時ディレクトリにSQLiteファイルを作って
+    その中でベンチマークを実行する (インメモリDBだとSDカードの書き込みコストが測れないため)。
+    field_app のマイグレーションはリポジトリに含めていないので、manage.py test と同じく
+    モデル定義から直接テーブルを作る (settings.py の MIGRATION_MODULES)。
+    """
+    connection = connections['default']
+    tmpdir = tempfile.mkdtemp(prefix='field_bench_')
+    connection.settings_dict.setdefault('TEST', {})['NAME'] = os.path.join(tmpdir, 'bench.sqlite3')
+    with override_settings(MIGRATION_MODULES={**settings.MIGRATION_MODULES, 'field_app': None}):
+        old_name = connection.creation.create_test_db(verbosity=0, autoclobber=True, serialize=False)
+    try:
+        yield tmpdir
+    finally:
+        connection.creation.destroy_test_db(old_name, verbosity=0)
+        shutil.rmtree(tmpdir, ignore_errors=True)
+
+
+def percentile(values, pct):
+    """ソート済みでなくてもよい数値リストのパーセンタイル (最近傍法)"""
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    index = min(len(ordered) - 1, max(0, int(round(pct / 100 * len(ordered))) - 1))
+    return ordered[index]
@@ -0,0 +1,224 @@
+# field_app/bundles.py
+"""
+回線が使えない避難所から、USBメモリでデータを持ち出すための「バンドル」ファイル。
+
+    <name>.bundle      gzip 圧縮した JSONL (1行目がヘッダ、最終行が件数入りのフッタ)
+    <name>.bundle.sig  バンドル全体の HMAC-SHA256 (config.BUNDLE_SIGNING_KEY で署名)
+
+書き出しはクエリセットを一定件数ずつ読みながら逐次圧縮するため、
+未同期データが何件あってもメモリ使用量は一定になる。
+取り込み側 (回線のある別のラズパイ) では署名を確認してから未同期テーブルに登録し、
+通常の sync_data でそのまま中央サーバーへ送信する。IDはそのまま引き継ぐので、
+同じバンドルを2回取り込んでも二重登録にはならない。
+IDは違うが既に登録済みの行と重なるもの (同じ希望ログインIDの仮登録など) は取り込まず、
+競合 (conflicts) として件数を返す。
+"""
+import datetime
+import gzip
+import hashlib
+import hmac
+import json
+import logging
+import uuid
+
+from django.utils import timezone
+from django.utils.dateparse import parse_datetime
+
+import config
+from . import checkin_status, name_search, user_index
+from .models import UnsyncedCheckin, UnsyncedDistribution, UnsyncedFieldReport, UnsyncedUserRegistration
+
+logger = logging.getLogger('field_app.bundles')
+
+BUNDLE_VERSION = 1
+
+# config.py で配布している署名鍵の初期値。誰でも知っている値なので、このままでは書き出し・取り込みをしない
+DEFAULT_SIGNING_KEY = 'dummy-bundle-signing-key'
+
+# バンドル内の種類 -> (モデル, 書き出すフィールド, 日時フィールド)
+BUNDLE_MODELS = {
+    'registration': (
+        UnsyncedUserRegistration,
+        ('id', 'full_name', 'username', 'password', 'created_at'),
+        'created_at',
+    ),
+    'checkin': (
+        UnsyncedCheckin,
+        ('id', 'username', 'shelter_id', 'checkin_type', 'timestamp', 'device_id'),
+        'timestamp',
+    ),
+    'report': (
+        UnsyncedFieldReport,
+        ('id', 'shelter_id', 'current_evacuees', 'medical_needs', 'food_stock', 'timestamp', 'device_id'),
+        'timestamp',
+    ),
+    'distribution': (
+        UnsyncedDistribution,
+        ('id', 'username', 'item_id', 'timestamp', 'device_id'),
+        'timestamp',
+    ),
+}
+
+
+def _json_default(value):
+    # DjangoJSONEncoder はマイクロ秒を切り捨てるため、日時は isoformat() でそのまま書き出す
+    if isinstance(value, datetime.datetime):
+        return value.isoformat()
+    if isinstance(value, uuid.UUID):
+        return str(value)
+    raise TypeError(f'{type(value).__name__} はJSONに変換できません')
+
+
+class BundleError(Exception):
+    """バンドルの署名不一致・形式不正"""
+
+
+def signature_path(path):
+    return str(path) + '.sig'
+
+
+def _signer():
+    if not config.BUNDLE_SIGNING_KEY or config.BUNDLE_SIGNING_KEY == DEFAULT_SIGNING_KEY:
+        raise BundleError('BUNDLE_SIGNING_KEY が初期値のままです。config.py で運用単位ごとの値に変更してください。')
+    return hmac.new(config.BUNDLE_SIGNING_KEY.encode('utf-8'), digestmod=hashlib.sha256)
+
+
+class _SigningWriter:
+    """書き込んだバイト列をそのまま HMAC に流し込むファイルラッパー"""
+
+    def __init__(self, raw):
+        self.raw = raw
+        self.mac = _signer()
+
+    def write(self, data):
+        self.mac.update(data)
+        return self.raw.write(data)
+
+    def flush(self):
+        self.raw.flush()
+
+
+def export_bundle(path, chunk_size=None):
+    """
+    未同期データを全てバンドルファイルに書き出す。種類ごとの件数を返す。
+    (書き出したレコードの同期状態は変更しない)
+    """
+    chunk_size = chunk_size or config.BUNDLE_CHUNK_SIZE
+    counts = {}
+    _signer()  # 署名鍵が初期値のままなら、ファイルを作る前に断る
+    with open(path, 'wb') as raw:
+        writer = _SigningWriter(raw)
+        with gzip.GzipFile(fileobj=writer, mode='wb') as gz:
+            def write_line(obj):
+                gz.write(json.dumps(obj, default=_json_default, ensure_ascii=False).encode('utf-8') + b'\n')
+
+            write_line({
+                'type': 'header',
+                'version': BUNDLE_VERSION,
+                'shelter_id': config.SHELTER_ID,
+                'device_id': config.DEVICE_ID,
+                'created_at': timezone.now(),
+            })
+            for kind, (model, fields, _) in BUNDLE_MODELS.items():
+                counts[kind] = 0
+                queryset = model.objects.filter(is_synced=False).order_by('pk').values_list(*fields)
+                for values in queryset.iterator(chunk_size=chunk_size):
+                    write_line({'type': kind, **dict(zip(fields, values))})
+                    counts[kind] += 1
+            write_line({'type': 'footer', 'counts': counts})
+        raw.flush()
+
+    with open(signature_path(path), 'w', encoding='ascii') as f:
+        f.write(writer.mac.hexdigest() + '\n')
+    return counts
+
+
+def verify_bundle(path):
+    """バンドル全体の署名を確認する (一致しなければ BundleError)"""
+    mac = _signer()
+    try:
+        with open(signature_path(path), encoding='ascii') as f:
+            expected = f.read().strip()
+    except FileNotFoundError:
+        raise BundleError('署名ファイル (.sig) が見つかりません。')
+
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(64 * 1024), b''):
+            mac.update(block)
+    if not hmac.compare_digest(mac.hexdigest(), expected):
+        raise BundleError('署名が一致しません。改ざんされたか、別の署名鍵で作成されたバンドルです。')
+
+
+def _build(kind, row):
+    model, fields, time_field = BUNDLE_MODELS[kind]
+    values = {name: row[name] for name in fields}
+    values['id'] = uuid.UUID(values['id'])
+    values[time_field] = parse_datetime(values[time_field])
+    return model(**values)
+
+
+def import_bundle(path, chunk_size=None):
+    """
+    署名を確認した上で、バンドルの内容を未同期テーブルに登録する。
+    種類ごとに {'imported': 新規件数, 'skipped': 同じIDで登録済みの件数,
+    'conflicts': 一意制約 (仮登録の希望ログインIDなど) に反して取り込めなかった件数} を返す。
+    """
+    chunk_size = chunk_size or config.BUNDLE_CHUNK_SIZE
+    verify_bundle(path)
+
+    result = {kind: {'imported': 0, 'skipped': 0, 'conflicts': 0} for kind in BUNDLE_MODELS}
+    buffers = {kind: [] for kind in BUNDLE_MODELS}
+    footer = None
+
+    def flush(kind):
+        model = BUNDLE_MODELS[kind][0]
+        objs = buffers[kind]
+        existing = set(model.objects.filter(pk__in=[o.pk for o in objs]).values_list('pk', flat=True))
+        new_objs = [o for o in objs if o.pk not in existing]
+        model.objects.bulk_create(new_objs, ignore_conflicts=True)
+        # ignore_conflicts では何件入ったか分からないため、登録できた行を数え直す
+        inserted = set(model.objects.filter(pk__in=[o.pk for o in new_objs]).values_list('pk', flat=True))
+        imported = [o for o in new_objs if o.pk in inserted]
+        conflicts = [o for o in new_objs if o.pk not in inserted]
+        if model is UnsyncedCheckin:
+            checkin_status.record(imported)  # bulk_create では post_save が呼ばれないため
+        if conflicts:
+            if model is UnsyncedUserRegistration:
+                logger.warning('希望ログインIDが既に使われている仮登録を取り込めませんでした: %s',
+                               ', '.join(o.username for o in conflicts))
+            else:
+                logger.warning('%s: 既存の行と重なるため %d 件を取り込めませんでした', kind, len(conflicts))
+        result[kind]['imported'] += len(imported)
+        result[kind]['skipped'] += len(existing)
+        result[kind]['conflicts'] += len(conflicts)
+        buffers[kind] = []
+
+    with gzip.open(path, 'rt', encoding='utf-8') as f:
+        header = json.loads(f.readline() or '{}')
+        if header.get('type') != 'header' or header.get('version') != BUNDLE_VERSION:
+            raise BundleError('バンドルの形式に対応していません。')
+
+        for line in f:
+            row = json.loads(line)
+            kind = row.pop('type')
+            if kind == 'footer':
+                footer = row
+                continue
+            if kind not in BUNDLE_MODELS:
+                raise BundleError(f'不明なレコード種別です: {kind}')
+            buffers[kind].append(_build(kind, row))
+            if len(buffers[kind]) >= chunk_size:
+                flush(kind)
+
+    for kind in BUNDLE_MODELS:
+        if buffers[kind]:
+            flush(kind)
+
+    if result['registration']['imported']:
+        # bulk_create ではシグナルが呼ばれないため、ログインIDのインデックスと氏名検索に仮登録の分を入れ直す
+        user_index.refresh()
+        if name_search.available():
+            name_search.rebuild()
+    if footer is None:
+        raise BundleError('バンドルが途中で切れています (フッタがありません)。取り込み済みの分は有効です。')
+    return result
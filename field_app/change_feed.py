@@ -0,0 +1,157 @@
+# field_app/change_feed.py
+"""
+中央サーバーからの変更通知 (ロングポーリング) を受け取り、マスタデータを差分で取り直す。
+
+fetch_master_data を定期的に実行するだけだと、間隔を短くすれば回線を無駄に使い、
+長くすれば新しい避難者・配布品目がなかなか反映されない。そこで常駐プロセス
+(スケジューラ) が中央サーバーに問い合わせを出したままにしておき、変更があった時だけ
+その種類 (users / items) を、変更された日時以降の差分として取り直す。
+
+中央サーバー側のAPI:
+    GET {central}/api/changes/?cursor=<前回の cursor>&wait=<秒>
+    -> 200 {"cursor": 12, "changes": [{"topic": "users", "since": "2026-01-01T00:00:00+00:00"}, ...]}
+    変更が無ければ wait 秒まで待ってから空の changes を返す。
+    cursor を省略すると、待たずに現在の cursor を返す。
+    cursor が古すぎて差分を返せない場合は "reset": true (全件を取り直す)。
+
+通知が途切れている間 (中央サーバーが未対応・通信断) は、スケジューラのマスタデータ取得の
+間隔を CHANGE_FEED_FALLBACK_POLL_SECONDS に縮めて、従来どおりのポーリングで補う。
+cursor は取り直しに成功してから進める。取り直しに失敗した場合は通知が途切れたときと同じく
+ポーリングで補い、再接続したときに同じ変更をもう一度受け取って取り直す。
+"""
+import io
+import logging
+import random
+import threading
+import time
+
+import requests
+from django.core.management import call_command
+from django.core.management.base import CommandError
+from django.db import close_old_connections
+
+import config
+from . import metrics
+from .utils import central_request, get_active_central_url
+
+logger = logging.getLogger('field_app.change_feed')
+
+# 通知の topic -> fetch_master_data --only に渡す種類
+TOPICS = {'users': 'users', 'items': 'items'}
+
+
+class ChangeFeedListener:
+    """変更通知を受け取り続けるバックグラウンドスレッド"""
+
+    def __init__(self, on_state_change=None):
+        self.cursor = None
+        self.received_cursor = None  # 最後の問い合わせで受け取った cursor (取り直しに成功したら cursor に進める)
+        self.connected = None     # 未接続 (まだ問い合わせていない) なら None
+        self.failures = 0
+        self.last_event = None   # 最後に変更通知を受けた時刻
+        self.last_error = ''
+        self._on_state_change = on_state_change  # 接続状態が変わったときに呼ぶ (connected を渡す)
+        self._stopped = threading.Event()
+        self._thread = None
+
+    def start(self):
+        self._thread = threading.Thread(target=self.run_forever, name='field-change-feed', daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        self._stopped.set()
+
+    def as_dict(self):
+        return {
+            'connected': self.connected,
+            'last_event': self.last_event,
+            'last_error': self.last_error,
+            'failures': self.failures,
+        }
+
+    def run_forever(self):
+        while not self._stopped.is_set():
+            try:
+                changes = self.poll_once()
+                if changes:
+                    self.apply(changes)
+            except (requests.exceptions.RequestException, ValueError, KeyError, CommandError) as e:
+                self.failures += 1
+                self.last_error = f'{type(e).__name__}: {e}'[:200]
+                self._set_connected(False)
+                delay = min(config.CHANGE_FEED_RETRY_SECONDS * 2 ** (self.failures - 1),
+                            config.SCHEDULER_MAX_INTERVAL_SECONDS)
+                ratio = config.SCHEDULER_JITTER_RATIO
+                self._stopped.wait(delay * random.uniform(1 - ratio, 1 + ratio))
+                continue
+            self.failures = 0
+            self.last_error = ''
+            self._set_connected(True)
+
+    def poll_once(self):
+        """
+        中央サーバーに変更を問い合わせ (変更が無ければ最大 CHANGE_FEED_WAIT_SECONDS 待たされる)、
+        取り直すべき種類 -> 差分の起点 (None は全件) の辞書を返す。
+        取り直すものが無ければ、その場で cursor を進める (あれば apply() が成功してから進める)。
+        """
+        params = {'wait': config.CHANGE_FEED_WAIT_SECONDS}
+        if self.cursor is not None:
+            params['cursor'] = self.cursor
+        url = get_active_central_url() + config.API_BASE_PATH + 'changes/'
+        response = central_request('get', url, params=params, timeout=config.CHANGE_FEED_WAIT_SECONDS + 10,
+                                   verify=config.VERIFY_SSL)
+        if response.status_code != 200:
+            # 404 なら中央サーバーが未対応。ポーリングに任せ、間隔を空けて再接続を試みる
+            raise requests.exceptions.HTTPError(f'HTTP {response.status_code}', response=response)
+        data = response.json()
+        self.received_cursor = data['cursor']
+        if data.get('reset'):
+            return {kind: None for kind in TOPICS.values()}
+
+        pending = {}
+        for change in data.get('changes', []):
+            kind = TOPICS.get(change.get('topic'))
+            if kind is None:
+                continue  # このデバイスが扱わない種類
+            metrics.change_feed_events.inc(topic=change['topic'])
+            since = change.get('since')
+            if kind in pending:
+                # 同じ種類の変更が複数あれば、最も古い日時から取り直す
+                previous = pending[kind]
+                pending[kind] = None if previous is None or since is None else min(previous, since)
+            else:
+                pending[kind] = since
+        if not pending:
+            self.cursor = self.received_cursor
+        return pending
+
+    def apply(self, pending):
+        """
+        poll_once の結果に従い、変わった種類だけを差分で取り直す。
+        全て取り直せたら cursor を進める。失敗した場合は CommandError を送出し、cursor は進めない
+        (次の問い合わせで同じ変更をもう一度受け取る)。
+        """
+        self.last_event = time.time()
+        close_old_connections()
+        try:
+            for kind, since in pending.items():
+                logger.info('変更通知を受けました: %s (%s 以降)', kind, since or '全件')
+                options = {'only': [kind]}
+                if since:
+                    options['since'] = since
+                call_command('fetch_master_data', stdout=io.StringIO(), stderr=io.StringIO(), **options)
+            self.cursor = self.received_cursor
+        finally:
+            close_old_connections()
+
+    def _set_connected(self, connected):
+        if connected == self.connected:
+            return
+        self.connected = connected
+        metrics.change_feed_connected.set(1 if connected else 0)
+        if connected:
+            logger.info('中央サーバーからの変更通知を受信しています。')
+        else:
+            logger.warning('変更通知が途切れました。マスタデータは定期取得で補います: %s', self.last_error)
+        if self._on_state_change:
+            self._on_state_change(connected)
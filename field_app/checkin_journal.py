@@ -0,0 +1,274 @@
+# field_app/checkin_journal.py
+"""
+チェックイン記録のグループコミット (write-behind) 層。
+
+UnsyncedCheckin.objects.create はそれぞれが独立したトランザクションになり、
+1件ごとにSDカードへの fsync が発生する。複数のタブレットから同時にスキャンされると、
+その書き込み待ちが直列に積み重なってしまう。
+
+この層を有効にすると (config.CHECKIN_GROUP_COMMIT = True)、
+  1. スキャン結果を追記専用のジャーナルファイルに1行書き込み、
+     同時に来た他のスキャンとまとめて1回の fsync で永続化した時点で応答を返す。
+  2. ジャーナルにたまったイベントは、一定間隔 (CHECKIN_FLUSH_INTERVAL_MS) または
+     一定件数 (CHECKIN_FLUSH_MAX_EVENTS) ごとに、1つのトランザクションでSQLiteへ書き込む。
+  3. SQLiteへの書き込みが済んだジャーナルのセグメントは削除する。
+プロセスが途中で落ちた場合は、残っているセグメントを次回起動時に再生する。
+書き込み中のセグメントには排他ロックをかけておき、ロックが取れるものだけを落ちたプロセスの分とみなす
+(ファイル名の pid は再起動後に別のプロセスへ使い回されることがあり、生死の判定には使えない)。
+レコードのIDはジャーナルに書く時点で採番するため、再生が重複しても二重登録にはならない。
+"""
+import atexit
+import json
+import logging
+import os
+import threading
+import time
+import uuid
+
+from django.db import transaction
+from django.utils import timezone
+from django.utils.dateparse import parse_datetime
+
+import config
+from . import checkin_status, metrics
+from .models import UnsyncedCheckin
+
+try:
+    import fcntl
+except ImportError:  # Windows の開発環境
+    fcntl = None
+    import msvcrt
+
+logger = logging.getLogger('field_app.checkin')
+
+_journal = None
+_journal_lock = threading.Lock()
+
+
+class CheckinJournal:
+
+    def __init__(self, directory, flush_interval, max_batch):
+        self.directory = directory
+        self.flush_interval = flush_interval
+        self.max_batch = max_batch
+        os.makedirs(directory, exist_ok=True)
+
+        self._lock = threading.Lock()        # セグメントへの追記・切り替え用
+        self._sync_lock = threading.Lock()   # fsync の実行用 (同時に1スレッドだけ)
+        self._written_seq = 0
+        self._durable_seq = 0
+        self._pending = []                   # まだSQLiteに書いていないイベント
+        self._pending_last = {}              # username -> 未反映の最新 checkin_type
+        self._segment_no = 0
+        self._closed_segments = []           # SQLiteへの反映待ちの閉じたセグメント
+        self._file = self._open_segment()
+
+        self._wakeup = threading.Event()
+        self._stopped = False
+        self._flusher = threading.Thread(target=self._flush_loop, name='checkin-journal', daemon=True)
+        self._flusher.start()
+
+    # -----------------------------------------------------
+    # 書き込み側
+    # -----------------------------------------------------
+    def append(self, username, shelter_id, checkin_type):
+        """
+        チェックインイベントをジャーナルに書き込み、永続化されるまで待ってから返す。
+        SQLiteへの反映はバックグラウンドでまとめて行われる。
+        """
+        event = {
+            'id': str(uuid.uuid4()),
+            'username': username,
+            'shelter_id': shelter_id,
+            'checkin_type': checkin_type,
+            'timestamp': timezone.now().isoformat(),
+        }
+        line = json.dumps(event, ensure_ascii=False) + '\n'
+
+        with self._lock:
+            self._file.write(line)
+            self._written_seq += 1
+            seq = self._written_seq
+            self._pending.append(event)
+            self._pending_last[username] = checkin_type
+            pending_count = len(self._pending)
+
+        self._wait_durable(seq)
+        if pending_count >= self.max_batch:
+            self._wakeup.set()
+        return event
+
+    def pending_last_type(self, username):
+        """まだSQLiteに反映されていない、そのユーザーの最新の種別を返す (なければ None)"""
+        with self._lock:
+            return self._pending_last.get(username)
+
+    def _wait_durable(self, seq):
+        # 先に fsync を始めたスレッドがいれば、その完了で自分の分も永続化されていることが多い
+        # (これがグループコミットになる)
+        with self._sync_lock:
+            if self._durable_seq >= seq:
+                return
+            with self._lock:
+                self._file.flush()
+                target_seq = self._written_seq
+                fileno = self._file.fileno()
+            os.fsync(fileno)
+            self._durable_seq = target_seq
+
+    # -----------------------------------------------------
+    # SQLiteへの書き出し
+    # -----------------------------------------------------
+    def _open_segment(self):
+        self._segment_no += 1
+        name = f'{os.getpid()}-{int(time.time() * 1000)}-{self._segment_no}.jsonl'
+        f = open(os.path.join(self.directory, name), 'a', encoding='utf-8')
+        # 閉じるまでロックを持ち続け、動作中であることを recover() に知らせる
+        _lock_segment(f)
+        return f
+
+    def _flush_loop(self):
+        while not self._stopped:
+            self._wakeup.wait(self.flush_interval)
+            self._wakeup.clear()
+            try:
+                self.flush()
+            except Exception:
+                logger.exception('チェックインジャーナルのSQLiteへの反映に失敗しました。次回に再試行します。')
+
+    def flush(self):
+        """たまっているイベントを1つのトランザクションでSQLiteへ書き込む"""
+        with self._sync_lock, self._lock:
+            if not self._pending:
+                return 0
+            events, self._pending = self._pending, []
+            self._file.flush()
+            os.fsync(self._file.fileno())
+            self._file.close()
+            self._durable_seq = self._written_seq
+            self._closed_segments.append(self._file.name)
+            self._file = self._open_segment()
+
+        try:
+            write_events(events)
+        except Exception:
+            # 書き込めなかったイベントは次回の flush で再挑戦する (セグメントも残しておく)
+            with self._lock:
+                self._pending = events + self._pending
+            raise
+
+        with self._lock:
+            segments, self._closed_segments = self._closed_segments, []
+            still_pending = {e['username'] for e in self._pending}
+            for event in events:
+                if event['username'] not in still_pending:
+                    self._pending_last.pop(event['username'], None)
+        for path in segments:
+            os.remove(path)
+        return len(events)
+
+    def close(self):
+        self._stopped = True
+        self._wakeup.set()
+        self.flush()
+        with self._lock:
+            self._file.close()
+            if os.path.getsize(self._file.name) == 0:
+                os.remove(self._file.name)
+
+
+def write_events(events):
+    """ジャーナルのイベントを UnsyncedCheckin として一括登録する (同じIDのものは無視)"""
+    records = [
+        UnsyncedCheckin(
+            id=event['id'],
+            username=event['username'],
+            shelter_id=event['shelter_id'],
+            checkin_type=event['checkin_type'],
+            timestamp=parse_datetime(event['timestamp']),
+        )
+        for event in events
+    ]
+    with transaction.atomic():
+        UnsyncedCheckin.objects.bulk_create(records, ignore_conflicts=True)
+        checkin_status.record(records)
+    # bulk_create では post_save が呼ばれないため、バックログ件数はここで反映する
+    for record in records:
+        metrics.note_unsynced_created('UnsyncedCheckin', record.timestamp)
+
+
+def _lock_segment(f):
+    """セグメントに排他ロックをかける。書き込み中のジャーナルが持っていれば False"""
+    try:
+        if fcntl is not None:
+            fcntl.flock(f.fileno(), fcntl.LOCK_EX | fcntl.LOCK_NB)
+        else:
+            f.seek(0)
+            msvcrt.locking(f.fileno(), msvcrt.LK_NBLCK, 1)
+    except OSError:
+        return False
+    return True
+
+
+def recover(directory=None):
+    """
+    前回のプロセスが残したジャーナルのセグメントをSQLiteへ再生し、削除する。
+    動作中のジャーナルのセグメント (ロックが取れないもの) には手を付けない。再生したイベント数を返す。
+    """
+    directory = directory or config.CHECKIN_JOURNAL_DIR
+    if not os.path.isdir(directory):
+        return 0
+
+    replayed = 0
+    for name in sorted(os.listdir(directory)):
+        if not name.endswith('.jsonl'):
+            continue
+        # このプロセスのジャーナルが閉じたセグメントは、SQLiteへの反映を待っているだけ
+        pid = int(name.split('-', 1)[0])
+        if pid == os.getpid() and _journal is not None:
+            continue
+
+        path = os.path.join(directory, name)
+        events = []
+        with open(path, encoding='utf-8') as f:
+            if not _lock_segment(f):
+                continue
+            for line in f:
+                try:
+                    events.append(json.loads(line))
+                except ValueError:
+                    # 書き込み途中で落ちた最終行 (fsync前なので、まだ応答も返していない)
+                    logger.warning('ジャーナルの壊れた行を読み飛ばしました: %s', name)
+        if events:
+            write_events(events)
+            replayed += len(events)
+        os.remove(path)
+
+    if replayed:
+        logger.info('チェックインジャーナルから %d 件を再生しました', replayed)
+    return replayed
+
+
+def get_journal():
+    """プロセス内で共有するジャーナルを返す。初回呼び出し時に前回分の再生も行う"""
+    global _journal
+    if _journal is None:
+        with _journal_lock:
+            if _journal is None:
+                recover()
+                _journal = CheckinJournal(
+                    config.CHECKIN_JOURNAL_DIR,
+                    flush_interval=config.CHECKIN_FLUSH_INTERVAL_MS / 1000,
+                    max_batch=config.CHECKIN_FLUSH_MAX_EVENTS,
+                )
+                atexit.register(shutdown)
+    return _journal
+
+
+def shutdown():
+    """ジャーナルの残りをSQLiteへ反映してから閉じる (プロセス終了時に呼ばれる)"""
+    global _journal
+    with _journal_lock:
+        if _journal is not None:
+            _journal.close()
+            _journal = None
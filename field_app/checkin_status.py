@@ -0,0 +1,79 @@
+# field_app/checkin_status.py
+"""
+ログインIDごとの最後の入退所 (CheckinStatus) の更新。
+
+同期済みの UnsyncedCheckin は ARCHIVE_RETENTION_DAYS を過ぎるとアーカイブへ移して削除されるため、
+長く入所している人ほど、チェックイン記録のテーブルからは「入所中」と分からなくなる。
+そこで、チェックイン記録を登録する全ての経路 (画面からの保存のシグナル、グループコミットの
+ジャーナル、ピアからの受け取り、バンドルの取り込み) から record() を呼び、最新の1件を残しておく。
+"""
+from django.db import connection, transaction
+from django.utils.dateparse import parse_datetime
+
+from .models import CheckinStatus, UnsyncedCheckin
+
+_UPSERT = (
+    f'INSERT INTO {CheckinStatus._meta.db_table} (username, shelter_id, checkin_type, timestamp) '
+    f'VALUES (%s, %s, %s, %s) '
+    f'ON CONFLICT (username) DO UPDATE SET shelter_id = excluded.shelter_id, '
+    f'checkin_type = excluded.checkin_type, timestamp = excluded.timestamp '
+    # 後から届いた古い記録 (ピア・バンドル経由など) では上書きしない
+    f'WHERE excluded.timestamp >= {CheckinStatus._meta.db_table}.timestamp'
+)
+
+
+def record(checkins):
+    """チェックイン記録 (UnsyncedCheckin のリスト) を、ログインIDごとの最後の入退所に反映する"""
+    latest = {}
+    for checkin in checkins:
+        current = latest.get(checkin.username)
+        if current is None or checkin.timestamp >= current.timestamp:
+            latest[checkin.username] = checkin
+    if not latest:
+        return
+    timestamp_field = CheckinStatus._meta.get_field('timestamp')
+    rows = [(c.username, c.shelter_id, c.checkin_type, timestamp_field.get_db_prep_value(c.timestamp, connection))
+            for c in latest.values()]
+    with connection.cursor() as cursor:
+        cursor.executemany(_UPSERT, rows)
+
+
+def last_type(username):
+    """
+    そのログインIDの最後の入退所の種別 ('checkin' / 'checkout'、記録が無ければ None)。
+    アーカイブ済みの記録も CheckinStatus に残っているので、長く入所している人も「入所中」と分かる。
+    """
+    status = CheckinStatus.objects.filter(username=username).values_list('checkin_type', flat=True).first()
+    if status is not None:
+        return status
+    # CheckinStatus を追加する前 (rebuild 前) の記録
+    last_record = UnsyncedCheckin.objects.filter(username=username).order_by('-timestamp').first()
+    return last_record.checkin_type if last_record else None
+
+
+@transaction.atomic
+def rebuild():
+    """
+    チェックイン記録のテーブルから作り直す (CheckinStatus を追加した直後の1回用)。
+    作り直す前にアーカイブへ移された記録は、archive.search('checkins') から反映する。
+    """
+    from . import archive
+
+    CheckinStatus.objects.all().delete()
+    batch = []
+    for row in archive.search('checkins'):
+        batch.append(UnsyncedCheckin(username=row['username'], shelter_id=row['shelter_id'],
+                                     checkin_type=row['checkin_type'],
+                                     timestamp=parse_datetime(row['timestamp'])))
+        if len(batch) >= 2000:
+            record(batch)
+            batch = []
+    record(batch)
+    batch = []
+    for checkin in UnsyncedCheckin.objects.only('username', 'shelter_id', 'checkin_type', 'timestamp').iterator(
+            chunk_size=2000):
+        batch.append(checkin)
+        if len(batch) >= 2000:
+            record(batch)
+            batch = []
+    record(batch)
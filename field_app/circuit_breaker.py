@@ -0,0 +1,148 @@
+# field_app/circuit_breaker.py
+"""
+中央サーバーごとのサーキットブレーカー。
+
+中央サーバーが落ちているときに、画面を開くたびにタイムアウト (3〜10秒) まで待たされないよう、
+連続して失敗したら一定時間 (クールダウン) は送信せずにすぐ失敗させる。
+クールダウンが明けたら1件だけ試しに送り (半開)、成功すれば元に戻す。
+
+- 失敗とみなすのは、通信エラー (タイムアウト・接続エラー) と 5xx の応答
+- ブレーカーはプロセス内で共有し、接続先 (CENTRAL_SERVER_URLS の各URL) ごとに1つ持つ
+- 開いている間の送信は CircuitOpenError (requests の ConnectionError の一種) になるため、
+  呼び出し側は既存の RequestException の処理でそのまま扱える
+"""
+import threading
+import time
+from urllib.parse import urlsplit
+
+import requests
+
+import config
+from . import metrics
+
+CLOSED = 'closed'
+OPEN = 'open'
+HALF_OPEN = 'half_open'
+
+# メトリクス (field_central_circuit_state) に出す値
+_STATE_VALUES = {CLOSED: 0, HALF_OPEN: 1, OPEN: 2}
+_STATE_LABELS = {CLOSED: '接続中', HALF_OPEN: '確認中', OPEN: '遮断中'}
+
+
+class CircuitOpenError(requests.exceptions.ConnectionError):
+    """ブレーカーが開いているため、中央サーバーへ送信せずに失敗させたことを表す"""
+
+    def __init__(self, target, retry_after):
+        super().__init__(f'{target} への送信を一時停止中です (あと {retry_after:.0f} 秒)')
+        self.target = target
+        self.retry_after = retry_after
+
+
+class CircuitBreaker:
+    def __init__(self, target, clock=time.monotonic):
+        self.target = target
+        self._clock = clock
+        self._lock = threading.Lock()
+        self.state = CLOSED
+        self.failures = 0            # 連続した失敗の回数
+        self.opened_at = None        # 最後に開いた時刻 (clock の値)
+        self.last_error = None
+        self._probing = False        # 半開状態で、試しの1件を送信中か
+        metrics.central_circuit_state.set(_STATE_VALUES[CLOSED], target=target)
+
+    def _set_state(self, state):
+        self.state = state
+        metrics.central_circuit_state.set(_STATE_VALUES[state], target=self.target)
+
+    def retry_after(self):
+        """開いている場合、次に試せるまでの秒数 (それ以外は 0)"""
+        if self.state != OPEN:
+            return 0.0
+        return max(0.0, self.opened_at + config.CENTRAL_BREAKER_COOLDOWN_SECONDS - self._clock())
+
+    def is_open(self):
+        """今送信しても即座に失敗させられる状態か (クールダウン中、または試しの1件を送信中)"""
+        with self._lock:
+            return (self.state == OPEN and self.retry_after() > 0) or (self.state == HALF_OPEN and self._probing)
+
+    def before_request(self):
+        """送信前に呼ぶ。送信してはいけない場合は CircuitOpenError を送出する"""
+        with self._lock:
+            if self.state == CLOSED:
+                return
+            if self.state == OPEN:
+                remaining = self.retry_after()
+                if remaining > 0:
+                    raise CircuitOpenError(self.target, remaining)
+                self._set_state(HALF_OPEN)
+            if self._probing:
+                # 試しの1件の結果が出るまでは、他のリクエストは待たせずに失敗させる
+                raise CircuitOpenError(self.target, 0)
+            self._probing = True
+
+    def record_success(self):
+        with self._lock:
+            self.failures = 0
+            self._probing = False
+            self.last_error = None
+            if self.state != CLOSED:
+                self._set_state(CLOSED)
+
+    def record_failure(self, error):
+        with self._lock:
+            self.failures += 1
+            self.last_error = str(error) or type(error).__name__
+            self._probing = False
+            if self.state == HALF_OPEN or self.failures >= config.CENTRAL_BREAKER_FAILURE_THRESHOLD:
+                self.opened_at = self._clock()
+                self._set_state(OPEN)
+
+    def abandon(self):
+        """送信が (キャンセルなど) 成否の判定前に打ち切られた場合に、試しの1件の枠を返す"""
+        with self._lock:
+            self._probing = False
+
+    def as_dict(self):
+        with self._lock:
+            return {
+                'target': self.target,
+                'state': self.state,
+                'label': _STATE_LABELS[self.state],
+                'failures': self.failures,
+                'retry_after': round(self.retry_after()),
+                'last_error': self.last_error,
+            }
+
+
+_breakers = {}
+_registry_lock = threading.Lock()
+
+
+def target_of(url):
+    """URLから、ブレーカーを共有する単位 (スキーム + ホスト:ポート) を取り出す"""
+    parts = urlsplit(url)
+    return f'{parts.scheme}://{parts.netloc}'
+
+
+def breaker_for(url):
+    target = target_of(url)
+    breaker = _breakers.get(target)
+    if breaker is None:
+        with _registry_lock:
+            breaker = _breakers.setdefault(target, CircuitBreaker(target))
+    return breaker
+
+
+def is_open(url):
+    """url の接続先が遮断中なら True (画面をすぐにオフライン表示に切り替える判断に使う)"""
+    return breaker_for(url).is_open()
+
+
+def is_failure_status(status_code):
+    return status_code >= 500
+
+
+def states():
+    """ホーム画面・確認用に、このプロセスが持つ全ブレーカーの状態を返す"""
+    return [_breakers[target].as_dict() for target in sorted(_breakers)]
+
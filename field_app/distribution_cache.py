@@ -0,0 +1,131 @@
+# field_app/distribution_cache.py
+"""
+炊き出しの受け取り可否の事前確認 (炊き出し確認画面の、食事時の行列対策)。
+
+食事の時間には数百人が数分のうちに同じ物資を受け取りに来るが、1人ずつ中央サーバーの
+check-distribution/ に問い合わせると、細い回線の往復がそのまま行列の待ち時間になる。そこで
+- 配布の予定時刻 (config.DISTRIBUTION_TIMES) の DISTRIBUTION_PREWARM_LEAD_MINUTES 分前に、
+  この避難所に入所中の全員 × その日の全物資の受け取り可否を、まとめて問い合わせておく (prewarm)
+  (1回の問い合わせには DISTRIBUTION_PREWARM_BATCH_SIZE 人ずつ含める)
+- スキャンされたら、期限内の事前確認の結果で判定し (answer)、配布した記録は UnsyncedDistribution に
+  ためて、sync_data が record-distributions/ にまとめて送る
+事前確認の結果が無い人 (後から入所した人・期限切れなど) は、これまで通りその場で問い合わせる。
+
+同じ避難所に複数のラズパイがある場合、事前確認の後に別のラズパイで受け取った分は
+このラズパイの結果には反映されない (中央サーバーに記録を送った後の事前確認からは反映される)。
+"""
+import logging
+from datetime import timedelta
+
+from django.db import transaction
+from django.db.models import Exists, OuterRef
+from django.utils import timezone
+
+import config
+from . import checkin_status
+from .models import CheckinStatus, DistributionEligibility, DistributionItem, UnsyncedCheckin, UnsyncedDistribution
+from .utils import central_request, get_active_central_url
+
+logger = logging.getLogger('field_app.distribution')
+
+# 判定結果 (中央サーバーの check-distribution/ と同じ形で返す)
+GRANTED = {'can_distribute': True, 'message': '配布可能です。受け取りを記録しました。'}
+REFUSED = {'can_distribute': False, 'message': '既に受け取り済みです。'}
+
+
+def due_slot(now=None):
+    """
+    事前確認を行う時間帯なら、その配布の予定時刻 ('2026-10-19 12:00' など) を返す。
+    予定時刻の DISTRIBUTION_PREWARM_LEAD_MINUTES 分前から予定時刻までが対象 (それ以外は None)。
+    """
+    now = timezone.localtime(now or timezone.now())
+    lead = timedelta(minutes=config.DISTRIBUTION_PREWARM_LEAD_MINUTES)
+    for value in config.DISTRIBUTION_TIMES:
+        hour, minute = map(int, value.split(':'))
+        scheduled = now.replace(hour=hour, minute=minute, second=0, microsecond=0)
+        if scheduled < now:
+            scheduled += timedelta(days=1)  # 日付をまたぐ場合 (23:50 に 00:10 の分など)
+        if scheduled - lead <= now:
+            return scheduled.strftime('%Y-%m-%d %H:%M')
+    return None
+
+
+def checked_in_usernames(shelter_id=None):
+    """
+    この避難所に入所中 (最後の記録が入所) のログインIDを返す。
+    チェックイン記録はアーカイブで消えるため、ログインIDごとの最後の入退所 (CheckinStatus) から判断する。
+    """
+    if not CheckinStatus.objects.exists() and UnsyncedCheckin.objects.exists():
+        checkin_status.rebuild()  # CheckinStatus を追加する前からある記録を反映する (初回のみ)
+    return list(CheckinStatus.objects.filter(shelter_id=shelter_id or config.SHELTER_ID, checkin_type='checkin')
+                .values_list('username', flat=True))
+
+
+def prewarm(item_ids=None, usernames=None):
+    """
+    入所中の全員 × 物資 (省略時はマスタの全物資) の受け取り可否を中央サーバーにまとめて問い合わせ、
+    DISTRIBUTION_ELIGIBILITY_TTL_SECONDS の期限付きで保存する。保存した件数を返す。
+    通信エラーは requests の例外として送出する (それまでに受け取った分は保存済み)。
+    """
+    item_ids = [str(item_id) for item_id in (item_ids or DistributionItem.objects.values_list('id', flat=True))]
+    usernames = checked_in_usernames() if usernames is None else list(usernames)
+    DistributionEligibility.objects.filter(expires_at__lte=timezone.now()).delete()
+    if not item_ids or not usernames:
+        return 0
+
+    api_url = get_active_central_url() + config.API_BASE_PATH + 'check-distribution-bulk/'
+    batch_size = config.DISTRIBUTION_PREWARM_BATCH_SIZE
+    stored = 0
+    for start in range(0, len(usernames), batch_size):
+        batch = usernames[start:start + batch_size]
+        response = central_request('post', api_url, endpoint='check-distribution-bulk', timeout=30, json={
+            'usernames': batch,
+            'item_ids': item_ids,
+            'device_id': config.DEVICE_ID,
+        })
+        response.raise_for_status()
+        stored += _store(response.json().get('results', []))
+    logger.info('炊き出しの受け取り可否を事前確認しました (%d人 × %d品目、%d件)', len(usernames), len(item_ids), stored)
+    return stored
+
+
+def _store(results):
+    now = timezone.now()
+    expires_at = now + timedelta(seconds=config.DISTRIBUTION_ELIGIBILITY_TTL_SECONDS)
+    entries = [DistributionEligibility(username=result['username'], item_id=str(result['item_id']),
+                                       can_distribute=bool(result['can_distribute']),
+                                       fetched_at=now, expires_at=expires_at)
+               for result in results]
+    with transaction.atomic():
+        DistributionEligibility.objects.bulk_create(
+            entries, update_conflicts=True, unique_fields=['username', 'item_id'],
+            update_fields=['can_distribute', 'fetched_at', 'expires_at'])
+        # 中央サーバーにまだ記録を送っていない受け取りは、中央の結果が「可」でも受け取り済みとする
+        handed_out = UnsyncedDistribution.objects.filter(is_synced=False, username=OuterRef('username'),
+                                                         item_id=OuterRef('item_id'))
+        DistributionEligibility.objects.filter(Exists(handed_out), can_distribute=True).update(can_distribute=False)
+    return len(entries)
+
+
+def answer(username, item_id):
+    """
+    事前確認の結果でスキャンを判定する。配布可能なら受け取りを記録して GRANTED を返す。
+    期限内の結果が無ければ None (呼び出し側で中央サーバーに問い合わせる)。
+    """
+    entries = DistributionEligibility.objects.filter(username=username, item_id=str(item_id),
+                                                     expires_at__gt=timezone.now())
+    can_distribute = entries.values_list('can_distribute', flat=True).first()
+    if can_distribute is None:
+        return None
+    if can_distribute:
+        with transaction.atomic():
+            # 「可」の行を「不可」に書き換えられた場合だけ配布する (同時に同じ人をスキャンしても1回だけ)
+            if entries.filter(can_distribute=True).update(can_distribute=False):
+                UnsyncedDistribution.objects.create(username=username, item_id=str(item_id))
+                return GRANTED
+    return REFUSED
+
+
+def remember_recorded(username, item_id):
+    """その場で問い合わせて中央サーバーに記録された受け取りを、事前確認の結果にも反映する"""
+    DistributionEligibility.objects.filter(username=username, item_id=str(item_id)).update(can_distribute=False)
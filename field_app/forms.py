@@ -1,4 +1,6 @@
 from django import forms
+from django.contrib.auth.hashers import make_password
+
 from .models import UnsyncedFieldReport, UnsyncedUserRegistration
 
 
@@ -67,3 +69,11 @@ class FieldSignUpForm(forms.ModelForm):
 
         return cleaned_data
 
+    def save(self, commit=True):
+        # 生のパスワードは端末にも中央サーバーにも残さない (本登録時はこのハッシュをそのまま使う)
+        registration = super().save(commit=False)
+        registration.password = make_password(self.cleaned_data['password'])
+        if commit:
+            registration.save()
+        return registration
+
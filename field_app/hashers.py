@@ -0,0 +1,71 @@
+# field_app/hashers.py
+"""
+この端末向けの強さにしたパスワードのハッシュ (settings.PASSWORD_HASHERS、config.PASSWORD_HASHER)。
+
+fetch_master_data は中央サーバーのハッシュをそのまま取り込むため、何もしなければログインの
+CPU時間は中央サーバーの設定 (Django 標準の PBKDF2 100万回など) で決まり、ラズパイ3では1秒近くかかる。
+PASSWORD_HASHERS の先頭をここの方式にしておくと、Django はログインに成功したときに
+(先頭の方式・強さと違うハッシュを) 自動で作り直すので、2回目以降のログインはこの強さで確認される。
+方式名は Django 標準と同じ ('argon2' / 'pbkdf2_sha256') なので、中央サーバーでもそのまま確認できる。
+
+argon2-cffi (requirements.txt) が入っていれば argon2 を使う。入っていない場合の PBKDF2 では、
+中央サーバーのハッシュの反復回数がこの端末の設定より多ければ作り直さない (弱いハッシュに置き換えない)。
+その場合、そのユーザーのログインは中央サーバーの強さのまま確認される。
+"""
+from django.contrib.auth.hashers import Argon2PasswordHasher, PBKDF2PasswordHasher, identify_hasher, make_password
+
+import config
+
+try:
+    import argon2
+except ImportError:  # argon2-cffi が無ければ PBKDF2 を使う
+    argon2 = None
+
+
+class FieldArgon2PasswordHasher(Argon2PasswordHasher):
+    time_cost = config.PASSWORD_ARGON2_TIME_COST
+    memory_cost = config.PASSWORD_ARGON2_MEMORY_KIB
+    parallelism = config.PASSWORD_ARGON2_PARALLELISM
+
+
+class FieldPBKDF2PasswordHasher(PBKDF2PasswordHasher):
+    iterations = config.PASSWORD_PBKDF2_ITERATIONS
+
+    def must_update(self, encoded):
+        # 反復回数が少ないハッシュだけを作り直す (Django 標準は、多い場合も設定の回数に揃えてしまう)
+        return self.decode(encoded)['iterations'] < self.iterations
+
+
+# 中央サーバーから取り込んだハッシュを確認するための、Django 標準の残りの方式
+# (pbkdf2_sha256 と argon2 は上のクラスが強さに関係なく確認する。同じ方式名を並べると後のものが使われる)
+_DJANGO_HASHERS = [
+    'django.contrib.auth.hashers.PBKDF2SHA1PasswordHasher',
+    'django.contrib.auth.hashers.BCryptSHA256PasswordHasher',
+    'django.contrib.auth.hashers.ScryptPasswordHasher',
+]
+
+
+def password_hashers(policy=None):
+    """settings.PASSWORD_HASHERS の値。先頭が新しく作るハッシュの方式になる"""
+    policy = policy or config.PASSWORD_HASHER
+    if policy == 'auto':
+        policy = 'argon2' if argon2 is not None else 'pbkdf2'
+    if policy == 'argon2':
+        preferred = ['field_app.hashers.FieldArgon2PasswordHasher', 'field_app.hashers.FieldPBKDF2PasswordHasher']
+    elif policy == 'pbkdf2':
+        preferred = ['field_app.hashers.FieldPBKDF2PasswordHasher', 'field_app.hashers.FieldArgon2PasswordHasher']
+    else:
+        raise ValueError(f'config.PASSWORD_HASHER の値が不正です: {policy}')
+    return preferred + _DJANGO_HASHERS
+
+
+def ensure_hashed(value):
+    """
+    仮登録のパスワードをハッシュにして返す (ハッシュ済みならそのまま)。
+    以前のフォームは生のパスワードを保存していたため、その行を送る前に使う。
+    """
+    try:
+        identify_hasher(value)
+        return value
+    except ValueError:
+        return make_password(value)
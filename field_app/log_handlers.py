@@ -0,0 +1,146 @@
+# field_app/log_handlers.py
+"""
+SDカードへの書き込み回数を抑えるためのログハンドラ群。
+
+- QueueingBufferedFileHandler: ログ出力をキューに積むだけで即座に戻る (リクエスト処理を待たせない)
+- BufferedRotatingFileHandler: RAM上にためたログを、件数・時間・重要度の条件でまとめて書き出す
+- StructuredFormatter: 1行1レコードのJSON形式 (後から grep / jq で集計しやすい)
+"""
+import atexit
+import json
+import logging
+import logging.handlers
+import queue
+import threading
+import time
+
+# LogRecord が標準で持っている属性 (これ以外は extra= で渡された構造化フィールドとみなす)
+_STANDARD_ATTRS = set(vars(logging.LogRecord('', 0, '', 0, '', (), None))) | {'message', 'asctime'}
+
+
+class StructuredFormatter(logging.Formatter):
+    """ログを1行のJSONとして整形する。extra= で渡した値もそのままキーとして出力する"""
+
+    def format(self, record):
+        entry = {
+            'ts': self.formatTime(record, '%Y-%m-%dT%H:%M:%S'),
+            'level': record.levelname,
+            'logger': record.name,
+            'msg': record.getMessage(),
+        }
+        for key, value in vars(record).items():
+            if key not in _STANDARD_ATTRS and not key.startswith('_'):
+                entry[key] = value
+        if record.exc_info:
+            entry['exc'] = self.formatException(record.exc_info)
+        return json.dumps(entry, ensure_ascii=False, default=str)
+
+
+class BufferedRotatingFileHandler(logging.handlers.RotatingFileHandler):
+    """
+    ログをRAMにためておき、まとめてファイルへ書き出すローテーション付きハンドラ。
+    以下のいずれかでフラッシュする:
+      - ためた件数が capacity に達した
+      - flush_level 以上 (既定: ERROR) のログが来た
+      - 最後のフラッシュから flush_interval 秒が経過した
+    """
+
+    def __init__(self, filename, max_bytes=0, backup_count=0, capacity=200,
+                 flush_interval=30.0, flush_level=logging.ERROR, encoding='utf-8'):
+        super().__init__(filename, maxBytes=max_bytes, backupCount=backup_count,
+                         encoding=encoding, delay=True)
+        self.capacity = capacity
+        self.flush_interval = flush_interval
+        self.flush_level = flush_level
+        self.buffer = []
+        self._last_flush = time.monotonic()
+
+        # ログが途絶えても flush_interval ごとに書き出されるようにする
+        self._stop = threading.Event()
+        self._timer = threading.Thread(target=self._flush_periodically, name='log-flusher', daemon=True)
+        self._timer.start()
+
+    def emit(self, record):
+        try:
+            msg = self.format(record)
+        except Exception:
+            self.handleError(record)
+            return
+        with self.lock:
+            self.buffer.append(msg)
+            should_flush = (
+                len(self.buffer) >= self.capacity
+                or record.levelno >= self.flush_level
+                or time.monotonic() - self._last_flush >= self.flush_interval
+            )
+        if should_flush:
+            self.flush()
+
+    def flush(self):
+        with self.lock:
+            if not self.buffer:
+                return
+            lines, self.buffer = self.buffer, []
+            if self.stream is None:
+                self.stream = self._open()
+            for line in lines:
+                data = line + self.terminator
+                if self.maxBytes > 0 and self.stream.tell() + len(data.encode('utf-8')) >= self.maxBytes:
+                    self.doRollover()
+                    # delay=True のため、doRollover() は新しいファイルを開かずに stream を None にする
+                    if self.stream is None:
+                        self.stream = self._open()
+                self.stream.write(data)
+            self.stream.flush()
+            self._last_flush = time.monotonic()
+
+    def _flush_periodically(self):
+        while not self._stop.wait(self.flush_interval):
+            try:
+                self.flush()
+            except Exception:
+                pass
+
+    def close(self):
+        self._stop.set()
+        try:
+            self.flush()
+        finally:
+            super().close()
+
+
+class QueueingBufferedFileHandler(logging.handlers.QueueHandler):
+    """
+    ログ呼び出し側ではキューに積むだけにし、ファイルへの書き出しは
+    専用スレッド (QueueListener) 上の BufferedRotatingFileHandler に任せるハンドラ。
+    キューが溢れた場合はリクエスト処理を止めないよう、そのログを捨てて件数だけ数える。
+    """
+
+    def __init__(self, filename, max_bytes=0, backup_count=0, capacity=200,
+                 flush_interval=30.0, queue_size=10000):
+        super().__init__(queue.Queue(queue_size))
+        self.dropped = 0
+        self.target = BufferedRotatingFileHandler(
+            filename, max_bytes=max_bytes, backup_count=backup_count,
+            capacity=capacity, flush_interval=flush_interval,
+        )
+        self.listener = logging.handlers.QueueListener(self.queue, self.target, respect_handler_level=True)
+        self.listener.start()
+        atexit.register(self.close)
+
+    def setFormatter(self, fmt):
+        # 整形は書き出し側のスレッドで行う (dictConfig の formatter 指定をそちらに渡す)
+        self.target.setFormatter(fmt)
+
+    def enqueue(self, record):
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            self.dropped += 1
+
+    def close(self):
+        if self.listener is not None:
+            self.listener.stop()
+            self.listener = None
+            self.target.close()
+        super().close()
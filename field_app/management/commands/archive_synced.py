@@ -0,0 +1,31 @@
+# field_app/management/commands/archive_synced.py
+from django.core.management.base import BaseCommand
+
+import config
+from field_app import archive
+
+
+class Command(BaseCommand):
+    help = '保持期間を過ぎた同期済みレコードを日付別の圧縮アーカイブへ移し、データベースから削除します。'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--days', type=int, default=config.ARCHIVE_RETENTION_DAYS,
+                            help='同期済みレコードをデータベースに残しておく日数')
+        parser.add_argument('--batch-size', type=int, default=config.ARCHIVE_BATCH_SIZE,
+                            help='1回のトランザクションで削除する件数')
+        parser.add_argument('--no-vacuum', action='store_true', help='削除後の incremental vacuum を行わない')
+
+    def handle(self, *args, **options):
+        moved = archive.archive_synced(options['days'], options['batch_size'])
+        for kind, count in moved.items():
+            self.stdout.write(f'{kind}: {count}件をアーカイブしました')
+
+        if not options['no_vacuum'] and any(moved.values()):
+            if archive.incremental_vacuum():
+                self.stdout.write('空き領域を解放しました (incremental vacuum)')
+            else:
+                self.stdout.write(self.style.WARNING(
+                    'auto_vacuum が INCREMENTAL ではないため、空き領域は解放していません '
+                    '(manage.py enable_incremental_vacuum を一度実行してください)'))
+
+        self.stdout.write(self.style.SUCCESS('アーカイブ処理が完了しました'))
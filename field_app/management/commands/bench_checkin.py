@@ -0,0 +1,72 @@
+# field_app/management/commands/bench_checkin.py
+import os
+import threading
+import time
+
+from django.core.management.base import BaseCommand
+from django.test import Client
+
+import config
+from field_app import checkin_journal
+from field_app.benchmarking import scratch_database, percentile
+from field_app.models import User
+
+
+class Command(BaseCommand):
+    help = '複数タブレットからの同時スキャンを模擬し、グループコミットの有無で受付件数/秒を比較します。'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--scans', type=int, default=400, help='1回の計測で送るスキャン数の合計')
+        parser.add_argument('--tablets', type=int, default=4, help='同時にスキャンするタブレット数 (スレッド数)')
+
+    def handle(self, *args, **options):
+        original = config.CHECKIN_GROUP_COMMIT, config.CHECKIN_JOURNAL_DIR
+        try:
+            with scratch_database() as tmpdir:
+                config.CHECKIN_JOURNAL_DIR = os.path.join(tmpdir, 'journal')
+                User.objects.create_user(username='benchstaff', password='x', role='rescuer')
+                for group_commit in (False, True):
+                    config.CHECKIN_GROUP_COMMIT = group_commit
+                    self.run_round(group_commit, options['scans'], options['tablets'])
+                checkin_journal.shutdown()
+        finally:
+            config.CHECKIN_GROUP_COMMIT, config.CHECKIN_JOURNAL_DIR = original
+
+    def run_round(self, group_commit, scans, tablets):
+        latencies = []
+        lock = threading.Lock()
+        per_tablet = scans // tablets
+
+        def tablet(no):
+            client = Client()
+            client.force_login(User.objects.get(username='benchstaff'))
+            mode = 'gc' if group_commit else 'direct'
+            for i in range(per_tablet):
+                start = time.perf_counter()
+                client.post('/checkin/', {'username': f'{mode}{no}x{i}', 'checkin_type': 'checkin'})
+                elapsed = time.perf_counter() - start
+                with lock:
+                    latencies.append(elapsed)
+
+        threads = [threading.Thread(target=tablet, args=(n,)) for n in range(tablets)]
+        started = time.perf_counter()
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        wall = time.perf_counter() - started
+
+        # ジャーナルに残っている分をSQLiteへ反映するまでの時間も参考として出す
+        drain = 0.0
+        if group_commit:
+            drain_start = time.perf_counter()
+            checkin_journal.get_journal().flush()
+            drain = time.perf_counter() - drain_start
+
+        label = 'グループコミットあり' if group_commit else 'グループコミットなし'
+        self.stdout.write(self.style.SUCCESS(f'--- {label} ({tablets}台 x {per_tablet}件) ---'))
+        self.stdout.write(f'  受付件数/秒 : {len(latencies) / wall:.1f}')
+        self.stdout.write(f'  p50 / p95 / p99 (ms) : {percentile(latencies, 50) * 1000:.1f} / '
+                          f'{percentile(latencies, 95) * 1000:.1f} / {percentile(latencies, 99) * 1000:.1f}')
+        if group_commit:
+            self.stdout.write(f'  残りのSQLite反映 : {drain * 1000:.1f} ms')
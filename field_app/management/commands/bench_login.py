@@ -0,0 +1,74 @@
+# field_app/management/commands/bench_login.py
+import threading
+import time
+
+from django.conf import global_settings
+from django.contrib.auth.hashers import PBKDF2PasswordHasher
+from django.core.management.base import BaseCommand
+from django.test import Client, override_settings
+
+from field_app import hashers
+from field_app.benchmarking import scratch_database, percentile
+from field_app.models import User
+
+PASSWORD = 'bench-password'
+
+
+class Command(BaseCommand):
+    help = ('交代時などに複数のタブレットから同時にログインしたときの、ログイン件数/秒と待ち時間を'
+            'パスワードのハッシュの方式ごとに比較します (1回目は中央サーバーのハッシュの確認と作り直し)。')
+
+    def add_arguments(self, parser):
+        parser.add_argument('--users', type=int, default=8, help='ログインするユーザー数 (1回の計測のログイン数)')
+        parser.add_argument('--tablets', type=int, default=2, help='同時にログインするタブレット数 (スレッド数)')
+
+    def handle(self, *args, **options):
+        policies = [('central', '中央サーバーの標準 (作り直さない)', list(global_settings.PASSWORD_HASHERS)),
+                    ('pbkdf2', 'この端末向けの PBKDF2', hashers.password_hashers('pbkdf2'))]
+        if hashers.argon2 is not None:
+            policies.append(('argon2', 'argon2', hashers.password_hashers('argon2')))
+        else:
+            self.stdout.write('argon2-cffi が入っていないため、argon2 は計測しません。')
+
+        # fetch_master_data で取り込むのと同じ、中央サーバー (Django 標準) の強さのハッシュ
+        central_hash = PBKDF2PasswordHasher().encode(PASSWORD, PBKDF2PasswordHasher().salt())
+        with scratch_database():
+            for name, label, policy_hashers in policies:
+                usernames = [f'{name}{i:04d}' for i in range(options['users'])]
+                User.objects.bulk_create([User(username=username, password=central_hash,
+                                               central_password_hash=central_hash) for username in usernames])
+                with override_settings(PASSWORD_HASHERS=policy_hashers):
+                    self.stdout.write(self.style.SUCCESS(f'--- {label} ({options["tablets"]}台) ---'))
+                    self.run_round('1回目のログイン', usernames, options['tablets'])
+                    self.run_round('2回目以降のログイン', usernames, options['tablets'])
+                algorithm = User.objects.get(username=usernames[0]).password.split('$', 2)[:2]
+                self.stdout.write(f'  保存されたハッシュ : {"$".join(algorithm)}')
+
+    def run_round(self, label, usernames, tablets):
+        latencies = []
+        failures = []
+        lock = threading.Lock()
+
+        def tablet(no):
+            client = Client()
+            for username in usernames[no::tablets]:
+                start = time.perf_counter()
+                response = client.post('/login/', {'username': username, 'password': PASSWORD})
+                elapsed = time.perf_counter() - start
+                client.logout()
+                with lock:
+                    latencies.append(elapsed)
+                    if response.status_code != 302:
+                        failures.append(username)
+
+        threads = [threading.Thread(target=tablet, args=(n,)) for n in range(tablets)]
+        started = time.perf_counter()
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        wall = time.perf_counter() - started
+
+        self.stdout.write(f'  {label} : {len(latencies) / wall:.1f} 件/秒、p50 / p95 (ms) '
+                          f'{percentile(latencies, 50) * 1000:.0f} / {percentile(latencies, 95) * 1000:.0f}'
+                          + (f'、失敗 {len(failures)} 件' if failures else ''))
@@ -0,0 +1,126 @@
+# field_app/management/commands/bench_slow_central.py
+import os
+import subprocess
+import sys
+import threading
+import time
+
+import requests
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection
+
+from field_app.benchmarking import percentile, scratch_database
+from field_app.management.commands.bench_sync import _free_port
+from field_app.models import User
+from field_app.stub_central import CentralState, Conditions, StubCentralServer
+
+# 計測するサーバーの起動方法 ({port} と {threads} は実行時に置き換える)
+SERVER_COMMANDS = {
+    'asgi': [sys.executable, '-m', 'uvicorn', 'rpi_server_project.asgi:application',
+             '--host', '127.0.0.1', '--port', '{port}', '--workers', '1', '--log-level', 'warning'],
+    'wsgi': [sys.executable, '-m', 'gunicorn', 'rpi_server_project.wsgi:application',
+             '--bind', '127.0.0.1:{port}', '--workers', '1', '--threads', '{threads}', '--log-level', 'warning'],
+}
+
+
+class Command(BaseCommand):
+    help = ('中央サーバーが遅い状況で、中央サーバーを待つ画面 (炊き出し確認) を開き続けるタブレットと、'
+            'ローカルだけで完結する画面 (受付) を開くタブレットを同時に動かし、'
+            'ASGI (async ビュー) と WSGI (スレッド) で受付画面の応答時間を比較します。')
+
+    def add_arguments(self, parser):
+        parser.add_argument('--modes', default='asgi,wsgi', help='計測するサーバー (asgi / wsgi、カンマ区切り)')
+        parser.add_argument('--central-latency-ms', type=float, default=3000, help='スタブ中央サーバーの応答遅延')
+        parser.add_argument('--slow-clients', type=int, default=8, help='炊き出し確認画面を開き続けるタブレット数')
+        parser.add_argument('--local-clients', type=int, default=2, help='受付画面を開き続けるタブレット数')
+        parser.add_argument('--threads', type=int, default=4, help='WSGI サーバーのスレッド数')
+        parser.add_argument('--duration', type=float, default=15, help='計測時間 (秒)')
+
+    def handle(self, *args, **options):
+        modes = [mode for mode in options['modes'].split(',') if mode]
+        for mode in modes:
+            if mode not in SERVER_COMMANDS:
+                raise CommandError(f'不明なサーバーです: {mode}')
+
+        stub = StubCentralServer(conditions=Conditions(latency_ms=options['central_latency_ms']),
+                                 state=CentralState(user_count=10)).start_background()
+        try:
+            with scratch_database():
+                User.objects.create_user(username='benchstaff', password='bench', role='rescuer')
+                db_path = connection.settings_dict['NAME']
+                for mode in modes:
+                    self.run_mode(mode, options, db_path, stub.url)
+        finally:
+            stub.stop()
+
+    def run_mode(self, mode, options, db_path, central_url):
+        port = _free_port()
+        base_url = f'http://127.0.0.1:{port}'
+        command = [part.format(port=port, threads=options['threads']) for part in SERVER_COMMANDS[mode]]
+        env = dict(os.environ, FIELD_DB_PATH=str(db_path), FIELD_CENTRAL_SERVER_URLS=central_url,
+                   FIELD_SCHEDULER_ENABLED='0', FIELD_RUN_DIR=os.path.join(os.path.dirname(db_path), 'run'))
+        process = subprocess.Popen(command, cwd=settings.BASE_DIR, env=env,
+                                   stdout=subprocess.DEVNULL, stderr=subprocess.PIPE)
+        try:
+            self.wait_ready(base_url, process, mode)
+            slow, local = self.run_load(base_url, options)
+        finally:
+            process.terminate()
+            process.wait(timeout=10)
+
+        label = 'ASGI (async ビュー)' if mode == 'asgi' else f'WSGI ({options["threads"]}スレッド)'
+        self.stdout.write(self.style.SUCCESS(f'--- {label} / 中央サーバーの遅延 {options["central_latency_ms"]:.0f}ms ---'))
+        self.stdout.write(f'  受付画面 (ローカル)   : {len(local)}件, p50 / p95 / p99 = '
+                          f'{percentile(local, 50) * 1000:.0f} / {percentile(local, 95) * 1000:.0f} / '
+                          f'{percentile(local, 99) * 1000:.0f} ms')
+        self.stdout.write(f'  炊き出し確認 (中央待ち): {len(slow)}件, p50 = {percentile(slow, 50) * 1000:.0f} ms')
+
+    @staticmethod
+    def wait_ready(base_url, process, mode):
+        deadline = time.monotonic() + 30
+        while time.monotonic() < deadline:
+            if process.poll() is not None:
+                raise CommandError(f'{mode} サーバーを起動できませんでした: {process.stderr.read().decode()[-500:]}')
+            try:
+                requests.get(base_url + '/login/', timeout=1)
+                return
+            except requests.exceptions.RequestException:
+                time.sleep(0.2)
+        raise CommandError(f'{mode} サーバーが起動しませんでした。')
+
+    @staticmethod
+    def login(base_url):
+        session = requests.Session()
+        session.get(base_url + '/login/', timeout=30)
+        session.post(base_url + '/login/', timeout=30, data={
+            'username': 'benchstaff', 'password': 'bench',
+            'csrfmiddlewaretoken': session.cookies.get('csrftoken', ''),
+        })
+        return session
+
+    def run_load(self, base_url, options):
+        slow_latencies, local_latencies = [], []
+        lock = threading.Lock()
+        sessions = [self.login(base_url) for _ in range(options['slow_clients'] + options['local_clients'])]
+        deadline = time.monotonic() + options['duration']
+
+        def client(session, path, latencies):
+            while time.monotonic() < deadline:
+                start = time.perf_counter()
+                try:
+                    session.get(base_url + path, timeout=60)
+                except requests.exceptions.RequestException:
+                    continue
+                with lock:
+                    latencies.append(time.perf_counter() - start)
+
+        threads = [threading.Thread(target=client, args=(session, '/food/', slow_latencies))
+                   for session in sessions[:options['slow_clients']]]
+        threads += [threading.Thread(target=client, args=(session, '/checkin/', local_latencies))
+                    for session in sessions[options['slow_clients']:]]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        return slow_latencies, local_latencies
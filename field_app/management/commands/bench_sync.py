@@ -0,0 +1,266 @@
+# field_app/management/commands/bench_sync.py
+import datetime
+import io
+import json
+import os
+import platform
+import socket
+import subprocess
+import sys
+import threading
+import time
+
+import requests
+from django.conf import settings
+from django.contrib.auth.hashers import make_password
+from django.core.management import call_command
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection
+
+import config
+from field_app.benchmarking import scratch_database
+from field_app.models import UnsyncedCheckin, UnsyncedFieldReport, UnsyncedUserRegistration
+from field_app.utils import forget_active_central_url
+
+# --models で指定する名前 -> モデル
+BENCH_MODELS = {
+    'checkins': UnsyncedCheckin,
+    'reports': UnsyncedFieldReport,
+    'registrations': UnsyncedUserRegistration,
+}
+
+
+def _int_list(value):
+    return [int(v) for v in value.split(',') if v]
+
+
+def _free_port():
+    with socket.socket() as s:
+        s.bind(('127.0.0.1', 0))
+        return s.getsockname()[1]
+
+
+class RssSampler:
+    """計測中のプロセスの常駐メモリ (RSS) の最大値を、一定間隔で読み取って記録する"""
+
+    def __init__(self, interval=0.05):
+        self.interval = interval
+        self.peak_kb = 0
+        self._stopped = threading.Event()
+        self._thread = threading.Thread(target=self._run, daemon=True)
+
+    @staticmethod
+    def current_kb():
+        try:
+            with open('/proc/self/status') as f:
+                for line in f:
+                    if line.startswith('VmRSS:'):
+                        return int(line.split()[1])
+        except OSError:
+            pass
+        import resource  # /proc が無い環境では、プロセス開始以降の最大値で代用する
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+    def _run(self):
+        while not self._stopped.is_set():
+            self.peak_kb = max(self.peak_kb, self.current_kb())
+            self._stopped.wait(self.interval)
+
+    def __enter__(self):
+        self._thread.start()
+        return self
+
+    def __exit__(self, *exc):
+        self._stopped.set()
+        self._thread.join()
+        self.peak_kb = max(self.peak_kb, self.current_kb())
+
+
+class Command(BaseCommand):
+    help = ('未同期レコードのバックログ (1k/10k/100k 件など) を用意し、RTT を変えたスタブ中央サーバーに対して '
+            'sync_data を実行して、送信件数/秒・最大RSS・SQL文の数・送信バイト数をJSONに記録します。')
+
+    def add_arguments(self, parser):
+        parser.add_argument('--sizes', type=_int_list, default=[1000, 10000, 100000],
+                            help='モデルごとのバックログ件数 (カンマ区切り)')
+        parser.add_argument('--rtts', type=_int_list, default=[0, 50, 200],
+                            help='スタブ中央サーバーの応答遅延 (ミリ秒、カンマ区切り)')
+        parser.add_argument('--models', default=','.join(BENCH_MODELS),
+                            help=f'バックログを用意するモデル ({", ".join(BENCH_MODELS)})')
+        parser.add_argument('--budget', type=float, default=300,
+                            help='1回の計測の見積もり時間がこの秒数を超える組み合わせは実行しない')
+        parser.add_argument('--coalesce', action='store_true',
+                            help='現場レポートの間引き (REPORT_COALESCE_THRESHOLD) を有効なまま計測する')
+        parser.add_argument('--output', help='結果のJSONの保存先 (省略時は bench_results/ 以下)')
+        parser.add_argument('--compare', help='比較対象とする過去の結果JSON')
+
+    def handle(self, *args, **options):
+        models = [name for name in options['models'].split(',') if name]
+        unknown = set(models) - set(BENCH_MODELS)
+        if unknown:
+            raise CommandError(f'不明なモデルです: {", ".join(sorted(unknown))}')
+
+        # 仮登録の同期ではローカルユーザー作成時にパスワードのハッシュ計算が走るため、見積もりに含める
+        hash_seconds = 0.0
+        if 'registrations' in models:
+            start = time.perf_counter()
+            make_password('bench')
+            hash_seconds = time.perf_counter() - start
+
+        runs = []
+        for size in options['sizes']:
+            for rtt in options['rtts']:
+                # 1件あたり RTT / 並列数、ただしローカルDBの更新 (1件ごとのコミット) で最低 10ms はかかる
+                estimate = (size * len(models) * max(rtt / config.SYNC_CONCURRENCY, 10) / 1000
+                            + (size * hash_seconds if 'registrations' in models else 0))
+                if estimate > options['budget']:
+                    self.stdout.write(f'size={size} rtt={rtt}ms: 見積もり {estimate:.0f}秒 > --budget のため省略')
+                    runs.append({'size': size, 'rtt_ms': rtt, 'skipped': True, 'estimated_seconds': round(estimate)})
+                    continue
+                result = self.run_one(size, rtt, models, options['coalesce'])
+                runs.append(result)
+                self.stdout.write(
+                    f'size={size} rtt={rtt}ms: {result["records_per_second"]:.1f} 件/秒, '
+                    f'RSS最大 {result["peak_rss_mb"]:.1f} MB, SQL {result["sql_statements"]} 文, '
+                    f'送信 {result["bytes_sent"] / 1024:.0f} KiB ({result["seconds"]:.1f}秒)')
+
+        report = {
+            'commit': self.git_commit(),
+            'created_at': datetime.datetime.now(datetime.timezone.utc).isoformat(),
+            'platform': {'python': platform.python_version(), 'machine': platform.machine(), 'system': platform.system()},
+            'config': {
+                'SYNC_CONCURRENCY': config.SYNC_CONCURRENCY,
+                'SYNC_REQUEST_TIMEOUT_SECONDS': config.SYNC_REQUEST_TIMEOUT_SECONDS,
+                'SYNC_RETRIES': config.SYNC_RETRIES,
+                'coalesce': options['coalesce'],
+                'models': models,
+            },
+            'runs': runs,
+        }
+        output = options['output'] or os.path.join(
+            settings.BASE_DIR, 'bench_results',
+            f'sync-{report["commit"] or "nogit"}-{datetime.datetime.now():%Y%m%d-%H%M%S}.json')
+        os.makedirs(os.path.dirname(os.path.abspath(output)), exist_ok=True)
+        with open(output, 'w', encoding='utf-8') as f:
+            json.dump(report, f, ensure_ascii=False, indent=2)
+        self.stdout.write(self.style.SUCCESS(f'結果を保存しました: {output}'))
+
+        if options['compare']:
+            self.compare(options['compare'], report)
+
+    # -----------------------------------------------------
+    # 1回分の計測
+    # -----------------------------------------------------
+    def run_one(self, size, rtt, models, coalesce):
+        with scratch_database(), self.stub_central(rtt) as central_url:
+            self.seed(size, models)
+            statements = 0
+
+            def count_statements(execute, sql, params, many, context):
+                nonlocal statements
+                statements += 1
+                return execute(sql, params, many, context)
+
+            original = config.CENTRAL_SERVER_URLS, config.REPORT_COALESCE_THRESHOLD
+            config.CENTRAL_SERVER_URLS = [central_url]
+            if not coalesce:
+                config.REPORT_COALESCE_THRESHOLD = float('inf')
+            forget_active_central_url()
+            try:
+                with connection.execute_wrapper(count_statements), RssSampler() as rss:
+                    started = time.perf_counter()
+                    call_command('sync_data', stdout=io.StringIO(), stderr=io.StringIO())
+                    seconds = time.perf_counter() - started
+            finally:
+                config.CENTRAL_SERVER_URLS, config.REPORT_COALESCE_THRESHOLD = original
+                forget_active_central_url()
+
+            per_model = {name: BENCH_MODELS[name].objects.filter(is_synced=True).count() for name in models}
+            stub_stats = requests.get(central_url + '/stats', timeout=5).json()
+
+        records = sum(per_model.values())
+        return {
+            'size': size,
+            'rtt_ms': rtt,
+            'seconds': round(seconds, 3),
+            'records': records,
+            'records_per_second': round(records / seconds, 1) if seconds else 0,
+            'synced': per_model,
+            'peak_rss_mb': round(rss.peak_kb / 1024, 1),
+            'sql_statements': statements,
+            'requests': stub_stats['requests'],
+            'bytes_sent': stub_stats['bytes_in'],
+            'bytes_received': stub_stats['bytes_out'],
+        }
+
+    def seed(self, size, models):
+        batch = 5000
+        if 'checkins' in models:
+            for start in range(0, size, batch):
+                UnsyncedCheckin.objects.bulk_create(
+                    UnsyncedCheckin(username=f'user{i:06d}', shelter_id=config.SHELTER_ID,
+                                    checkin_type='checkin' if i % 2 else 'checkout')
+                    for i in range(start, min(size, start + batch)))
+        if 'reports' in models:
+            for start in range(0, size, batch):
+                UnsyncedFieldReport.objects.bulk_create(
+                    UnsyncedFieldReport(shelter_id=config.SHELTER_ID, current_evacuees=i % 500,
+                                        medical_needs=i % 20, food_stock='safe')
+                    for i in range(start, min(size, start + batch)))
+        if 'registrations' in models:
+            password = make_password('bench')
+            for start in range(0, size, batch):
+                UnsyncedUserRegistration.objects.bulk_create(
+                    UnsyncedUserRegistration(full_name=f'仮登録 {i}', username=f'bench{i:06d}', password=password)
+                    for i in range(start, min(size, start + batch)))
+
+    class stub_central:
+        """スタブ中央サーバーを別プロセスで起動する (計測対象のRSS・CPUに含めないため)"""
+
+        def __init__(self, rtt):
+            self.rtt = rtt
+            self.port = _free_port()
+            self.url = f'http://127.0.0.1:{self.port}'
+
+        def __enter__(self):
+            command = [sys.executable, str(settings.BASE_DIR / 'manage.py'), 'stub_central',
+                       '--port', str(self.port), '--latency-ms', str(self.rtt), '--jitter-ms', '0', '--users', '0']
+            self.process = subprocess.Popen(command, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+            deadline = time.monotonic() + 30
+            while time.monotonic() < deadline:
+                try:
+                    requests.get(self.url + '/stats', timeout=1)
+                    return self.url
+                except requests.exceptions.RequestException:
+                    time.sleep(0.2)
+            self.process.kill()
+            raise CommandError('スタブ中央サーバーが起動しませんでした。')
+
+        def __exit__(self, *exc):
+            self.process.terminate()
+            self.process.wait(timeout=10)
+
+    # -----------------------------------------------------
+    # 補助
+    # -----------------------------------------------------
+    @staticmethod
+    def git_commit():
+        try:
+            return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], cwd=settings.BASE_DIR,
+                                  capture_output=True, text=True, timeout=10).stdout.strip() or None
+        except (OSError, subprocess.SubprocessError):
+            return None
+
+    def compare(self, path, report):
+        with open(path, encoding='utf-8') as f:
+            baseline = json.load(f)
+        previous = {(r['size'], r['rtt_ms']): r for r in baseline['runs'] if not r.get('skipped')}
+        self.stdout.write(f'--- {baseline.get("commit")} との比較 (件/秒) ---')
+        for run in report['runs']:
+            before = previous.get((run['size'], run['rtt_ms']))
+            if run.get('skipped') or not before:
+                continue
+            ratio = run['records_per_second'] / before['records_per_second'] if before['records_per_second'] else 0
+            self.stdout.write(f'size={run["size"]} rtt={run["rtt_ms"]}ms: '
+                              f'{before["records_per_second"]:.1f} -> {run["records_per_second"]:.1f} (x{ratio:.2f}), '
+                              f'SQL {before["sql_statements"]} -> {run["sql_statements"]}')
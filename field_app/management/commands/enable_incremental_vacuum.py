@@ -0,0 +1,17 @@
+# field_app/management/commands/enable_incremental_vacuum.py
+from django.core.management.base import BaseCommand
+
+from field_app import archive
+
+
+class Command(BaseCommand):
+    help = ('データベースの auto_vacuum を INCREMENTAL に切り替えます (保守作業として一度だけ実行)。'
+            '既存のデータベースではフル VACUUM を行うため、終わるまでデータベース全体がロックされ、'
+            'データベースと同じくらいの空きディスクが必要です。受付をしていない時間に実行してください。'
+            '切り替えた後は、アーカイブ処理のたびに incremental vacuum で空き領域を少しずつ解放します。')
+
+    def handle(self, *args, **options):
+        if archive.enable_incremental_vacuum():
+            self.stdout.write(self.style.SUCCESS('auto_vacuum を INCREMENTAL に切り替えました'))
+        else:
+            self.stdout.write('既に INCREMENTAL になっているため、何もしませんでした')
@@ -0,0 +1,26 @@
+# field_app/management/commands/export_bundle.py
+from django.core.management.base import BaseCommand, CommandError
+from django.utils import timezone
+
+import config
+from field_app import bundles
+
+
+class Command(BaseCommand):
+    help = '未同期データを署名付きの圧縮バンドルに書き出します（回線がない時にUSBメモリで持ち出す用）。'
+
+    def add_arguments(self, parser):
+        parser.add_argument('path', nargs='?',
+                            help='出力先のファイル (省略時は <DEVICE_ID>-<日時>.bundle)')
+
+    def handle(self, *args, **options):
+        path = options['path'] or f"{config.DEVICE_ID}-{timezone.localtime().strftime('%Y%m%d-%H%M%S')}.bundle"
+        try:
+            counts = bundles.export_bundle(path)
+        except bundles.BundleError as e:
+            raise CommandError(str(e))
+
+        self.stdout.write(self.style.SUCCESS(f'バンドルを書き出しました: {path}'))
+        self.stdout.write(f'  署名ファイル: {bundles.signature_path(path)} (一緒にコピーしてください)')
+        for kind, count in counts.items():
+            self.stdout.write(f'  {kind}: {count}件')
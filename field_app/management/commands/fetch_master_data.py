@@ -1,27 +1,53 @@
-import requests
-from django.core.management.base import BaseCommand
+import logging
+
+from django.core.management.base import BaseCommand, CommandError
 from django.utils import timezone
 
 from field_app.models import DistributionItem, User  # ラズパイ側のモデル
 import config
-from field_app.utils import get_active_central_url
+from field_app import metrics, user_index
+from field_app.utils import get_active_central_url, central_request
+
+logger = logging.getLogger('field_app.master')
 
 
 class Command(BaseCommand):
-    help = '中央サーバーからマスタデータ（ユーザー、配布品目）を取得してUUIDを含めて同期する'
+    help = ('中央サーバーからマスタデータ（ユーザー、配布品目）を取得してUUIDを含めて同期する'
+            '（取得できなかった種類があれば、残りを取得した後にエラーで終了する）')
+
+    def add_arguments(self, parser):
+        # 変更通知 (change_feed) を受けたときは、変わった種類だけを差分で取り直す
+        parser.add_argument('--only', action='append', choices=['items', 'users'],
+                            help='取得するマスタの種類 (省略時は両方)')
+        parser.add_argument('--since', help='この日時 (ISO 8601、中央サーバーの時刻) 以降に更新された分だけを取得する')
 
     def handle(self, *args, **options):
         self.stdout.write("--- データ同期を開始します ---")
+        only = options.get('only') or ['items', 'users']
+        since = options.get('since')
+
+        failed = []
 
         # 1. 配布物資マスタの同期
-        self.fetch_distribution_items()
+        if 'items' in only and not self.fetch_distribution_items(since):
+            failed.append('配布品目')
 
         # 2. ユーザー情報の同期
-        self.fetch_users()
+        if 'users' in only:
+            if not self.fetch_users(since):
+                failed.append('ユーザー')
+
+            # web サーバー側のログインIDインデックスに更新を知らせる
+            user_index.touch_stamp()
 
+        metrics.write_snapshot('fetch_master_data')
+        if failed:
+            # スケジューラや変更通知 (change_feed) が失敗として扱い、取り直せるようにする
+            raise CommandError(f'マスタデータの取得に失敗しました: {", ".join(failed)}')
         self.stdout.write("--- データ同期が完了しました ---")
 
-    def fetch_distribution_items(self):
+    def fetch_distribution_items(self, since=None):
+        """配布品目を取り込む。取得できなければ False を返す"""
         now = timezone.localtime(timezone.now()).strftime('%Y-%m-%d %H:%M:%S')
         self.stdout.write(f'[{now}] 配布品目を同期中...')
 
@@ -29,7 +55,7 @@ class Command(BaseCommand):
         url = get_active_central_url() + config.API_BASE_PATH + 'distribution-items/'
 
         try:
-            response = requests.get(url, timeout=10)
+            response = central_request('get', url, params={'since': since} if since else None, timeout=10)
             if response.status_code == 200:
                 items = response.json().get('items', [])
                 count = 0
@@ -47,20 +73,23 @@ class Command(BaseCommand):
                     count += 1
 
                 self.stdout.write(self.style.SUCCESS(f'品目マスタ更新完了: {count}件'))
-            else:
-                self.stdout.write(self.style.ERROR(f'品目取得失敗: {response.status_code}'))
+                return True
+            self.stdout.write(self.style.ERROR(f'品目取得失敗: {response.status_code}'))
 
         except Exception as e:
+            logger.warning('配布品目の取得に失敗しました: %s', e)
             self.stdout.write(self.style.ERROR(f'品目通信エラー: {e}'))
+        return False
 
-    def fetch_users(self):
+    def fetch_users(self, since=None):
+        """ユーザーを取り込む。取得できなければ False を返す"""
         now = timezone.localtime(timezone.now()).strftime('%Y-%m-%d %H:%M:%S')
         self.stdout.write(self.style.SUCCESS(f'[{now}]--- ユーザー情報の同期 ---'))
 
         url = get_active_central_url() + config.API_BASE_PATH + 'get-all-users/'
 
         try:
-            response = requests.get(url, timeout=15)
+            response = central_request('get', url, params={'since': since} if since else None, timeout=15)
             if response.status_code == 200:
                 users_data = response.json().get('users', [])
                 created_count = 0
@@ -75,8 +104,7 @@ class Command(BaseCommand):
                         if str(local_user.id) != u_data['id']:
                             # IDが違う場合（ローカルで手動作成したユーザー等）
                             # 古いユーザーを削除しないと、Unique制約で新しいIDのユーザーを作れない
-                            self.stdout.write(self.style.WARNING(
-                                f"  競合検出: {u_data['username']} のID不一致。ローカルを削除して再作成します。"))
+                            logger.warning('競合検出: %s のID不一致。ローカルを削除して再作成します。', u_data['username'])
                             local_user.delete()
 
                             # 削除したので新規作成へ
@@ -95,12 +123,14 @@ class Command(BaseCommand):
                 self.stdout.write(self.style.SUCCESS(
                     f'ユーザー同期完了: 新規 {created_count} / 更新 {updated_count}'
                 ))
+                return True
 
-            else:
-                self.stdout.write(self.style.ERROR(f'ユーザー取得失敗: HTTP {response.status_code}'))
+            self.stdout.write(self.style.ERROR(f'ユーザー取得失敗: HTTP {response.status_code}'))
 
         except Exception as e:
+            logger.warning('ユーザー情報の取得に失敗しました: %s', e)
             self.stdout.write(self.style.ERROR(f'ユーザー通信エラー: {e}'))
+        return False
 
     # --- ヘルパーメソッド ---
     def create_user_from_data(self, data):
@@ -116,6 +146,7 @@ class Command(BaseCommand):
             is_superuser=(data['role'] == 'admin')
         )
         u.password = data['password']  # ハッシュ済みパスワードを直接セット
+        u.central_password_hash = data['password']
         u.save()
 
     def update_user_from_data(self, user, data):
@@ -123,7 +154,11 @@ class Command(BaseCommand):
         user.full_name = data['full_name']
         user.email = data['email']
         user.role = data['role']
-        user.password = data['password']  # パスワード変更も反映
+        # パスワード変更も反映する。ただし中央サーバーのハッシュが前回と同じなら、ログイン時に
+        # この端末向けに作り直したハッシュ (field_app/hashers.py) を古いものに戻さない
+        if data['password'] != user.central_password_hash:
+            user.password = data['password']
+            user.central_password_hash = data['password']
         user.is_active = True
         user.is_staff = (data['role'] == 'admin')
         user.is_superuser = (data['role'] == 'admin')
@@ -0,0 +1,30 @@
+# field_app/management/commands/import_bundle.py
+from django.core.management import call_command
+from django.core.management.base import BaseCommand, CommandError
+
+from field_app import bundles
+
+
+class Command(BaseCommand):
+    help = '別のラズパイで書き出したバンドルを取り込み、未同期データとして登録します。'
+
+    def add_arguments(self, parser):
+        parser.add_argument('path', help='取り込むバンドルファイル (.sig も同じ場所に置くこと)')
+        parser.add_argument('--sync', action='store_true', help='取り込み後、そのまま sync_data を実行する')
+
+    def handle(self, *args, **options):
+        try:
+            result = bundles.import_bundle(options['path'])
+        except bundles.BundleError as e:
+            raise CommandError(str(e))
+
+        self.stdout.write(self.style.SUCCESS(f"バンドルを取り込みました: {options['path']}"))
+        for kind, counts in result.items():
+            self.stdout.write(f"  {kind}: 新規 {counts['imported']}件 / 登録済み {counts['skipped']}件"
+                              f" / 競合 {counts['conflicts']}件")
+        if result['registration']['conflicts']:
+            self.stdout.write(self.style.WARNING(
+                '希望ログインIDが既に使われている仮登録は取り込んでいません (ログを確認してください)'))
+
+        if options['sync']:
+            call_command('sync_data')
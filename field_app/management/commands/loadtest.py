@@ -0,0 +1,147 @@
+# field_app/management/commands/loadtest.py
+import io
+import random
+import threading
+import time
+
+from django.core.management import call_command
+from django.core.management.base import BaseCommand, CommandError
+from django.test import Client
+
+import config
+from field_app.benchmarking import percentile, scratch_database
+from field_app.models import DistributionItem, User
+from field_app.stub_central import PROFILES, CentralState, Conditions, StubCentralServer
+from field_app.utils import forget_active_central_url
+
+SCENARIOS = ('checkin', 'food', 'chat')
+
+
+def parse_mix(value):
+    """'checkin=6,food=3,chat=1' 形式のシナリオの比率を読み取る"""
+    weights = {}
+    for part in value.split(','):
+        name, _, weight = part.partition('=')
+        if name not in SCENARIOS:
+            raise CommandError(f'不明なシナリオです: {name} (使えるもの: {", ".join(SCENARIOS)})')
+        weights[name] = float(weight or 1)
+    return weights
+
+
+class Command(BaseCommand):
+    help = ('多数のタブレットからの操作 (受付・炊き出し・チャット) を模擬し、'
+            'スタブ中央サーバーに対する応答時間 (p50/p95/p99) と処理件数/秒を計測します。')
+
+    def add_arguments(self, parser):
+        parser.add_argument('--tablets', type=int, default=8, help='同時に操作するタブレット数 (スレッド数)')
+        parser.add_argument('--duration', type=float, default=20, help='計測時間 (秒)')
+        parser.add_argument('--mix', type=parse_mix, default=parse_mix('checkin=6,food=3,chat=1'),
+                            help='シナリオの比率 (例: checkin=6,food=3,chat=1)')
+        parser.add_argument('--profile', choices=sorted(PROFILES), default='lan', help='スタブの回線状況のプリセット')
+        parser.add_argument('--latency-ms', type=float)
+        parser.add_argument('--jitter-ms', type=float)
+        parser.add_argument('--bandwidth-kbps', type=float)
+        parser.add_argument('--loss-rate', type=float)
+        parser.add_argument('--error-rate', type=float)
+        parser.add_argument('--users', type=int, default=1000, help='スタブが返す避難者の数')
+        parser.add_argument('--central', help='起動済みの中央サーバー (またはスタブ) のURL。省略時はスタブを内部で起動')
+
+    def handle(self, *args, **options):
+        server = None
+        if options['central']:
+            central_url = options['central'].rstrip('/')
+        else:
+            settings = dict(PROFILES[options['profile']])
+            for name in settings:
+                if options[name] is not None:
+                    settings[name] = options[name]
+            # パケットロスはビュー側のタイムアウト (最短3秒) より少し長く待たせて再現する
+            server = StubCentralServer(conditions=Conditions(loss_hold_seconds=6, **settings),
+                                       state=CentralState(user_count=options['users'])).start_background()
+            central_url = server.url
+            self.stdout.write(f'スタブ中央サーバー: {central_url} '
+                              f'({", ".join(f"{k}={v}" for k, v in settings.items())})')
+
+        original = config.CENTRAL_SERVER_URLS, config.SCHEDULER_ENABLED
+        try:
+            config.CENTRAL_SERVER_URLS = [central_url]
+            config.SCHEDULER_ENABLED = False
+            forget_active_central_url()
+            with scratch_database():
+                call_command('fetch_master_data', stdout=io.StringIO())
+                usernames = list(User.objects.values_list('username', flat=True))
+                item_ids = [str(pk) for pk in DistributionItem.objects.values_list('pk', flat=True)]
+                if not usernames or not item_ids:
+                    raise CommandError('中央サーバーからマスタデータを取得できませんでした。')
+                User.objects.create_user(username='loadstaff', password='x', role='rescuer')
+                results = self.run(options, usernames, item_ids)
+            self.report(results, options['duration'])
+        finally:
+            config.CENTRAL_SERVER_URLS, config.SCHEDULER_ENABLED = original
+            forget_active_central_url()
+            if server is not None:
+                self.stdout.write(f'スタブの受信状況: {server.state.stats()}')
+                server.stop()
+
+    def run(self, options, usernames, item_ids):
+        results = {name: {'latencies': [], 'errors': 0} for name in options['mix']}
+        lock = threading.Lock()
+        names, weights = zip(*options['mix'].items())
+        deadline = time.monotonic() + options['duration']
+        staff = User.objects.get(username='loadstaff')
+
+        def checkin(client, rng):
+            return client.post('/checkin/', {'username': rng.choice(usernames),
+                                             'checkin_type': rng.choice(('checkin', 'checkout'))})
+
+        def food(client, rng):
+            return client.post('/food/', {'username': rng.choice(usernames), 'item_id': rng.choice(item_ids)})
+
+        def chat(client, rng):
+            if rng.random() < 0.3:
+                return client.post('/chat/', {'group_id': '1', 'message': 'loadtest'})
+            return client.get('/chat/', {'group_id': '1'})
+
+        scenarios = {'checkin': checkin, 'food': food, 'chat': chat}
+
+        def tablet(no):
+            rng = random.Random(no)
+            client = Client()
+            client.force_login(staff)
+            while time.monotonic() < deadline:
+                name = rng.choices(names, weights)[0]
+                start = time.perf_counter()
+                try:
+                    ok = scenarios[name](client, rng).status_code < 400
+                except Exception:
+                    ok = False
+                elapsed = time.perf_counter() - start
+                with lock:
+                    results[name]['latencies'].append(elapsed)
+                    if not ok:
+                        results[name]['errors'] += 1
+
+        threads = [threading.Thread(target=tablet, args=(n,)) for n in range(options['tablets'])]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        return results
+
+    def report(self, results, duration):
+        self.stdout.write(self.style.SUCCESS(f'--- 結果 ({duration:.0f}秒) ---'))
+        self.stdout.write(f'{"scenario":<10}{"count":>8}{"errors":>8}{"req/s":>9}{"p50(ms)":>10}{"p95(ms)":>10}{"p99(ms)":>10}')
+        all_latencies = []
+        total_errors = 0
+        for name, result in results.items():
+            latencies = result['latencies']
+            all_latencies += latencies
+            total_errors += result['errors']
+            self.stdout.write(self.format_row(name, latencies, result['errors'], duration))
+        self.stdout.write(self.format_row('total', all_latencies, total_errors, duration))
+
+    @staticmethod
+    def format_row(name, latencies, errors, duration):
+        return (f'{name:<10}{len(latencies):>8}{errors:>8}{len(latencies) / duration:>9.1f}'
+                f'{percentile(latencies, 50) * 1000:>10.1f}{percentile(latencies, 95) * 1000:>10.1f}'
+                f'{percentile(latencies, 99) * 1000:>10.1f}')
@@ -0,0 +1,28 @@
+# field_app/management/commands/peer_sync.py
+import time
+
+from django.core.management.base import BaseCommand
+
+import config
+from field_app import peer_sync
+
+
+class Command(BaseCommand):
+    help = '同じ避難所の他のラズパイ (config.PEER_URLS) からチェックイン記録を取得します。'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--loop', action='store_true',
+                            help=f'終了せず、PEER_SYNC_INTERVAL_SECONDS ({config.PEER_SYNC_INTERVAL_SECONDS}秒) ごとに繰り返す')
+
+    def handle(self, *args, **options):
+        if not config.PEER_URLS:
+            self.stdout.write('config.PEER_URLS にピアが登録されていません。')
+            return
+
+        while True:
+            for peer_url, imported in peer_sync.sync_all_peers().items():
+                if imported or not options['loop']:
+                    self.stdout.write(f'{peer_url}: {imported}件を取り込みました')
+            if not options['loop']:
+                break
+            time.sleep(config.PEER_SYNC_INTERVAL_SECONDS)
@@ -0,0 +1,20 @@
+# field_app/management/commands/prewarm_distribution.py
+import requests
+from django.core.management.base import BaseCommand, CommandError
+
+from field_app import distribution_cache
+
+
+class Command(BaseCommand):
+    help = '入所中の避難者全員の炊き出しの受け取り可否を、中央サーバーにまとめて問い合わせておきます。'
+
+    def add_arguments(self, parser):
+        # 省略時はマスタデータの全物資 (スケジューラは配布の予定時刻の前に自動で実行する)
+        parser.add_argument('--item', action='append', dest='item_ids', help='対象の配布物資ID (複数指定可)')
+
+    def handle(self, *args, **options):
+        try:
+            stored = distribution_cache.prewarm(item_ids=options['item_ids'])
+        except requests.exceptions.RequestException as e:
+            raise CommandError(f'中央サーバーに問い合わせできませんでした: {e}')
+        self.stdout.write(self.style.SUCCESS(f'{stored}件の受け取り可否を保存しました。'))
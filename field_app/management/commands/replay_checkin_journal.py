@@ -0,0 +1,12 @@
+# field_app/management/commands/replay_checkin_journal.py
+from django.core.management.base import BaseCommand
+
+from field_app import checkin_journal
+
+
+class Command(BaseCommand):
+    help = '異常終了時に残ったチェックインジャーナルを再生し、SQLiteへ反映します（起動前に実行）。'
+
+    def handle(self, *args, **options):
+        replayed = checkin_journal.recover()
+        self.stdout.write(self.style.SUCCESS(f'ジャーナルから {replayed} 件のチェックイン記録を再生しました。'))
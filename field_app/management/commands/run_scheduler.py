@@ -0,0 +1,23 @@
+# field_app/management/commands/run_scheduler.py
+import time
+
+from django.core.management.base import BaseCommand
+
+from field_app import tasks
+
+
+class Command(BaseCommand):
+    help = '同期・マスタデータ取得・疎通確認の定期実行を、web サーバーとは別のプロセスで動かします。'
+
+    def handle(self, *args, **options):
+        scheduler = tasks.start()
+        if scheduler is None:
+            self.stderr.write('スケジューラは無効化されているか、別のプロセスで既に動作しています。')
+            return
+
+        self.stdout.write(self.style.SUCCESS('スケジューラを起動しました。Ctrl+C で終了します。'))
+        try:
+            while True:
+                time.sleep(1)
+        except KeyboardInterrupt:
+            scheduler.stop()
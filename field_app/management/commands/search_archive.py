@@ -0,0 +1,31 @@
+# field_app/management/commands/search_archive.py
+import datetime
+import json
+
+from django.core.management.base import BaseCommand
+
+from field_app import archive
+
+
+class Command(BaseCommand):
+    help = 'アーカイブ済みのチェックイン記録・現場レポートを検索し、JSONLで出力します（監査用）。'
+
+    def add_arguments(self, parser):
+        parser.add_argument('kind', choices=sorted(archive.ARCHIVED_MODELS), help='検索対象')
+        parser.add_argument('--from', dest='date_from', type=datetime.date.fromisoformat, help='開始日 (YYYY-MM-DD)')
+        parser.add_argument('--to', dest='date_to', type=datetime.date.fromisoformat, help='終了日 (YYYY-MM-DD)')
+        parser.add_argument('--username', help='避難者のログインID (checkins のみ)')
+        parser.add_argument('--shelter-id', help='避難所ID')
+
+    def handle(self, *args, **options):
+        filters = {}
+        if options['username']:
+            filters['username'] = options['username']
+        if options['shelter_id']:
+            filters['shelter_id'] = options['shelter_id']
+
+        count = 0
+        for row in archive.search(options['kind'], options['date_from'], options['date_to'], **filters):
+            self.stdout.write(json.dumps(row, ensure_ascii=False))
+            count += 1
+        self.stderr.write(f'{count}件見つかりました')
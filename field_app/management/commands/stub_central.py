@@ -0,0 +1,45 @@
+# field_app/management/commands/stub_central.py
+from django.core.management.base import BaseCommand
+
+from field_app.stub_central import PROFILES, CentralState, Conditions, StubCentralServer
+
+
+class Command(BaseCommand):
+    help = '中央サーバーAPIのスタブを起動します (遅延・帯域・パケットロス・エラー率を設定可能)。'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--host', default='127.0.0.1')
+        parser.add_argument('--port', type=int, default=8100)
+        parser.add_argument('--profile', choices=sorted(PROFILES), help='回線状況のプリセット (個別の指定で上書き可)')
+        parser.add_argument('--latency-ms', type=float, help='応答までの遅延 (ミリ秒)')
+        parser.add_argument('--jitter-ms', type=float, help='遅延に加えるランダムな揺らぎの最大値 (ミリ秒)')
+        parser.add_argument('--bandwidth-kbps', type=float, help='全接続で共有する帯域 (kbps、0 で無制限)')
+        parser.add_argument('--loss-rate', type=float, help='応答を返さずに接続を切る割合 (0〜1)')
+        parser.add_argument('--error-rate', type=float, help='503 を返す割合 (0〜1)')
+        parser.add_argument('--loss-hold-seconds', type=float, default=30.0,
+                            help='パケットロス時に接続を切るまで待つ秒数')
+        parser.add_argument('--users', type=int, default=100, help='get-all-users で返すユーザー数')
+
+    def handle(self, *args, **options):
+        settings = dict(PROFILES['lan'])
+        if options['profile']:
+            settings.update(PROFILES[options['profile']])
+        for name in settings:
+            if options[name] is not None:
+                settings[name] = options[name]
+
+        server = StubCentralServer(
+            (options['host'], options['port']),
+            conditions=Conditions(loss_hold_seconds=options['loss_hold_seconds'], **settings),
+            state=CentralState(user_count=options['users']),
+        )
+        conditions = ', '.join(f'{name}={value}' for name, value in settings.items())
+        self.stdout.write(self.style.SUCCESS(f'スタブ中央サーバーを起動しました: {server.url} ({conditions})'))
+        self.stdout.write(f'config.CENTRAL_SERVER_URLS に "{server.url}" を設定してください。受信状況は {server.url}/stats')
+        try:
+            server.serve_forever()
+        except KeyboardInterrupt:
+            pass
+        finally:
+            server.server_close()
+            self.stdout.write(str(server.state.stats()))
@@ -1,13 +1,31 @@
 # field_app/management/commands/sync_data.py
 
+import logging
+import time
+
 import requests
 from django.core.management.base import BaseCommand
-from django.db.models import Q
 from django.utils import timezone
 
 import config  # ラズパイ側のプロジェクトルートにある config.py
-from field_app.models import UnsyncedCheckin, UnsyncedFieldReport, UnsyncedUserRegistration, User
-from field_app.utils import get_active_central_url
+from field_app.models import UnsyncedCheckin, UnsyncedDistribution, User
+from field_app import metrics, sync_lanes, sync_progress
+from field_app.hashers import ensure_hashed
+from field_app.report_coalescing import coalesce_field_reports
+from field_app.utils import get_active_central_url, central_request, is_sync_accepted, iter_backlog, upload_records
+
+# レコード単位のログは stdout ではなくロガーへ (本番では DEBUG を出さず、SDカードへの書き込みを抑える)
+logger = logging.getLogger('field_app.sync')
+
+
+def _error_message(response, default='不明なサーバーエラー'):
+    """エラー応答から表示用のメッセージを取り出す"""
+    # JSONとして解析できるか試す
+    try:
+        return response.json().get('message', default)
+    except (ValueError, AttributeError):
+        # JSONじゃなかった場合（500エラーでHTMLが返ってきた時など）
+        return f"サーバーエラー (Raw): {response.text[:100]}..."  # 最初の100文字だけ表示
 
 
 class Command(BaseCommand):
@@ -16,20 +34,42 @@ class Command(BaseCommand):
     def handle(self, *args, **kwargs):
         now = timezone.localtime(timezone.now()).strftime('%Y-%m-%d %H:%M:%S')
         self.stdout.write(self.style.SUCCESS(f'[{now}] ===== データ同期処理を開始します ====='))
+        started = time.monotonic()
+        # 進み具合をホーム画面の進捗バーに伝える (sync_progress.py)
+        self.progress = sync_progress.SyncProgress()
 
         # ネットワーク接続があるか、まず最初に軽くチェック
         if not self.check_network_connection():
             self.stderr.write(self.style.ERROR(f'[{now}] ネットワークに接続できません。同期処理を中断します。'))
+            self.progress.finish(sync_progress.ABORTED)
             return
 
-        # 1. 未同期の「新規ユーザー仮登録」を同期
-        self.sync_user_registrations()
+        # 送信の優先度 (sync_lanes.LANES) の高い順に送る。低いレーンを送っている間に
+        # 急ぎのレーンの記録が増えたら、そちらを先に送る (send_urgent)
+        self.synced_counts = synced_counts = dict.fromkeys(['registrations', 'checkins', 'reports', 'distributions'], 0)
+        try:
+            # 1. 食料が尽きそうな「現場状況報告」を同期 (critical)
+            synced_counts['reports'] += self.sync_critical_reports()
+
+            # 2. 未同期の「新規ユーザー仮登録」を同期 (registrations)
+            synced_counts['registrations'] += self.sync_user_registrations()
 
-        # 2. 未同期の「避難所チェックイン記録」を同期
-        self.sync_checkins()
+            # 3. 未同期の「避難所チェックイン記録」を同期 (checkins)
+            synced_counts['checkins'] += self.sync_checkins()
 
-        # 3. 未同期の「現場状況報告」を同期
-        self.sync_field_reports()
+            # 4. 残りの「現場状況報告」を同期 (bulk)
+            synced_counts['reports'] += self.sync_field_reports()
+
+            # 5. 事前確認で配布した「受け取り記録」をまとめて同期 (bulk)
+            synced_counts['distributions'] += self.sync_distributions()
+        except BaseException:
+            self.progress.finish(sync_progress.ABORTED)
+            raise
+        self.progress.finish()
+
+        # 所要時間と送信件数を /metrics 用に記録
+        metrics.record_sync_run(time.monotonic() - started, synced_counts)
+        metrics.write_snapshot('sync_data')
 
         end_time = timezone.localtime(timezone.now()).strftime('%H:%M:%S')
         self.stdout.write(self.style.SUCCESS(f'[{end_time}] ===== 全ての同期処理が完了しました =====\n'))
@@ -38,154 +78,293 @@ class Command(BaseCommand):
         """中央サーバーのルートにアクセスできるか簡単な疎通確認を行う"""
         try:
             # SSL証明書の検証設定を config.py から読み込む
-            requests.get(get_active_central_url(), timeout=5, verify=config.VERIFY_SSL)
+            central_request('get', get_active_central_url(), endpoint='health', timeout=5, verify=config.VERIFY_SSL)
             return True
         except requests.exceptions.RequestException:
             return False
 
+    def send_urgent(self, lanes):
+        """低いレーンを送っている間に増えた、急ぎのレーンの記録を先に送る (sync_lanes.yield_to_urgent)"""
+        for lane in lanes:
+            self.stdout.write(f'優先度の高い記録 ({lane}) が増えたため、先に送ります')
+            if lane == sync_lanes.CRITICAL:
+                self.synced_counts['reports'] += self.sync_critical_reports()
+            elif lane == sync_lanes.REGISTRATIONS:
+                self.synced_counts['registrations'] += self.sync_user_registrations()
+
+    def backlog(self, queryset, time_field, lane, chunk_size=None):
+        """未同期の行を古い順に返す (急ぎのレーンの記録が増えたら、途中でそちらを先に送る)"""
+        return sync_lanes.yield_to_urgent(iter_backlog(queryset, time_field, chunk_size=chunk_size), lane,
+                                          self.send_urgent)
+
     def sync_checkins(self):
         """未同期のチェックイン記録を同期する"""
-        self.stdout.write("\n--- [2/3] 避難所チェックイン記録の同期を開始 ---")
+        self.stdout.write("\n--- [3/5] 避難所チェックイン記録の同期を開始 ---")
         unsynced_records = UnsyncedCheckin.objects.filter(is_synced=False)
+        total = unsynced_records.count()
 
-        if not unsynced_records:
+        if not total:
             self.stdout.write(self.style.SUCCESS('同期対象のチェックイン記録はありませんでした。'))
-            return
+            return 0
 
-        self.stdout.write(f'{len(unsynced_records)}件の未同期チェックインを同期します...')
+        self.stdout.write(f'{total}件の未同期チェックインを同期します...')
+        self.progress.begin('checkins', 'チェックイン記録', total)
         api_url = get_active_central_url() + config.API_BASE_PATH + 'shelter-checkin-sync/'
+        synced = 0
 
-        for record in unsynced_records:
-            now_str = timezone.localtime(timezone.now()).strftime('%H:%M:%S')
-
-            payload = {
+        def build_payload(record):
+            return {
+                "id": str(record.id),  # 冪等キー (再送・並列送信しても中央で1件として扱われる)
                 "username": record.username,
-                "shelter_management_id": config.SHELTER_ID,  # configから管理IDを取得
+                "shelter_management_id": record.shelter_id,  # 記録時の避難所ID (取り込んだ記録は元の避難所)
                 "checkin_type": record.checkin_type,
                 "timestamp": record.timestamp.isoformat(),  # ISO 8601形式の文字列に変換
-                "device_id": config.DEVICE_ID
+                "device_id": record.device_id
             }
-            try:
-                response = requests.post(api_url, json=payload, timeout=10, verify=config.VERIFY_SSL)
-                if response.status_code in [200, 201]:  # 成功 (201 Created も考慮)
-                    record.is_synced = True
-                    record.last_sync_error = None
-                    record.save()
-                    self.stdout.write(self.style.SUCCESS(f'[{now_str}]   -> ID {record.id} ({record.username}): 同期成功'))
-                else:  # APIがエラーを返した場合
-                    error_msg = response.json().get('message', '不明なサーバーエラー')
-                    record.last_sync_error = f"HTTP {response.status_code}: {error_msg}"
-                    record.sync_attempts += 1
-                    record.save()
-                    self.stdout.write(self.style.ERROR(f'[{now_str}]   -> ID {record.id} ({record.username}): 同期失敗 - {error_msg}'))
-
-            except requests.exceptions.RequestException as e:  # ネットワーク接続エラー
-                record.last_sync_error = f"ネットワークエラー: {e}"
+
+        # 送信は並列に行い、結果の反映 (DBの更新) はこのスレッドで行う
+        records = self.backlog(unsynced_records, 'timestamp', sync_lanes.CHECKINS)
+        for record, response, error in upload_records(api_url, records, build_payload, sync_lanes.CHECKINS):
+            if error is not None:  # 再送しても繋がらなかった
+                record.last_sync_error = f"ネットワークエラー: {error}"
                 record.sync_attempts += 1
                 record.save()
-                self.stdout.write(self.style.ERROR(f'[{now_str}]   -> ID {record.id} ({record.username}): ネットワーク接続エラー'))
+                self.progress.record('checkins', ok=False)
+                logger.warning('チェックイン同期時のネットワーク接続エラー: %s', error, extra={'record_id': record.id})
                 self.stderr.write('中央サーバーへの接続が失われました。このタスクを中断します。')
                 break  # ネットワークが切れたら、このループは中断
+            if response is None:
+                continue  # 中断により送信しなかった分
+            if is_sync_accepted(response):  # 成功 (既に反映済みだった場合も含む)
+                record.is_synced = True
+                record.last_sync_error = None
+                record.save()
+                synced += 1
+                self.progress.record('checkins')
+                logger.debug('checkin synced', extra={'record_id': record.id, 'username': record.username})
+            else:  # APIがエラーを返した場合
+                error_msg = _error_message(response)
+                record.last_sync_error = f"HTTP {response.status_code}: {error_msg}"
+                record.sync_attempts += 1
+                record.save()
+                self.progress.record('checkins', ok=False)
+                logger.warning('チェックイン同期失敗: %s', error_msg, extra={'record_id': record.id, 'username': record.username})
+
+        self.progress.end('checkins')
+        self.stdout.write(f'チェックイン記録: {synced}件 同期成功')
+        return synced
+
+    def sync_critical_reports(self):
+        """食料が「本日分で尽きる」の現場状況報告を、他の記録より先に同期する"""
+        self.stdout.write("\n--- [1/5] 緊急の現場状況報告の同期を開始 ---")
+        return self.upload_field_reports(sync_lanes.critical_reports(), sync_lanes.CRITICAL,
+                                         'critical_reports', '緊急の現場レポート')
 
     def sync_field_reports(self):
-        """未同期の現場状況報告を同期する"""
-        self.stdout.write("\n--- [3/3] 現場状況報告の同期を開始 ---")
-        unsynced_records = UnsyncedFieldReport.objects.filter(is_synced=False)
+        """残りの未同期の現場状況報告を同期する"""
+        self.stdout.write("\n--- [4/5] 現場状況報告の同期を開始 ---")
 
-        if not unsynced_records:
-            self.stdout.write(self.style.SUCCESS('同期対象の現場レポートはありませんでした。'))
-            return
+        # 通信断の間にたまった古いスナップショットは、時間帯ごとの代表だけを送る
+        superseded, kept = coalesce_field_reports()
+        if superseded:
+            self.stdout.write(f'古いレポート {superseded}件を間引きました ({kept}件の代表にまとめました)')
 
-        self.stdout.write(f'{len(unsynced_records)}件の未同期レポートを同期します...')
+        return self.upload_field_reports(sync_lanes.bulk_reports(), sync_lanes.BULK, 'reports', '現場レポート')
+
+    def upload_field_reports(self, unsynced_records, lane, stream, label):
+        total = unsynced_records.count()
+
+        if not total:
+            self.stdout.write(self.style.SUCCESS(f'同期対象の{label}はありませんでした。'))
+            return 0
+
+        self.stdout.write(f'{total}件の未同期レポートを同期します...')
+        self.progress.begin(stream, label, total)
         api_url = get_active_central_url() + config.API_BASE_PATH + 'field-report/'
+        synced = 0
 
-        for record in unsynced_records:
+        def build_payload(record):
             payload = {
-                "shelter_management_id": config.SHELTER_ID,
+                "id": str(record.id),  # 冪等キー
+                "shelter_management_id": record.shelter_id,
                 "current_evacuees": record.current_evacuees,
                 "medical_needs": record.medical_needs,
                 "food_stock": record.food_stock,
                 "timestamp": record.timestamp.isoformat(),
-                "device_id": config.DEVICE_ID
+                "device_id": record.device_id
             }
+            if record.coalesced_count > 1:
+                # 間引いた時間帯の代表。まとめた件数と、その間の最小・最大値を添える
+                payload["coalesced_count"] = record.coalesced_count
+                if record.min_evacuees is not None:
+                    payload["evacuees_range"] = [record.min_evacuees, record.max_evacuees]
+                    payload["medical_needs_range"] = [record.min_medical_needs, record.max_medical_needs]
+            return payload
+
+        records = self.backlog(unsynced_records, 'timestamp', lane)
+        for record, response, error in upload_records(api_url, records, build_payload, lane):
+            if error is not None:
+                self.progress.record(stream, ok=False)
+                logger.warning('現場レポート同期時のネットワーク接続エラー: %s', error, extra={'record_id': record.id})
+                self.stderr.write('中央サーバーへの接続が失われました。このタスクを中断します。')
+                break
+            if response is None:
+                continue
+            if is_sync_accepted(response):
+                record.is_synced = True
+                record.save()
+                synced += 1
+                self.progress.record(stream)
+                logger.debug('field report synced', extra={'record_id': record.id})
+            else:
+                self.progress.record(stream, ok=False)
+                logger.warning('現場レポート同期失敗: HTTP %s %s', response.status_code, response.text[:200], extra={'record_id': record.id})
+
+        self.progress.end(stream)
+        self.stdout.write(f'{label}: {synced}件 同期成功')
+        return synced
+
+    def sync_distributions(self):
+        """
+        事前確認 (distribution_cache) で配布した受け取りを、DISTRIBUTION_RECORD_BATCH_SIZE 件ずつ
+        1回の送信にまとめて記録する (各記録のUUIDで、再送しても中央では1件として扱われる)
+        """
+        self.stdout.write("\n--- [5/5] 炊き出しの受け取り記録の同期を開始 ---")
+        unsynced_records = UnsyncedDistribution.objects.filter(is_synced=False)
+        total = unsynced_records.count()
+
+        if not total:
+            self.stdout.write(self.style.SUCCESS('同期対象の受け取り記録はありませんでした。'))
+            return 0
+
+        self.stdout.write(f'{total}件の未同期の受け取り記録を同期します...')
+        self.progress.begin('distributions', '受け取り記録', total)
+        api_url = get_active_central_url() + config.API_BASE_PATH + 'record-distributions/'
+        batch_size = config.DISTRIBUTION_RECORD_BATCH_SIZE
+        synced = 0
+
+        def send(batch):
+            payload = {'records': [{
+                "id": str(record.id),  # 冪等キー
+                "username": record.username,
+                "item_id": record.item_id,
+                "timestamp": record.timestamp.isoformat(),
+                "device_id": record.device_id,
+            } for record in batch]}
+            sync_lanes.throttle(sync_lanes.BULK, sync_lanes.payload_size(payload))
             try:
-                response = requests.post(api_url, json=payload, timeout=10, verify=config.VERIFY_SSL)
-                if response.status_code in [200, 201]:
-                    record.is_synced = True
-                    record.save()
-                    self.stdout.write(self.style.SUCCESS(f'  -> ID {record.id}: 同期成功'))
-                else:
-                    self.stdout.write(self.style.ERROR(f'  -> ID {record.id}: 同期失敗 - {response.text}'))
-
+                response = central_request('post', api_url, endpoint='record-distributions', json=payload,
+                                           timeout=config.SYNC_REQUEST_TIMEOUT_SECONDS * 2)
             except requests.exceptions.RequestException as e:
-                self.stdout.write(self.style.ERROR(f'  -> ID {record.id}: ネットワーク接続エラー'))
+                logger.warning('受け取り記録の同期時のネットワーク接続エラー: %s', e)
                 self.stderr.write('中央サーバーへの接続が失われました。このタスクを中断します。')
-                break
+                for _ in batch:
+                    self.progress.record('distributions', ok=False)
+                return None
+            ids = [record.id for record in batch]
+            if is_sync_accepted(response):
+                UnsyncedDistribution.objects.filter(pk__in=ids).update(is_synced=True, last_sync_error=None)
+                for _ in batch:
+                    self.progress.record('distributions')
+                return len(batch)
+            error_msg = _error_message(response)
+            UnsyncedDistribution.objects.filter(pk__in=ids).update(
+                last_sync_error=f"HTTP {response.status_code}: {error_msg}")
+            for _ in batch:
+                self.progress.record('distributions', ok=False)
+            logger.warning('受け取り記録の同期失敗 (HTTP %s): %s', response.status_code, error_msg)
+            return 0
+
+        batch = []
+        for record in self.backlog(unsynced_records, 'timestamp', sync_lanes.BULK, chunk_size=batch_size):
+            batch.append(record)
+            if len(batch) >= batch_size:
+                sent = send(batch)
+                if sent is None:
+                    break
+                synced += sent
+                batch = []
+        else:
+            if batch:
+                synced += send(batch) or 0
+
+        self.progress.end('distributions')
+        self.stdout.write(f'受け取り記録: {synced}件 同期成功')
+        return synced
 
     def sync_user_registrations(self):
 
-        self.stdout.write("\n--- [1/3] 新規ユーザー仮登録の同期を開始 ---")
-        unsynced_users = UnsyncedUserRegistration.objects.filter(
-            Q(sync_error__isnull=True) | Q(sync_error=''),
-            is_synced=False
-        )
+        self.stdout.write("\n--- [2/5] 新規ユーザー仮登録の同期を開始 ---")
+        unsynced_users = sync_lanes.pending_registrations()
 
-        if not unsynced_users:
+        total = unsynced_users.count()
+
+        if not total:
             self.stdout.write(self.style.SUCCESS('同期対象の仮登録ユーザーはいませんでした。'))
-            return
+            return 0
+
+        self.progress.begin('registrations', '仮登録ユーザー', total)
 
         api_url = get_active_central_url() + config.API_BASE_PATH + 'register-field-user/'
+        synced = 0
 
-        for user_reg in unsynced_users:
-            payload = {
+        def build_payload(user_reg):
+            # 以前のフォームで生のまま保存された行も、ハッシュにしてから送る
+            user_reg.password = ensure_hashed(user_reg.password)
+            return {
+                "id": str(user_reg.id),  # 冪等キー
                 "full_name": user_reg.full_name,
                 "username": user_reg.username,
                 "password": user_reg.password,  # ハッシュ済みのパスワードを送る
             }
-            try:
-                response = requests.post(api_url, json=payload, timeout=10, verify=config.VERIFY_SSL)
-
-                # ★ 変更点: JSONデコードを try の中ではなく、ステータスコード確認後に行う
-                if response.status_code == 201:  # 成功
-                    user_reg.is_synced = True
-                    user_reg.sync_error = None  # エラーをクリア
-                    user_reg.save()
-
-                    if not User.objects.filter(username=user_reg.username).exists():
-                        User.objects.create_user(
-                            username=user_reg.username,
-                            password=user_reg.password,  # 生のパスワードを渡すとハッシュ化して保存される
-                            full_name=user_reg.full_name,
-                            role='general'  # デフォルトは一般ユーザーとして作成
-                        )
-                        self.stdout.write(self.style.SUCCESS(f'     (ラズパイ内にもユーザーを作成しました)'))
-
-                    self.stdout.write(self.style.SUCCESS(f'  -> ユーザー {user_reg.username}: 本登録成功'))
-
-                else:  # API側でロジックエラー (400, 409, 500など)
-                    # JSONとして解析できるか試す
-                    try:
-                        error_json = response.json()
-                        error_msg = error_json.get('message', '不明なエラー')
-                    except ValueError:
-                        # JSONじゃなかった場合（500エラーでHTMLが返ってきた時など）
-                        error_msg = f"サーバーエラー (Raw): {response.text[:100]}..."  # 最初の100文字だけ表示
-
-                    # データベースにエラーを保存
-                    user_reg.sync_error = f"HTTP {response.status_code}: {error_msg}"
-                    user_reg.save()
-
-                    # ★ ターミナルに見やすく出力
-                    self.stdout.write(
-                        self.style.ERROR(f'  -> ユーザー {user_reg.username}: 失敗 (HTTP {response.status_code})'))
-                    self.stdout.write(self.style.WARNING(f'     理由: {error_msg}'))
 
-            except requests.exceptions.RequestException as e:
+        records = self.backlog(unsynced_users, 'created_at', sync_lanes.REGISTRATIONS)
+        for user_reg, response, error in upload_records(api_url, records, build_payload, sync_lanes.REGISTRATIONS):
+            if error is not None:
                 # 通信自体の失敗（タイムアウト、DNSエラーなど）
-                user_reg.sync_error = f"ネットワーク接続エラー: {str(e)}"
+                user_reg.sync_error = f"ネットワーク接続エラー: {str(error)}"
                 user_reg.save()
+                self.progress.record('registrations', ok=False)
 
-                self.stdout.write(self.style.ERROR(f'  -> ユーザー {user_reg.username}: ネットワーク接続エラー'))
-                self.stderr.write(f'詳細: {str(e)}')
+                logger.warning('仮登録ユーザー同期時のネットワーク接続エラー: %s', error, extra={'username': user_reg.username})
                 self.stderr.write('中央サーバーへの接続が失われました。このタスクを中断します。')
                 break
+            if response is None:
+                continue
+
+            # ★ 変更点: JSONデコードを try の中ではなく、ステータスコード確認後に行う
+            # (同じ冪等キーで既に本登録済みだった場合も成功として扱う)
+            if is_sync_accepted(response):
+                user_reg.is_synced = True
+                user_reg.sync_error = None  # エラーをクリア
+                user_reg.save()
+                synced += 1
+                self.progress.record('registrations')
+
+                if not User.objects.filter(username=user_reg.username).exists():
+                    # 中央サーバーに送ったハッシュをそのまま使う (create_user に渡すとハッシュを更にハッシュ化してしまう)
+                    User.objects.create(
+                        username=user_reg.username,
+                        password=user_reg.password,
+                        central_password_hash=user_reg.password,
+                        full_name=user_reg.full_name,
+                        role='general'  # デフォルトは一般ユーザーとして作成
+                    )
+                    logger.debug('local user created', extra={'username': user_reg.username})
+
+                logger.debug('registration synced', extra={'username': user_reg.username})
+
+            else:  # API側でロジックエラー (400, 409, 500など)
+                error_msg = _error_message(response, default='不明なエラー')
+
+                # データベースにエラーを保存
+                user_reg.sync_error = f"HTTP {response.status_code}: {error_msg}"
+                user_reg.save()
+                self.progress.record('registrations', ok=False)
+
+                logger.warning('仮登録ユーザーの本登録失敗 (HTTP %s): %s', response.status_code, error_msg,
+                               extra={'username': user_reg.username})
+
+        self.progress.end('registrations')
+        self.stdout.write(f'仮登録ユーザー: {synced}件 本登録成功')
+        return synced
@@ -0,0 +1,213 @@
+# field_app/media_cache.py
+"""
+チャットの画像を中央サーバーから取得してディスクにキャッシュする (views.chat_media_view)。
+
+チャットの履歴には中央サーバー上の画像のURLが入っているため、そのままでは各タブレットが
+避難所の細い回線で原寸の画像を毎回取得してしまう。そこでラズパイが代わりに1回だけ取得し、
+- 原寸の画像と、履歴の一覧用のサムネイル (Pillow が入っている場合のみ作る) をディスクに置く
+- 合計が CHAT_MEDIA_CACHE_MAX_BYTES を超えたら、最近使われていないものから消す (LRU)
+- 同じ画像への同時の要求は、中央サーバーへの1回の取得にまとめる
+- 取得は送信の bulk レーン (sync_lanes) の帯域の上限の範囲で行う
+タブレットには一覧ではサムネイルを、タップされたときだけ原寸の画像を返す。
+
+取得は central_stream_async で行う (async ビュー用)。CHAT_MEDIA_MAX_IMAGE_BYTES を超える画像は、
+Content-Length を見て本文を受信する前に断り、無ければ超えた時点で受信をやめる。
+同時の要求をまとめるのはイベントループ単位なので、全ての要求が1つのループで動く ASGI で動かしたときに最も効く。
+"""
+import asyncio
+import hashlib
+import os
+import time
+import weakref
+from urllib.parse import urlsplit
+
+import requests
+from asgiref.sync import sync_to_async
+
+import config
+from . import sync_lanes
+from .utils import central_stream_async, get_active_central_url_async
+
+try:
+    from PIL import Image, ImageOps
+except ImportError:  # Pillow が無ければサムネイルを作らず、一覧でも原寸の画像を返す
+    Image = None
+
+# キャッシュする画像の種類と、保存するときの拡張子 (SVG などブラウザでスクリプトが動くものは扱わない)
+CONTENT_TYPES = {'image/jpeg': '.jpg', 'image/png': '.png', 'image/gif': '.gif', 'image/webp': '.webp'}
+EXTENSIONS = {ext: content_type for content_type, ext in CONTENT_TYPES.items()}
+
+FULL, THUMB = 'full', 'thumb'
+
+# 最終使用時刻 (ファイルの更新時刻) を更新する最短の間隔。ヒットのたびにSDカードへ書かないため
+TOUCH_INTERVAL_SECONDS = 3600
+
+# イベントループ -> {キー: 取得中の Task}
+_inflight = weakref.WeakKeyDictionary()
+
+
+class MediaUnavailable(Exception):
+    """画像を返せない (status はビューが返すHTTPステータス)"""
+
+    def __init__(self, message, status):
+        super().__init__(message)
+        self.status = status
+
+
+def source_path(src):
+    """
+    チャットの image_url (パスのみ、または中央サーバーの絶対URL) から、中央サーバー上のパスを取り出す。
+    中央サーバー以外のURLや、CHAT_MEDIA_PATH_PREFIXES 以外のパスは None (任意のURLの中継はしない)。
+    """
+    parts = urlsplit(src or '')
+    if parts.scheme or parts.netloc:
+        central_hosts = {urlsplit(url).netloc for url in config.CENTRAL_SERVER_URLS}
+        if parts.scheme not in ('http', 'https') or parts.netloc not in central_hosts:
+            return None
+    path = parts.path
+    if '..' in path.split('/') or not any(path.startswith(prefix) for prefix in config.CHAT_MEDIA_PATH_PREFIXES):
+        return None
+    return path + (f'?{parts.query}' if parts.query else '')
+
+
+def cache_key(path):
+    return hashlib.sha256(path.encode('utf-8')).hexdigest()[:32]
+
+
+def lookup(key, variant):
+    """キャッシュにある画像の (ファイルのパス, Content-Type) を返す。無ければ None"""
+    if variant == THUMB:
+        path = os.path.join(config.CHAT_MEDIA_CACHE_DIR, f'{key}.thumb.jpg')
+        if os.path.exists(path):
+            return path, 'image/jpeg'
+        # サムネイルを作れなかった画像 (Pillow が無い・読めない形式) は原寸で返す
+    for ext, content_type in EXTENSIONS.items():
+        path = os.path.join(config.CHAT_MEDIA_CACHE_DIR, f'{key}.full{ext}')
+        if os.path.exists(path):
+            return path, content_type
+    return None
+
+
+async def fetch(path, variant=FULL):
+    """
+    中央サーバー上の path の画像を、キャッシュから (無ければ取得して) 返す。
+    (ファイルのパス, Content-Type) を返し、返せない場合は MediaUnavailable を送出する。
+    """
+    key = cache_key(path)
+    found = lookup(key, variant)
+    if found is None:
+        loop = asyncio.get_running_loop()
+        inflight = _inflight.setdefault(loop, {})
+        task = inflight.get(key)
+        if task is None:
+            task = inflight[key] = loop.create_task(_fill(path, key))
+            task.add_done_callback(lambda _: inflight.pop(key, None))
+        # 待っている1人が切断しても、同じ画像を待つ他の要求のために取得は続ける
+        await asyncio.shield(task)
+        found = lookup(key, variant)
+        if found is None:
+            raise MediaUnavailable('キャッシュに保存できませんでした', 502)
+    else:
+        _touch(found[0])
+    return found
+
+
+async def _fill(path, key):
+    url = (await get_active_central_url_async()).rstrip('/') + path
+    # 画像の取得は bulk レーン。大きさは取得するまで分からないので、前の取得の分を返し終わるまで待ち、
+    # 取得した後で受信した分を引く
+    await sync_lanes.throttle_async(sync_lanes.BULK, 0)
+    received = 0
+    try:
+        async with central_stream_async('get', url, endpoint='chat-media',
+                                        timeout=config.CHAT_MEDIA_FETCH_TIMEOUT_SECONDS) as response:
+            if response.status_code != 200:
+                raise MediaUnavailable(f'HTTP {response.status_code}', 404 if response.status_code == 404 else 502)
+            content_type = response.headers.get('Content-Type', '').split(';')[0].strip().lower()
+            ext = CONTENT_TYPES.get(content_type)
+            if ext is None:
+                raise MediaUnavailable(f'画像ではありません ({content_type})', 415)
+            # 大きすぎる画像は本文を受信する前に断り、Content-Length が無ければ上限を超えた時点で受信をやめる
+            length = response.headers.get('Content-Length', '')
+            if length.isdigit() and int(length) > config.CHAT_MEDIA_MAX_IMAGE_BYTES:
+                raise MediaUnavailable('画像が大きすぎます', 413)
+            chunks = []
+            async for chunk in response.aiter_bytes():
+                received += len(chunk)
+                if received > config.CHAT_MEDIA_MAX_IMAGE_BYTES:
+                    raise MediaUnavailable('画像が大きすぎます', 413)
+                chunks.append(chunk)
+    except requests.exceptions.RequestException as e:
+        raise MediaUnavailable(f'中央サーバーから画像を取得できませんでした: {e}', 502) from e
+    finally:
+        sync_lanes.charge(sync_lanes.BULK, received)
+    await sync_to_async(_store, thread_sensitive=False)(key, ext, b''.join(chunks))
+
+
+def _store(key, ext, content):
+    """原寸の画像とサムネイルを書き込み、上限を超えた分を古いものから消す (スレッドで実行)"""
+    os.makedirs(config.CHAT_MEDIA_CACHE_DIR, exist_ok=True)
+    full_path = os.path.join(config.CHAT_MEDIA_CACHE_DIR, f'{key}.full{ext}')
+    _write_atomic(full_path, content)
+    if Image is not None:
+        try:
+            _make_thumbnail(full_path, os.path.join(config.CHAT_MEDIA_CACHE_DIR, f'{key}.thumb.jpg'))
+        except (OSError, ValueError, Image.DecompressionBombError):
+            pass  # 読めない画像は原寸で返す
+    evict()
+
+
+def _make_thumbnail(source, destination):
+    with Image.open(source) as image:
+        image = ImageOps.exif_transpose(image)  # スマートフォンの写真の向きを反映
+        image.thumbnail((config.CHAT_MEDIA_THUMBNAIL_SIZE, config.CHAT_MEDIA_THUMBNAIL_SIZE))
+        if image.mode != 'RGB':
+            # 透過部分は白にする (チャットの画像は白背景で表示している)
+            background = Image.new('RGB', image.size, 'white')
+            rgba = image.convert('RGBA')
+            background.paste(rgba, mask=rgba.getchannel('A'))
+            image = background
+        tmp_path = f'{destination}.{os.getpid()}.tmp'
+        image.save(tmp_path, 'JPEG', quality=80, optimize=True)
+    os.replace(tmp_path, destination)
+
+
+def _write_atomic(path, content):
+    tmp_path = f'{path}.{os.getpid()}.tmp'
+    with open(tmp_path, 'wb') as f:
+        f.write(content)
+    os.replace(tmp_path, path)
+
+
+def _touch(path):
+    """LRU のために最終使用時刻を更新する (TOUCH_INTERVAL_SECONDS より古い場合のみ)"""
+    try:
+        if time.time() - os.stat(path).st_mtime > TOUCH_INTERVAL_SECONDS:
+            os.utime(path)
+    except OSError:
+        pass
+
+
+def evict(max_bytes=None):
+    """キャッシュの合計が上限を超えていたら、最終使用時刻の古いファイルから上限の9割まで消す"""
+    max_bytes = config.CHAT_MEDIA_CACHE_MAX_BYTES if max_bytes is None else max_bytes
+    try:
+        entries = [entry for entry in os.scandir(config.CHAT_MEDIA_CACHE_DIR)
+                   if entry.is_file() and not entry.name.endswith('.tmp')]
+    except OSError:
+        return 0
+    stats = [(entry.path, entry.stat()) for entry in entries]
+    total = sum(stat.st_size for _, stat in stats)
+    if total <= max_bytes:
+        return 0
+    removed = 0
+    for path, stat in sorted(stats, key=lambda item: item[1].st_mtime):
+        if total <= max_bytes * 0.9:
+            break
+        try:
+            os.remove(path)
+        except OSError:
+            continue
+        total -= stat.st_size
+        removed += 1
+    return removed
@@ -0,0 +1,322 @@
+# field_app/metrics.py
+"""
+Prometheus のテキスト形式 (text exposition format) で出力するための、
+プロセス内の軽量なメトリクス集計モジュール。
+
+スクレイプのたびに COUNT クエリを発行しないよう、値は全て処理の途中で
+加算されるカウンタ・ゲージ・ヒストグラムとしてメモリ上に保持する。
+別プロセスで動く管理コマンド (sync_data など) は、終了時に自分の値を
+スナップショットとして METRICS_SNAPSHOT_DIR に書き出し、
+/metrics の出力時に process ラベル付きで合流させる。
+"""
+import json
+import os
+import threading
+import time
+
+import config
+
+_lock = threading.Lock()
+_registry = {}
+
+# 中央サーバーAPI・ビューのレイテンシ用のバケット (秒)
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+
+
+def _escape(value):
+    return str(value).replace('\\', '\\\\').replace('\n', '\\n').replace('"', '\\"')
+
+
+def _format_labels(labels):
+    if not labels:
+        return ''
+    body = ','.join(f'{k}="{_escape(v)}"' for k, v in labels.items())
+    return '{' + body + '}'
+
+
+def _format_value(value):
+    if value == float('inf'):
+        return '+Inf'
+    if float(value).is_integer():
+        return str(int(value))
+    return repr(float(value))
+
+
+class _Metric:
+    kind = 'untyped'
+
+    def __init__(self, name, documentation, labelnames=()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self._values = {}
+        _registry[name] = self
+
+    def _key(self, labels):
+        return tuple(str(labels.get(n, '')) for n in self.labelnames)
+
+    def _labels(self, key):
+        return dict(zip(self.labelnames, key))
+
+    def reset(self):
+        with _lock:
+            self._values.clear()
+
+    def samples(self):
+        """(サフィックス, ラベル辞書, 値) のリストを返す"""
+        with _lock:
+            return [('', self._labels(k), v) for k, v in self._values.items()]
+
+
+class Counter(_Metric):
+    kind = 'counter'
+
+    def inc(self, amount=1, **labels):
+        key = self._key(labels)
+        with _lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+
+class Gauge(_Metric):
+    kind = 'gauge'
+
+    def set(self, value, **labels):
+        with _lock:
+            self._values[self._key(labels)] = value
+
+    def inc(self, amount=1, **labels):
+        key = self._key(labels)
+        with _lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def get(self, **labels):
+        with _lock:
+            return self._values.get(self._key(labels))
+
+
+class Histogram(_Metric):
+    kind = 'histogram'
+
+    def __init__(self, name, documentation, labelnames=(), buckets=LATENCY_BUCKETS):
+        super().__init__(name, documentation, labelnames)
+        self.buckets = tuple(buckets) + (float('inf'),)
+
+    def observe(self, value, **labels):
+        key = self._key(labels)
+        with _lock:
+            entry = self._values.get(key)
+            if entry is None:
+                entry = self._values[key] = [[0] * len(self.buckets), 0.0, 0]
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    entry[0][i] += 1
+            entry[1] += value
+            entry[2] += 1
+
+    def samples(self):
+        result = []
+        with _lock:
+            items = [(k, list(v[0]), v[1], v[2]) for k, v in self._values.items()]
+        for key, counts, total, count in items:
+            labels = self._labels(key)
+            for bound, c in zip(self.buckets, counts):
+                result.append(('_bucket', {**labels, 'le': _format_value(bound)}, c))
+            result.append(('_sum', labels, total))
+            result.append(('_count', labels, count))
+        return result
+
+
+# =========================================================
+# メトリクス定義
+# =========================================================
+backlog_depth = Gauge(
+    'field_backlog_depth', '未同期レコード数 (モデル別)', ['model'])
+backlog_oldest_age = Gauge(
+    'field_backlog_oldest_age_seconds', '最も古い未同期レコードの経過秒数 (モデル別)', ['model'])
+
+sync_run_duration = Gauge(
+    'field_sync_last_run_duration_seconds', '直近の同期処理の所要時間 (秒)')
+sync_run_timestamp = Gauge(
+    'field_sync_last_run_timestamp_seconds', '直近の同期処理の終了時刻 (UNIX時刻)')
+sync_records = Counter(
+    'field_sync_records_total', '中央サーバーへの送信に成功したレコード数', ['stream'])
+sync_records_per_second = Gauge(
+    'field_sync_last_run_records_per_second', '直近の同期処理のスループット (件/秒)', ['stream'])
+
+central_latency = Histogram(
+    'field_central_api_latency_seconds', '中央サーバーAPIの応答時間 (秒)', ['endpoint'])
+central_errors = Counter(
+    'field_central_api_errors_total', '中央サーバーAPIのエラー数 (HTTPステータス・例外別)', ['endpoint', 'status'])
+central_circuit_state = Gauge(
+    'field_central_circuit_state', '中央サーバーごとのサーキットブレーカーの状態 (0=接続中, 1=確認中, 2=遮断中)', ['target'])
+
+change_feed_connected = Gauge(
+    'field_change_feed_connected', '中央サーバーからの変更通知を受信中か (1=受信中, 0=途切れて定期取得で補っている)')
+change_feed_events = Counter(
+    'field_change_feed_events_total', '受け取った変更通知の数 (種類別)', ['topic'])
+
+sync_lane_bytes = Counter(
+    'field_sync_lane_bytes_total', '中央サーバーとの送受信量 (バイト、送信のレーン別)', ['lane'])
+sync_lane_wait = Counter(
+    'field_sync_lane_wait_seconds_total', '帯域の上限のために送信を待たせた秒数 (レーン別)', ['lane'])
+
+view_latency = Histogram(
+    'field_view_latency_seconds', 'ビューごとのリクエスト処理時間 (秒)', ['view', 'method'])
+
+
+# =========================================================
+# 記録用ヘルパー
+# =========================================================
+def record_central_call(endpoint, seconds, status):
+    """中央サーバーAPI呼び出し1回分を記録する。status はHTTPステータスか例外クラス名"""
+    central_latency.observe(seconds, endpoint=endpoint)
+    if not isinstance(status, int) or status >= 400:
+        central_errors.inc(endpoint=endpoint, status=status)
+
+
+def record_lane_traffic(lane, nbytes, waited):
+    """送信のレーン (sync_lanes) ごとの送受信量と、帯域の上限で待たせた秒数を記録する"""
+    sync_lane_bytes.inc(nbytes, lane=lane)
+    if waited:
+        sync_lane_wait.inc(waited, lane=lane)
+
+
+def record_sync_run(duration, synced_counts):
+    """同期処理1回分の所要時間と、ストリーム別の送信件数を記録する"""
+    sync_run_duration.set(duration)
+    sync_run_timestamp.set(time.time())
+    for stream, count in synced_counts.items():
+        sync_records.inc(count, stream=stream)
+        sync_records_per_second.set(count / duration if duration > 0 else 0, stream=stream)
+
+
+# =========================================================
+# 未同期件数 (バックログ) の追跡
+# =========================================================
+_backlog_state = {}  # model名 -> {'depth': int, 'oldest': datetime | None}
+_backlog_refreshed_at = 0.0
+
+
+def _backlog_querysets():
+    from .models import UnsyncedCheckin, UnsyncedDistribution, UnsyncedFieldReport, UnsyncedUserRegistration
+    return {
+        'UnsyncedCheckin': (UnsyncedCheckin.objects.filter(is_synced=False), 'timestamp'),
+        'UnsyncedDistribution': (UnsyncedDistribution.objects.filter(is_synced=False), 'timestamp'),
+        'UnsyncedFieldReport': (UnsyncedFieldReport.objects.filter(is_synced=False), 'timestamp'),
+        'UnsyncedUserRegistration': (UnsyncedUserRegistration.objects.filter(is_synced=False), 'created_at'),
+    }
+
+
+def refresh_backlog():
+    """DBから未同期件数と最古レコードの日時を取り直す (TTLごと、または同期直後のみ)"""
+    global _backlog_refreshed_at
+    from django.db.models import Count, Min
+
+    state = {}
+    for model_name, (queryset, time_field) in _backlog_querysets().items():
+        agg = queryset.aggregate(depth=Count('pk'), oldest=Min(time_field))
+        state[model_name] = agg
+    with _lock:
+        _backlog_state.clear()
+        _backlog_state.update(state)
+        _backlog_refreshed_at = time.monotonic()
+
+
+def note_unsynced_created(model_name, created_at):
+    """未同期レコードが1件作られたことを反映する (post_save シグナルから呼ばれる)"""
+    with _lock:
+        entry = _backlog_state.get(model_name)
+        if entry is None:
+            return  # まだ一度も集計していなければ、次回の refresh に任せる
+        entry['depth'] += 1
+        if entry['oldest'] is None:
+            entry['oldest'] = created_at
+
+
+def backlog_total():
+    """全モデルの未同期件数の合計 (直近の集計値 + それ以降の追加分)"""
+    with _lock:
+        return sum(entry['depth'] for entry in _backlog_state.values())
+
+
+def _update_backlog_gauges():
+    if time.monotonic() - _backlog_refreshed_at > config.METRICS_BACKLOG_REFRESH_SECONDS:
+        refresh_backlog()
+
+    from django.utils import timezone
+    now = timezone.now()
+    with _lock:
+        state = {k: dict(v) for k, v in _backlog_state.items()}
+    for model_name, entry in state.items():
+        backlog_depth.set(entry['depth'], model=model_name)
+        oldest = entry['oldest']
+        backlog_oldest_age.set((now - oldest).total_seconds() if oldest else 0, model=model_name)
+
+
+# =========================================================
+# 別プロセスとの受け渡し・出力
+# =========================================================
+def snapshot():
+    """現在の全メトリクスをJSONで保存できる形に変換する"""
+    return {
+        name: {'kind': m.kind, 'help': m.documentation, 'samples': m.samples()}
+        for name, m in _registry.items()
+    }
+
+
+def write_snapshot(process_name):
+    """
+    管理コマンドなど短命なプロセスの値を、/metrics から読めるようにファイルへ書き出す。
+    書き出したプロセスの pid も残し、同じプロセス (スケジューラから call_command で動かした場合) の
+    /metrics では読み込まない (自分の値を二重に数えないため)。
+    """
+    os.makedirs(config.METRICS_SNAPSHOT_DIR, exist_ok=True)
+    path = os.path.join(config.METRICS_SNAPSHOT_DIR, f'{process_name}.json')
+    tmp_path = f'{path}.{os.getpid()}.tmp'
+    with open(tmp_path, 'w', encoding='utf-8') as f:
+        json.dump({'pid': os.getpid(), 'families': snapshot()}, f, ensure_ascii=False)
+    os.replace(tmp_path, path)  # 書き込み途中のファイルを読まれないように置き換える
+
+
+def _read_snapshots():
+    try:
+        names = sorted(os.listdir(config.METRICS_SNAPSHOT_DIR))
+    except FileNotFoundError:
+        return {}
+    result = {}
+    for filename in names:
+        if not filename.endswith('.json'):
+            continue
+        try:
+            with open(os.path.join(config.METRICS_SNAPSHOT_DIR, filename), encoding='utf-8') as f:
+                snap = json.load(f)
+        except (OSError, ValueError):
+            continue
+        if snap.get('pid') == os.getpid():
+            continue  # このプロセス自身の値 (レジストリから直接出力する)
+        result[filename[:-len('.json')]] = snap.get('families', {})
+    return result
+
+
+def render():
+    """全メトリクスを Prometheus のテキスト形式で返す"""
+    _update_backlog_gauges()
+
+    families = {}
+    for name, family in snapshot().items():
+        families[name] = dict(family, samples=list(family['samples']))
+    for process_name, snap in _read_snapshots().items():
+        for name, family in snap.items():
+            target = families.setdefault(name, {'kind': family['kind'], 'help': family['help'], 'samples': []})
+            for suffix, labels, value in family['samples']:
+                target['samples'].append((suffix, {'process': process_name, **labels}, value))
+
+    lines = []
+    for name, family in families.items():
+        if not family['samples']:
+            continue
+        lines.append(f'# HELP {name} {_escape(family["help"])}')
+        lines.append(f'# TYPE {name} {family["kind"]}')
+        for suffix, labels, value in family['samples']:
+            lines.append(f'{name}{suffix}{_format_labels(labels)} {_format_value(value)}')
+    return '\n'.join(lines) + '\n'
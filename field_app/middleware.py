@@ -0,0 +1,76 @@
+# field_app/middleware.py
+import time
+
+from asgiref.sync import iscoroutinefunction, markcoroutinefunction
+
+from . import metrics, profiling
+
+
+class ViewMetricsMiddleware:
+    """ビューごとのリクエスト処理時間を metrics に記録するミドルウェア"""
+    # async ビュー (炊き出し確認・チャット) を asgi.py で動かす際に、
+    # 同期処理への切り替えを挟まないよう、同期・非同期の両方に対応する
+    sync_capable = True
+    async_capable = True
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+        if iscoroutinefunction(self.get_response):
+            markcoroutinefunction(self)
+
+    def __call__(self, request):
+        if iscoroutinefunction(self):
+            return self.__acall__(request)
+        start = time.monotonic()
+        response = self.get_response(request)
+        self._observe(request, start)
+        return response
+
+    async def __acall__(self, request):
+        start = time.monotonic()
+        response = await self.get_response(request)
+        self._observe(request, start)
+        return response
+
+    @staticmethod
+    def _observe(request, start):
+        match = request.resolver_match
+        view_name = match.view_name if match else 'unresolved'
+        metrics.view_latency.observe(time.monotonic() - start, view=view_name, method=request.method)
+
+
+class ProfilingMiddleware:
+    """
+    管理者が ?_profile=1 または X-Field-Profile ヘッダを付けたリクエストを計測するミドルウェア
+    (計測の中身は profiling.py を参照)。request.user を見るため AuthenticationMiddleware の後に置く。
+    """
+    sync_capable = True
+    async_capable = True
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+        if iscoroutinefunction(self.get_response):
+            markcoroutinefunction(self)
+
+    def __call__(self, request):
+        if iscoroutinefunction(self):
+            return self.__acall__(request)
+        if not profiling.requested(request) or not request.user.is_staff:
+            return self.get_response(request)
+        report, token, start = profiling.start(request)
+        response = self.get_response(request)
+        profiling.finish(report, token, start, response)
+        return response
+
+    async def __acall__(self, request):
+        if not profiling.requested(request) or not await _is_staff(request):
+            return await self.get_response(request)
+        report, token, start = profiling.start(request)
+        response = await self.get_response(request)
+        profiling.finish(report, token, start, response)
+        return response
+
+
+async def _is_staff(request):
+    user = await request.auser()
+    return user.is_staff
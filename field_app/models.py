@@ -4,6 +4,9 @@ import uuid
 from django.contrib.auth.models import AbstractUser, Group, Permission
 from django.core.validators import RegexValidator
 from django.db import models
+from django.utils import timezone
+
+import config
 
 
 # =========================================================
@@ -16,6 +19,11 @@ class UUIDModel(models.Model):
         abstract = True
 
 
+def current_device_id():
+    """記録を作成したデバイスのID (config.DEVICE_ID) を返す。モデルの default 用"""
+    return config.DEVICE_ID
+
+
 # =========================================================
 # 2. Userモデル (ID上書き & バリデーション)
 # =========================================================
@@ -44,6 +52,8 @@ class User(AbstractUser):
     )
     full_name = models.CharField(verbose_name='氏名', max_length=150, blank=True)
     email = models.EmailField(verbose_name='メールアドレス', blank=True, unique=False)  # ラズパイ側はUnique制約緩めてもOKだが、合わせても良い
+    # 中央サーバーから最後に取り込んだパスワードのハッシュ (password はログイン時に作り直されるため別に持つ)
+    central_password_hash = models.CharField(max_length=128, blank=True, editable=False)
 
     # related_name の衝突回避
     groups = models.ManyToManyField(
@@ -98,9 +108,20 @@ class UnsyncedCheckin(UUIDModel):
 
     # 4. いつ (When)
     # この記録が作成された日時
+    # (auto_now_add だと bulk_create 時に上書きされるため、ジャーナルの再生などで
+    #  スキャン時点の日時を保てるよう default で設定する)
     timestamp = models.DateTimeField(
         verbose_name="記録日時",
-        auto_now_add=True  # レコード作成時に自動で現在日時が設定される
+        default=timezone.now,  # レコード作成時に自動で現在日時が設定される
+        editable=False
+    )
+
+    # どのデバイスで記録されたか
+    # (USBメモリ経由で別のラズパイから取り込んだ記録も、元のデバイスIDのまま送信するため)
+    device_id = models.CharField(
+        verbose_name="記録デバイスID",
+        max_length=100,
+        default=current_device_id
     )
 
     # 5. 同期状態 (Status)
@@ -133,6 +154,27 @@ class UnsyncedCheckin(UUIDModel):
         verbose_name = "未同期チェックイン記録"
         verbose_name_plural = "未同期チェックイン記録"
         ordering = ['-timestamp']  # 新しい記録から順に表示
+        # 管理画面の絞り込み (同期状態 × 日時) と、日時順の一覧を大きなテーブルでも索引で引けるように
+        # 未同期の行だけの索引は、同期処理が (日時, id) の順に辿るのにも使う (utils.iter_backlog)。
+        # (SQLite では is_synced=False の条件が NOT "is_synced" になり、(is_synced, ...) の索引の先頭列としては使われない)
+        indexes = [
+            models.Index(fields=['timestamp', 'id'], condition=models.Q(is_synced=False), name='checkin_backlog_idx'),
+            models.Index(fields=['timestamp'], name='checkin_ts_idx'),
+        ]
+
+
+class CheckinStatus(models.Model):
+    """
+    ログインIDごとの最後の入退所 (checkin_status.record で更新する)。
+    同期済みのチェックイン記録はアーカイブへ移して削除するため、入所中かどうかはこちらで判断する。
+    """
+    username = models.CharField(verbose_name="避難者のログインID", max_length=150, unique=True)
+    shelter_id = models.CharField(verbose_name="避難所ID")
+    checkin_type = models.CharField(verbose_name="種別", max_length=10, choices=UnsyncedCheckin.CHECKIN_TYPE_CHOICES)
+    timestamp = models.DateTimeField(verbose_name="記録日時")
+
+    def __str__(self):
+        return f"{self.username}: {self.get_checkin_type_display()} ({self.shelter_id})"
 
 
 class UnsyncedFieldReport(UUIDModel):
@@ -154,21 +196,42 @@ class UnsyncedFieldReport(UUIDModel):
     food_stock = models.CharField(verbose_name="食料の残量", max_length=10, choices=FOOD_STOCK_CHOICES)
 
     # 3. いつ (When)
-    timestamp = models.DateTimeField(verbose_name="報告日時", auto_now_add=True)
+    timestamp = models.DateTimeField(verbose_name="報告日時", default=timezone.now, editable=False)
 
     # 4. 誰が (Who) - 任意
     # reported_by = models.ForeignKey(settings.AUTH_USER_MODEL, on_delete=models.SET_NULL, null=True, blank=True)
 
+    # どのデバイスで記録されたか
+    device_id = models.CharField(verbose_name="記録デバイスID", max_length=100, default=current_device_id)
+
     # 5. 同期状態 (Status)
     is_synced = models.BooleanField(verbose_name="同期済み", default=False, db_index=True)
 
+    # 6. 間引き (report_coalescing)
+    # 同じ時間帯の新しいレポートに置き換えられ、送信しないことにしたもの (is_synced=True として扱う)
+    is_superseded = models.BooleanField(verbose_name="間引き済み", default=False)
+    # 代表として残したレポートに、その時間帯でまとめた件数と最小・最大値を持たせる
+    coalesced_count = models.PositiveIntegerField(verbose_name="まとめた件数", default=1)
+    min_evacuees = models.PositiveIntegerField(verbose_name="避難者数 (最小)", null=True, blank=True)
+    max_evacuees = models.PositiveIntegerField(verbose_name="避難者数 (最大)", null=True, blank=True)
+    min_medical_needs = models.PositiveIntegerField(verbose_name="医療・要介護者数 (最小)", null=True, blank=True)
+    max_medical_needs = models.PositiveIntegerField(verbose_name="医療・要介護者数 (最大)", null=True, blank=True)
+
     def __str__(self):
-        return f"[{'同期済' if self.is_synced else '未同期'}] {self.timestamp.strftime('%Y-%m-%d %H:%M')} - 避難所ID:{self.shelter_id}"
+        if self.is_superseded:
+            status = '間引き'
+        else:
+            status = '同期済' if self.is_synced else '未同期'
+        return f"[{status}] {self.timestamp.strftime('%Y-%m-%d %H:%M')} - 避難所ID:{self.shelter_id}"
 
     class Meta:
         verbose_name = "未同期 現場状況報告"
         verbose_name_plural = "未同期 現場状況報告"
         ordering = ['-timestamp']
+        indexes = [
+            models.Index(fields=['timestamp', 'id'], condition=models.Q(is_synced=False), name='report_backlog_idx'),
+            models.Index(fields=['timestamp'], name='report_ts_idx'),
+        ]
 
 
 class UnsyncedUserRegistration(UUIDModel):
@@ -180,11 +243,16 @@ class UnsyncedUserRegistration(UUIDModel):
     # 同期状態を管理するフィールド
     is_synced = models.BooleanField(verbose_name="同期済み", default=False)
     sync_error = models.TextField(verbose_name="同期エラー", blank=True, null=True)
-    created_at = models.DateTimeField(auto_now_add=True)
+    created_at = models.DateTimeField(default=timezone.now, editable=False)
 
     def __str__(self):
         return f"{self.full_name} ({self.username}) - {'同期済' if self.is_synced else '未同期'}"
 
+    class Meta:
+        indexes = [
+            models.Index(fields=['created_at', 'id'], condition=models.Q(is_synced=False), name='registration_backlog_idx'),
+        ]
+
 
 
 class DistributionItem(UUIDModel):
@@ -193,4 +261,57 @@ class DistributionItem(UUIDModel):
     description = models.TextField(verbose_name="説明", blank=True, null=True)
 
     def __str__(self):
-        return self.name
\ No newline at end of file
+        return self.name
+
+
+class DistributionEligibility(models.Model):
+    """
+    炊き出しの前に中央サーバーへまとめて問い合わせておいた、避難者 × 配布物資ごとの受け取り可否
+    (distribution_cache.prewarm)。期限内なら、スキャンのたびに中央サーバーへ問い合わせずにこれで判定する。
+    """
+    username = models.CharField(verbose_name="避難者のログインID", max_length=150)
+    item_id = models.CharField(verbose_name="配布物資ID", max_length=64)
+    can_distribute = models.BooleanField(verbose_name="受け取り可能")
+    fetched_at = models.DateTimeField(verbose_name="取得日時")
+    expires_at = models.DateTimeField(verbose_name="有効期限")
+
+    def __str__(self):
+        return f"{self.username} / {self.item_id}: {'可' if self.can_distribute else '不可'}"
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(fields=['username', 'item_id'], name='eligibility_user_item_uniq'),
+        ]
+
+
+class UnsyncedDistribution(UUIDModel):
+    """事前確認 (DistributionEligibility) で配布を判定し、まだ中央サーバーに記録していない受け取り"""
+    username = models.CharField(verbose_name="避難者のログインID", max_length=150)
+    item_id = models.CharField(verbose_name="配布物資ID", max_length=64)
+    timestamp = models.DateTimeField(verbose_name="受け取り日時", default=timezone.now, editable=False)
+    device_id = models.CharField(verbose_name="記録デバイスID", max_length=100, default=current_device_id)
+    is_synced = models.BooleanField(verbose_name="同期済み", default=False)
+    last_sync_error = models.TextField(verbose_name="最終同期エラー", blank=True, null=True)
+
+    def __str__(self):
+        sync_status = "同期済" if self.is_synced else "未同期"
+        return f"[{sync_status}] {self.timestamp.strftime('%Y-%m-%d %H:%M')} - {self.username} ({self.item_id})"
+
+    class Meta:
+        verbose_name = "未同期 配布記録"
+        verbose_name_plural = "未同期 配布記録"
+        indexes = [
+            models.Index(fields=['timestamp', 'id'], condition=models.Q(is_synced=False), name='distribution_backlog_idx'),
+        ]
+
+
+class PeerCursor(UUIDModel):
+    """同じ避難所の他のラズパイから、どこまでチェックイン記録を受け取ったかを管理するモデル"""
+    peer_url = models.CharField(verbose_name="ピアのURL", max_length=200, unique=True)
+    peer_device_id = models.CharField(verbose_name="ピアのデバイスID", max_length=100, blank=True)
+    last_timestamp = models.DateTimeField(verbose_name="受信済みの最新記録日時", null=True, blank=True)
+    last_pulled_at = models.DateTimeField(verbose_name="最終取得日時", null=True, blank=True)
+    last_error = models.TextField(verbose_name="最終エラー", blank=True, null=True)
+
+    def __str__(self):
+        return f"{self.peer_device_id or self.peer_url} ({self.last_timestamp})"
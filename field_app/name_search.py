@@ -0,0 +1,192 @@
+# field_app/name_search.py
+"""
+QRコードを紛失・破損した避難者を、氏名 (またはログインIDの一部) で探すための検索インデックス。
+
+対象は User と、まだ本登録されていない仮登録ユーザー (UnsyncedUserRegistration)。
+SQLite の FTS5 (trigram) を使い、入力途中の文字列でも数ミリ秒で部分一致を返す。
+氏名とログインIDは normalize() で揃えた「読み」の列に入れて検索するので、
+ひらがな / カタカナ、全角 / 半角、大文字 / 小文字、空白の有無の違いは区別しない
+(漢字の氏名をかなで引くことはできない。User には読み仮名の項目が無いため)。
+
+テーブル (マイグレーションではなく、初めて使うときに作る):
+    field_app_name_search_doc : ログインIDごとに1行 (氏名・状態・読み)
+    field_app_name_search     : 読みの FTS5 インデックス (doc を元にトリガーで更新する)
+
+更新は、User・仮登録の保存・削除のシグナルから1件ずつ行う (fetch_master_data での取り込みを含む)。
+テーブルを作ったときと、シグナルの呼ばれない一括登録 (bundles.import_bundle) の後は全件から作り直す。
+SQLite に FTS5 (trigram、3.34以降) が無い場合は、ORM の icontains で検索する。
+"""
+import logging
+import unicodedata
+
+from django.db import DatabaseError, OperationalError, connection, transaction
+from django.db.models import Q
+
+logger = logging.getLogger('field_app.name_search')
+
+DOC_TABLE = 'field_app_name_search_doc'
+FTS_TABLE = 'field_app_name_search'
+
+REGISTERED, PENDING = 'registered', 'pending'
+
+# trigram は3文字単位の索引なので、それより短い入力は読みの列を LIKE で調べる
+TRIGRAM = 3
+
+_SCHEMA = [
+    f'''CREATE TABLE IF NOT EXISTS {DOC_TABLE} (
+        id INTEGER PRIMARY KEY,
+        username TEXT NOT NULL UNIQUE,
+        full_name TEXT NOT NULL,
+        status TEXT NOT NULL,
+        reading TEXT NOT NULL
+    )''',
+    f'''CREATE VIRTUAL TABLE IF NOT EXISTS {FTS_TABLE} USING fts5(
+        reading, content='{DOC_TABLE}', content_rowid='id', tokenize='trigram'
+    )''',
+    f'''CREATE TRIGGER IF NOT EXISTS {FTS_TABLE}_ai AFTER INSERT ON {DOC_TABLE} BEGIN
+        INSERT INTO {FTS_TABLE}(rowid, reading) VALUES (new.id, new.reading);
+    END''',
+    f'''CREATE TRIGGER IF NOT EXISTS {FTS_TABLE}_ad AFTER DELETE ON {DOC_TABLE} BEGIN
+        INSERT INTO {FTS_TABLE}({FTS_TABLE}, rowid, reading) VALUES ('delete', old.id, old.reading);
+    END''',
+    f'''CREATE TRIGGER IF NOT EXISTS {FTS_TABLE}_au AFTER UPDATE ON {DOC_TABLE} BEGIN
+        INSERT INTO {FTS_TABLE}({FTS_TABLE}, rowid, reading) VALUES ('delete', old.id, old.reading);
+        INSERT INTO {FTS_TABLE}(rowid, reading) VALUES (new.id, new.reading);
+    END''',
+]
+
+_available = None  # FTS5 (trigram) が使えるか。未確認なら None
+
+
+def normalize(text):
+    """検索用に文字列を揃える (全角/半角・カタカナ/ひらがな・大文字/小文字・空白)"""
+    text = unicodedata.normalize('NFKC', text or '').lower()
+    text = ''.join(chr(ord(ch) - 0x60) if 'ァ' <= ch <= 'ヶ' else ch for ch in text)
+    return ''.join(text.split())
+
+
+def _reading(username, full_name):
+    # 区切りの空白は normalize() 後の検索語に含まれないので、氏名とIDをまたいで一致することはない
+    return f'{normalize(full_name)} {normalize(username)}'
+
+
+def available():
+    global _available
+    if _available is None:
+        if connection.vendor != 'sqlite':
+            _available = False
+        else:
+            try:
+                _run(lambda cursor: cursor.execute(f'SELECT 1 FROM {DOC_TABLE} LIMIT 0'))
+                _available = True
+            except DatabaseError as e:
+                logger.warning('FTS5 が使えないため、氏名検索は通常の検索で行います: %s', e)
+                _available = False
+    return _available
+
+
+def _create(cursor):
+    for statement in _SCHEMA:
+        cursor.execute(statement)
+
+
+def _run(func):
+    """検索用テーブルに対して func(cursor) を実行する。テーブルが無ければ作って全件を入れてから実行する"""
+    try:
+        with connection.cursor() as cursor:
+            return func(cursor)
+    except OperationalError as e:
+        if 'no such table' not in str(e):
+            raise
+    with transaction.atomic():
+        with connection.cursor() as cursor:
+            _create(cursor)
+        rebuild()
+        with connection.cursor() as cursor:
+            return func(cursor)
+
+
+def rebuild():
+    """User と仮登録から全件を入れ直す"""
+    from .models import User, UnsyncedUserRegistration
+
+    with transaction.atomic(), connection.cursor() as cursor:
+        _create(cursor)
+        cursor.execute(f'DELETE FROM {DOC_TABLE}')
+        rows = ((username, full_name, REGISTERED, _reading(username, full_name))
+                for username, full_name in User.objects.values_list('username', 'full_name').iterator(chunk_size=5000))
+        cursor.executemany(f'INSERT INTO {DOC_TABLE} (username, full_name, status, reading) VALUES (%s, %s, %s, %s)',
+                           list(rows))
+        pending = UnsyncedUserRegistration.objects.filter(is_synced=False).values_list('username', 'full_name')
+        cursor.executemany(
+            f'INSERT INTO {DOC_TABLE} (username, full_name, status, reading) VALUES (%s, %s, %s, %s) '
+            f'ON CONFLICT (username) DO NOTHING',
+            [(username, full_name, PENDING, _reading(username, full_name)) for username, full_name in pending])
+
+
+# ---------------------------------------------------------
+# シグナルから呼ばれる、1件ずつの反映
+# ---------------------------------------------------------
+def put(username, full_name, status):
+    """1人分を追加・更新する。本登録済みの行は、仮登録の保存では上書きしない"""
+    if not available():
+        return
+    sql = (f'INSERT INTO {DOC_TABLE} (username, full_name, status, reading) VALUES (%s, %s, %s, %s) '
+           f'ON CONFLICT (username) DO UPDATE SET full_name = excluded.full_name, status = excluded.status, '
+           f'reading = excluded.reading')
+    if status == PENDING:
+        sql += f" WHERE {DOC_TABLE}.status = '{PENDING}'"
+    _run(lambda cursor: cursor.execute(sql, [username, full_name, status, _reading(username, full_name)]))
+
+
+def remove(username, status):
+    if not available():
+        return
+    _run(lambda cursor: cursor.execute(f'DELETE FROM {DOC_TABLE} WHERE username = %s AND status = %s',
+                                       [username, status]))
+
+
+# ---------------------------------------------------------
+# 検索
+# ---------------------------------------------------------
+def search(query, limit=20):
+    """
+    氏名・ログインIDの一部で検索し、[{'username', 'full_name', 'status'}, ...] を返す。
+    読みの先頭に近い位置で一致したもの、短いものから順に並べる。
+    """
+    term = normalize(query)
+    if not term:
+        return []
+    if not available():
+        return _search_orm(query, limit)
+
+    def execute(cursor):
+        if len(term) >= TRIGRAM:
+            phrase = '"' + term.replace('"', '""') + '"'
+            cursor.execute(
+                f'SELECT d.username, d.full_name, d.status FROM {FTS_TABLE} f JOIN {DOC_TABLE} d ON d.id = f.rowid '
+                f'WHERE {FTS_TABLE} MATCH %s ORDER BY instr(d.reading, %s), length(d.reading) LIMIT %s',
+                [phrase, term, limit])
+        else:
+            pattern = '%' + term.replace('\\', '\\\\').replace('%', '\\%').replace('_', '\\_') + '%'
+            cursor.execute(
+                f"SELECT username, full_name, status FROM {DOC_TABLE} WHERE reading LIKE %s ESCAPE '\\' "
+                f'ORDER BY instr(reading, %s), length(reading) LIMIT %s',
+                [pattern, term, limit])
+        return cursor.fetchall()
+
+    return [{'username': username, 'full_name': full_name, 'status': status}
+            for username, full_name, status in _run(execute)]
+
+
+def _search_orm(query, limit):
+    from .models import User, UnsyncedUserRegistration
+
+    condition = Q(username__icontains=query) | Q(full_name__icontains=query)
+    results = [{'username': username, 'full_name': full_name, 'status': REGISTERED}
+               for username, full_name in User.objects.filter(condition).values_list('username', 'full_name')[:limit]]
+    found = {result['username'] for result in results}
+    pending = UnsyncedUserRegistration.objects.filter(condition, is_synced=False).values_list('username', 'full_name')
+    results += [{'username': username, 'full_name': full_name, 'status': PENDING}
+                for username, full_name in pending[:limit] if username not in found]
+    return results[:limit]
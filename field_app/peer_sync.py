@@ -0,0 +1,231 @@
+# field_app/peer_sync.py
+"""
+同じ避難所 (SHELTER_ID) に置かれた複数のラズパイの間で、チェックイン記録を直接やり取りする。
+
+入口ごとにラズパイを置くと、各ラズパイは自分で記録した UnsyncedCheckin しか知らないため、
+A入口で入所してB入口で退所した人の連続操作チェックが効かず、人数も中央サーバーを
+一周するまで合わない。そこで config.PEER_URLS に登録した相手から、
+相手自身が記録したイベントを数秒おきに取得して、自分のDBにも登録する。
+
+- 各イベントはUUIDで識別するので、同じものを何度受け取っても重複しない
+- 相手ごとにカーソル (受信済みの最新記録日時) を PeerCursor に保存し、差分だけを取得する
+- 受け取った記録の中央サーバーへの送信は記録した本人 (元のデバイス) が行うため、
+  自分のDBには is_synced=True として登録する
+"""
+import datetime
+import hmac
+import logging
+import threading
+import time
+import uuid
+
+import requests
+from django.db import close_old_connections, transaction
+from django.db.models import Q
+from django.utils import timezone
+from django.utils.dateparse import parse_datetime
+
+import config
+from . import checkin_status
+from .models import PeerCursor, UnsyncedCheckin
+
+logger = logging.getLogger('field_app.peer')
+
+PEER_FIELDS = ('id', 'username', 'shelter_id', 'checkin_type', 'timestamp', 'device_id')
+
+
+# config.py で配布している共有キーの初期値。誰でも知っている値なので、このままではピアのAPIで記録を返さない
+DEFAULT_SHARED_KEY = 'dummy-peer-shared-key'
+
+
+def shared_key_configured():
+    """PEER_SHARED_KEY が初期値から変更されているか"""
+    return bool(config.PEER_SHARED_KEY) and config.PEER_SHARED_KEY != DEFAULT_SHARED_KEY
+
+
+def is_authorized_peer(request):
+    """ピアからの問い合わせが同じ避難所・同じ共有キーのものか確認する"""
+    if not shared_key_configured():
+        logger.warning('PEER_SHARED_KEY が初期値のままのため、ピアからの問い合わせを断りました')
+        return False
+    # 一致するまでの時間から共有キーを推測されないよう、比較には compare_digest を使う
+    key = request.headers.get('X-Peer-Key', '').encode('utf-8')
+    return (
+        hmac.compare_digest(key, config.PEER_SHARED_KEY.encode('utf-8'))
+        and request.headers.get('X-Shelter-Id') == config.SHELTER_ID
+    )
+
+
+def local_events_since(since, limit, after_id=None):
+    """
+    このデバイスで記録したチェックインのうち、since 以降のものを (timestamp, id) の順に返す。
+    after_id を指定すると、timestamp が since と同じものは after_id より後ろから返す (ページ送り用)。
+    """
+    queryset = UnsyncedCheckin.objects.filter(device_id=config.DEVICE_ID, shelter_id=config.SHELTER_ID)
+    if since and after_id:
+        queryset = queryset.filter(Q(timestamp__gt=since) | Q(timestamp=since, id__gt=after_id))
+    elif since:
+        queryset = queryset.filter(timestamp__gte=since)
+    rows = list(queryset.order_by('timestamp', 'id').values(*PEER_FIELDS)[:limit + 1])
+    # JsonResponse の既定のエンコーダはマイクロ秒を切り捨てるため、ここで文字列にしておく
+    events = [dict(row, id=str(row['id']), timestamp=row['timestamp'].isoformat()) for row in rows[:limit]]
+    return events, len(rows) > limit
+
+
+def _build_record(event):
+    """受け取ったイベントを UnsyncedCheckin にする。項目が欠けている・値が不正なら None"""
+    try:
+        if any(not isinstance(event[name], str) or not event[name] for name in PEER_FIELDS):
+            return None
+        timestamp = parse_datetime(event['timestamp'])
+        record_id = uuid.UUID(event['id'])
+    except (TypeError, KeyError, ValueError):
+        return None
+    if timestamp is None or timezone.is_naive(timestamp) or event['checkin_type'] not in ('checkin', 'checkout'):
+        return None
+    return UnsyncedCheckin(
+        id=record_id,
+        username=event['username'],
+        shelter_id=event['shelter_id'],
+        checkin_type=event['checkin_type'],
+        timestamp=timestamp,
+        device_id=event['device_id'],
+        is_synced=True,  # 中央サーバーへは元のデバイスが送信する
+    )
+
+
+def ingest_events(events):
+    """ピアから受け取ったイベントを登録する。新しく登録した件数を返す (不正なイベントは読み飛ばす)"""
+    records = []
+    malformed = 0
+    for event in events:
+        record = _build_record(event)
+        if record is None:
+            malformed += 1
+            continue
+        # 他の避難所の記録や、自分が記録したもの (相手経由で戻ってきたもの) は受け取らない
+        if record.shelter_id != config.SHELTER_ID or record.device_id == config.DEVICE_ID:
+            continue
+        records.append(record)
+    if malformed:
+        logger.warning('ピアから受け取ったイベントのうち %d 件は項目が欠けているか値が不正なため、登録しませんでした',
+                       malformed)
+    if not records:
+        return 0
+    existing = set(UnsyncedCheckin.objects.filter(pk__in=[r.pk for r in records]).values_list('pk', flat=True))
+    new_records = [r for r in records if r.pk not in existing]
+    with transaction.atomic():
+        UnsyncedCheckin.objects.bulk_create(new_records, ignore_conflicts=True)
+        checkin_status.record(new_records)  # bulk_create では post_save が呼ばれないため
+    return len(new_records)
+
+
+def pull_from_peer(peer_url, session=requests):
+    """1台のピアから、前回のカーソル以降のイベントを全て取得する。新規登録件数を返す"""
+    cursor, _ = PeerCursor.objects.get_or_create(peer_url=peer_url)
+    since = cursor.last_timestamp
+    if since:
+        since -= datetime.timedelta(seconds=config.PEER_CURSOR_OVERLAP_SECONDS)
+
+    imported = 0
+    after_id = None
+    try:
+        while True:
+            params = {'limit': config.PEER_BATCH_SIZE}
+            if since:
+                params['since'] = since.isoformat()
+            if after_id:
+                params['after_id'] = after_id
+            response = session.get(
+                peer_url.rstrip('/') + '/peer/checkins/',
+                params=params,
+                headers={'X-Peer-Key': config.PEER_SHARED_KEY, 'X-Shelter-Id': config.SHELTER_ID},
+                timeout=2,
+            )
+            if response.status_code != 200:
+                raise requests.exceptions.RequestException(f'HTTP {response.status_code}')
+            data = response.json()
+            events = data.get('events', []) if isinstance(data, dict) else None
+            if not isinstance(events, list) or not all(isinstance(event, dict) for event in events):
+                raise ValueError('ピアの応答の形式が不正です')
+            imported += ingest_events(events)
+
+            cursor.peer_device_id = data.get('device_id', cursor.peer_device_id)
+            if events:
+                # 次のページは最後のイベントの (timestamp, id) から。読めなければ、この回はここまでにする
+                last = _build_record(events[-1])
+                if last is None:
+                    raise ValueError('ピアの応答の最後のイベントが不正なため、続きを取得できません')
+                if cursor.last_timestamp is None or last.timestamp > cursor.last_timestamp:
+                    cursor.last_timestamp = last.timestamp
+                since, after_id = last.timestamp, str(last.id)
+            if not data.get('has_more'):
+                break
+        cursor.last_error = None
+    except (requests.exceptions.RequestException, ValueError) as e:
+        cursor.last_error = str(e)
+        logger.warning('ピア %s からの取得に失敗しました: %s', peer_url, e)
+
+    cursor.last_pulled_at = timezone.now()
+    cursor.save()
+    if imported:
+        logger.info('ピア %s から %d 件のチェックイン記録を受け取りました', peer_url, imported)
+    return imported
+
+
+def sync_all_peers(session=requests):
+    """config.PEER_URLS の全てのピアから取得する。ピアごとの新規登録件数を返す"""
+    return {peer_url: pull_from_peer(peer_url, session=session) for peer_url in config.PEER_URLS}
+
+
+class PeerSyncWorker:
+    """
+    config.PEER_URLS のピアから PEER_SYNC_INTERVAL_SECONDS ごとに取得し続けるバックグラウンドスレッド。
+    数秒おきのLAN内の取得が、スケジューラの長い処理 (中央サーバーへの同期など) の後ろで待たされないよう、
+    変更通知 (change_feed) と同じくスケジューラとは別のスレッドで動かす。
+    """
+
+    def __init__(self, session=requests):
+        self.session = session
+        self.last_run = None
+        self.last_imported = 0
+        self.last_error = ''
+        self.failures = 0
+        self._stopped = threading.Event()
+        self._thread = None
+
+    def start(self):
+        self._thread = threading.Thread(target=self.run_forever, name='field-peer-sync', daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        self._stopped.set()
+
+    def as_dict(self):
+        return {
+            'last_run': self.last_run,
+            'last_imported': self.last_imported,
+            'last_error': self.last_error,
+            'failures': self.failures,
+        }
+
+    def run_forever(self):
+        while not self._stopped.is_set():
+            self.run_once()
+            self._stopped.wait(config.PEER_SYNC_INTERVAL_SECONDS)
+
+    def run_once(self):
+        """全てのピアから1回ずつ取得する (通信の失敗は pull_from_peer がピアごとに記録する)"""
+        close_old_connections()
+        try:
+            self.last_imported = sum(sync_all_peers(self.session).values())
+            self.last_error = ''
+            self.failures = 0
+        except Exception as e:
+            # DBのロック待ちなどで落ちても、スレッドは止めずに次の回で取り直す
+            self.failures += 1
+            self.last_error = f'{type(e).__name__}: {e}'[:200]
+            logger.exception('ピア同期に失敗しました')
+        finally:
+            close_old_connections()
+        self.last_run = time.time()
@@ -0,0 +1,239 @@
+# field_app/profiling.py
+"""
+現場でのリクエスト単位のプロファイリング (「受付画面が遅い」などの調査用)。
+
+管理者 (is_staff) が URL に ?_profile=1 を付けるか、X-Field-Profile ヘッダを付けて
+アクセスしたリクエストだけを計測する (ProfilingMiddleware)。計測する内容は:
+- サンプリングによるプロファイル: リクエストを処理しているスレッドのスタックを
+  PROFILING_SAMPLE_INTERVAL_MS ごとに取り、関数ごと・呼び出し経路ごとに数える
+  (async ビューでは、イベントループのスレッドを見る)
+- 実行された全てのSQLとその所要時間
+- 中央サーバーへの全ての送信 (utils.central_request / central_request_async) とその所要時間
+
+結果は PROFILING_DIR に1リクエスト1ファイルで保存し、PROFILING_MAX_REPORTS 件を
+超えたら古いものから消す。/diagnostics/profiles/ (管理者のみ) で一覧・詳細を見られる。
+
+計測していないリクエストでは、ミドルウェアがクエリ文字列とヘッダを確認するだけで、
+SQLのフックも最初に計測が要求されるまで仕込まない。
+"""
+import contextvars
+import json
+import os
+import re
+import sys
+import threading
+import time
+import uuid
+from collections import Counter
+
+from django.db import connections
+from django.db.backends.signals import connection_created
+
+import config
+
+_current = contextvars.ContextVar('field_profile', default=None)
+
+# 保存したレポートのID (ファイル名) の形式
+REPORT_ID = re.compile(r'^\d{13}-[0-9a-f]{8}$')
+
+_hook_lock = threading.Lock()
+_hook_installed = False
+
+
+def requested(request):
+    """このリクエストで計測が求められているか (ユーザーの確認は呼び出し側で行う)"""
+    return '_profile=' in request.META.get('QUERY_STRING', '') or 'HTTP_X_FIELD_PROFILE' in request.META
+
+
+class Report:
+    """計測中のリクエスト1件分の記録"""
+
+    def __init__(self, request):
+        self.id = f'{int(time.time() * 1000)}-{uuid.uuid4().hex[:8]}'
+        self.method = request.method
+        self.path = request.get_full_path()
+        self.user = request.user.get_username()
+        self.started_at = time.time()
+        self.queries = []
+        self.query_count = 0
+        self.query_seconds = 0.0
+        self.central_calls = []
+        self.sampler = None
+
+    def add_query(self, sql, seconds, many):
+        self.query_count += 1
+        self.query_seconds += seconds
+        if len(self.queries) < config.PROFILING_MAX_QUERIES:
+            self.queries.append({'sql': sql, 'ms': round(seconds * 1000, 3), 'many': many})
+
+    def add_central_call(self, method, url, endpoint, seconds, status):
+        self.central_calls.append({'method': method.upper(), 'url': url, 'endpoint': endpoint,
+                                   'ms': round(seconds * 1000, 1), 'status': str(status)})
+
+    def as_dict(self, status_code, duration):
+        stacks = self.sampler.stacks if self.sampler else Counter()
+        own = Counter()    # 関数ごとの、スタックの一番上にいた回数 (その関数自体で使った時間)
+        total = Counter()  # 関数ごとの、スタックのどこかにいた回数 (呼び出し先を含む時間)
+        for stack, count in stacks.items():
+            frames = stack.split(';')
+            own[frames[-1]] += count
+            for frame in set(frames):
+                total[frame] += count
+        return {
+            'id': self.id,
+            'method': self.method,
+            'path': self.path,
+            'user': self.user,
+            'status': status_code,
+            'started_at': self.started_at,
+            'duration_ms': round(duration * 1000, 1),
+            'sql_count': self.query_count,
+            'sql_ms': round(self.query_seconds * 1000, 1),
+            'queries': self.queries,
+            'central_ms': round(sum(c['ms'] for c in self.central_calls), 1),
+            'central_calls': self.central_calls,
+            'sample_interval_ms': config.PROFILING_SAMPLE_INTERVAL_MS,
+            'samples': sum(stacks.values()),
+            'functions': [{'function': name, 'own': own[name], 'total': count}
+                          for name, count in total.most_common(50)],
+            # flamegraph.pl / speedscope にそのまま貼れる形式 ("a;b;c 回数")
+            'stacks': [f'{stack} {count}' for stack, count in stacks.most_common(300)],
+        }
+
+
+class Sampler:
+    """指定したスレッドのスタックを一定間隔で記録する"""
+    MAX_DEPTH = 60
+
+    def __init__(self, thread_id, interval):
+        self.thread_id = thread_id
+        self.interval = interval
+        self.stacks = Counter()
+        self._stopped = threading.Event()
+        self._thread = threading.Thread(target=self._run, name='field-profiler', daemon=True)
+
+    def start(self):
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self._stopped.set()
+        self._thread.join()
+
+    def _run(self):
+        while not self._stopped.wait(self.interval):
+            frame = sys._current_frames().get(self.thread_id)
+            frames = []
+            while frame is not None and len(frames) < self.MAX_DEPTH:
+                code = frame.f_code
+                frames.append(f'{code.co_name} ({_short_path(code.co_filename)}:{code.co_firstlineno})')
+                frame = frame.f_back
+            if frames:
+                self.stacks[';'.join(reversed(frames))] += 1
+
+
+def _short_path(filename):
+    for marker in ('site-packages' + os.sep, config.BASE_DIR + os.sep):
+        if marker in filename:
+            return filename.split(marker, 1)[1]
+    return os.path.basename(filename)
+
+
+# ---------------------------------------------------------
+# 計測の開始・終了 (ProfilingMiddleware から呼ぶ)
+# ---------------------------------------------------------
+def start(request):
+    _install_sql_hook()
+    report = Report(request)
+    report.sampler = Sampler(threading.get_ident(), config.PROFILING_SAMPLE_INTERVAL_MS / 1000).start()
+    token = _current.set(report)
+    return report, token, time.perf_counter()
+
+
+def finish(report, token, started, response):
+    report.sampler.stop()
+    _current.reset(token)
+    data = report.as_dict(response.status_code, time.perf_counter() - started)
+    save(data)
+    response['X-Field-Profile-Id'] = report.id
+    return data
+
+
+def note_central_call(method, url, endpoint, seconds, status):
+    """utils.central_request から呼ばれる。計測中のリクエストがあれば記録する"""
+    report = _current.get()
+    if report is not None:
+        report.add_central_call(method, url, endpoint, seconds, status)
+
+
+# ---------------------------------------------------------
+# SQLの記録
+# ---------------------------------------------------------
+def _record_sql(execute, sql, params, many, context):
+    report = _current.get()
+    if report is None:
+        return execute(sql, params, many, context)
+    start = time.perf_counter()
+    try:
+        return execute(sql, params, many, context)
+    finally:
+        report.add_query(sql, time.perf_counter() - start, many)
+
+
+def _add_wrapper(connection):
+    if _record_sql not in connection.execute_wrappers:
+        connection.execute_wrappers.append(_record_sql)
+
+
+def _on_connection_created(sender, connection, **kwargs):
+    _add_wrapper(connection)
+
+
+def _install_sql_hook():
+    """最初に計測が要求された時に、以後作られる接続と、このスレッドの既存の接続にフックを仕込む"""
+    global _hook_installed
+    if _hook_installed:
+        return
+    with _hook_lock:
+        if not _hook_installed:
+            connection_created.connect(_on_connection_created, dispatch_uid='field_profiling')
+            _hook_installed = True
+    for connection in connections.all(initialized_only=True):
+        _add_wrapper(connection)
+
+
+# ---------------------------------------------------------
+# 保存 (件数に上限のあるリングとしてディスクに置く)
+# ---------------------------------------------------------
+def save(data):
+    os.makedirs(config.PROFILING_DIR, exist_ok=True)
+    path = os.path.join(config.PROFILING_DIR, data['id'] + '.json')
+    with open(path + '.tmp', 'w', encoding='utf-8') as f:
+        json.dump(data, f, ensure_ascii=False)
+    os.replace(path + '.tmp', path)
+    for report_id in list_ids()[config.PROFILING_MAX_REPORTS:]:
+        try:
+            os.remove(os.path.join(config.PROFILING_DIR, report_id + '.json'))
+        except OSError:
+            pass
+
+
+def list_ids():
+    """保存されているレポートのIDを新しい順に返す"""
+    try:
+        names = os.listdir(config.PROFILING_DIR)
+    except OSError:
+        return []
+    return sorted((name[:-5] for name in names if name.endswith('.json') and REPORT_ID.match(name[:-5])),
+                  reverse=True)
+
+
+def load(report_id):
+    """レポートを読み込む (見つからない・IDの形式が違う場合は None)"""
+    if not REPORT_ID.match(report_id):
+        return None
+    try:
+        with open(os.path.join(config.PROFILING_DIR, report_id + '.json'), encoding='utf-8') as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return None
@@ -0,0 +1,103 @@
+# field_app/report_coalescing.py
+"""
+未送信の現場レポート (UnsyncedFieldReport) の間引き。
+
+現場レポートは「その時点の避難所の状態」のスナップショットなので、長時間の通信断の後に
+たまった古いレポートを全て順番に送っても、本部で役に立つのは最新の数件だけになる。
+未送信のレポートが REPORT_COALESCE_THRESHOLD 件を超えた場合は、避難所ごと・
+REPORT_COALESCE_BUCKET_MINUTES 分ごとの時間帯で最新の1件だけを残す
+(最新のレポートは最後の時間帯の代表として必ず残る)。
+
+残りは is_superseded=True にして、is_synced=True と同じく送信対象から外す。
+レコード自体は削除しないため、通常の同期済みレコードと同じくアーカイブに移される。
+代表として残したレポートには、まとめた件数と、その時間帯の最小値・最大値を付けて送る。
+"""
+import logging
+
+from django.db import transaction
+
+import config
+from .models import UnsyncedFieldReport
+
+logger = logging.getLogger('field_app.sync')
+
+# 1回の UPDATE で扱う件数 (SQLite の変数の上限を超えないように)
+_UPDATE_CHUNK = 500
+
+
+def _bucket(timestamp, bucket_seconds):
+    return int(timestamp.timestamp() // bucket_seconds)
+
+
+def _range(value, low, high):
+    """レポート1件の [最小, 最大] (まだ間引かれていなければ、その値だけ)"""
+    return [value if low is None else low, value if high is None else high]
+
+
+def _merge(a, b):
+    return [min(a[0], b[0]), max(a[1], b[1])]
+
+
+def coalesce_field_reports(threshold=None, bucket_minutes=None, keep_stats=None):
+    """
+    未送信のレポートが閾値を超えていれば間引きを行う。
+    (間引いた件数, 代表として残した件数) を返す。閾値以下なら何もせず (0, 0)。
+    """
+    threshold = config.REPORT_COALESCE_THRESHOLD if threshold is None else threshold
+    bucket_seconds = (bucket_minutes or config.REPORT_COALESCE_BUCKET_MINUTES) * 60
+    keep_stats = config.REPORT_COALESCE_STATS if keep_stats is None else keep_stats
+
+    pending = UnsyncedFieldReport.objects.filter(is_synced=False)
+    if pending.count() <= threshold:
+        return 0, 0
+
+    # (避難所, 時間帯) ごとに、最新のレポートと最小・最大値を集める
+    # (前回の間引きで代表になったレポートは、まとめた分の最小・最大値を持っているのでそれも含める)
+    groups = {}
+    rows = pending.order_by('timestamp', 'pk').values_list(
+        'pk', 'shelter_id', 'timestamp', 'current_evacuees', 'medical_needs', 'coalesced_count',
+        'min_evacuees', 'max_evacuees', 'min_medical_needs', 'max_medical_needs')
+    for (pk, shelter_id, timestamp, evacuees, medical, count,
+         min_evacuees, max_evacuees, min_medical, max_medical) in rows.iterator(chunk_size=2000):
+        evacuees_range = _range(evacuees, min_evacuees, max_evacuees)
+        medical_range = _range(medical, min_medical, max_medical)
+        key = (shelter_id, _bucket(timestamp, bucket_seconds))
+        group = groups.get(key)
+        if group is None:
+            groups[key] = {
+                'keep': pk, 'superseded': [], 'count': count,
+                'evacuees': evacuees_range, 'medical': medical_range,
+            }
+            continue
+        # 時刻順に読んでいるので、後から来たものが新しい
+        group['superseded'].append(group['keep'])
+        group['keep'] = pk
+        group['count'] += count
+        group['evacuees'] = _merge(group['evacuees'], evacuees_range)
+        group['medical'] = _merge(group['medical'], medical_range)
+
+    superseded = [pk for group in groups.values() for pk in group['superseded']]
+    if not superseded:
+        return 0, 0
+
+    with transaction.atomic():
+        for i in range(0, len(superseded), _UPDATE_CHUNK):
+            UnsyncedFieldReport.objects.filter(pk__in=superseded[i:i + _UPDATE_CHUNK]).update(
+                is_synced=True, is_superseded=True)
+
+        kept = []
+        for group in groups.values():
+            if not group['superseded']:
+                continue
+            report = UnsyncedFieldReport(pk=group['keep'], coalesced_count=group['count'])
+            if keep_stats:
+                report.min_evacuees, report.max_evacuees = group['evacuees']
+                report.min_medical_needs, report.max_medical_needs = group['medical']
+            kept.append(report)
+        fields = ['coalesced_count']
+        if keep_stats:
+            fields += ['min_evacuees', 'max_evacuees', 'min_medical_needs', 'max_medical_needs']
+        UnsyncedFieldReport.objects.bulk_update(kept, fields, batch_size=_UPDATE_CHUNK)
+
+    logger.info('未送信の現場レポート %d 件を間引きました (代表 %d 件)', len(superseded), len(kept))
+    return len(superseded), len(kept)
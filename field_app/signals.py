@@ -0,0 +1,82 @@
+# field_app/signals.py
+from django.db.models.signals import post_delete, post_save, pre_save
+from django.dispatch import receiver
+
+from . import checkin_status, metrics, name_search, user_index
+from .models import UnsyncedCheckin, UnsyncedDistribution, UnsyncedFieldReport, UnsyncedUserRegistration, User
+
+
+@receiver(post_save, sender=UnsyncedCheckin)
+@receiver(post_save, sender=UnsyncedDistribution)
+@receiver(post_save, sender=UnsyncedFieldReport)
+@receiver(post_save, sender=UnsyncedUserRegistration)
+def count_new_unsynced_record(sender, instance, created, **kwargs):
+    """未同期レコードの作成をメトリクスのバックログ件数に反映する (COUNTクエリを使わないため)"""
+    if created and not instance.is_synced:
+        created_at = getattr(instance, 'timestamp', None) or getattr(instance, 'created_at', None)
+        metrics.note_unsynced_created(sender.__name__, created_at)
+
+
+@receiver(post_save, sender=UnsyncedCheckin)
+def update_checkin_status(sender, instance, created, **kwargs):
+    """ログインIDごとの最後の入退所を更新する (bulk_create する経路では、それぞれで呼んでいる)"""
+    if created:
+        checkin_status.record([instance])
+
+
+# --- QRコード確認用のログインIDインデックス (user_index) の更新 ---
+@receiver(post_save, sender=User)
+def index_user(sender, instance, **kwargs):
+    user_index.put_user(instance.username, instance.full_name)
+
+
+@receiver(post_delete, sender=User)
+def unindex_user(sender, instance, **kwargs):
+    user_index.remove_user(instance.username)
+
+
+@receiver(pre_save, sender=UnsyncedUserRegistration)
+def remember_old_pending_username(sender, instance, **kwargs):
+    # 未同期ユーザー修正画面でログインIDが変更された場合に、古いIDをインデックスから消すため
+    if not instance._state.adding:
+        instance._index_old_username = (
+            sender.objects.filter(pk=instance.pk).values_list('username', flat=True).first()
+        )
+
+
+@receiver(post_save, sender=UnsyncedUserRegistration)
+def index_pending_user(sender, instance, **kwargs):
+    user_index.put_pending(instance.username, instance.full_name, instance.is_synced,
+                           old_username=getattr(instance, '_index_old_username', None))
+
+
+@receiver(post_delete, sender=UnsyncedUserRegistration)
+def unindex_pending_user(sender, instance, **kwargs):
+    user_index.remove_pending(instance.username)
+
+
+# --- 氏名検索のインデックス (name_search) の更新 ---
+@receiver(post_save, sender=User)
+def index_user_name(sender, instance, **kwargs):
+    name_search.put(instance.username, instance.full_name, name_search.REGISTERED)
+
+
+@receiver(post_delete, sender=User)
+def unindex_user_name(sender, instance, **kwargs):
+    name_search.remove(instance.username, name_search.REGISTERED)
+
+
+@receiver(post_save, sender=UnsyncedUserRegistration)
+def index_pending_user_name(sender, instance, **kwargs):
+    old_username = getattr(instance, '_index_old_username', None)
+    if old_username and old_username != instance.username:
+        name_search.remove(old_username, name_search.PENDING)
+    if instance.is_synced:
+        name_search.remove(instance.username, name_search.PENDING)
+    else:
+        name_search.put(instance.username, instance.full_name, name_search.PENDING)
+
+
+@receiver(post_delete, sender=UnsyncedUserRegistration)
+def unindex_pending_user_name(sender, instance, **kwargs):
+    name_search.remove(instance.username, name_search.PENDING)
@@ -0,0 +1,456 @@
+# field_app/stub_central.py
+"""
+ラズパイが呼び出す中央サーバーAPIを一通り実装した、検証用のスタブサーバー。
+
+本物の中央サーバー (config.CENTRAL_SERVER_URLS) を使わずに、同期処理やチャットなどを
+1台のLinuxマシン上で試すためのもの。災害時の回線状況を再現できるよう、
+遅延・帯域・パケットロス・エラー率を設定できる (`manage.py stub_central` で起動)。
+
+- 遅延 (latency_ms / jitter_ms) : 応答を返す前に待つ時間
+- 帯域 (bandwidth_kbps) : 全ての接続で共有する回線として、送受信のバイト数に応じて待つ
+- パケットロス (loss_rate) : 応答を返さずに接続を切る。半分は処理前 (要求が届かなかった)、
+  半分は処理後 (応答だけが失われた) に落とすので、再送時の二重登録の有無を確認できる
+- エラー率 (error_rate) : 処理せずに 503 を返す
+
+アップロード系のAPIは冪等キー (Idempotency-Key ヘッダ、またはペイロードの "id") で
+重複を判定し、同じキーの再送には 409 + Idempotent-Replayed: true を返す。
+
+変更通知 (/api/changes/、change_feed 参照) にも対応する。検証用に
+POST /stub/changes/ ({"topic": "users" | "items", "count": 1}) でユーザー・品目を追加すると、
+待機中のロングポーリングに通知が返る (/stats と同様に件数には数えない)。
+
+チャットで送られた画像は GET /media/chat/<名前> で返す (取得回数は /stats の media)。
+"""
+import datetime
+import json
+import mimetypes
+import random
+import re
+import threading
+import time
+import uuid
+from urllib.parse import parse_qs, urlsplit
+from email.parser import BytesParser
+from email.policy import HTTP
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+# 回線状況のプリセット (manage.py stub_central --profile)
+PROFILES = {
+    'lan': {'latency_ms': 1, 'jitter_ms': 1, 'bandwidth_kbps': 0, 'loss_rate': 0.0, 'error_rate': 0.0},
+    'lte': {'latency_ms': 60, 'jitter_ms': 30, 'bandwidth_kbps': 5000, 'loss_rate': 0.01, 'error_rate': 0.0},
+    'congested': {'latency_ms': 400, 'jitter_ms': 600, 'bandwidth_kbps': 256, 'loss_rate': 0.05, 'error_rate': 0.05},
+    'satellite': {'latency_ms': 700, 'jitter_ms': 100, 'bandwidth_kbps': 128, 'loss_rate': 0.03, 'error_rate': 0.01},
+}
+
+_GROUP_MESSAGES_PATH = re.compile(r'^/api/groups/(?P<group_id>[^/]+)/messages/$')
+
+# Conditions.html_rate で返す、中継機器のページ (JSON ではない)
+_INTERCEPTED_PAGE = '<!DOCTYPE html><html><body><h1>ネットワークに接続するにはログインしてください</h1></body></html>'.encode()
+
+# 変更通知のために保持しておく変更の件数 (これより古い cursor には reset を返す)
+CHANGE_LOG_SIZE = 1000
+
+
+def _now():
+    return datetime.datetime.now(datetime.timezone.utc).isoformat()
+
+
+def _updated_since(entries, since):
+    """since (ISO 8601) 以降に更新されたものだけを返す (差分取得)"""
+    if not since:
+        return entries
+    since = datetime.datetime.fromisoformat(since)
+    return [entry for entry in entries if datetime.datetime.fromisoformat(entry['updated_at']) >= since]
+
+
+class Conditions:
+    """スタブが再現する回線状況"""
+
+    def __init__(self, latency_ms=0, jitter_ms=0, bandwidth_kbps=0, loss_rate=0.0, error_rate=0.0,
+                 loss_hold_seconds=30.0, html_rate=0.0):
+        self.latency_ms = latency_ms
+        self.jitter_ms = jitter_ms
+        self.bandwidth_kbps = bandwidth_kbps
+        self.loss_rate = loss_rate
+        self.error_rate = error_rate
+        # パケットロス時に、接続を切るまで黙って待つ秒数 (クライアントのタイムアウトより長くする)
+        self.loss_hold_seconds = loss_hold_seconds
+        # 途中の中継機器 (認証画面・プロキシのエラーページ) が、200 で HTML を返してくる割合
+        self.html_rate = html_rate
+
+        self._link_lock = threading.Lock()
+        self._link_free_at = 0.0
+
+    def delay(self):
+        seconds = (self.latency_ms + random.uniform(0, self.jitter_ms)) / 1000
+        if seconds > 0:
+            time.sleep(seconds)
+
+    def transfer(self, size):
+        """size バイトを共有回線で送受信し終わるまで待つ"""
+        if not self.bandwidth_kbps or size <= 0:
+            return
+        duration = size * 8 / (self.bandwidth_kbps * 1000)
+        with self._link_lock:
+            start = max(time.monotonic(), self._link_free_at)
+            self._link_free_at = start + duration
+            finish = self._link_free_at
+        time.sleep(max(0.0, finish - time.monotonic()))
+
+
+class CentralState:
+    """スタブが受け取ったデータ (プロセス内のメモリのみ)"""
+
+    def __init__(self, user_count=100, item_count=5):
+        from django.contrib.auth.hashers import make_password
+
+        self.lock = threading.Lock()
+        self.changed = threading.Condition(self.lock)  # 変更通知を待つロングポーリング用
+        self.password = make_password('password')  # 全員同じハッシュで十分 (生成コストを抑える)
+        self.users = [self._new_user(i) for i in range(user_count)]
+        self.items = [self._new_item(i) for i in range(item_count)]
+        self.change_log = []  # (cursor, topic, changed_at)
+        self.cursor = 0
+        self.groups = [{'id': 'all', 'name': '全体連絡'}, {'id': '1', 'name': '第1班'}, {'id': '2', 'name': '第2班'}]
+        self.records = {'checkins': {}, 'reports': {}, 'registrations': {}, 'distributions': {}}
+        self.usernames = {user['username'] for user in self.users}
+        self.distributions = set()
+        self.messages = {}
+        self.media = {}  # パス -> (Content-Type, 内容)
+        self.counters = {'requests': 0, 'replayed': 0, 'dropped': 0, 'errors': 0, 'bytes_in': 0, 'bytes_out': 0,
+                         'media': 0}
+
+    def _new_user(self, i):
+        return {
+            'id': str(uuid.uuid5(uuid.NAMESPACE_URL, f'stub-user-{i}')),
+            'username': f'user{i:05d}',
+            'full_name': f'避難者 {i:05d}',
+            'email': f'user{i:05d}@example.com',
+            'role': 'general',
+            'password': self.password,
+            'updated_at': _now(),
+        }
+
+    def _new_item(self, i):
+        return {'id': str(uuid.uuid5(uuid.NAMESPACE_URL, f'stub-item-{i}')), 'name': f'物資{i + 1}',
+                'description': '', 'updated_at': _now()}
+
+    def add(self, topic, count=1):
+        """ユーザー (users) または品目 (items) を追加し、変更を通知する"""
+        with self.changed:
+            if topic == 'users':
+                new = [self._new_user(len(self.users) + i) for i in range(count)]
+                self.users.extend(new)
+                self.usernames.update(user['username'] for user in new)
+            else:
+                new = [self._new_item(len(self.items) + i) for i in range(count)]
+                self.items.extend(new)
+            self.cursor += 1
+            self.change_log = self.change_log[-CHANGE_LOG_SIZE + 1:] + [(self.cursor, topic, new[0]['updated_at'])]
+            self.changed.notify_all()
+        return new
+
+    def changes_since(self, cursor, wait):
+        """cursor より後の変更を返す。無ければ wait 秒まで待つ"""
+        with self.changed:
+            if cursor is None:
+                return {'cursor': self.cursor, 'changes': []}
+            if self.change_log and cursor < self.change_log[0][0] - 1:
+                return {'cursor': self.cursor, 'changes': [], 'reset': True}  # 古すぎて差分を返せない
+            self.changed.wait_for(lambda: self.cursor > cursor, timeout=wait)
+            changes = [{'topic': topic, 'since': changed_at}
+                       for seq, topic, changed_at in self.change_log if seq > cursor]
+            return {'cursor': self.cursor, 'changes': changes}
+
+    def add_media(self, content, content_type='image/png'):
+        """チャットの画像を置き、その image_url (パス) を返す"""
+        path = f'/media/chat/{uuid.uuid4().hex}{mimetypes.guess_extension(content_type) or ""}'
+        with self.lock:
+            self.media[path] = (content_type, content)
+        return path
+
+    def count(self, name, amount=1):
+        with self.lock:
+            self.counters[name] += amount
+
+    def stats(self):
+        with self.lock:
+            return {
+                **self.counters,
+                'checkins': len(self.records['checkins']),
+                'reports': len(self.records['reports']),
+                'registrations': len(self.records['registrations']),
+                'distributions': len(self.distributions),
+                'messages': sum(len(m) for m in self.messages.values()),
+            }
+
+
+class StubCentralHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'  # keep-alive (クライアントの Session での接続の使い回しを再現)
+    server_version = 'StubCentral/1.0'
+
+    def log_message(self, format, *args):
+        pass  # アクセスログは出さない (負荷試験の邪魔になるため)
+
+    @property
+    def state(self):
+        return self.server.state
+
+    @property
+    def conditions(self):
+        return self.server.conditions
+
+    # -----------------------------------------------------
+    # 入出力と回線状況の再現
+    # -----------------------------------------------------
+    def _read_body(self):
+        length = int(self.headers.get('Content-Length') or 0)
+        body = self.rfile.read(length) if length else b''
+        self.conditions.transfer(len(body))
+        self.state.count('bytes_in', len(body))
+        return body
+
+    def _send_json(self, status, data, headers=None):
+        body = json.dumps(data, ensure_ascii=False).encode('utf-8')
+        self.conditions.delay()
+        self.conditions.transfer(len(body))
+        self.state.count('bytes_out', len(body))
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json; charset=utf-8')
+        self.send_header('Content-Length', str(len(body)))
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        self.end_headers()
+        self.wfile.write(body)
+
+    def _send_bytes(self, content_type, body):
+        self.conditions.delay()
+        self.conditions.transfer(len(body))
+        self.state.count('bytes_out', len(body))
+        self.send_response(200)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def _drop(self):
+        """応答を返さずに接続を切る (パケットロス)"""
+        self.state.count('dropped')
+        time.sleep(self.conditions.loss_hold_seconds)
+        self.close_connection = True
+
+    def _handle(self, method):
+        path = self.path.split('?', 1)[0]
+        if path == '/stats':  # 検証用 (回線状況の影響を受けず、件数にも数えない)
+            body = json.dumps(self.state.stats()).encode('utf-8')
+            self.send_response(200)
+            self.send_header('Content-Type', 'application/json')
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+            return
+        if method == 'POST' and path == '/stub/changes/':  # 検証用 (変更を起こして通知する)
+            payload = json.loads(self._read_body() or b'{}')
+            added = self.state.add(payload.get('topic', 'users'), int(payload.get('count', 1)))
+            return self._send_json(200, {'added': len(added)})
+
+        self.state.count('requests')
+        # 要求行とヘッダの分も、回線を流れたバイト数に含める
+        self.state.count('bytes_in', len(self.requestline) + len(str(self.headers)))
+        body = self._read_body() if method == 'POST' else b''
+
+        lost = random.random() < self.conditions.loss_rate
+        if lost and random.random() < 0.5:
+            return self._drop()  # 要求が届かなかった
+        if random.random() < self.conditions.error_rate:
+            self.state.count('errors')
+            if lost:
+                return self._drop()
+            return self._send_json(503, {'message': 'スタブ: 一時的なエラー'})
+        if random.random() < self.conditions.html_rate:
+            return self._send_bytes('text/html; charset=utf-8', _INTERCEPTED_PAGE)
+
+        route = ROUTES.get((method, path))
+        kwargs = {}
+        if route is None and method == 'GET':
+            match = _GROUP_MESSAGES_PATH.match(path)
+            if match:
+                route, kwargs = StubCentralHandler.group_messages, match.groupdict()
+            elif path == '/':
+                route = StubCentralHandler.health
+            elif path.startswith('/media/'):
+                return self.media(path)
+        if route is None:
+            return self._send_json(404, {'message': f'スタブ: 未対応のAPIです ({method} {self.path})'})
+
+        status, data, headers = route(self, body, **kwargs)
+        if lost:
+            return self._drop()  # 処理は済んだが、応答が失われた
+        self._send_json(status, data, headers)
+
+    def do_GET(self):
+        self._handle('GET')
+
+    def do_POST(self):
+        self._handle('POST')
+
+    # -----------------------------------------------------
+    # 各API
+    # -----------------------------------------------------
+    def health(self, body):
+        return 200, {'status': 'ok'}, None
+
+    def _idempotent_store(self, kind, body, validate=None):
+        payload = json.loads(body or b'{}')
+        key = self.headers.get('Idempotency-Key') or payload.get('id')
+        if not key:
+            return 400, {'message': 'スタブ: 冪等キー (id) がありません'}, None
+        with self.state.lock:
+            if key in self.state.records[kind]:
+                self.state.counters['replayed'] += 1
+                return 409, {'status': 'already_applied', 'id': key}, {'Idempotent-Replayed': 'true'}
+            if validate:
+                error = validate(payload)
+                if error:
+                    return 409, {'message': error}, None
+            self.state.records[kind][key] = payload
+        return 201, {'status': 'created', 'id': key}, None
+
+    def shelter_checkin_sync(self, body):
+        return self._idempotent_store('checkins', body)
+
+    def field_report(self, body):
+        return self._idempotent_store('reports', body)
+
+    def register_field_user(self, body):
+        def validate(payload):
+            if payload.get('username') in self.state.usernames:
+                return 'このログインIDは既に使われています。'
+            self.state.usernames.add(payload.get('username'))
+            return None
+
+        return self._idempotent_store('registrations', body, validate)
+
+    def _query(self, name):
+        return parse_qs(urlsplit(self.path).query).get(name, [None])[0]
+
+    def distribution_items(self, body):
+        with self.state.lock:
+            return 200, {'items': _updated_since(self.state.items, self._query('since'))}, None
+
+    def get_all_users(self, body):
+        with self.state.lock:
+            return 200, {'users': _updated_since(self.state.users, self._query('since'))}, None
+
+    def changes(self, body):
+        cursor = self._query('cursor')
+        wait = min(float(self._query('wait') or 0), 60)
+        return 200, self.state.changes_since(int(cursor) if cursor is not None else None, wait), None
+
+    def check_distribution(self, body):
+        payload = json.loads(body or b'{}')
+        key = (payload.get('username'), payload.get('item_id'))
+        with self.state.lock:
+            already = key in self.state.distributions
+            self.state.distributions.add(key)
+        if already:
+            return 200, {'can_distribute': False, 'message': '既に受け取り済みです。'}, None
+        return 200, {'can_distribute': True, 'message': '配布可能です。受け取りを記録しました。'}, None
+
+    def check_distribution_bulk(self, body):
+        payload = json.loads(body or b'{}')
+        with self.state.lock:
+            results = [{'username': username, 'item_id': item_id,
+                        'can_distribute': (username, item_id) not in self.state.distributions}
+                       for username in payload.get('usernames', []) for item_id in payload.get('item_ids', [])]
+        return 200, {'results': results}, None
+
+    def record_distributions(self, body):
+        payload = json.loads(body or b'{}')
+        with self.state.lock:
+            new = [record for record in payload.get('records', [])
+                   if record.get('id') not in self.state.records['distributions']]
+            for record in new:
+                self.state.records['distributions'][record['id']] = record
+                self.state.distributions.add((record.get('username'), record.get('item_id')))
+            self.state.counters['replayed'] += len(payload.get('records', [])) - len(new)
+        return 200, {'recorded': len(new)}, None
+
+    def get_user_groups(self, body):
+        return 200, {'groups': self.state.groups}, None
+
+    def post_group_message(self, body):
+        content_type = self.headers.get('Content-Type', '')
+        message = BytesParser(policy=HTTP).parsebytes(
+            f'Content-Type: {content_type}\r\n\r\n'.encode('latin-1') + body)
+        fields = {}
+        image_url = ''
+        for part in message.iter_parts() if message.is_multipart() else []:
+            name = part.get_param('name', header='content-disposition')
+            if part.get_filename():
+                image_url = self.state.add_media(part.get_payload(decode=True), part.get_content_type())
+            elif name:
+                fields[name] = part.get_content()
+        group_id = fields.get('group_id', 'all')
+        entry = {
+            'id': str(uuid.uuid4()),
+            'sender': self.headers.get('X-User-Login-Id', ''),
+            'sender_full_name': '',
+            'content': fields.get('message', ''),
+            'image_url': image_url,
+        }
+        with self.state.lock:
+            self.state.messages.setdefault(group_id, []).append(entry)
+        return 200, {**entry, 'message': entry['content']}, None
+
+    def media(self, path):
+        with self.state.lock:
+            found = self.state.media.get(path)
+        if found is None:
+            return self._send_json(404, {'message': 'スタブ: 画像がありません'})
+        self.state.count('media')
+        self._send_bytes(*found)
+
+    def group_messages(self, body, group_id):
+        with self.state.lock:
+            history = list(self.state.messages.get(group_id, [])[-50:])
+        return 200, {'messages': history}, None
+
+
+ROUTES = {
+    ('POST', '/api/shelter-checkin-sync/'): StubCentralHandler.shelter_checkin_sync,
+    ('POST', '/api/field-report/'): StubCentralHandler.field_report,
+    ('POST', '/api/register-field-user/'): StubCentralHandler.register_field_user,
+    ('GET', '/api/distribution-items/'): StubCentralHandler.distribution_items,
+    ('GET', '/api/get-all-users/'): StubCentralHandler.get_all_users,
+    ('GET', '/api/changes/'): StubCentralHandler.changes,
+    ('POST', '/api/check-distribution/'): StubCentralHandler.check_distribution,
+    ('POST', '/api/check-distribution-bulk/'): StubCentralHandler.check_distribution_bulk,
+    ('POST', '/api/record-distributions/'): StubCentralHandler.record_distributions,
+    ('GET', '/api/get-user-groups/'): StubCentralHandler.get_user_groups,
+    ('POST', '/api/post-group-message/'): StubCentralHandler.post_group_message,
+}
+
+
+class StubCentralServer(ThreadingHTTPServer):
+    daemon_threads = True
+
+    def __init__(self, address=('127.0.0.1', 0), conditions=None, state=None):
+        super().__init__(address, StubCentralHandler)
+        self.conditions = conditions or Conditions()
+        self.state = state or CentralState()
+
+    @property
+    def url(self):
+        host, port = self.server_address[:2]
+        return f'http://{host}:{port}'
+
+    def start_background(self):
+        """別スレッドで起動する (テストや loadtest から使う)"""
+        thread = threading.Thread(target=self.serve_forever, name='stub-central', daemon=True)
+        thread.start()
+        return self
+
+    def stop(self):
+        self.shutdown()
+        self.server_close()
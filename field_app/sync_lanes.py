@@ -0,0 +1,177 @@
+# field_app/sync_lanes.py
+"""
+中央サーバーへの送信の優先度 (レーン) と、レーンごとの帯域の上限 (トークンバケット)。
+
+通信断の後には数万件のチェックイン記録がたまっていることがあり、全てを同じ扱いで送ると、
+「食料が本日分で尽きる」という現場レポートがその後ろで待たされる。また、従量課金や衛星回線の
+ような細い回線では、チャットの画像や古い記録の送信が回線を使い切ってしまう。そこで
+- 送信を LANES の4つに分け、sync_data は優先度の高いレーンから順に送る。低いレーンを送っている間も
+  SYNC_LANE_CHECK_SECONDS ごとに急ぎのレーン (critical・registrations) に新しい記録が増えていないか
+  確かめ、あれば先に送る (yield_to_urgent)
+- レーンごとに SYNC_LINK_BYTES_PER_SECOND × SYNC_LANE_SHARES[レーン] バイト/秒でトークンが貯まる
+  バケットを持ち、送る前に送信量 (バイト) 分のトークンを使う。足りなければ貯まるまで待つ (throttle)。
+  大きさが事前に分からない画像の取得は、バケットが空でなくなるまで待ってから取得し、
+  取得した後で使った分を引く (charge。次の取得が待たされる)
+バケットはプロセスの中で共有する (cron で sync_data を別に動かす場合、その分は別に数える)。
+"""
+import asyncio
+import json
+import threading
+import time
+
+from django.db.models import Q
+from django.utils import timezone
+
+import config
+from . import metrics
+
+# 優先度の高い順
+CRITICAL, REGISTRATIONS, CHECKINS, BULK = 'critical', 'registrations', 'checkins', 'bulk'
+LANES = (CRITICAL, REGISTRATIONS, CHECKINS, BULK)
+
+# critical レーンで送る現場レポートの食料の残量
+CRITICAL_FOOD_STOCK = ('critical',)
+
+
+def critical_reports():
+    """critical レーンで送る、未送信の現場レポート"""
+    from .models import UnsyncedFieldReport
+    return UnsyncedFieldReport.objects.filter(is_synced=False, food_stock__in=CRITICAL_FOOD_STOCK)
+
+
+def bulk_reports():
+    """bulk レーンで送る、残りの未送信の現場レポート"""
+    from .models import UnsyncedFieldReport
+    return UnsyncedFieldReport.objects.filter(is_synced=False).exclude(food_stock__in=CRITICAL_FOOD_STOCK)
+
+
+def pending_registrations():
+    """送信する仮登録 (エラーになったものは、スタッフが直すまで送らない)"""
+    from .models import UnsyncedUserRegistration
+    return UnsyncedUserRegistration.objects.filter(Q(sync_error__isnull=True) | Q(sync_error=''), is_synced=False)
+
+
+# 低いレーンの送信に割り込むレーンと、新しい記録が増えたかを確かめるための (未送信の行, 日時フィールド)
+# (チェックイン記録は入所中ずっと増え続けるため、bulk レーンへの割り込みはせず送る順番だけで優先する)
+_URGENT = {
+    CRITICAL: (critical_reports, 'timestamp'),
+    REGISTRATIONS: (pending_registrations, 'created_at'),
+}
+
+
+def arrived_since(since, lane):
+    """lane より優先度の高い急ぎのレーンのうち、since 以降に未送信の記録が増えたレーンを優先度順に返す"""
+    lanes = []
+    for higher in LANES[:LANES.index(lane)]:
+        if higher not in _URGENT:
+            continue
+        queryset, time_field = _URGENT[higher]
+        if queryset().filter(**{f'{time_field}__gte': since}).exists():
+            lanes.append(higher)
+    return lanes
+
+
+def yield_to_urgent(records, lane, send_urgent, interval=None):
+    """
+    lane のレコード (records) を1件ずつ返しながら、interval 秒ごとに上の急ぎのレーンに新しい記録が
+    増えていないか確かめ、あれば send_urgent(レーンのリスト) で先に送らせてから続けるジェネレータ。
+    送れずに残った記録で何度も割り込まないよう、前回確かめた後に増えたものだけを見る。
+    """
+    interval = config.SYNC_LANE_CHECK_SECONDS if interval is None else interval
+    checked_at = timezone.now()
+    next_check = time.monotonic() + interval
+    for record in records:
+        if time.monotonic() >= next_check:
+            now = timezone.now()
+            lanes = arrived_since(checked_at, lane)
+            checked_at = now
+            if lanes:
+                send_urgent(lanes)
+            next_check = time.monotonic() + interval
+        yield record
+
+
+# =========================================================
+# 帯域の上限 (トークンバケット)
+# =========================================================
+class TokenBucket:
+    """rate バイト/秒で burst バイトまで貯まるバケット"""
+
+    def __init__(self, rate, burst):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self.updated = time.monotonic()
+        self.lock = threading.Lock()
+
+    def reserve(self, nbytes):
+        """
+        nbytes 分のトークンを使い、送ってよくなるまでの秒数を返す。
+        足りない分は前借りする (後から来た送信は、前借りを返し終わるまで待つことになる)
+        """
+        with self.lock:
+            now = time.monotonic()
+            self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+            self.updated = now
+            self.tokens -= nbytes
+            return max(0.0, -self.tokens / self.rate)
+
+
+_buckets = {}
+_buckets_lock = threading.Lock()
+
+
+def lane_rate(lane):
+    """lane が使ってよい帯域 (バイト/秒)。上限が無ければ None"""
+    share = config.SYNC_LANE_SHARES.get(lane)
+    if not config.SYNC_LINK_BYTES_PER_SECOND or share is None:
+        return None
+    return config.SYNC_LINK_BYTES_PER_SECOND * share
+
+
+def _bucket(lane):
+    rate = lane_rate(lane)
+    if rate is None:
+        return None
+    with _buckets_lock:
+        bucket = _buckets.get(lane)
+        if bucket is None or bucket.rate != rate:  # 設定が変わったら作り直す
+            bucket = _buckets[lane] = TokenBucket(rate, rate * config.SYNC_LANE_BURST_SECONDS)
+    return bucket
+
+
+def _reserve(lane, nbytes):
+    bucket = _bucket(lane)
+    wait = bucket.reserve(nbytes) if bucket is not None else 0.0
+    metrics.record_lane_traffic(lane, nbytes, wait)
+    return wait
+
+
+def payload_size(payload):
+    """JSONで送る payload のおおよそのバイト数"""
+    return len(json.dumps(payload).encode('utf-8'))
+
+
+def throttle(lane, nbytes):
+    """lane で nbytes を送る前に呼ぶ。帯域の上限を超えないよう、必要なら待つ"""
+    wait = _reserve(lane, nbytes)
+    if wait:
+        time.sleep(wait)
+
+
+async def throttle_async(lane, nbytes):
+    """throttle の非同期版 (イベントループを止めずに待つ)"""
+    wait = _reserve(lane, nbytes)
+    if wait:
+        await asyncio.sleep(wait)
+
+
+def charge(lane, nbytes):
+    """送受信した後で分かった量を引く (待たずに前借りし、次の送信を待たせる)"""
+    _reserve(lane, nbytes)
+
+
+def reset():
+    """バケットを捨てる (設定の変更後やテスト用)"""
+    with _buckets_lock:
+        _buckets.clear()
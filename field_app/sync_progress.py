@@ -0,0 +1,151 @@
+# field_app/sync_progress.py
+"""
+同期 (sync_data) の進み具合を、画面 (ホーム画面の進捗バー) に伝えるための共有ファイル。
+
+sync_data は手動同期では別プロセス、スケジューラではスレッドで動くため、進み具合は
+SYNC_PROGRESS_PATH の小さなJSONファイルに書き出す。書き込みは SYNC_PROGRESS_WRITE_INTERVAL_MS
+ごとにまとめ、送信1件ごとにはSDカードへ書かない。読む側 (views.sync_progress_stream_view) は
+ファイルの更新時刻だけを見て、変わったときだけ読み直して Server-Sent Events で送る。
+
+ファイルの内容:
+    {"run_id": "...", "pid": 123, "state": "running" | "done" | "aborted",
+     "started_at": ..., "updated_at": ..., "current": "checkins",
+     "streams": {"checkins": {"label": "チェックイン記録", "done": 120, "total": 500,
+                              "errors": 2, "rate": 35.2, "finished": false}, ...}}
+"""
+import json
+import os
+import time
+import uuid
+
+import config
+
+RUNNING, DONE, ABORTED = 'running', 'done', 'aborted'
+
+
+class SyncProgress:
+    """1回の同期処理の進み具合を書き出す (sync_data から使う)"""
+
+    def __init__(self, path=None):
+        self.path = path or config.SYNC_PROGRESS_PATH
+        now = time.time()
+        self.state = {
+            'run_id': uuid.uuid4().hex,
+            'pid': os.getpid(),
+            'state': RUNNING,
+            'started_at': now,
+            'updated_at': now,
+            'current': None,
+            'streams': {},
+        }
+        self._stream_started = {}
+        self._last_write = 0.0
+        self._write()
+
+    def begin(self, stream, label, total):
+        """stream (checkins など) の送信を始める"""
+        self.state['current'] = stream
+        self.state['streams'][stream] = {'label': label, 'done': 0, 'total': total, 'errors': 0,
+                                         'rate': 0.0, 'finished': False}
+        self._stream_started[stream] = time.monotonic()
+        self._write()
+
+    def record(self, stream, ok=True):
+        """1件の送信結果を記録する (書き出しは間隔をあけてまとめて行う)"""
+        entry = self.state['streams'][stream]
+        entry['done'] += 1
+        if not ok:
+            entry['errors'] += 1
+        elapsed = time.monotonic() - self._stream_started[stream]
+        entry['rate'] = round(entry['done'] / elapsed, 1) if elapsed > 0 else 0.0
+        if time.monotonic() - self._last_write >= config.SYNC_PROGRESS_WRITE_INTERVAL_MS / 1000:
+            self._write()
+
+    def end(self, stream):
+        self.state['streams'][stream]['finished'] = True
+        self._write()
+
+    def finish(self, state=DONE):
+        self.state['state'] = state
+        self.state['current'] = None
+        self._write()
+
+    def _write(self):
+        self._last_write = time.monotonic()
+        self.state['updated_at'] = time.time()
+        try:
+            os.makedirs(os.path.dirname(self.path), exist_ok=True)
+            tmp_path = f'{self.path}.{os.getpid()}.tmp'
+            with open(tmp_path, 'w', encoding='utf-8') as f:
+                json.dump(self.state, f, ensure_ascii=False)
+            os.replace(tmp_path, self.path)
+        except OSError:
+            pass  # 表示用なので、書けなくても同期は続ける
+
+
+def version(path=None):
+    """ファイルが変わったかを見るための値 (無ければ None)。stat だけで読み込みはしない"""
+    try:
+        return os.stat(path or config.SYNC_PROGRESS_PATH).st_mtime_ns
+    except OSError:
+        return None
+
+
+def read(path=None):
+    """最新の進み具合を読み込む (無ければ None)"""
+    try:
+        with open(path or config.SYNC_PROGRESS_PATH, encoding='utf-8') as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return None
+
+
+def is_running(progress):
+    """同期が実行中か (途中で落ちたプロセスの 'running' は、更新が途絶えたら実行中とみなさない)"""
+    return (progress is not None and progress.get('state') == RUNNING
+            and time.time() - progress.get('updated_at', 0) < config.SYNC_PROGRESS_STALE_SECONDS)
+
+
+class EventStream:
+    """
+    進み具合を Server-Sent Events として送る内容を作る (views.sync_progress_stream_view)。
+    SYNC_PROGRESS_POLL_SECONDS ごとに step() を呼ぶと、ファイルが変わっていれば progress イベントを、
+    しばらく送るものが無ければ keep-alive のコメントを返す。同期が行われていない状態が
+    idle_seconds (省略時は SYNC_PROGRESS_IDLE_SECONDS) 続いたら closed を True にする
+    (ブラウザが後で繋ぎ直す)。idle_seconds=0 なら、同期が行われていなければ現在の状態を1回送って閉じる。
+    """
+    KEEP_ALIVE_SECONDS = 15
+
+    def __init__(self, idle_seconds=None):
+        self.idle_seconds = config.SYNC_PROGRESS_IDLE_SECONDS if idle_seconds is None else idle_seconds
+        self.closed = False
+        self._version = object()  # 最初の step() で必ず現在の状態を送る
+        self._progress = None
+        self._last_sent = time.monotonic()
+        self._idle_since = None
+
+    def first(self):
+        return f'retry: {config.SYNC_PROGRESS_RETRY_MS}\n\n'
+
+    def step(self):
+        now = time.monotonic()
+        chunk = ''
+        current = version()
+        if current != self._version:
+            self._version = current
+            self._progress = read()
+            data = dict(self._progress or {}, running=is_running(self._progress))
+            chunk = f'event: progress\ndata: {json.dumps(data, ensure_ascii=False)}\n\n'
+        elif now - self._last_sent >= self.KEEP_ALIVE_SECONDS:
+            chunk = ': keep-alive\n\n'  # 切断されたクライアントを検出するためにも送る
+        if chunk:
+            self._last_sent = now
+
+        if is_running(self._progress):
+            self._idle_since = None
+        else:
+            if self._idle_since is None:
+                self._idle_since = now
+            if now - self._idle_since >= self.idle_seconds:
+                self.closed = True
+        return chunk
@@ -0,0 +1,371 @@
+# field_app/tasks.py
+"""
+同期・マスタデータ取得・疎通確認を定期的に実行する、プロセス内のスケジューラ。
+
+cron で sync_data を固定間隔で実行する代わりに、web サーバーのプロセス内で
+バックグラウンドスレッドとして動かす (wsgi.py / asgi.py から start() を呼ぶ)。
+cron や systemd で別に動かしたい場合は `manage.py run_scheduler` を使う。
+
+実行間隔は状況に応じて変わる。
+- 同期 (sync)   : 中央サーバーに繋がっていて未同期件数が増えている間は短く、
+                  増えていなければ基本間隔に戻し、繋がらない間は倍々に延ばす
+- 疎通確認 (health) : 失敗が続く間は倍々に延ばし、復旧したらすぐに同期を走らせる
+- マスタデータ (master) : 失敗したときだけ延ばす
+- 炊き出しの事前確認 (prewarm) : 配布の予定時刻の前に1回だけ (config.DISTRIBUTION_TIMES がある場合のみ)
+- アーカイブ (archive) : 保持期間を過ぎた同期済みレコードを固定間隔でアーカイブへ移し、空き領域を解放する
+中央サーバーからの変更通知 (change_feed) を受信している間は、マスタデータは通知を受けた
+種類だけを差分で取り直し、定期取得は取りこぼし対策として基本間隔のままにする。
+通知が途切れたら、定期取得の間隔を CHANGE_FEED_FALLBACK_POLL_SECONDS に縮める。
+同じ避難所のラズパイとのピア同期 (config.PEER_URLS がある場合のみ) も、LAN内を数秒おきに
+取得するため、変更通知と同じくジョブとは別のスレッド (peer_sync.PeerSyncWorker) で動かす。
+どの間隔にも ±SCHEDULER_JITTER_RATIO の揺らぎを加え、多数のラズパイが
+同じ秒に中央サーバーへ集中しないようにする。
+
+gunicorn のワーカーなど複数のプロセスで start() が呼ばれても、ロックファイルを
+取れた1プロセスだけが実行する。実行状態は SCHEDULER_STATE_PATH に書き出すので、
+どのプロセスの home_view からも read_status() で表示できる。
+"""
+import io
+import json
+import logging
+import os
+import random
+import subprocess
+import sys
+import threading
+import time
+
+import requests
+from django.core.management import call_command
+from django.db import close_old_connections
+
+import config
+from . import archive, change_feed, distribution_cache, metrics, peer_sync
+from .utils import central_request, forget_active_central_url, get_active_central_url
+
+try:
+    import fcntl
+except ImportError:  # Windows の開発環境
+    fcntl = None
+    import msvcrt
+
+logger = logging.getLogger('field_app.tasks')
+
+_scheduler = None
+_scheduler_lock = threading.Lock()
+
+
+class Job:
+    """スケジューラで実行する処理1つ分の設定と、直近の実行状態"""
+
+    def __init__(self, name, label, func, interval, min_interval=None, max_interval=None):
+        self.name = name
+        self.label = label
+        self.func = func
+        self.base_interval = interval
+        self.min_interval = min_interval or interval
+        self.max_interval = max_interval or interval
+        self.interval = interval
+        self.next_run = 0.0
+        self.last_run = None
+        self.last_success = None
+        self.last_duration = None
+        self.last_result = None
+        self.last_error = ''
+        self.failures = 0
+
+    def as_dict(self):
+        return {
+            'name': self.name,
+            'label': self.label,
+            'interval': round(self.interval, 1),
+            'next_run': self.next_run,
+            'last_run': self.last_run,
+            'last_success': self.last_success,
+            'last_duration': self.last_duration,
+            'last_result': self.last_result,
+            'last_error': self.last_error,
+            'failures': self.failures,
+        }
+
+
+def _jittered(seconds):
+    ratio = config.SCHEDULER_JITTER_RATIO
+    return seconds * random.uniform(1 - ratio, 1 + ratio)
+
+
+class Scheduler:
+
+    def __init__(self, clock=time.time):
+        self.clock = clock            # 現在時刻 (テストでは進め方を決められる時計に差し替える)
+        self.central_ok = None        # 直近の疎通確認の結果 (未確認なら None)
+        self._last_backlog = None
+        self._prewarmed_slot = None   # 事前確認を済ませた配布の予定時刻
+        self._wakeup = threading.Event()
+        self._stopped = False
+        self._thread = None
+
+        self.jobs = [
+            Job('health', '疎通確認', self.check_health,
+                config.SCHEDULER_HEALTH_INTERVAL_SECONDS,
+                max_interval=config.SCHEDULER_MAX_INTERVAL_SECONDS),
+            Job('sync', 'データ同期', self.run_sync,
+                config.SCHEDULER_SYNC_INTERVAL_SECONDS,
+                min_interval=config.SCHEDULER_SYNC_MIN_INTERVAL_SECONDS,
+                max_interval=config.SCHEDULER_MAX_INTERVAL_SECONDS),
+            Job('master', 'マスタデータ取得', self.run_fetch_master,
+                config.SCHEDULER_MASTER_INTERVAL_SECONDS,
+                max_interval=max(config.SCHEDULER_MASTER_INTERVAL_SECONDS, config.SCHEDULER_MAX_INTERVAL_SECONDS)),
+            Job('archive', 'アーカイブ', self.run_archive, config.SCHEDULER_ARCHIVE_INTERVAL_SECONDS),
+        ]
+        if config.DISTRIBUTION_TIMES:
+            self.jobs.append(Job('prewarm', '炊き出しの事前確認', self.run_prewarm_distribution,
+                                 config.SCHEDULER_PREWARM_CHECK_SECONDS))
+        self.change_feed = None
+        if config.CHANGE_FEED_ENABLED:
+            self.change_feed = change_feed.ChangeFeedListener(on_state_change=self.change_feed_state_changed)
+        self.peer_sync = peer_sync.PeerSyncWorker() if config.PEER_URLS else None
+
+        # 起動直後に全台が一斉に問い合わせないよう、初回もずらす
+        now = self.clock()
+        for job in self.jobs:
+            job.next_run = now + random.uniform(0, min(job.base_interval, 10))
+
+    def job(self, name):
+        return next(job for job in self.jobs if job.name == name)
+
+    # -----------------------------------------------------
+    # 各ジョブ (戻り値は結果の表示用。失敗は例外で知らせる)
+    # -----------------------------------------------------
+    def check_health(self):
+        try:
+            central_request('get', get_active_central_url(), endpoint='health',
+                            timeout=5, verify=config.VERIFY_SSL)
+        except requests.exceptions.RequestException:
+            # 次回は別の候補URLも試せるように、接続先のキャッシュを捨てる
+            forget_active_central_url()
+            self.central_ok = False
+            raise
+        recovered = self.central_ok is False
+        self.central_ok = True
+        if recovered:
+            # 復旧したら、たまっている分をすぐに送る
+            logger.info('中央サーバーとの接続が復旧しました。同期を前倒しします。')
+            self.job('sync').interval = self.job('sync').base_interval
+            self.job('sync').next_run = self.clock()
+        return 'ok'
+
+    def run_sync(self):
+        if self.central_ok is False:
+            return 'skipped'
+        call_command('sync_data', stdout=io.StringIO(), stderr=io.StringIO())
+        return 'ok'
+
+    def run_fetch_master(self):
+        if self.central_ok is False:
+            return 'skipped'
+        call_command('fetch_master_data', stdout=io.StringIO(), stderr=io.StringIO())
+        return 'ok'
+
+    def change_feed_state_changed(self, connected):
+        """変更通知の受信状態に合わせて、マスタデータの定期取得の間隔を切り替える (通知のスレッドから呼ばれる)"""
+        master = self.job('master')
+        if connected:
+            master.base_interval = master.interval = config.SCHEDULER_MASTER_INTERVAL_SECONDS
+            return
+        fallback = min(config.CHANGE_FEED_FALLBACK_POLL_SECONDS, config.SCHEDULER_MASTER_INTERVAL_SECONDS)
+        master.base_interval = master.interval = fallback
+        master.next_run = min(master.next_run, self.clock() + _jittered(fallback))
+        self._wakeup.set()
+
+    def run_prewarm_distribution(self):
+        slot = distribution_cache.due_slot()
+        if slot is None or slot == self._prewarmed_slot or self.central_ok is False:
+            return 'skipped'  # 失敗した場合は、予定時刻までの次の確認で再び試す
+        stored = distribution_cache.prewarm()
+        self._prewarmed_slot = slot
+        return f'{stored}件'
+
+    def run_archive(self):
+        moved = archive.archive_synced()
+        if any(moved.values()):
+            archive.incremental_vacuum()
+        return f'{sum(moved.values())}件'
+
+    # -----------------------------------------------------
+    # 間隔の調整
+    # -----------------------------------------------------
+    def _backlog_total(self):
+        metrics.refresh_backlog()
+        return metrics.backlog_total()
+
+    def next_interval(self, job, failed):
+        if job.name == 'sync':
+            if failed or self.central_ok is False:
+                return min(job.interval * 2, job.max_interval)
+            backlog = self._backlog_total()
+            growing = self._last_backlog is not None and backlog > self._last_backlog
+            self._last_backlog = backlog
+            if growing:
+                return max(job.interval / 2, job.min_interval)
+            # 増えていなければ、基本間隔まで少しずつ戻す
+            if job.interval < job.base_interval:
+                return min(job.interval * 2, job.base_interval)
+            return job.base_interval
+        if failed:
+            return min(job.interval * 2, job.max_interval)
+        return job.base_interval
+
+    # -----------------------------------------------------
+    # 実行ループ
+    # -----------------------------------------------------
+    def run_job(self, job):
+        close_old_connections()
+        started = self.clock()
+        failed = False
+        try:
+            job.last_result = job.func()
+            job.last_error = ''
+            job.failures = 0
+            if job.last_result != 'skipped':
+                job.last_success = started
+        except Exception as e:
+            failed = True
+            job.failures += 1
+            job.last_result = 'error'
+            job.last_error = f'{type(e).__name__}: {e}'[:200]
+            if job.name == 'health':
+                logger.warning('中央サーバーに接続できません (%d回連続)', job.failures)
+            else:
+                logger.exception('%s に失敗しました', job.label)
+        finally:
+            close_old_connections()
+        job.last_run = started
+        job.last_duration = self.clock() - started
+        job.interval = self.next_interval(job, failed)
+        job.next_run = self.clock() + _jittered(job.interval)
+
+    def run_forever(self):
+        while not self._stopped:
+            job = min(self.jobs, key=lambda j: j.next_run)
+            delay = job.next_run - self.clock()
+            if delay > 0:
+                # 他のジョブの next_run が前倒しされた場合に備え、最大1秒ごとに見直す
+                self._wakeup.wait(min(delay, 1.0))
+                self._wakeup.clear()
+                continue
+            self.run_job(job)
+            try:
+                self.write_status()
+            except OSError as e:
+                # 表示用の状態ファイルが書けなくても (SDカードの容量不足など)、ジョブは止めない
+                logger.warning('スケジューラの実行状態を書き出せませんでした: %s', e)
+
+    def write_status(self):
+        status = {
+            'pid': os.getpid(),
+            'updated_at': self.clock(),
+            'central_ok': self.central_ok,
+            'jobs': [job.as_dict() for job in self.jobs],
+            'change_feed': self.change_feed.as_dict() if self.change_feed else None,
+            'peer_sync': self.peer_sync.as_dict() if self.peer_sync else None,
+        }
+        os.makedirs(os.path.dirname(config.SCHEDULER_STATE_PATH), exist_ok=True)
+        tmp_path = config.SCHEDULER_STATE_PATH + '.tmp'
+        with open(tmp_path, 'w', encoding='utf-8') as f:
+            json.dump(status, f, ensure_ascii=False)
+        os.replace(tmp_path, config.SCHEDULER_STATE_PATH)
+
+    def start(self):
+        self._thread = threading.Thread(target=self.run_forever, name='field-scheduler', daemon=True)
+        self._thread.start()
+        if self.change_feed:
+            self.change_feed.start()
+        if self.peer_sync:
+            self.peer_sync.start()
+
+    def stop(self):
+        self._stopped = True
+        self._wakeup.set()
+        if self.change_feed:
+            self.change_feed.stop()
+        if self.peer_sync:
+            self.peer_sync.stop()
+
+
+def _acquire_leader_lock():
+    """スケジューラを動かすプロセスを1つに絞るためのロック。取れればファイルを返す"""
+    os.makedirs(os.path.dirname(config.SCHEDULER_LOCK_PATH), exist_ok=True)
+    f = open(config.SCHEDULER_LOCK_PATH, 'a+')
+    try:
+        if fcntl is not None:
+            fcntl.flock(f.fileno(), fcntl.LOCK_EX | fcntl.LOCK_NB)
+        else:
+            msvcrt.locking(f.fileno(), msvcrt.LK_NBLCK, 1)
+    except OSError:
+        f.close()
+        return None
+    return f
+
+
+def start():
+    """
+    スケジューラをバックグラウンドスレッドで起動する。
+    無効化されている場合や、別のプロセスが既に動かしている場合は何もしない。
+    """
+    global _scheduler
+    if not config.SCHEDULER_ENABLED:
+        return None
+    with _scheduler_lock:
+        if _scheduler is not None:
+            return _scheduler
+        lock_file = _acquire_leader_lock()
+        if lock_file is None:
+            logger.debug('スケジューラは別のプロセスで動作中です')
+            return None
+        _scheduler = Scheduler()
+        _scheduler.lock_file = lock_file  # プロセスが終わるまでロックを持ち続ける
+        _scheduler.start()
+        logger.info('スケジューラを起動しました (pid=%d)', os.getpid())
+        return _scheduler
+
+
+def request_sync():
+    """
+    同期をすぐに実行させる (管理画面の「今すぐ再送」など)。
+    このプロセスでスケジューラが動いていれば次の同期を前倒しし、
+    そうでなければ手動同期と同様に sync_data を別プロセスで起動する。
+    """
+    scheduler = _scheduler
+    if scheduler is not None:
+        scheduler.job('sync').next_run = scheduler.clock()
+        scheduler._wakeup.set()
+        return
+    subprocess.Popen([sys.executable, os.path.join(config.BASE_DIR, 'manage.py'), 'sync_data'])
+
+
+def read_status():
+    """
+    スケジューラの実行状態を、画面表示用に読み込む (動いていなければ None)。
+    時刻は datetime に変換して返す。
+    """
+    from datetime import datetime, timezone as dt_timezone
+
+    try:
+        with open(config.SCHEDULER_STATE_PATH, encoding='utf-8') as f:
+            status = json.load(f)
+    except (OSError, ValueError):
+        return None
+
+    def to_datetime(value):
+        return datetime.fromtimestamp(value, tz=dt_timezone.utc) if value else None
+
+    for job in status['jobs']:
+        for key in ('next_run', 'last_run', 'last_success'):
+            job[key] = to_datetime(job[key])
+    if status.get('change_feed'):
+        status['change_feed']['last_event'] = to_datetime(status['change_feed']['last_event'])
+    if status.get('peer_sync'):
+        status['peer_sync']['last_run'] = to_datetime(status['peer_sync']['last_run'])
+    status['updated_at'] = to_datetime(status['updated_at'])
+    return status
@@ -0,0 +1,1608 @@
+import asyncio
+import datetime
+import io
+import json
+import logging
+import os
+import re
+import shutil
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+import uuid
+from collections import Counter
+from contextlib import contextmanager
+
+import requests
+from django.conf import settings
+from django.contrib.admin import site as admin_site
+from django.contrib.auth.hashers import PBKDF2PasswordHasher, identify_hasher
+from django.core.cache import cache
+from django.core.management import call_command
+from django.core.management.base import CommandError
+from django.db import connection
+from django.test import SimpleTestCase, TestCase, TransactionTestCase, override_settings
+from django.test.utils import CaptureQueriesContext
+from django.urls import reverse
+from django.utils import timezone
+
+import config
+from . import (archive, bundles, change_feed, checkin_journal, checkin_status, circuit_breaker, distribution_cache,
+               hashers, log_handlers, media_cache, metrics, name_search, peer_sync, profiling, sync_lanes,
+               sync_progress, tasks, user_index, utils)
+from .admin import EstimatedCountPaginator
+from .forms import FieldSignUpForm
+from .report_coalescing import coalesce_field_reports
+from .stub_central import CentralState, Conditions, StubCentralServer
+from .models import (CheckinStatus, DistributionItem, PeerCursor, UnsyncedCheckin, UnsyncedDistribution,
+                     UnsyncedFieldReport, UnsyncedUserRegistration, User)
+
+
+@contextmanager
+def override_config(**values):
+    """config.py の値を一時的に書き換える"""
+    original = {name: getattr(config, name) for name in values}
+    for name, value in values.items():
+        setattr(config, name, value)
+    try:
+        yield
+    finally:
+        for name, value in original.items():
+            setattr(config, name, value)
+
+
+@contextmanager
+def override_attribute(obj, name, value):
+    """オブジェクトの属性を一時的に書き換える (登録済みの ModelAdmin の設定など)"""
+    original = getattr(obj, name)
+    setattr(obj, name, value)
+    try:
+        yield
+    finally:
+        setattr(obj, name, original)
+
+
+class BufferedLogHandlerTests(SimpleTestCase):
+    """SDカード向けのバッファ付きログハンドラ"""
+
+    def test_flush_rotates_past_max_bytes_and_keeps_writing(self):
+        tmpdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, tmpdir)
+        path = os.path.join(tmpdir, 'field_app.log')
+        handler = log_handlers.BufferedRotatingFileHandler(path, max_bytes=200, backup_count=5, capacity=1000,
+                                                           flush_interval=3600)
+        self.addCleanup(handler.close)
+        for i in range(20):
+            handler.emit(logging.LogRecord('field_app', logging.INFO, __file__, 0, f'line {i:02d} ' + 'x' * 20,
+                                           (), None))
+        handler.flush()
+
+        with open(path, encoding='utf-8') as f:
+            current = f.read()
+        with open(path + '.1', encoding='utf-8') as f:
+            rotated = f.read()
+        self.assertIn('line 19', current)
+        self.assertTrue(rotated.strip())
+        # ローテーションをまたいでも1行も失われない
+        written = ''
+        for name in sorted(os.listdir(tmpdir), reverse=True):
+            with open(os.path.join(tmpdir, name), encoding='utf-8') as f:
+                written += f.read()
+        self.assertEqual(written.splitlines(), [f'line {i:02d} ' + 'x' * 20 for i in range(20)])
+
+
+class AsyncClientTests(SimpleTestCase):
+    """async ビューから中央サーバーへ送るときの httpx.AsyncClient"""
+
+    def test_client_is_closed_unless_the_loop_is_long_lived(self):
+        async def clients():
+            # WSGI のように、リクエストごとに作られて閉じられるループ
+            async with utils._async_client() as first:
+                pass
+            # ASGI サーバーのように動き続けるループ (asgi.py)
+            utils.use_shared_async_client()
+            async with utils._async_client() as shared:
+                pass
+            async with utils._async_client() as again:
+                pass
+            closed = shared.is_closed
+            await shared.aclose()
+            return first, shared, again, closed
+
+        first, shared, again, closed = asyncio.run(clients())
+        self.assertTrue(first.is_closed)
+        self.assertIs(shared, again)
+        self.assertFalse(closed)
+
+
+class CircuitBreakerTests(SimpleTestCase):
+    """中央サーバーごとのサーキットブレーカーの状態遷移"""
+
+    def setUp(self):
+        self.now = 1000.0
+        self.enterContext(override_config(CENTRAL_BREAKER_FAILURE_THRESHOLD=3, CENTRAL_BREAKER_COOLDOWN_SECONDS=30))
+        self.breaker = circuit_breaker.CircuitBreaker('http://central.test', clock=lambda: self.now)
+
+    def open_breaker(self):
+        for _ in range(3):
+            self.breaker.before_request()
+            self.breaker.record_failure('HTTP 503')
+
+    def test_opens_after_consecutive_failures(self):
+        for _ in range(2):
+            self.breaker.before_request()
+            self.breaker.record_failure('HTTP 503')
+        self.breaker.record_success()  # 途中で成功すれば数え直す
+        for _ in range(2):
+            self.breaker.record_failure('HTTP 503')
+        self.assertEqual(self.breaker.state, circuit_breaker.CLOSED)
+        self.breaker.record_failure('HTTP 503')
+        self.assertEqual(self.breaker.state, circuit_breaker.OPEN)
+
+    def test_fails_fast_during_the_cooldown(self):
+        self.open_breaker()
+        self.now += 10
+        with self.assertRaises(circuit_breaker.CircuitOpenError) as raised:
+            self.breaker.before_request()
+        self.assertEqual(raised.exception.retry_after, 20)
+        self.assertTrue(self.breaker.is_open())
+
+        # 共有のブレーカーが開いていれば、中央サーバーへは送信しない (接続エラーではなく CircuitOpenError)
+        url = 'http://breaker-test.invalid'
+        shared = circuit_breaker.breaker_for(url)
+        self.addCleanup(circuit_breaker._breakers.pop, circuit_breaker.target_of(url))
+        for _ in range(3):
+            shared.record_failure('HTTP 503')
+        with self.assertRaises(circuit_breaker.CircuitOpenError):
+            utils.central_request('get', url, timeout=1)
+
+    def test_only_one_probe_is_sent_after_the_cooldown(self):
+        self.open_breaker()
+        self.now += 30
+        self.assertFalse(self.breaker.is_open())
+        self.breaker.before_request()  # 試しの1件
+        self.assertEqual(self.breaker.state, circuit_breaker.HALF_OPEN)
+        with self.assertRaises(circuit_breaker.CircuitOpenError):
+            self.breaker.before_request()
+        # 試しの1件が打ち切られたら、次の1件を試せる
+        self.breaker.abandon()
+        self.breaker.before_request()
+
+    def test_probe_result_closes_or_reopens(self):
+        self.open_breaker()
+        self.now += 30
+        self.breaker.before_request()
+        self.breaker.record_failure('timeout')
+        self.assertEqual(self.breaker.state, circuit_breaker.OPEN)
+        self.assertEqual(self.breaker.retry_after(), 30)  # クールダウンをやり直す
+
+        self.now += 30
+        self.breaker.before_request()
+        self.breaker.record_success()
+        self.assertEqual(self.breaker.state, circuit_breaker.CLOSED)
+        self.assertEqual(self.breaker.failures, 0)
+        self.breaker.before_request()
+        self.breaker.before_request()  # 閉じていれば同時に何件でも送れる
+
+
+class SchedulerTests(SimpleTestCase):
+    """スケジューラの間隔調整・ジッター・リーダーロック (時計は進め方を決められるものに差し替える)"""
+
+    def setUp(self):
+        self.now = 1000.0
+        self.tmpdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.tmpdir, ignore_errors=True)
+        self.enterContext(override_config(
+            SCHEDULER_HEALTH_INTERVAL_SECONDS=30, SCHEDULER_SYNC_INTERVAL_SECONDS=60,
+            SCHEDULER_SYNC_MIN_INTERVAL_SECONDS=10, SCHEDULER_MAX_INTERVAL_SECONDS=400,
+            SCHEDULER_JITTER_RATIO=0, CHANGE_FEED_ENABLED=False, PEER_URLS=[], DISTRIBUTION_TIMES=[],
+            SCHEDULER_STATE_PATH=os.path.join(self.tmpdir, 'scheduler.json'),
+            SCHEDULER_LOCK_PATH=os.path.join(self.tmpdir, 'scheduler.lock')))
+        self.scheduler = tasks.Scheduler(clock=lambda: self.now)
+
+    def run_sync(self, backlog, func=lambda: 'ok'):
+        """未同期件数が backlog の状態で同期ジョブを1回動かし、次の間隔を返す"""
+        sync = self.scheduler.job('sync')
+        sync.func = func
+        self.scheduler._backlog_total = lambda: backlog
+        self.now += sync.interval
+        self.scheduler.run_job(sync)
+        self.assertEqual(sync.next_run, self.now + sync.interval)
+        return sync.interval
+
+    def test_sync_interval_follows_the_backlog(self):
+        self.scheduler.central_ok = True
+        # 未同期件数が増えている間は最短間隔まで縮め、止まったら基本間隔まで少しずつ戻す
+        intervals = [self.run_sync(backlog) for backlog in (100, 200, 400, 800, 1600, 1600, 1600, 1600)]
+        self.assertEqual(intervals, [60, 30, 15, 10, 10, 20, 40, 60])
+
+    def test_sync_interval_backs_off_while_failing(self):
+        self.scheduler.central_ok = True
+
+        def fail():
+            raise requests.exceptions.ConnectionError('unreachable')
+
+        with self.assertLogs('field_app.tasks', 'ERROR'):
+            intervals = [self.run_sync(0, fail) for _ in range(4)]
+        self.assertEqual(intervals, [120, 240, 400, 400])
+        self.assertEqual(self.scheduler.job('sync').failures, 4)
+
+        # 中央サーバーに届かない間は、同期自体が成功しても縮めない
+        self.scheduler.central_ok = False
+        self.assertEqual(self.run_sync(0), 400)
+        self.assertEqual(self.scheduler.job('sync').failures, 0)
+
+    def test_health_recovery_brings_the_sync_forward(self):
+        with socket.socket() as sock:
+            sock.bind(('127.0.0.1', 0))
+            closed_url = f'http://127.0.0.1:{sock.getsockname()[1]}'
+        self.addCleanup(circuit_breaker._breakers.pop, circuit_breaker.target_of(closed_url), None)
+        self.addCleanup(utils.forget_active_central_url)
+        health = self.scheduler.job('health')
+        sync = self.scheduler.job('sync')
+        sync.interval = 400
+
+        with override_config(CENTRAL_SERVER_URLS=[closed_url], CENTRAL_BREAKER_FAILURE_THRESHOLD=10 ** 6):
+            utils.forget_active_central_url()
+            with self.assertLogs('field_app.tasks', 'WARNING'):
+                for expected in (60, 120, 240):
+                    self.scheduler.run_job(health)
+                    self.assertEqual(health.interval, expected)
+        self.assertIs(self.scheduler.central_ok, False)
+        self.assertEqual(health.failures, 3)
+
+        server = StubCentralServer(conditions=Conditions(), state=CentralState()).start_background()
+        self.addCleanup(server.stop)
+        self.now += 240
+        with override_config(CENTRAL_SERVER_URLS=[server.url]):
+            utils.forget_active_central_url()
+            self.scheduler.run_job(health)
+        self.assertIs(self.scheduler.central_ok, True)
+        self.assertEqual(health.interval, 30)
+        self.assertEqual(health.failures, 0)
+        # たまっている分をすぐに送れるよう、同期を基本間隔に戻して今の時刻に前倒しする
+        self.assertEqual(sync.interval, 60)
+        self.assertEqual(sync.next_run, self.now)
+
+    def test_jitter_spreads_the_next_run(self):
+        with override_config(SCHEDULER_JITTER_RATIO=0.2):
+            delays = [tasks._jittered(100) for _ in range(200)]
+            health = self.scheduler.job('health')
+            health.func = lambda: 'ok'
+            self.scheduler.run_job(health)
+        self.assertTrue(all(80 <= delay <= 120 for delay in delays))
+        self.assertGreater(max(delays) - min(delays), 20)  # 全台が同じ間隔にそろわない
+        self.assertTrue(self.now + 24 <= health.next_run <= self.now + 36)
+
+    def test_only_one_process_holds_the_leader_lock(self):
+        lock_file = tasks._acquire_leader_lock()
+        self.assertIsNotNone(lock_file)
+        self.addCleanup(lock_file.close)
+        self.assertIsNone(tasks._acquire_leader_lock())
+
+        # 別のプロセスからも取れない
+        probe = ('import fcntl, sys\n'
+                 'f = open(sys.argv[1], "a+")\n'
+                 'try:\n'
+                 '    fcntl.flock(f.fileno(), fcntl.LOCK_EX | fcntl.LOCK_NB)\n'
+                 'except OSError:\n'
+                 '    sys.exit(1)\n')
+        result = subprocess.run([sys.executable, '-c', probe, config.SCHEDULER_LOCK_PATH])
+        self.assertEqual(result.returncode, 1)
+
+        # 持っていたプロセスが終われば (ファイルが閉じられれば)、次のプロセスが引き継げる
+        lock_file.close()
+        self.assertEqual(subprocess.run([sys.executable, '-c', probe, config.SCHEDULER_LOCK_PATH]).returncode, 0)
+        second = tasks._acquire_leader_lock()
+        self.assertIsNotNone(second)
+        second.close()
+
+    def test_status_write_failure_does_not_stop_the_loop(self):
+        # 状態ファイルの置き場所が作れない (通常のファイルの下を指している)
+        blocker = os.path.join(self.tmpdir, 'blocker')
+        open(blocker, 'w').close()
+        runs = []
+
+        def job():
+            runs.append(self.now)
+            if len(runs) == 2:
+                self.scheduler._stopped = True
+            return 'ok'
+
+        self.scheduler.jobs = [tasks.Job('probe', '確認', job, 0)]
+        with override_config(SCHEDULER_STATE_PATH=os.path.join(blocker, 'scheduler.json')), \
+                self.assertLogs('field_app.tasks', 'WARNING') as logs:
+            self.scheduler.run_forever()
+        self.assertEqual(len(runs), 2)  # 書き出しに失敗した後も、次の回が動いた
+        self.assertIn('スケジューラの実行状態を書き出せませんでした', logs.output[0])
+
+
+class MetricsSnapshotTests(TestCase):
+    """管理コマンドの値の /metrics への受け渡し"""
+
+    def setUp(self):
+        tmpdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, tmpdir)
+        self.enterContext(override_config(METRICS_SNAPSHOT_DIR=tmpdir))
+        metrics.sync_records.reset()
+        self.addCleanup(metrics.sync_records.reset)
+
+    def test_snapshot_of_the_same_process_is_not_counted_twice(self):
+        metrics.sync_records.inc(5, stream='checkins')
+        metrics.write_snapshot('sync_data')  # スケジューラから call_command で動かした場合
+        output = metrics.render()
+        self.assertEqual(output.count('field_sync_records_total{'), 1)
+        self.assertNotIn('process="sync_data"', output)
+
+        # 別のプロセス (cron の sync_data) が書き出した値は、process ラベル付きで出力する
+        path = os.path.join(config.METRICS_SNAPSHOT_DIR, 'sync_data.json')
+        with open(path, encoding='utf-8') as f:
+            snap = json.load(f)
+        snap['pid'] = -1
+        with open(path, 'w', encoding='utf-8') as f:
+            json.dump(snap, f)
+        self.assertIn('field_sync_records_total{process="sync_data",stream="checkins"} 5', metrics.render())
+
+
+class CheckinStatusTests(TestCase):
+    """ログインIDごとの最後の入退所 (チェックイン記録のアーカイブ後も入所中と分かること)"""
+
+    def test_checked_in_evacuees_survive_archiving(self):
+        tmpdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, tmpdir)
+        self.enterContext(override_config(ARCHIVE_DIR=tmpdir))
+        long_ago = timezone.now() - datetime.timedelta(days=10)
+        for username, checkin_type, timestamp in [('taro', 'checkin', long_ago), ('hanako', 'checkin', long_ago),
+                                                   ('hanako', 'checkout', long_ago + datetime.timedelta(hours=1))]:
+            record = UnsyncedCheckin.objects.create(username=username, shelter_id=config.SHELTER_ID,
+                                                    checkin_type=checkin_type, is_synced=True)
+            UnsyncedCheckin.objects.filter(pk=record.pk).update(timestamp=timestamp)
+        # ピア経由で後から届いた古い記録では、最後の入退所を上書きしない
+        peer_sync.ingest_events([{'id': str(uuid.uuid4()), 'username': 'taro', 'shelter_id': config.SHELTER_ID,
+                                  'checkin_type': 'checkout', 'device_id': 'RPi_B',
+                                  'timestamp': (long_ago - datetime.timedelta(days=1)).isoformat()}])
+
+        archive.archive_synced(retention_days=3)
+        self.assertFalse(UnsyncedCheckin.objects.exists())
+        self.assertEqual(distribution_cache.checked_in_usernames(), ['taro'])
+
+        # CheckinStatus を追加する前の端末では、アーカイブと残りの記録から作り直す
+        CheckinStatus.objects.all().delete()
+        UnsyncedCheckin.objects.create(username='jiro', shelter_id=config.SHELTER_ID, checkin_type='checkin')
+        CheckinStatus.objects.all().delete()
+        self.assertEqual(sorted(distribution_cache.checked_in_usernames()), ['jiro', 'taro'])
+
+    def test_duplicate_checkin_is_refused_after_the_original_was_archived(self):
+        tmpdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, tmpdir)
+        self.enterContext(override_config(ARCHIVE_DIR=tmpdir, CHECKIN_GROUP_COMMIT=False,
+                                          CHECKIN_UNKNOWN_USER_POLICY='warn'))
+        self.client.force_login(User.objects.create_user(username='staff', password='x', role='rescuer'))
+        record = UnsyncedCheckin.objects.create(username='taro', shelter_id=config.SHELTER_ID,
+                                                checkin_type='checkin', is_synced=True)
+        UnsyncedCheckin.objects.filter(pk=record.pk).update(
+            timestamp=timezone.now() - datetime.timedelta(days=10))
+        archive.archive_synced(retention_days=3)
+        self.assertFalse(UnsyncedCheckin.objects.exists())
+
+        response = self.client.post(reverse('field_app:shelter_checkin'),
+                                    {'username': 'taro', 'checkin_type': 'checkin'}, follow=True)
+        self.assertIn('既に「入所」済み', ' '.join(str(m) for m in response.context['messages']))
+        self.assertFalse(UnsyncedCheckin.objects.exists())
+
+
+class CheckinJournalRecoveryTests(TestCase):
+    """プロセスが落ちた後のチェックインジャーナルの再生"""
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.directory)
+
+    def test_unflushed_events_are_replayed_exactly_once(self):
+        journal = checkin_journal.CheckinJournal(self.directory, flush_interval=3600, max_batch=10 ** 6)
+        events = [journal.append(username, config.SHELTER_ID, 'checkin') for username in ('taro', 'hanako', 'jiro')]
+        # 1件目は SQLite への反映が済んだが、セグメントを消す前に落ちた状態
+        checkin_journal.write_events(events[:1])
+        journal._stopped = True
+        journal._file.close()
+        self.assertEqual(UnsyncedCheckin.objects.count(), 1)
+
+        self.assertEqual(checkin_journal.recover(self.directory), 3)
+        self.assertEqual(sorted(str(pk) for pk in UnsyncedCheckin.objects.values_list('pk', flat=True)),
+                         sorted(event['id'] for event in events))
+        self.assertEqual(CheckinStatus.objects.count(), 3)
+        self.assertEqual(os.listdir(self.directory), [])
+
+        self.assertEqual(checkin_journal.recover(self.directory), 0)
+        self.assertEqual(UnsyncedCheckin.objects.count(), 3)
+
+    def test_torn_last_line_is_skipped(self):
+        lines = [json.dumps({'id': str(uuid.uuid4()), 'username': username, 'shelter_id': config.SHELTER_ID,
+                             'checkin_type': 'checkin', 'timestamp': timezone.now().isoformat()})
+                 for username in ('taro', 'hanako', 'jiro')]
+        # 書き込み途中で落ちた最終行 (fsync 前なので、まだ応答も返していない)
+        crashed = subprocess.Popen([sys.executable, '-c', 'pass'])
+        crashed.wait()
+        with open(os.path.join(self.directory, f'{crashed.pid}-1-1.jsonl'), 'w', encoding='utf-8') as f:
+            f.write('\n'.join(lines[:2]) + '\n' + lines[2][:25])
+        # 動作中の別プロセスのセグメントには手を付けない
+        running = os.path.join(self.directory, f'{os.getppid()}-1-1.jsonl')
+        with open(running, 'w', encoding='utf-8') as f:
+            f.write(lines[2] + '\n')
+        self.hold_segment(running)
+
+        with self.assertLogs('field_app.checkin', 'WARNING'):
+            self.assertEqual(checkin_journal.recover(self.directory), 2)
+        self.assertEqual(sorted(UnsyncedCheckin.objects.values_list('username', flat=True)), ['hanako', 'taro'])
+        self.assertEqual(os.listdir(self.directory), [os.path.basename(running)])
+
+    def test_reused_pid_does_not_hide_a_crashed_segment(self):
+        # 再起動後、落ちたプロセスの pid が別の (動作中の) プロセスに使い回されている
+        event = {'id': str(uuid.uuid4()), 'username': 'taro', 'shelter_id': config.SHELTER_ID,
+                 'checkin_type': 'checkin', 'timestamp': timezone.now().isoformat()}
+        crashed = os.path.join(self.directory, f'{os.getppid()}-1-1.jsonl')
+        with open(crashed, 'w', encoding='utf-8') as f:
+            f.write(json.dumps(event) + '\n')
+        # 同じプロセス内でも、書き込み中のジャーナルのセグメントは再生しない
+        journal = checkin_journal.CheckinJournal(self.directory, flush_interval=3600, max_batch=10 ** 6)
+        self.addCleanup(journal._file.close)
+        journal._stopped = True
+        journal.append('hanako', config.SHELTER_ID, 'checkin')
+
+        self.assertEqual(checkin_journal.recover(self.directory), 1)
+        self.assertEqual(list(UnsyncedCheckin.objects.values_list('username', flat=True)), ['taro'])
+        self.assertEqual(os.listdir(self.directory), [os.path.basename(journal._file.name)])
+
+    def hold_segment(self, path):
+        """別のプロセスに、書き込み中のジャーナルと同じロックを持たせておく"""
+        holder = subprocess.Popen(
+            [sys.executable, '-c', 'import fcntl, sys\n'
+                                   'f = open(sys.argv[1], "a")\n'
+                                   'fcntl.flock(f.fileno(), fcntl.LOCK_EX)\n'
+                                   'print("locked", flush=True)\n'
+                                   'sys.stdin.read()\n', path],
+            stdin=subprocess.PIPE, stdout=subprocess.PIPE, text=True)
+        self.addCleanup(holder.wait)
+        self.addCleanup(holder.stdin.close)
+        self.addCleanup(holder.stdout.close)
+        self.assertEqual(holder.stdout.readline().strip(), 'locked')
+
+
+class ArchiveTests(TestCase):
+    """保持期間を過ぎた同期済みレコードのアーカイブと検索"""
+
+    def setUp(self):
+        tmpdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, tmpdir)
+        self.enterContext(override_config(ARCHIVE_DIR=tmpdir))
+        self.long_ago = timezone.now() - datetime.timedelta(days=10)
+
+    def create_checkins(self, usernames, timestamp, is_synced=True):
+        records = UnsyncedCheckin.objects.bulk_create([
+            UnsyncedCheckin(username=username, shelter_id=config.SHELTER_ID, checkin_type='checkin',
+                            is_synced=is_synced) for username in usernames])
+        UnsyncedCheckin.objects.filter(pk__in=[r.pk for r in records]).update(timestamp=timestamp)
+        return [str(r.pk) for r in records]
+
+    def test_scheduler_archives_synced_rows_and_search_finds_them(self):
+        from .tasks import Scheduler
+        old_ids = self.create_checkins([f'user{i:03d}' for i in range(30)], self.long_ago)
+        self.create_checkins(['unsent'], self.long_ago, is_synced=False)
+        self.create_checkins(['recent'], timezone.now())
+        report = UnsyncedFieldReport.objects.create(shelter_id=config.SHELTER_ID, current_evacuees=10,
+                                                    medical_needs=1, food_stock='warning', is_synced=True)
+        UnsyncedFieldReport.objects.filter(pk=report.pk).update(timestamp=self.long_ago)
+
+        with override_config(ARCHIVE_BATCH_SIZE=7):
+            self.assertEqual(Scheduler().run_archive(), '31件')
+        self.assertEqual(sorted(UnsyncedCheckin.objects.values_list('username', flat=True)), ['recent', 'unsent'])
+        self.assertFalse(UnsyncedFieldReport.objects.exists())
+
+        self.assertEqual(sorted(row['id'] for row in archive.search('checkins')), sorted(old_ids))
+        self.assertEqual([row['username'] for row in archive.search('checkins', username='user007')], ['user007'])
+        self.assertEqual([row['id'] for row in archive.search('reports', food_stock='warning')], [str(report.pk)])
+        day = timezone.localtime(self.long_ago).date()
+        self.assertEqual(len(list(archive.search('checkins', date_from=day, date_to=day))), 30)
+        self.assertEqual(list(archive.search('checkins', date_from=day + datetime.timedelta(days=1))), [])
+
+    def test_rows_archived_twice_after_a_crash_are_returned_once(self):
+        ids = self.create_checkins(['taro', 'hanako'], self.long_ago)
+        # アーカイブへの追記の後、SQLiteから削除する前に落ちた状態
+        day = timezone.localtime(self.long_ago).date()
+        archive._append_segment('checkins', day, list(UnsyncedCheckin.objects.values()))
+        self.assertEqual(UnsyncedCheckin.objects.count(), 2)
+
+        self.assertEqual(archive.archive_synced(), {'checkins': 2, 'reports': 0})
+        self.assertFalse(UnsyncedCheckin.objects.exists())
+        self.assertEqual(sorted(row['id'] for row in archive.search('checkins')), sorted(ids))
+        self.assertEqual(len(list(archive.search('checkins', username='taro'))), 1)
+
+    def test_incremental_vacuum_never_runs_a_full_vacuum(self):
+        with connection.cursor() as cursor:
+            cursor.execute('PRAGMA auto_vacuum')
+            incremental = cursor.fetchone()[0] == archive.AUTO_VACUUM_INCREMENTAL
+        with CaptureQueriesContext(connection) as queries:
+            self.assertEqual(archive.incremental_vacuum(), incremental)
+        self.assertFalse([q['sql'] for q in queries.captured_queries if q['sql'].strip().upper() == 'VACUUM'])
+
+
+class ReportCoalescingTests(TestCase):
+    """長時間の通信断の後にたまった現場レポートの間引き"""
+
+    # 30分の時間帯の区切りちょうどの時刻
+    BASE = datetime.datetime(2026, 10, 1, 9, 0, tzinfo=datetime.timezone.utc)
+
+    def create_report(self, minutes, evacuees, medical=0, shelter_id=None):
+        report = UnsyncedFieldReport.objects.create(shelter_id=shelter_id or config.SHELTER_ID,
+                                                    current_evacuees=evacuees, medical_needs=medical,
+                                                    food_stock='safe')
+        UnsyncedFieldReport.objects.filter(pk=report.pk).update(
+            timestamp=self.BASE + datetime.timedelta(minutes=minutes))
+        return report.pk
+
+    def pending(self):
+        return list(UnsyncedFieldReport.objects.filter(is_synced=False).order_by('timestamp')
+                    .values_list('pk', flat=True))
+
+    def test_nothing_is_coalesced_up_to_the_threshold(self):
+        for minutes in (0, 5, 10):
+            self.create_report(minutes, 100)
+        self.assertEqual(coalesce_field_reports(threshold=3, bucket_minutes=30), (0, 0))
+        self.assertEqual(len(self.pending()), 3)
+        self.assertEqual(coalesce_field_reports(threshold=2, bucket_minutes=30), (2, 1))
+        self.assertEqual(len(self.pending()), 1)
+
+    def test_buckets_split_on_the_boundary_and_the_newest_report_is_kept(self):
+        first = self.create_report(0, 100)
+        last_in_bucket = self.create_report(29.99, 120, medical=3)
+        next_bucket = self.create_report(30, 90)
+        other_shelter = self.create_report(10, 40, shelter_id='OTHER')
+
+        self.assertEqual(coalesce_field_reports(threshold=0, bucket_minutes=30), (1, 1))
+        self.assertEqual(self.pending(), [other_shelter, last_in_bucket, next_bucket])
+        superseded = UnsyncedFieldReport.objects.get(pk=first)
+        self.assertTrue(superseded.is_superseded and superseded.is_synced)
+
+        kept = UnsyncedFieldReport.objects.get(pk=last_in_bucket)
+        self.assertEqual((kept.coalesced_count, kept.min_evacuees, kept.max_evacuees), (2, 100, 120))
+        self.assertEqual((kept.min_medical_needs, kept.max_medical_needs), (0, 3))
+        untouched = UnsyncedFieldReport.objects.get(pk=next_bucket)
+        self.assertEqual((untouched.coalesced_count, untouched.min_evacuees), (1, None))
+
+    def test_coalescing_again_keeps_the_range_of_earlier_rounds(self):
+        self.create_report(0, 10, medical=5)
+        self.create_report(5, 50, medical=1)
+        self.assertEqual(coalesce_field_reports(threshold=0, bucket_minutes=30), (1, 1))
+
+        # 通信断が続き、同じ時間帯に新しいレポートが来てから再び間引く
+        newest = self.create_report(20, 30, medical=2)
+        self.assertEqual(coalesce_field_reports(threshold=0, bucket_minutes=30), (1, 1))
+        self.assertEqual(self.pending(), [newest])
+        kept = UnsyncedFieldReport.objects.get(pk=newest)
+        self.assertEqual(kept.coalesced_count, 3)
+        self.assertEqual((kept.min_evacuees, kept.max_evacuees), (10, 50))
+        self.assertEqual((kept.min_medical_needs, kept.max_medical_needs), (1, 5))
+
+
+class SyncProgressStreamTests(TestCase):
+    """ホーム画面の進捗バー用の Server-Sent Events"""
+
+    def setUp(self):
+        tmpdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, tmpdir)
+        self.enterContext(override_config(SYNC_PROGRESS_PATH=os.path.join(tmpdir, 'sync_progress.json'),
+                                          SYNC_PROGRESS_POLL_SECONDS=0.01))
+
+    def test_wsgi_stream_sends_one_event_and_closes_while_idle(self):
+        self.client.force_login(User.objects.create(username='staff'))
+        started = time.monotonic()
+        response = self.client.get(reverse('field_app:sync_progress_stream'))
+        body = b''.join(response.streaming_content).decode('utf-8')
+        self.assertLess(time.monotonic() - started, 1)
+        self.assertTrue(body.startswith('retry: '))
+        self.assertEqual(body.count('event: progress'), 1)
+
+    def test_stream_stays_open_until_the_running_sync_finishes(self):
+        progress = sync_progress.SyncProgress()
+        stream = sync_progress.EventStream(idle_seconds=0)
+        self.assertIn('"running": true', stream.step())
+        self.assertFalse(stream.closed)
+
+        progress.finish()
+        self.assertIn('"state": "done"', stream.step())
+        self.assertTrue(stream.closed)
+
+
+class UserIndexTests(TransactionTestCase):
+    """
+    QRコードのログインIDを確認するプロセス内のインデックス。
+    作り直しはバックグラウンドのスレッドがDBを読むので、テストのトランザクションで包まない。
+    """
+
+    def setUp(self):
+        tmpdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, tmpdir)
+        # 後のテストに、一時ディレクトリのスタンプで読み込んだ状態を残さない (設定を戻した後に作り直す)
+        self.addCleanup(user_index.rebuild)
+        self.enterContext(override_config(USER_INDEX_STAMP_PATH=os.path.join(tmpdir, 'master_data.stamp')))
+        User.objects.create(username='idx-taro', full_name='山田 太郎')
+        UnsyncedUserRegistration.objects.create(username='idx-hanako', full_name='山田 花子', password='x')
+        user_index.rebuild()
+
+    def wait_for_rebuild(self):
+        thread = user_index._rebuild_thread
+        if thread is not None:
+            thread.join(timeout=10)
+
+    def test_lookup_follows_saves_without_queries(self):
+        with self.assertNumQueries(0):
+            self.assertEqual(user_index.lookup('idx-taro'), ('registered', '山田 太郎'))
+            self.assertEqual(user_index.lookup('idx-hanako'), ('pending', '山田 花子'))
+            self.assertEqual(user_index.lookup('idx-nobody'), (None, None))
+
+        User.objects.create(username='idx-jiro', full_name='山田 次郎')
+        registration = UnsyncedUserRegistration.objects.get(username='idx-hanako')
+        registration.username = 'idx-hana'  # 未同期ユーザー修正画面でのログインIDの変更
+        registration.save()
+        User.objects.filter(username='idx-taro').delete()
+        with self.assertNumQueries(0):
+            self.assertEqual(user_index.lookup('idx-jiro'), ('registered', '山田 次郎'))
+            self.assertEqual(user_index.lookup('idx-hana'), ('pending', '山田 花子'))
+            self.assertEqual(user_index.lookup('idx-hanako'), (None, None))
+            self.assertEqual(user_index.lookup('idx-taro'), (None, None))
+
+        # 本登録されたら、仮登録からは外れる
+        registration.is_synced = True
+        registration.save()
+        self.assertEqual(user_index.lookup('idx-hana'), (None, None))
+
+    def test_other_process_updates_are_picked_up_in_the_background(self):
+        self.enterContext(override_config(USER_INDEX_STAMP_CHECK_SECONDS=0))
+        # 別プロセスの fetch_master_data を模擬する (シグナルの呼ばれない登録と、スタンプの更新)
+        User.objects.bulk_create([User(username='idx-jiro', full_name='山田 次郎')])
+        with open(config.USER_INDEX_STAMP_PATH, 'a'):
+            pass
+        os.utime(config.USER_INDEX_STAMP_PATH, (time.time() + 60, time.time() + 60))
+
+        # 作り直しの途中でも、新しいIDはDBで確かめて答え、既にあるIDは古いインデックスで答える
+        self.assertEqual(user_index.lookup('idx-jiro'), ('registered', '山田 次郎'))
+        self.assertEqual(user_index.lookup('idx-taro'), ('registered', '山田 太郎'))
+        self.wait_for_rebuild()
+        with self.assertNumQueries(0):
+            self.assertEqual(user_index.lookup('idx-jiro'), ('registered', '山田 次郎'))
+            self.assertEqual(user_index.lookup('idx-nobody'), (None, None))
+
+    def test_saves_during_a_rebuild_are_not_lost(self):
+        # 作り直しが User を読み終えた後 (仮登録を読むとき) に、別のリクエストで User が保存された状況を作る
+        saved = []
+
+        def save_user_meanwhile(execute, sql, params, many, context):
+            if UnsyncedUserRegistration._meta.db_table in sql and not saved:
+                saved.append(User.objects.create(username='idx-saburo', full_name='山田 三郎'))
+            return execute(sql, params, many, context)
+
+        with connection.execute_wrapper(save_user_meanwhile):
+            user_index.rebuild()
+        self.assertTrue(saved)
+        self.assertEqual(user_index.lookup('idx-saburo'), ('registered', '山田 三郎'))
+
+
+class SyncQueueAdminTests(TestCase):
+    """未同期データの管理画面 (件数の見積もり・一括操作・エラー別の画面)"""
+
+    def setUp(self):
+        cache.clear()  # エラー内容ごとの集計を、前のテストから持ち越さない
+        self.admin_user = User.objects.create_superuser(username='admin', password='x')
+        self.client.force_login(self.admin_user)
+        # 「今すぐ再送」で sync_data のプロセスを起動せず、スケジューラの次の同期を前倒しするだけにする
+        self.scheduler = tasks.Scheduler()
+        tasks._scheduler = self.scheduler
+        self.addCleanup(setattr, tasks, '_scheduler', None)
+
+    def create_checkins(self, count, error=None, timestamp=None):
+        records = UnsyncedCheckin.objects.bulk_create(
+            UnsyncedCheckin(username=f'user{i}', shelter_id=config.SHELTER_ID, checkin_type='checkin',
+                            last_sync_error=error, sync_attempts=3,
+                            timestamp=timestamp or timezone.now() - datetime.timedelta(minutes=i))
+            for i in range(count))
+        return [record.pk for record in records]
+
+    def test_estimated_count_paginator(self):
+        pks = self.create_checkins(10)
+        UnsyncedCheckin.objects.filter(pk__in=pks[:3]).delete()  # 先頭から消えた (アーカイブ) 後の残りの行
+        queryset = UnsyncedCheckin.objects.order_by('pk')
+        # 絞り込みなしは rowid の範囲から見積もる (途中に欠けが無ければ件数と一致する)
+        with self.assertNumQueries(1) as queries:
+            self.assertEqual(EstimatedCountPaginator(queryset, 100).count, 7)
+        self.assertIn('MAX(rowid)', queries.captured_queries[0]['sql'])
+
+        class SmallCap(EstimatedCountPaginator):
+            ESTIMATE_CAP = 5
+
+        self.assertEqual(SmallCap(queryset.filter(is_synced=False), 100).count, 5)
+        self.assertEqual(SmallCap(queryset.filter(username='user9'), 100).count, 1)
+
+    def test_bulk_actions_update_the_selected_rows(self):
+        pks = self.create_checkins(4, error='HTTP 500')
+        url = reverse('admin:field_app_unsyncedcheckin_changelist')
+        self.scheduler.job('sync').next_run = time.time() + 3600
+
+        self.client.post(url, {'action': 'retry_now', '_selected_action': pks[:2]})
+        self.assertEqual(UnsyncedCheckin.objects.filter(last_sync_error__isnull=True).count(), 2)
+        self.assertLessEqual(self.scheduler.job('sync').next_run, time.time())
+
+        self.client.post(url, {'action': 'reset_attempts', '_selected_action': pks[1:3]})
+        self.assertEqual(sorted(UnsyncedCheckin.objects.values_list('sync_attempts', flat=True)), [0, 0, 3, 3])
+
+        reports = UnsyncedFieldReport.objects.bulk_create(
+            UnsyncedFieldReport(shelter_id=config.SHELTER_ID, current_evacuees=100, medical_needs=0,
+                                food_stock='safe', is_synced=i == 0)
+            for i in range(3))
+        self.client.post(reverse('admin:field_app_unsyncedfieldreport_changelist'),
+                         {'action': 'mark_superseded', '_selected_action': [r.pk for r in reports]})
+        # 送信済みの行は間引き済みにしない
+        self.assertEqual(UnsyncedFieldReport.objects.filter(is_superseded=True).count(), 2)
+        self.assertFalse(UnsyncedFieldReport.objects.filter(is_synced=False).exists())
+
+    def test_errors_view_pages_by_keyset_and_counts_are_cached(self):
+        same_time = timezone.now() - datetime.timedelta(hours=1)
+        pks = self.create_checkins(5, error='HTTP 500')
+        pks += self.create_checkins(3, error='HTTP 500', timestamp=same_time)  # 同じ日時の行も飛ばさない
+        self.create_checkins(2, error='タイムアウト')
+        url = reverse('admin:field_app_unsyncedcheckin_errors')
+        self.enterContext(override_config(ADMIN_ERROR_GROUPS_CACHE_SECONDS=60))
+        model_admin = admin_site._registry[UnsyncedCheckin]
+        self.enterContext(override_attribute(model_admin, 'errors_page_size', 3))
+
+        seen = []
+        params = {'error': 'HTTP 500'}
+        while True:
+            response = self.client.get(url, params)
+            self.assertEqual(response.context['groups'], [('HTTP 500', 8), ('タイムアウト', 2)])
+            seen += [row.pk for row in response.context['rows']]
+            if not response.context['next_cursor']:
+                break
+            params['before'] = response.context['next_cursor']
+        expected = UnsyncedCheckin.objects.filter(pk__in=pks).order_by('-timestamp', '-pk')
+        self.assertEqual(seen, [record.pk for record in expected])
+
+        # 集計は使い回し (件数の変化は反映されない)、一括操作をしたら集計し直す
+        self.create_checkins(1, error='タイムアウト')
+        with CaptureQueriesContext(connection) as queries:
+            response = self.client.get(url)
+        self.assertEqual(response.context['groups'][1], ('タイムアウト', 2))
+        self.assertFalse(any('GROUP BY' in query['sql'] for query in queries.captured_queries))
+        self.client.post(url, {'error': 'HTTP 500', 'action': 'retry_now'})
+        self.assertEqual(self.client.get(url).context['groups'], [('タイムアウト', 3)])
+
+    def test_errors_view_requires_permission_on_the_model(self):
+        from django.contrib.auth.models import Permission
+
+        staff = User.objects.create_user(username='clerk', password='x', is_staff=True)
+        self.client.force_login(staff)
+        url = reverse('admin:field_app_unsyncedcheckin_errors')
+        self.create_checkins(1, error='HTTP 500')
+        with self.assertLogs('django.request', 'WARNING'):
+            self.assertEqual(self.client.get(url).status_code, 403)
+
+        staff.user_permissions.add(Permission.objects.get(codename='view_unsyncedcheckin'))
+        self.client.force_login(staff)
+        self.assertEqual(self.client.get(url).status_code, 200)
+        with self.assertLogs('django.request', 'WARNING'):
+            self.assertEqual(self.client.post(url, {'error': 'HTTP 500', 'action': 'retry_now'}).status_code, 403)
+        self.assertEqual(UnsyncedCheckin.objects.get().last_sync_error, 'HTTP 500')
+
+
+class ProfilingTests(TestCase):
+    """管理者が ?_profile=1 を付けたリクエストの計測 (ProfilingMiddleware) と、保存したレポート"""
+
+    def setUp(self):
+        tmpdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, tmpdir)
+        server = StubCentralServer(state=CentralState(user_count=0)).start_background()
+        self.addCleanup(server.stop)
+        self.enterContext(override_config(PROFILING_DIR=os.path.join(tmpdir, 'profiles'),
+                                          CENTRAL_SERVER_URLS=[server.url]))
+        utils.forget_active_central_url()
+        self.addCleanup(utils.forget_active_central_url)
+
+    def test_requests_from_non_staff_are_not_profiled(self):
+        self.client.force_login(User.objects.create_user(username='rescuer', password='x', role='rescuer'))
+        response = self.client.get(reverse('field_app:food_distribution'), {'_profile': '1'},
+                                   headers={'X-Field-Profile': '1'})
+        self.assertEqual(response.status_code, 200)
+        self.assertNotIn('X-Field-Profile-Id', response)
+        self.assertEqual(profiling.list_ids(), [])
+
+    def test_staff_request_is_saved_with_sql_and_central_calls(self):
+        self.client.force_login(User.objects.create_user(username='staff', password='x', is_staff=True))
+        self.client.get(reverse('field_app:food_distribution'))
+        self.assertEqual(profiling.list_ids(), [])  # 付けていなければ計測しない
+
+        response = self.client.get(reverse('field_app:food_distribution'), {'_profile': '1'})
+        report = profiling.load(response['X-Field-Profile-Id'])
+        self.assertEqual(profiling.list_ids(), [report['id']])
+        self.assertEqual((report['method'], report['user'], report['status']), ('GET', 'staff', 200))
+        self.assertEqual(report['sql_count'], len(report['queries']))
+        self.assertTrue(any('field_app_user' in query['sql'] for query in report['queries']))
+        self.assertEqual([call['endpoint'] for call in report['central_calls']], ['distribution-items/'])
+        self.assertEqual(report['central_calls'][0]['status'], '200')
+
+    def test_old_reports_are_removed_beyond_the_limit(self):
+        with override_config(PROFILING_MAX_REPORTS=3):
+            for i in range(5):
+                profiling.save({'id': f'{1700000000000 + i}-{i:08x}'})
+        self.assertEqual(profiling.list_ids(), [f'{1700000000000 + i}-{i:08x}' for i in (4, 3, 2)])
+        self.assertEqual(len(os.listdir(config.PROFILING_DIR)), 3)
+
+    def test_load_accepts_only_report_ids(self):
+        profiling.save({'id': '1700000000000-0000abcd'})
+        self.assertEqual(profiling.load('1700000000000-0000abcd'), {'id': '1700000000000-0000abcd'})
+        with open(os.path.join(config.PROFILING_DIR, 'settings.json'), 'w') as f:
+            f.write('{}')
+        for report_id in ['settings', '../profiles/1700000000000-0000abcd', '1700000000000-0000ABCD',
+                          '1700000000000-0000abcd.json', '']:
+            with self.subTest(report_id=report_id):
+                self.assertIsNone(profiling.load(report_id))
+        self.assertEqual(profiling.list_ids(), ['1700000000000-0000abcd'])
+
+
+class NameSearchTests(TestCase):
+    """QRコードを紛失した避難者の氏名検索 (表記の揺れを区別しないこと)"""
+
+    def setUp(self):
+        User.objects.create(username='taro01', full_name='ヤマダ タロウ')
+        UnsyncedUserRegistration.objects.create(username='hanako', full_name='すずき はなこ', password='x')
+        name_search.rebuild()
+
+    def usernames(self, query):
+        return [result['username'] for result in name_search.search(query)]
+
+    def test_kana_width_and_spacing_variants_find_the_same_person(self):
+        for query in ['ヤマダ タロウ', 'やまだ たろう', 'やまだたろう', 'ﾔﾏﾀﾞ ﾀﾛｳ', 'ﾔﾏﾀﾞﾀﾛｳ', 'ヤマダ　タロウ',
+                      'ダタロ', 'たろ', 'ＴＡＲＯ０１', 'Taro']:
+            with self.subTest(query=query):
+                self.assertEqual(self.usernames(query), ['taro01'])
+        # 仮登録 (ひらがなで登録) もカタカナ・半角で見つかる
+        for query in ['スズキ ハナコ', 'ｽｽﾞｷﾊﾅｺ', 'すずき　はなこ', 'キハ']:
+            with self.subTest(query=query):
+                self.assertEqual(name_search.search(query), [{'username': 'hanako', 'full_name': 'すずき はなこ',
+                                                              'status': name_search.PENDING}])
+        self.assertEqual(self.usernames('やまだ はなこ'), [])
+        self.assertEqual(self.usernames('   '), [])
+
+    def test_index_follows_saves_and_the_view_returns_the_same_results(self):
+        User.objects.filter(username='taro01').delete()
+        UnsyncedUserRegistration.objects.create(username='jiro', full_name='ヤマダ ジロウ', password='x')
+        self.assertEqual(self.usernames('ﾔﾏﾀﾞ'), ['jiro'])
+
+        self.client.force_login(User.objects.create_user(username='staff', password='x', role='rescuer'))
+        response = self.client.get(reverse('field_app:name_search'), {'q': 'やまだ　じろう'})
+        self.assertEqual([result['username'] for result in response.json()['results']], ['jiro'])
+
+
+class BundleRoundTripTests(TestCase):
+    """USBメモリ持ち出し用バンドルの書き出し・取り込み"""
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.path = os.path.join(self.tmpdir, 'test.bundle')
+        self.enterContext(override_config(BUNDLE_SIGNING_KEY='test-bundle-signing-key'))
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def test_round_trip_100k_records(self):
+        UnsyncedCheckin.objects.bulk_create(
+            UnsyncedCheckin(username=f'user{i}', shelter_id='SHELTER_002', checkin_type='checkin',
+                            device_id='RPi_Other')
+            for i in range(100_000)
+        )
+        UnsyncedFieldReport.objects.create(shelter_id='SHELTER_002', current_evacuees=10,
+                                           medical_needs=1, food_stock='warning')
+        UnsyncedUserRegistration.objects.create(full_name='山田 太郎', username='taro', password='x')
+        distribution = UnsyncedDistribution.objects.create(username='user7', item_id='item-1', device_id='RPi_Other')
+        UnsyncedDistribution.objects.create(username='user8', item_id='item-1', is_synced=True)  # 送信済みは含めない
+        before = list(UnsyncedCheckin.objects.order_by('pk').values_list(
+            'pk', 'username', 'timestamp', 'device_id')[:50])
+
+        counts = bundles.export_bundle(self.path)
+        self.assertEqual(counts, {'registration': 1, 'checkin': 100_000, 'report': 1, 'distribution': 1})
+
+        # 持ち込み先のラズパイを模擬するため、いったん全て消してから取り込む
+        UnsyncedCheckin.objects.all().delete()
+        UnsyncedFieldReport.objects.all().delete()
+        UnsyncedUserRegistration.objects.all().delete()
+        UnsyncedDistribution.objects.all().delete()
+
+        result = bundles.import_bundle(self.path)
+        self.assertEqual(result['checkin'], {'imported': 100_000, 'skipped': 0, 'conflicts': 0})
+        self.assertEqual(UnsyncedCheckin.objects.filter(is_synced=False).count(), 100_000)
+        self.assertEqual(UnsyncedFieldReport.objects.get().shelter_id, 'SHELTER_002')
+        self.assertEqual(UnsyncedUserRegistration.objects.get().full_name, '山田 太郎')
+        imported = UnsyncedDistribution.objects.get()
+        self.assertEqual((imported.pk, imported.username, imported.item_id, imported.timestamp, imported.device_id,
+                          imported.is_synced),
+                         (distribution.pk, 'user7', 'item-1', distribution.timestamp, 'RPi_Other', False))
+        after = list(UnsyncedCheckin.objects.order_by('pk').values_list(
+            'pk', 'username', 'timestamp', 'device_id')[:50])
+        self.assertEqual(before, after)
+
+        # 同じバンドルを再度取り込んでも重複しない
+        result = bundles.import_bundle(self.path)
+        self.assertEqual(result['checkin'], {'imported': 0, 'skipped': 100_000, 'conflicts': 0})
+        self.assertEqual(UnsyncedCheckin.objects.count(), 100_000)
+
+    def test_registration_with_a_taken_username_is_reported_as_conflict(self):
+        UnsyncedUserRegistration.objects.create(full_name='山田 太郎', username='taro', password='x')
+        UnsyncedUserRegistration.objects.create(full_name='山田 花子', username='hanako', password='x')
+        bundles.export_bundle(self.path)
+
+        # 持ち込み先では、別の人が同じ希望ログインIDで仮登録済み
+        UnsyncedUserRegistration.objects.all().delete()
+        UnsyncedUserRegistration.objects.create(full_name='田中 太郎', username='taro', password='y')
+
+        with self.assertLogs('field_app.bundles', 'WARNING') as logs:
+            result = bundles.import_bundle(self.path)
+        self.assertEqual(result['registration'], {'imported': 1, 'skipped': 0, 'conflicts': 1})
+        self.assertIn('taro', logs.output[0])
+        self.assertEqual(UnsyncedUserRegistration.objects.get(username='taro').full_name, '田中 太郎')
+        self.assertTrue(UnsyncedUserRegistration.objects.filter(username='hanako').exists())
+
+    def test_tampered_bundle_is_rejected(self):
+        UnsyncedCheckin.objects.create(username='taro', shelter_id='S', checkin_type='checkin')
+        bundles.export_bundle(self.path)
+        with open(self.path, 'r+b') as f:
+            f.seek(20)
+            f.write(b'\x00')
+
+        with self.assertRaises(bundles.BundleError):
+            bundles.import_bundle(self.path)
+
+    def test_shipped_default_signing_key_is_refused(self):
+        UnsyncedCheckin.objects.create(username='taro', shelter_id='S', checkin_type='checkin')
+        bundles.export_bundle(self.path)
+        with override_config(BUNDLE_SIGNING_KEY=bundles.DEFAULT_SIGNING_KEY):
+            with self.assertRaises(CommandError):
+                call_command('export_bundle', os.path.join(self.tmpdir, 'default.bundle'), stdout=io.StringIO())
+            self.assertFalse(os.path.exists(os.path.join(self.tmpdir, 'default.bundle')))
+            with self.assertRaises(bundles.BundleError):
+                bundles.import_bundle(self.path)
+
+    def test_imported_registrations_are_found_by_the_checkin_screen(self):
+        UnsyncedUserRegistration.objects.create(full_name='山田 太郎', username='taro', password='x')
+        bundles.export_bundle(self.path)
+        UnsyncedUserRegistration.objects.all().delete()
+        stamp_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, stamp_dir)
+        self.enterContext(override_config(USER_INDEX_STAMP_PATH=os.path.join(stamp_dir, 'user_index.stamp')))
+        user_index.rebuild()
+        self.assertEqual(user_index.lookup('taro'), (None, None))
+
+        bundles.import_bundle(self.path)
+        self.assertEqual(user_index.lookup('taro'), ('pending', '山田 太郎'))
+        self.assertTrue(os.path.exists(config.USER_INDEX_STAMP_PATH))  # 他のプロセスにも知らせる
+
+
+class PeerSyncTests(TestCase):
+    """同じ避難所のラズパイ同士のチェックイン記録のやり取り"""
+
+    class _PeerSession:
+        """
+        requests の代わりに、テストクライアント経由で「B入口のラズパイ」に問い合わせる。
+        1つのDBで2台を模擬するため、返した記録はその場でDBから消し、
+        B だけが持っている記録を A が受け取る状況を作る。
+        """
+
+        def __init__(self, client):
+            self.client = client
+            self.calls = 0
+
+        def get(self, url, params=None, headers=None, timeout=None):
+            self.calls += 1
+            with override_config(DEVICE_ID='RPi_B'):
+                response = self.client.get('/peer/checkins/', params, headers=headers)
+            UnsyncedCheckin.objects.filter(pk__in=[e['id'] for e in response.json()['events']]).delete()
+            return response
+
+    def setUp(self):
+        self.staff = User.objects.create_user(username='staff', password='x', role='rescuer')
+        self.enterContext(override_config(PEER_SHARED_KEY='test-peer-shared-key'))
+
+    def test_pull_from_peer_pages_through_events_and_blocks_duplicate_checkin(self):
+        # B入口のラズパイで記録されたチェックイン
+        for i in range(7):
+            UnsyncedCheckin.objects.create(username=f'user{i}', shelter_id=config.SHELTER_ID,
+                                           checkin_type='checkin', device_id='RPi_B')
+        # 自分 (A) が記録したものではないので、A のAPIからは返さない
+        self.assertEqual(peer_sync.local_events_since(None, 100)[0], [])
+
+        session = self._PeerSession(self.client)
+        with override_config(PEER_BATCH_SIZE=3):
+            self.assertEqual(peer_sync.pull_from_peer('http://rpi-b', session=session), 7)
+        self.assertEqual(session.calls, 3)
+        self.assertEqual(UnsyncedCheckin.objects.filter(device_id='RPi_B', is_synced=True).count(), 7)
+
+        cursor = PeerCursor.objects.get(peer_url='http://rpi-b')
+        self.assertEqual(cursor.peer_device_id, 'RPi_B')
+        self.assertIsNone(cursor.last_error)
+        self.assertEqual(cursor.last_timestamp, UnsyncedCheckin.objects.latest('timestamp').timestamp)
+
+        # B の記録があるので、A 入口で同じ人が再度「入所」しようとすると警告になる
+        self.client.force_login(self.staff)
+        response = self.client.post('/checkin/', {'username': 'user3', 'checkin_type': 'checkin'}, follow=True)
+        self.assertContains(response, '既に「入所」済み')
+
+    def test_peer_sync_runs_outside_the_scheduler_jobs(self):
+        UnsyncedCheckin.objects.create(username='taro', shelter_id=config.SHELTER_ID, checkin_type='checkin',
+                                       device_id='RPi_B')
+        with override_config(PEER_URLS=['http://rpi-b']):
+            scheduler = tasks.Scheduler()
+            # 中央サーバーとの同期などのジョブの後ろで待たされないよう、専用のスレッドで取得する
+            self.assertNotIn('peer', [job.name for job in scheduler.jobs])
+            worker = scheduler.peer_sync
+            worker.session = self._PeerSession(self.client)
+            worker.run_once()
+        self.assertEqual(worker.as_dict()['last_imported'], 1)
+        self.assertEqual(worker.failures, 0)
+        self.assertIsNone(tasks.Scheduler().peer_sync)  # PEER_URLS が無ければ動かさない
+
+    def test_ingest_is_idempotent_and_marks_peer_records_as_synced(self):
+        event = {
+            'id': '5b7c9d1e-0000-4000-8000-000000000001', 'username': 'taro',
+            'shelter_id': config.SHELTER_ID, 'checkin_type': 'checkin',
+            'timestamp': '2026-01-01T09:00:00.123456+09:00', 'device_id': 'RPi_B',
+        }
+        other_shelter = dict(event, id='5b7c9d1e-0000-4000-8000-000000000002', shelter_id='OTHER')
+
+        self.assertEqual(peer_sync.ingest_events([event, other_shelter]), 1)
+        self.assertEqual(peer_sync.ingest_events([event]), 0)
+
+        record = UnsyncedCheckin.objects.get()
+        self.assertTrue(record.is_synced)
+        self.assertEqual(record.device_id, 'RPi_B')
+        self.assertEqual(record.timestamp.microsecond, 123456)
+
+    def test_malformed_events_are_skipped_and_logged(self):
+        event = {
+            'id': '5b7c9d1e-0000-4000-8000-000000000001', 'username': 'taro',
+            'shelter_id': config.SHELTER_ID, 'checkin_type': 'checkin',
+            'timestamp': '2026-01-01T09:00:00+09:00', 'device_id': 'RPi_B',
+        }
+        malformed = [
+            {key: value for key, value in event.items() if key != 'username'},
+            dict(event, id='not-a-uuid'),
+            dict(event, id='5b7c9d1e-0000-4000-8000-000000000003', checkin_type='visit'),
+            dict(event, id='5b7c9d1e-0000-4000-8000-000000000004', timestamp='2026-01-01T09:00:00'),
+            dict(event, id='5b7c9d1e-0000-4000-8000-000000000005', username=None),
+        ]
+        with self.assertLogs('field_app.peer', 'WARNING') as logs:
+            self.assertEqual(peer_sync.ingest_events(malformed + [event]), 1)
+        self.assertIn('5 件', logs.output[0])
+        self.assertEqual(UnsyncedCheckin.objects.get().username, 'taro')
+
+        # 最後のイベントが不正なら、読めた分だけ登録してこの回の取得を終える (続きは次の回に)
+        class Response:
+            status_code = 200
+
+            def json(self):
+                return {'device_id': 'RPi_B', 'has_more': True,
+                        'events': [dict(event, id='5b7c9d1e-0000-4000-8000-000000000006'), malformed[0]]}
+
+        class Session:
+            def get(self, url, **kwargs):
+                return Response()
+
+        with self.assertLogs('field_app.peer', 'WARNING'):
+            self.assertEqual(peer_sync.pull_from_peer('http://rpi-b', session=Session()), 1)
+        self.assertIn('不正', PeerCursor.objects.get(peer_url='http://rpi-b').last_error)
+
+    def test_peer_api_requires_shared_key(self):
+        response = self.client.get('/peer/checkins/', headers={'X-Shelter-Id': config.SHELTER_ID})
+        self.assertEqual(response.status_code, 403)
+        response = self.client.get('/peer/checkins/', headers={'X-Shelter-Id': config.SHELTER_ID,
+                                                              'X-Peer-Key': 'test-peer-shared-kez'})
+        self.assertEqual(response.status_code, 403)
+        response = self.client.get('/peer/checkins/', headers={'X-Shelter-Id': config.SHELTER_ID,
+                                                              'X-Peer-Key': 'test-peer-shared-key'})
+        self.assertEqual(response.status_code, 200)
+
+    def test_peer_api_is_closed_while_the_shared_key_is_the_shipped_default(self):
+        headers = {'X-Shelter-Id': config.SHELTER_ID, 'X-Peer-Key': peer_sync.DEFAULT_SHARED_KEY}
+        with override_config(PEER_SHARED_KEY=peer_sync.DEFAULT_SHARED_KEY), \
+                self.assertLogs('field_app.peer', 'WARNING'):
+            response = self.client.get('/peer/checkins/', headers=headers)
+        self.assertEqual(response.status_code, 403)
+
+
+class StubCentralSyncTests(TestCase):
+    """スタブ中央サーバーに対する sync_data (冪等キーによる二重登録の防止)"""
+
+    def start_stub(self, **conditions):
+        server = StubCentralServer(conditions=Conditions(**conditions),
+                                   state=CentralState(user_count=20)).start_background()
+        self.addCleanup(server.stop)
+        self.enterContext(override_config(CENTRAL_SERVER_URLS=[server.url], SYNC_REQUEST_TIMEOUT_SECONDS=0.5,
+                                          SYNC_RETRIES=6))
+        utils.forget_active_central_url()
+        self.addCleanup(utils.forget_active_central_url)
+        return server
+
+    def create_backlog(self, count):
+        records = UnsyncedCheckin.objects.bulk_create(
+            UnsyncedCheckin(username=f'user{i:05d}', shelter_id='SHELTER_001', checkin_type='checkin')
+            for i in range(count))
+        checkin_status.record(records)  # bulk_create する経路と同じく、最後の入退所も更新する
+
+    def test_lost_responses_and_errors_do_not_create_duplicates(self):
+        # 応答だけが失われる・503 が返る状況でも、再送で全件が1回ずつ登録される
+        server = self.start_stub(loss_rate=0.1, error_rate=0.1, loss_hold_seconds=1.0)
+        # 失敗が続いてもブレーカーで止めず、再送の挙動だけを確かめる
+        self.enterContext(override_config(CENTRAL_BREAKER_FAILURE_THRESHOLD=10 ** 6))
+        self.create_backlog(60)
+
+        # 最初の疎通確認自体が落ちることもあるので、スケジューラと同様に次の回で残りを送る
+        for _ in range(5):
+            call_command('sync_data', stdout=io.StringIO(), stderr=io.StringIO())
+            if not UnsyncedCheckin.objects.filter(is_synced=False).exists():
+                break
+
+        stats = server.state.stats()
+        self.assertEqual(UnsyncedCheckin.objects.filter(is_synced=False).count(), 0)
+        self.assertEqual(stats['checkins'], 60)
+        self.assertGreater(stats['dropped'] + stats['errors'], 0)
+
+    def test_resent_records_are_treated_as_already_applied(self):
+        server = self.start_stub()
+        self.create_backlog(10)
+        call_command('sync_data', stdout=io.StringIO(), stderr=io.StringIO())
+
+        # 同期済みの印が失われた (例: 送信直後に電源断) 想定で、もう一度送る
+        UnsyncedCheckin.objects.update(is_synced=False)
+        call_command('sync_data', stdout=io.StringIO(), stderr=io.StringIO())
+
+        stats = server.state.stats()
+        self.assertEqual(stats['checkins'], 10)
+        self.assertEqual(stats['replayed'], 10)
+        self.assertEqual(UnsyncedCheckin.objects.filter(is_synced=False).count(), 0)
+
+    def test_fetch_master_data_from_stub(self):
+        self.start_stub()
+        call_command('fetch_master_data', stdout=io.StringIO())
+        self.assertEqual(User.objects.filter(username__startswith='user').count(), 20)
+
+    def test_critical_reports_go_first_and_bulk_lane_is_rate_limited(self):
+        server = self.start_stub()
+        # bulk レーンは 1000 バイト/秒 (1秒分まではまとめて送れる)。他のレーンは上限なし
+        self.enterContext(override_config(SYNC_LINK_BYTES_PER_SECOND=2000, SYNC_LANE_BURST_SECONDS=1,
+                                          SYNC_LANE_SHARES={'critical': None, 'registrations': None,
+                                                            'checkins': None, 'bulk': 0.5}))
+        sync_lanes.reset()
+        self.addCleanup(sync_lanes.reset)
+        for i in range(8):
+            UnsyncedFieldReport.objects.create(shelter_id='SHELTER_001', current_evacuees=100 + i, medical_needs=0,
+                                               food_stock='safe')
+        critical = UnsyncedFieldReport.objects.create(shelter_id='SHELTER_001', current_evacuees=120,
+                                                      medical_needs=3, food_stock='critical')
+        self.create_backlog(20)
+        metrics.sync_lane_bytes.reset()
+
+        started = time.monotonic()
+        call_command('sync_data', stdout=io.StringIO(), stderr=io.StringIO())
+        elapsed = time.monotonic() - started
+
+        # 最も新しい緊急のレポートが、それより古いレポートより先に届いている
+        self.assertEqual(list(server.state.records['reports'])[0], str(critical.id))
+        self.assertEqual(len(server.state.records['reports']), 9)
+        self.assertEqual(len(server.state.records['checkins']), 20)
+        # bulk レーンで送った量から、1秒分を除いた分は上限の速さで待たされている
+        sent = {labels['lane']: value for _, labels, value in metrics.sync_lane_bytes.samples()}['bulk']
+        self.assertGreater(sent, 1500)
+        self.assertGreaterEqual(elapsed, (sent - 1000) / 1000 * 0.9)
+
+    def test_passwords_are_hashed_once_and_upgraded_on_login(self):
+        server = self.start_stub()
+        self.enterContext(override_settings(PASSWORD_HASHERS=hashers.password_hashers('pbkdf2')))
+        form = FieldSignUpForm({'full_name': '仮登録', 'username': 'newcomer', 'password': 'secret-pass',
+                                'password_confirm': 'secret-pass'})
+        self.assertTrue(form.is_valid())
+        registration = form.save()
+        self.assertNotEqual(registration.password, 'secret-pass')
+
+        # 本登録の後、送ったハッシュのままローカルのユーザーが作られ、同じパスワードでログインできる
+        call_command('sync_data', stdout=io.StringIO(), stderr=io.StringIO())
+        sent = next(iter(server.state.records['registrations'].values()))
+        self.assertEqual(sent['password'], registration.password)
+        self.assertTrue(self.client.login(username='newcomer', password='secret-pass'))
+
+        # 中央サーバーのハッシュがこの端末の設定より弱ければ、ログインに成功したときに作り直され、
+        # 中央サーバーのハッシュが変わらない限り、次のマスタ取得でも元に戻らない
+        weak_hash = PBKDF2PasswordHasher().encode('password', PBKDF2PasswordHasher().salt(), iterations=100_000)
+        for user in server.state.users:
+            user['password'] = weak_hash
+        call_command('fetch_master_data', stdout=io.StringIO())
+        self.assertTrue(self.client.login(username='user00000', password='password'))
+        upgraded = User.objects.get(username='user00000').password
+        self.assertEqual(identify_hasher(upgraded).decode(upgraded)['iterations'], config.PASSWORD_PBKDF2_ITERATIONS)
+        call_command('fetch_master_data', stdout=io.StringIO())
+        self.assertEqual(User.objects.get(username='user00000').password, upgraded)
+
+        # 中央サーバーの標準 (より強い) ハッシュは、少ない反復回数に作り直さない
+        central_hash = PBKDF2PasswordHasher().encode('password', PBKDF2PasswordHasher().salt())
+        for user in server.state.users:
+            user['password'] = central_hash
+        call_command('fetch_master_data', stdout=io.StringIO())
+        self.assertTrue(self.client.login(username='user00001', password='password'))
+        self.assertEqual(User.objects.get(username='user00001').password, central_hash)
+
+    def test_change_feed_triggers_delta_refresh(self):
+        server = self.start_stub()
+        self.enterContext(override_config(CHANGE_FEED_WAIT_SECONDS=1))
+        call_command('fetch_master_data', stdout=io.StringIO())
+        listener = change_feed.ChangeFeedListener()
+        self.assertEqual(listener.poll_once(), {})  # 最初の問い合わせは現在位置 (cursor) を受け取るだけ
+
+        # 変更が無ければ、待たされた後に空の通知が返る
+        self.assertEqual(listener.poll_once(), {})
+
+        server.state.add('users', 2)
+        pending = listener.poll_once()
+        self.assertEqual(list(pending), ['users'])
+
+        # 差分だけを取り直すので、通知より前からいるユーザーは上書きされない
+        User.objects.filter(username='user00000').update(full_name='ローカルで変更')
+        listener.apply(pending)
+        self.assertEqual(User.objects.filter(username__startswith='user').count(), 22)
+        self.assertEqual(User.objects.get(username='user00000').full_name, 'ローカルで変更')
+
+    def test_change_feed_cursor_advances_only_after_a_successful_refresh(self):
+        server = self.start_stub()
+        self.enterContext(override_config(CHANGE_FEED_WAIT_SECONDS=1))
+        listener = change_feed.ChangeFeedListener()
+        listener.poll_once()
+        cursor = listener.cursor
+
+        server.state.add('users', 2)
+        pending = listener.poll_once()
+        server.conditions.error_rate = 1.0  # 取り直しの途中で中央サーバーがエラーを返す
+        with self.assertRaises(CommandError):
+            listener.apply(pending)
+        self.assertEqual(listener.cursor, cursor)
+        self.assertFalse(User.objects.exists())
+
+        # 進めていない cursor で問い合わせるので、同じ変更をもう一度受け取って取り直せる
+        server.conditions.error_rate = 0.0
+        self.assertEqual(listener.poll_once(), pending)
+        listener.apply(pending)
+        self.assertGreater(listener.cursor, cursor)
+        self.assertEqual(User.objects.filter(username__startswith='user').count(), 2)
+
+    def test_prewarmed_eligibility_answers_scans_and_is_recorded_in_bulk(self):
+        server = self.start_stub()
+        call_command('fetch_master_data', stdout=io.StringIO())
+        item_id = str(DistributionItem.objects.order_by('name').values_list('id', flat=True).first())
+        self.create_backlog(4)
+        UnsyncedCheckin.objects.create(username='user00003', shelter_id='SHELTER_001', checkin_type='checkout')
+        server.state.distributions.add(('user00001', item_id))  # 事前確認の前に受け取り済み
+
+        # 入所中の3人 × 5品目を1回の問い合わせで確認する (退所した user00003 は含めない)
+        self.assertEqual(distribution_cache.prewarm(), 15)
+        requests_before = server.state.stats()['requests']
+
+        self.assertTrue(distribution_cache.answer('user00000', item_id)['can_distribute'])
+        self.assertFalse(distribution_cache.answer('user00000', item_id)['can_distribute'])
+        self.assertFalse(distribution_cache.answer('user00001', item_id)['can_distribute'])
+        self.assertIsNone(distribution_cache.answer('user00003', item_id))  # その場で問い合わせる
+        self.assertEqual(server.state.stats()['requests'], requests_before)
+
+        # 配布した分は sync_data でまとめて記録され、次の事前確認でも受け取り済みのまま
+        call_command('sync_data', stdout=io.StringIO(), stderr=io.StringIO())
+        self.assertFalse(UnsyncedDistribution.objects.filter(is_synced=False).exists())
+        self.assertIn(('user00000', item_id), server.state.distributions)
+        distribution_cache.prewarm()
+        self.assertFalse(distribution_cache.answer('user00000', item_id)['can_distribute'])
+
+    def test_chat_media_is_fetched_once_and_evicted_oldest_first(self):
+        server = self.start_stub(latency_ms=100)
+        cache_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, cache_dir)
+        self.enterContext(override_config(CHAT_MEDIA_CACHE_DIR=cache_dir))
+        first = server.state.add_media(b'\x89PNG first' * 100)
+        second = server.state.add_media(b'\x89PNG second' * 100)
+
+        async def fetch_many(path, count):
+            return await asyncio.gather(*(media_cache.fetch(path) for _ in range(count)))
+
+        # 同時の要求は中央サーバーへの1回の取得にまとめられ、以後はキャッシュから返る
+        results = asyncio.run(fetch_many(first, 5))
+        self.assertEqual({result for result in results}, {results[0]})
+        asyncio.run(fetch_many(first, 1))
+        self.assertEqual(server.state.stats()['media'], 1)
+
+        # 上限を超えたら、最終使用時刻の古い画像から消す
+        os.utime(results[0][0], (0, 0))
+        asyncio.run(fetch_many(second, 1))
+        media_cache.evict(max_bytes=1500)
+        self.assertIsNone(media_cache.lookup(media_cache.cache_key(first), media_cache.FULL))
+        self.assertIsNotNone(media_cache.lookup(media_cache.cache_key(second), media_cache.FULL))
+
+        # 中央サーバー以外のURLは中継しない
+        self.assertIsNone(media_cache.source_path('http://example.com/media/x.png'))
+        self.assertIsNone(media_cache.source_path('/media/../settings.py'))
+
+    def test_chat_media_thumbnail_and_size_limit(self):
+        from PIL import Image
+
+        server = self.start_stub()
+        cache_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, cache_dir)
+        self.enterContext(override_config(CHAT_MEDIA_CACHE_DIR=cache_dir, CHAT_MEDIA_THUMBNAIL_SIZE=100))
+        buffer = io.BytesIO()
+        Image.new('RGBA', (800, 400), (255, 0, 0, 0)).save(buffer, 'PNG')
+        photo = server.state.add_media(buffer.getvalue())
+
+        # 一覧用にはサムネイル (透過部分は白の JPEG)、タップされたときは原寸の画像を返す
+        thumb_path, content_type = asyncio.run(media_cache.fetch(photo, media_cache.THUMB))
+        self.assertEqual(content_type, 'image/jpeg')
+        with Image.open(thumb_path) as thumb:
+            self.assertEqual((thumb.size, thumb.mode), ((100, 50), 'RGB'))
+            self.assertEqual(thumb.getpixel((50, 25)), (255, 255, 255))
+        full_path, content_type = asyncio.run(media_cache.fetch(photo, media_cache.FULL))
+        self.assertEqual(content_type, 'image/png')
+        with open(full_path, 'rb') as f:
+            self.assertEqual(f.read(), buffer.getvalue())
+        self.assertEqual(server.state.stats()['media'], 1)
+
+        # 上限を超える画像は保存しない
+        large = server.state.add_media(b'\x89PNG large' * 200)
+        with override_config(CHAT_MEDIA_MAX_IMAGE_BYTES=1000):
+            with self.assertRaises(media_cache.MediaUnavailable) as raised:
+                asyncio.run(media_cache.fetch(large))
+        self.assertEqual(raised.exception.status, 413)
+        self.assertIsNone(media_cache.lookup(media_cache.cache_key(large), media_cache.FULL))
+
+    def test_html_page_instead_of_json_is_shown_as_an_error(self):
+        # 中継機器 (認証画面など) が 200 で HTML を返しても、画面は 500 にならずにエラーを表示する
+        server = self.start_stub()
+        call_command('fetch_master_data', stdout=io.StringIO())
+        staff = User.objects.create_user(username='staff', password='password', full_name='スタッフ', role='admin')
+        self.client.force_login(staff)
+        item_id = str(DistributionItem.objects.order_by('name').values_list('id', flat=True).first())
+        server.conditions.html_rate = 1.0
+
+        response = self.client.get(reverse('field_app:food_distribution'))
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(len(response.context['distribution_items']), 5)  # ローカルのマスタで代替する
+
+        response = self.client.post(reverse('field_app:food_distribution'),
+                                    {'username': 'user00000', 'item_id': item_id}, follow=True)
+        self.assertEqual(response.status_code, 200)
+        self.assertIn('応答を読み取れず', ' '.join(str(m) for m in response.context['messages']))
+
+        response = self.client.get(reverse('field_app:field_chat'), {'group_id': '1'})
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual((response.context['groups'], response.context['messages_history']), ([], []))
+
+
+class SeparateProcessCommandTests(SimpleTestCase):
+    """
+    manage.py test ではないプロセス (マイグレーションの設定などが本番と同じ) で実行する管理コマンド。
+    ベンチマーク用のコマンド (bench_*) は、ごく小さな件数で最後まで動くことを確かめる。
+    """
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.tmpdir)
+
+    def run_command(self, *args):
+        # 1台のPCで別のインスタンスを動かすときと同じく、DBと状態ファイルの置き場所を分ける
+        env = {**os.environ, 'FIELD_DB_PATH': os.path.join(self.tmpdir, 'db.sqlite3'),
+               'FIELD_RUN_DIR': os.path.join(self.tmpdir, 'run'), 'FIELD_SCHEDULER_ENABLED': '0'}
+        result = subprocess.run([sys.executable, os.path.join(settings.BASE_DIR, 'manage.py'), *args],
+                                cwd=self.tmpdir, env=env, capture_output=True, text=True, timeout=300)
+        self.assertEqual(result.returncode, 0, result.stderr)
+        return result.stdout
+
+    def test_run_dir_can_be_set_per_instance(self):
+        output = self.run_command('shell', '-c', 'import config; print(config.RUN_DIR, config.SCHEDULER_LOCK_PATH)')
+        run_dir, lock_path = output.splitlines()[-1].split()
+        self.assertEqual(run_dir, os.path.join(self.tmpdir, 'run'))
+        self.assertEqual(os.path.dirname(lock_path), run_dir)
+
+    def test_bench_checkin(self):
+        output = self.run_command('bench_checkin', '--scans', '4', '--tablets', '2')
+        self.assertIn('グループコミットあり', output)
+
+    def test_bench_sync(self):
+        result_path = os.path.join(self.tmpdir, 'result.json')
+        self.run_command('bench_sync', '--sizes', '5', '--rtts', '0', '--models', 'checkins,reports',
+                         '--output', result_path)
+        with open(result_path, encoding='utf-8') as f:
+            run, = json.load(f)['runs']
+        self.assertEqual(run['synced'], {'checkins': 5, 'reports': 5})
+
+
+class ViewBudgetTests(TestCase):
+    """
+    field_app/urls.py の全てのURLの、SQLの件数・中央サーバーへの送信数・所要時間の上限。
+    N+1 のクエリや、中央サーバーへの待ちを伴う呼び出しが画面に紛れ込んだら失敗する。
+
+    スタブ中央サーバーには CENTRAL_LATENCY_MS の遅延を入れているので、想定外の中央サーバーへの
+    送信は時間の上限も超える。時間の上限は遅い環境では環境変数 FIELD_TEST_TIME_SCALE で倍率を掛けられる。
+    上限を超えたときは、実行されたSQLを同じ形ごとにまとめて表示する (件数の多い形が N+1 の候補)。
+    URLを追加したら、BUDGETS にも上限を追加すること (追加しないと test_every_url_has_a_budget が失敗する)。
+    """
+    CENTRAL_LATENCY_MS = 200
+    TIME_SCALE = float(os.environ.get('FIELD_TEST_TIME_SCALE', '1'))
+
+    # (URL名, メソッド): (SQLの件数の上限, 中央サーバーへの送信数の上限, 所要時間の上限 (秒))
+    # SQLの件数には、ログイン状態の確認 (セッション・ユーザーの読み込み) の2件を含む
+    BUDGETS = {
+        ('home', 'GET'): (4, 0, 0.5),
+        ('login', 'GET'): (0, 0, 0.5),
+        ('logout', 'POST'): (4, 0, 0.5),
+        ('shelter_checkin', 'GET'): (3, 0, 0.5),
+        ('shelter_checkin', 'POST'): (5, 0, 0.5),  # 記録の保存と、ログインIDごとの最後の入退所の更新
+        ('checkin_lookup', 'GET'): (2, 0, 0.5),
+        ('name_search', 'GET'): (3, 0, 0.5),
+        ('food_distribution', 'GET'): (2, 1, 1.0),
+        ('food_distribution', 'POST'): (4, 2, 1.5),
+        ('field_report', 'GET'): (3, 0, 0.5),
+        ('field_report', 'POST'): (3, 0, 0.5),
+        # request.auser() とテンプレートの request.user が、それぞれユーザーを読み込む
+        ('field_chat', 'GET'): (3, 2, 1.5),
+        ('chat_media', 'GET'): (2, 0, 0.5),
+        ('manual_sync', 'POST'): (2, 0, 0.5),
+        ('sync_progress_stream', 'GET'): (2, 0, 0.5),
+        ('unsynced_users_list', 'GET'): (3, 0, 0.5),
+        ('unsynced_user_edit', 'GET'): (3, 0, 0.5),
+        ('signup', 'GET'): (0, 0, 0.5),
+        ('peer_checkins', 'GET'): (1, 0, 0.5),
+        ('metrics', 'GET'): (0, 0, 0.5),
+        ('profile_list', 'GET'): (2, 0, 0.5),
+        ('profile_detail', 'GET'): (2, 0, 0.5),
+    }
+
+    @classmethod
+    def setUpTestData(cls):
+        # 避難所の運用中を想定した量のデータ (パスワードのハッシュは1回だけ作って使い回す)
+        from django.contrib.auth.hashers import make_password
+
+        password = make_password('password')
+        cls.staff = User.objects.create(username='staff', password=password, full_name='スタッフ',
+                                        role='admin', is_staff=True, is_superuser=True)
+        User.objects.bulk_create(User(username=f'user{i:05d}', password=password, full_name=f'ヒナン シャ{i:05d}')
+                                 for i in range(500))
+        UnsyncedCheckin.objects.bulk_create(
+            UnsyncedCheckin(username=f'user{i % 500:05d}', shelter_id=config.SHELTER_ID,
+                            checkin_type='checkin' if i < 500 else 'checkout', is_synced=i < 4000)
+            for i in range(5000))
+        checkin_status.rebuild()  # bulk_create ではシグナルが呼ばれないため
+        UnsyncedFieldReport.objects.bulk_create(
+            UnsyncedFieldReport(shelter_id=config.SHELTER_ID, current_evacuees=100 + i, medical_needs=i % 7,
+                                food_stock='safe', is_synced=i < 150)
+            for i in range(200))
+        UnsyncedUserRegistration.objects.bulk_create(
+            UnsyncedUserRegistration(username=f'pending{i:03d}', full_name=f'カリ トウロク{i:03d}', password=password)
+            for i in range(50))
+        DistributionItem.objects.bulk_create(DistributionItem(name=f'物資{i + 1}') for i in range(5))
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.tmpdir)
+        self.server = StubCentralServer(conditions=Conditions(latency_ms=self.CENTRAL_LATENCY_MS),
+                                        state=CentralState(user_count=0)).start_background()
+        self.addCleanup(self.server.stop)
+        self.enterContext(override_config(
+            CENTRAL_SERVER_URLS=[self.server.url],
+            CHAT_MEDIA_CACHE_DIR=os.path.join(self.tmpdir, 'chat_media'),
+            PROFILING_DIR=os.path.join(self.tmpdir, 'profiles'),
+            SYNC_PROGRESS_PATH=os.path.join(self.tmpdir, 'sync_progress.json'),
+            PEER_SHARED_KEY='test-peer-shared-key',
+        ))
+        utils.forget_active_central_url()
+        self.addCleanup(utils.forget_active_central_url)
+        # bulk_create ではシグナルが呼ばれないため、fetch_master_data の後と同様にインデックスを作り直す
+        user_index.rebuild()
+        name_search.rebuild()
+        self.client.force_login(self.staff)
+
+    def cases(self):
+        """(URL名, メソッド, URL, 送信する内容, ヘッダ) の一覧"""
+        image_url = self.server.state.add_media(b'\x89PNG budget' * 100)
+        registration = UnsyncedUserRegistration.objects.order_by('created_at').first()
+        item = DistributionItem.objects.order_by('name').first()
+        # 計測結果の詳細の画面用に、計測したリクエストを1件作っておく
+        self.client.get(reverse('field_app:home'), {'_profile': '1'})
+        checkin_users = iter(f'user{i:05d}' for i in range(500))
+        return [
+            ('home', 'GET', reverse('field_app:home'), None, {}),
+            ('login', 'GET', reverse('field_app:login'), None, {}),
+            ('logout', 'POST', reverse('field_app:logout'), None, {}),
+            ('shelter_checkin', 'GET', reverse('field_app:shelter_checkin'), None, {}),
+            # 退所済みの人を1人ずつ入所させる (毎回新しい記録になるように)
+            ('shelter_checkin', 'POST', reverse('field_app:shelter_checkin'),
+             lambda: {'username': next(checkin_users), 'checkin_type': 'checkin'}, {}),
+            ('checkin_lookup', 'GET', reverse('field_app:checkin_lookup'), {'username': 'user00042'}, {}),
+            ('name_search', 'GET', reverse('field_app:name_search'), {'q': 'ひなん しゃ0004'}, {}),
+            ('food_distribution', 'GET', reverse('field_app:food_distribution'), None, {}),
+            ('food_distribution', 'POST', reverse('field_app:food_distribution'),
+             {'username': 'user00007', 'item_id': str(item.id)}, {}),
+            ('field_report', 'GET', reverse('field_app:field_report'), None, {}),
+            ('field_report', 'POST', reverse('field_app:field_report'),
+             {'current_evacuees': '120', 'medical_needs': '3', 'food_stock': 'safe'}, {}),
+            ('field_chat', 'GET', reverse('field_app:field_chat'), {'group_id': '1'}, {}),
+            ('chat_media', 'GET', reverse('field_app:chat_media'), {'src': image_url, 'size': 'thumb'}, {}),
+            # 同期の実行中は別プロセスを起動せずに戻る (テストから sync_data を起動しないため)
+            ('manual_sync', 'POST', reverse('field_app:manual_sync'), None, {}),
+            ('sync_progress_stream', 'GET', reverse('field_app:sync_progress_stream'), None, {}),
+            ('unsynced_users_list', 'GET', reverse('field_app:unsynced_users_list'), None, {}),
+            ('unsynced_user_edit', 'GET', reverse('field_app:unsynced_user_edit', args=[registration.pk]), None, {}),
+            ('signup', 'GET', reverse('field_app:signup'), None, {}),
+            ('peer_checkins', 'GET', reverse('field_app:peer_checkins'), {'limit': '500'},
+             {'X-Peer-Key': config.PEER_SHARED_KEY, 'X-Shelter-Id': config.SHELTER_ID}),
+            ('metrics', 'GET', reverse('field_app:metrics'), None, {}),
+            ('profile_list', 'GET', reverse('field_app:profile_list'), None, {}),
+            ('profile_detail', 'GET', reverse('field_app:profile_detail', args=[profiling.list_ids()[0]]), None, {}),
+        ]
+
+    def request(self, method, url, data, headers):
+        data = data() if callable(data) else data
+        if method == 'GET':
+            return self.client.get(url, data, headers=headers)
+        return self.client.post(url, data or {}, headers=headers)
+
+    def measure(self, method, url, data, headers):
+        """1回目 (キャッシュの準備など) は除き、2回目のSQL・中央サーバーへの送信数・所要時間を測る"""
+        self.request(method, url, data, headers)
+        self.client.force_login(self.staff)  # logout の後も同じ状態で測る
+        requests_before = self.server.state.stats()['requests']
+        with CaptureQueriesContext(connection) as queries:
+            started = time.perf_counter()
+            response = self.request(method, url, data, headers)
+            elapsed = time.perf_counter() - started
+        return response, queries.captured_queries, self.server.state.stats()['requests'] - requests_before, elapsed
+
+    def test_every_url_has_a_budget(self):
+        from .urls import urlpatterns
+
+        names = {pattern.name for pattern in urlpatterns}
+        self.assertEqual(names - {name for name, _ in self.BUDGETS}, set(),
+                         'BUDGETS に上限の無いURLがあります')
+        self.assertEqual({(name, method) for name, method, *_ in self.cases()}, set(self.BUDGETS))
+
+    def test_views_stay_within_budget(self):
+        sync_progress.SyncProgress()  # 同期の実行中を再現する (manual_sync 用)
+        for name, method, url, data, headers in self.cases():
+            max_queries, max_central, max_seconds = self.BUDGETS[(name, method)]
+            with self.subTest(view=name, method=method):
+                response, queries, central, elapsed = self.measure(method, url, data, headers)
+                self.assertLess(response.status_code, 400, f'{method} {url}: HTTP {response.status_code}')
+                self.assertLessEqual(len(queries), max_queries, _query_report(name, method, queries, max_queries))
+                self.assertLessEqual(central, max_central,
+                                     f'{method} {url}: 中央サーバーへの送信 {central}回 (上限 {max_central}回)')
+                self.assertLessEqual(elapsed, max_seconds * self.TIME_SCALE,
+                                     f'{method} {url}: {elapsed:.3f}秒 (上限 {max_seconds * self.TIME_SCALE:.3f}秒)')
+
+        # 送信の画面は、上限の範囲で記録まで済ませている (1回目と計測した2回目の2件ずつ)
+        self.assertEqual(UnsyncedCheckin.objects.filter(is_synced=False).count(), 1000 + 2)
+        self.assertEqual(UnsyncedFieldReport.objects.filter(is_synced=False).count(), 50 + 2)
+
+
+def _query_report(name, method, queries, max_queries):
+    """上限を超えたときの表示。同じ形のSQL (値を ? に置き換えたもの) ごとの回数と、実行順の一覧"""
+    shapes = Counter(_query_shape(query['sql']) for query in queries)
+    lines = [f'{method} {name}: SQL {len(queries)}件 (上限 {max_queries}件、{len(queries) - max_queries:+d}件)',
+             '同じ形のSQLの回数:']
+    lines += [f'  {count:3d}x  {shape}' for shape, count in shapes.most_common()]
+    lines.append('実行順:')
+    lines += [f'  {i:3d}. ({query["time"]}s) {query["sql"]}' for i, query in enumerate(queries, 1)]
+    return '\n'.join(lines)
+
+
+def _query_shape(sql):
+    sql = re.sub(r"'(?:[^']|'')*'", '?', sql)
+    sql = re.sub(r'\b\d+(?:\.\d+)?\b', '?', sql)
+    return re.sub(r'\(\?(?:, \?)*\)', '(...)', sql)
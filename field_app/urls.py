@@ -17,18 +17,32 @@ urlpatterns = [
 
     # --- 機能ページ ---
     path('checkin/', views.shelter_checkin_view, name='shelter_checkin'),
+    path('checkin/lookup/', views.checkin_lookup_view, name='checkin_lookup'),
+    path('checkin/search/', views.name_search_view, name='name_search'),
 
     path('food/', views.food_distribution_view, name='food_distribution'),
 
     path('report/', views.field_report_view, name='field_report'),
 
     path('chat/', views.field_chat_view, name='field_chat'),
+    path('chat/media/', views.chat_media_view, name='chat_media'),
 
     path('manual-sync/', views.manual_sync_view, name='manual_sync'),
+    path('manual-sync/progress/', views.sync_progress_stream_view, name='sync_progress_stream'),
 
     path('unsynced-users/', views.unsynced_users_list_view, name='unsynced_users_list'),
     path('unsynced-users/<uuid:pk>/edit/', views.unsynced_user_edit_view, name='unsynced_user_edit'),
 
     path('signup/', views.field_signup_view, name='signup'),
 
+    # --- 同じ避難所のラズパイ同士の同期 ---
+    path('peer/checkins/', views.peer_checkins_view, name='peer_checkins'),
+
+    # --- 監視 (Prometheus) ---
+    path('metrics', views.metrics_view, name='metrics'),
+
+    # --- リクエストの計測結果 (管理者のみ) ---
+    path('diagnostics/profiles/', views.profile_list_view, name='profile_list'),
+    path('diagnostics/profiles/<str:report_id>/', views.profile_detail_view, name='profile_detail'),
+
 ]
\ No newline at end of file
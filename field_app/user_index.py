@@ -0,0 +1,209 @@
+# field_app/user_index.py
+"""
+QRコードで読み取ったログインIDを、DBに問い合わせずにその場で確認するための
+プロセス内インデックス (ログインID -> 氏名)。
+
+対象は fetch_master_data で中央サーバーから取り込んだ User と、
+まだ本登録されていない仮登録ユーザー (UnsyncedUserRegistration)。
+
+- 同じプロセス内での変更 (スケジューラからの fetch_master_data、仮登録など) は
+  シグナル経由で1件ずつ反映する
+- 別プロセス (cron などで実行した fetch_master_data) での変更は、
+  そのコマンドが更新するスタンプファイル (config.USER_INDEX_STAMP_PATH) の時刻で検知し、作り直す。
+  10万人分の読み込みでスキャンを待たせないよう、作り直しはバックグラウンドのスレッドで行い、
+  その間は古いインデックスで答える (古いインデックスに無いIDだけはDBで確かめる)
+
+10万人分でも、ログインIDと氏名の文字列を辞書に持つだけなので数十MB程度に収まる。
+"""
+import logging
+import os
+import threading
+import time
+
+from django.db import connection
+
+import config
+
+logger = logging.getLogger('field_app.user_index')
+
+_lock = threading.Lock()
+_users = {}          # username -> full_name (本登録済み)
+_pending = {}        # username -> full_name (仮登録中)
+_loaded = False
+_stamp = None
+_checked_at = 0.0
+_rebuild_thread = None   # バックグラウンドで作り直しているスレッド (作り直していなければ None)
+_replays = []        # 作り直しの途中でシグナルから反映した変更 (作り直しごとのリスト。読み込み後に再適用する)
+
+
+def _read_stamp():
+    try:
+        return os.path.getmtime(config.USER_INDEX_STAMP_PATH)
+    except OSError:
+        return None
+
+
+def touch_stamp():
+    """マスタデータを更新したことを、他のプロセスのインデックスに知らせる"""
+    global _stamp
+    os.makedirs(os.path.dirname(config.USER_INDEX_STAMP_PATH), exist_ok=True)
+    with open(config.USER_INDEX_STAMP_PATH, 'a'):
+        os.utime(config.USER_INDEX_STAMP_PATH, None)
+    # このプロセス内の変更はシグナルで反映済みなので、自分では作り直さない
+    if _loaded:
+        _stamp = _read_stamp()
+
+
+def refresh():
+    """
+    シグナルを通らない変更 (bulk_create など) の後に呼ぶ。
+    他のプロセスにはスタンプファイルで知らせ、このプロセスで読み込み済みなら作り直す。
+    """
+    touch_stamp()
+    if _loaded:
+        rebuild()
+
+
+def rebuild():
+    """DBからインデックスを作り直す"""
+    global _loaded, _stamp, _checked_at
+    from .models import User, UnsyncedUserRegistration
+
+    replay = []
+    with _lock:
+        _replays.append(replay)
+    try:
+        stamp = _read_stamp()
+        users = {
+            username: full_name
+            for username, full_name in User.objects.values_list('username', 'full_name').iterator(chunk_size=5000)
+        }
+        pending = dict(UnsyncedUserRegistration.objects.filter(is_synced=False).values_list('username', 'full_name'))
+        with _lock:
+            _users.clear()
+            _users.update(users)
+            _pending.clear()
+            _pending.update(pending)
+            # 読み込んだ後に保存された分が、古い内容で上書きされないようにする
+            for change in replay:
+                change()
+            _loaded = True
+            _stamp = stamp
+            _checked_at = time.monotonic()
+    finally:
+        with _lock:
+            _replays.remove(replay)
+
+
+def _rebuild_in_background():
+    global _rebuild_thread
+    try:
+        rebuild()
+    except Exception:
+        # 次にスタンプを確認したときに、もう一度作り直す
+        logger.exception('ログインIDインデックスの作り直しに失敗しました')
+    finally:
+        connection.close()  # このスレッドのDB接続
+        with _lock:
+            _rebuild_thread = None
+
+
+def _start_rebuild():
+    global _rebuild_thread
+    with _lock:
+        if _rebuild_thread is not None:
+            return
+        _rebuild_thread = threading.Thread(target=_rebuild_in_background, name='field-user-index', daemon=True)
+        _rebuild_thread.start()
+
+
+def _ensure_fresh():
+    global _checked_at
+    if not _loaded:
+        rebuild()  # 答えられるインデックスがまだ無いので、最初の1回だけはその場で読み込む
+        return
+    # スタンプファイルの確認も数秒に1回まで (stat もスキャンごとには行わない)
+    if time.monotonic() - _checked_at < config.USER_INDEX_STAMP_CHECK_SECONDS:
+        return
+    _checked_at = time.monotonic()
+    if _read_stamp() != _stamp:
+        _start_rebuild()
+
+
+def _lookup_db(username):
+    from .models import User, UnsyncedUserRegistration
+
+    full_name = User.objects.filter(username=username).values_list('full_name', flat=True).first()
+    if full_name is not None:
+        return 'registered', full_name
+    full_name = UnsyncedUserRegistration.objects.filter(username=username, is_synced=False).values_list(
+        'full_name', flat=True).first()
+    if full_name is not None:
+        return 'pending', full_name
+    return None, None
+
+
+def lookup(username):
+    """
+    ログインIDを確認し、(状態, 氏名) を返す。
+    状態は 'registered' (本登録済み) / 'pending' (仮登録中) / None (不明なID)。
+    """
+    _ensure_fresh()
+    with _lock:
+        if username in _users:
+            return 'registered', _users[username]
+        if username in _pending:
+            return 'pending', _pending[username]
+        rebuilding = _rebuild_thread is not None
+    if rebuilding:
+        # 作り直しの途中は、他のプロセスで追加されたばかりのIDかもしれないのでDBで確かめる
+        return _lookup_db(username)
+    return None, None
+
+
+def size():
+    with _lock:
+        return len(_users) + len(_pending)
+
+
+# ---------------------------------------------------------
+# シグナルから呼ばれる、1件ずつの反映
+# ---------------------------------------------------------
+def _apply(change):
+    """変更を反映する。作り直しの途中なら、読み込みが終わった後にもう一度反映する"""
+    with _lock:
+        change()
+        for replay in _replays:
+            replay.append(change)
+
+
+def put_user(username, full_name):
+    if not _loaded and not _replays:
+        return  # まだ一度も読み込んでいなければ、初回の rebuild に任せる
+
+    def change():
+        _users[username] = full_name
+        _pending.pop(username, None)
+    _apply(change)
+
+
+def remove_user(username):
+    _apply(lambda: _users.pop(username, None))
+
+
+def put_pending(username, full_name, is_synced, old_username=None):
+    if not _loaded and not _replays:
+        return
+
+    def change():
+        if old_username and old_username != username:
+            _pending.pop(old_username, None)
+        if is_synced:
+            _pending.pop(username, None)
+        else:
+            _pending[username] = full_name
+    _apply(change)
+
+
+def remove_pending(username):
+    _apply(lambda: _pending.pop(username, None))
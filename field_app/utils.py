@@ -1,5 +1,16 @@
+import asyncio
+import contextlib
+import threading
+import time
+import weakref
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+from urllib.parse import urlsplit
+
+import httpx
 import requests
+
 import config
+from . import circuit_breaker, metrics, profiling, sync_lanes
 
 # 生きているURLをキャッシュしておく（毎回チェックすると遅いため）
 _cached_active_url = None
@@ -13,7 +24,8 @@ def get_active_central_url():
     global _cached_active_url
 
     # 既にキャッシュがあり、それがまだ有効ならそれを返す（簡易的なキャッシュ）
-    if _cached_active_url:
+    # (ブレーカーが遮断中なら、他の候補に切り替えられるよう探し直す)
+    if _cached_active_url and not circuit_breaker.is_open(_cached_active_url):
         return _cached_active_url
 
     # リストを順番に試す
@@ -23,7 +35,7 @@ def get_active_central_url():
         try:
             # 軽いリクエスト（HEADやルートへのGET）を送って生存確認
             # timeout=2 程度でサクサク次へ行く
-            requests.get(base_url, timeout=2)
+            central_request('get', base_url, endpoint='health', timeout=2)
 
             # 成功したらキャッシュして返す
             _cached_active_url = base_url
@@ -32,4 +44,306 @@ def get_active_central_url():
             continue
 
     # 全滅の場合はリストの先頭を返しておく
-    return config.CENTRAL_SERVER_URLS[0].rstrip('/')
\ No newline at end of file
+    return config.CENTRAL_SERVER_URLS[0].rstrip('/')
+
+
+async def get_active_central_url_async():
+    """get_active_central_url の非同期版 (async ビューから、イベントループを止めずに呼ぶ)"""
+    global _cached_active_url
+    if _cached_active_url and not circuit_breaker.is_open(_cached_active_url):
+        return _cached_active_url
+
+    for url in config.CENTRAL_SERVER_URLS:
+        base_url = url.rstrip('/')
+        try:
+            await central_request_async('get', base_url, endpoint='health', timeout=2)
+            _cached_active_url = base_url
+            return base_url
+        except requests.RequestException:
+            continue
+    return config.CENTRAL_SERVER_URLS[0].rstrip('/')
+
+
+def forget_active_central_url():
+    """キャッシュした接続先を捨て、次回は候補を先頭から試し直す"""
+    global _cached_active_url
+    _cached_active_url = None
+
+
+def central_endpoint_label(url):
+    """メトリクス用に、URLからAPIのエンドポイント名 (例: 'field-report/') を取り出す"""
+    path = urlsplit(url).path
+    if config.API_BASE_PATH in path:
+        path = path.split(config.API_BASE_PATH, 1)[1]
+    return path or '/'
+
+
+def central_request(method, url, endpoint=None, session=None, **kwargs):
+    """
+    中央サーバーへHTTPリクエストを送信する共通の窓口。
+    requests.request と同じ引数を受け取り、レスポンスや例外もそのまま返す。
+    (session を渡すと、その requests.Session で接続を使い回す)
+    あわせて、エンドポイント別の応答時間とエラー件数をメトリクスに記録する。
+    接続先のサーキットブレーカーが開いている間は送信せず、すぐに CircuitOpenError を送出する。
+    """
+    endpoint = endpoint or central_endpoint_label(url)
+    breaker = _before_central_call(method, url, endpoint)
+    start = time.monotonic()
+    try:
+        response = (session or requests).request(method, url, **kwargs)
+    except requests.exceptions.RequestException as e:
+        breaker.record_failure(e)
+        _record_central_call(method, url, endpoint, time.monotonic() - start, type(e).__name__)
+        raise
+    except BaseException:
+        breaker.abandon()
+        raise
+    _after_central_call(breaker, method, url, endpoint, start, response)
+    return response
+
+
+def _before_central_call(method, url, endpoint):
+    breaker = circuit_breaker.breaker_for(url)
+    try:
+        breaker.before_request()
+    except circuit_breaker.CircuitOpenError:
+        _record_central_call(method, url, endpoint, 0, 'CircuitOpen')
+        raise
+    return breaker
+
+
+def _after_central_call(breaker, method, url, endpoint, start, response):
+    if circuit_breaker.is_failure_status(response.status_code):
+        breaker.record_failure(f'HTTP {response.status_code}')
+    else:
+        breaker.record_success()
+    _record_central_call(method, url, endpoint, time.monotonic() - start, response.status_code)
+
+
+def _record_central_call(method, url, endpoint, seconds, outcome):
+    metrics.record_central_call(endpoint, seconds, outcome)
+    profiling.note_central_call(method, url, endpoint, seconds, outcome)  # 計測中のリクエストがあれば記録
+
+
+# =========================================================
+# async ビュー用の非同期クライアント
+# =========================================================
+# httpx.AsyncClient はイベントループに結び付く。ASGI サーバーのループはプロセスが終わるまで動き続けるので、
+# ループごとに1つ作って接続プールを共有する (asgi.py から use_shared_async_client() で登録する)。
+# それ以外のループ (WSGI・runserver・テストクライアントで async ビューを呼ぶと、asgiref がリクエストごとに
+# 新しいループを作って閉じる) では、閉じられないクライアントが残らないよう、送信ごとに作って閉じる
+_async_clients = weakref.WeakKeyDictionary()
+
+
+def _new_async_client():
+    return httpx.AsyncClient(
+        verify=config.VERIFY_SSL,
+        limits=httpx.Limits(max_connections=config.CENTRAL_ASYNC_MAX_CONNECTIONS,
+                            max_keepalive_connections=config.CENTRAL_ASYNC_MAX_CONNECTIONS),
+    )
+
+
+def use_shared_async_client():
+    """実行中のイベントループでは AsyncClient を共有する (動き続けるループ用。asgi.py から呼ぶ)"""
+    loop = asyncio.get_running_loop()
+    if loop not in _async_clients:
+        _async_clients[loop] = _new_async_client()
+
+
+@contextlib.asynccontextmanager
+async def _async_client():
+    client = _async_clients.get(asyncio.get_running_loop())
+    if client is not None:
+        yield client
+        return
+    async with _new_async_client() as client:
+        yield client
+
+
+async def central_request_async(method, url, endpoint=None, **kwargs):
+    """
+    central_request の非同期版。httpx.AsyncClient で送信する (ASGI サーバーでは共有のものを使う)。
+    呼び出し側のエラー処理を同期版と揃えるため、通信エラーは requests の例外
+    (Timeout / ConnectionError、いずれも RequestException) に置き換えて送出する。
+    """
+    endpoint = endpoint or central_endpoint_label(url)
+    kwargs.pop('verify', None)  # SSL検証はクライアント単位で設定済み
+    breaker = _before_central_call(method, url, endpoint)
+    start = time.monotonic()
+    with _async_call_errors(breaker, method, url, endpoint, start):
+        async with _async_client() as client:
+            response = await client.request(method, url, **kwargs)
+    _after_central_call(breaker, method, url, endpoint, start, response)
+    return response
+
+
+@contextlib.asynccontextmanager
+async def central_stream_async(method, url, endpoint=None, **kwargs):
+    """
+    central_request_async の、本文を読み込まずに応答を返す版 (async with で使う)。
+    本文は response.aiter_bytes() で少しずつ読み、途中でやめてもよい (抜けるときに接続を閉じる)。
+    本文の受信中の通信エラーも requests の例外に置き換えて送出する。
+    """
+    endpoint = endpoint or central_endpoint_label(url)
+    kwargs.pop('verify', None)
+    breaker = _before_central_call(method, url, endpoint)
+    start = time.monotonic()
+    async with _async_client() as client:
+        with _async_call_errors(breaker, method, url, endpoint, start):
+            response = await client.send(client.build_request(method, url, **kwargs), stream=True)
+        _after_central_call(breaker, method, url, endpoint, start, response)
+        try:
+            yield response
+        except httpx.TimeoutException as e:
+            raise requests.exceptions.Timeout(str(e)) from e
+        except httpx.HTTPError as e:
+            raise requests.exceptions.ConnectionError(str(e)) from e
+        finally:
+            await response.aclose()
+
+
+@contextlib.contextmanager
+def _async_call_errors(breaker, method, url, endpoint, start):
+    """httpx の通信エラーをブレーカーとメトリクスに記録し、requests の例外に置き換える"""
+    try:
+        yield
+    except httpx.TimeoutException as e:
+        breaker.record_failure(e)
+        _record_central_call(method, url, endpoint, time.monotonic() - start, 'Timeout')
+        raise requests.exceptions.Timeout(str(e)) from e
+    except httpx.HTTPError as e:
+        breaker.record_failure(e)
+        _record_central_call(method, url, endpoint, time.monotonic() - start, 'ConnectionError')
+        raise requests.exceptions.ConnectionError(str(e)) from e
+    except BaseException:
+        breaker.abandon()  # キャンセルされた場合など
+        raise
+
+
+# =========================================================
+# 未同期レコードのアップロード
+# =========================================================
+# 一時的な障害を示す5xxは、冪等キーがあるので再送してよい
+RETRYABLE_STATUS = (502, 503, 504)
+
+_thread_local = threading.local()
+
+
+def _thread_session():
+    session = getattr(_thread_local, 'session', None)
+    if session is None:
+        session = _thread_local.session = requests.Session()
+    return session
+
+
+def idempotency_headers(record):
+    """レコードのUUIDを冪等キーとして送るためのヘッダ (再送しても中央では1件として扱われる)"""
+    return {'Idempotency-Key': str(record.id)}
+
+
+def is_sync_accepted(response):
+    """
+    送信したレコードが中央サーバーに反映されたかを判定する。
+    同じ冪等キーで既に反映済みだった場合 (409 + Idempotent-Replayed ヘッダ、
+    または {"status": "already_applied"}) も成功として扱う。
+    """
+    if response.status_code in (200, 201):
+        return True
+    if response.status_code != 409:
+        return False
+    if response.headers.get('Idempotent-Replayed', '').lower() == 'true':
+        return True
+    try:
+        body = response.json()
+    except ValueError:
+        return False
+    return isinstance(body, dict) and body.get('status') == 'already_applied'
+
+
+def _upload_one(api_url, record, payload, abort, timeout, retries, lane):
+    attempt = 0
+    size = sync_lanes.payload_size(payload)
+    while True:
+        if abort.is_set():
+            return record, None, None
+        sync_lanes.throttle(lane, size)  # レーンの帯域の上限を超えないよう待つ (再送も数える)
+        try:
+            response = central_request('post', api_url, session=_thread_session(), json=payload,
+                                       headers=idempotency_headers(record),
+                                       timeout=timeout, verify=config.VERIFY_SSL)
+            if response.status_code not in RETRYABLE_STATUS or attempt >= retries:
+                return record, response, None
+        except circuit_breaker.CircuitOpenError as e:
+            return record, None, e  # 遮断中は再送を待っても送れないので、すぐに打ち切る
+        except requests.exceptions.RequestException as e:
+            if attempt >= retries:
+                return record, None, e
+        attempt += 1
+        time.sleep(0.5 * 2 ** (attempt - 1))
+
+
+def iter_backlog(queryset, time_field, chunk_size=None):
+    """
+    未同期の行 (queryset) を古い順に1件ずつ返すジェネレータ。
+    全件を一度に読み込まず、(日時, id) が前のまとまりの最後の行より後の行を chunk_size 件ずつ
+    索引 (is_synced, 日時) で引く (キーセット方式)。送信中に行を同期済みにしても、
+    送信に失敗した行が残っても、読む位置は前にしか進まない。
+    """
+    chunk_size = chunk_size or config.SYNC_READ_CHUNK_SIZE
+    queryset = queryset.order_by(time_field, 'pk')
+    after = None
+    while True:
+        chunk = queryset
+        if after is not None:
+            # (日時, id) > (timestamp, pk) を、索引の範囲検索になる形で書く
+            timestamp, pk = after
+            chunk = chunk.filter(**{f'{time_field}__gte': timestamp}).exclude(**{time_field: timestamp, 'pk__lte': pk})
+        rows = list(chunk[:chunk_size])
+        yield from rows
+        if len(rows) < chunk_size:
+            return
+        after = getattr(rows[-1], time_field), rows[-1].pk
+
+
+def upload_records(api_url, records, build_payload, lane, concurrency=None, timeout=None, retries=None):
+    """
+    レコードを中央サーバーへ並列に送信し、終わった順に (record, response, error) を返すジェネレータ。
+    - lane は送信の優先度 (sync_lanes.LANES)。そのレーンの帯域の上限の範囲で送る
+    - 各リクエストにはレコードのUUIDを冪等キーとして付けるため、タイムアウト後の再送や
+      並列送信をしても中央で二重登録にはならない
+    - 再送しても繋がらなかった場合は error に例外が入る。それ以降の送信は行わず、
+      まだ送っていないレコードは (record, None, None) として返す
+    DBの更新は呼び出し側 (このジェネレータを回すスレッド) で行う。
+    """
+    concurrency = concurrency or config.SYNC_CONCURRENCY
+    timeout = timeout or config.SYNC_REQUEST_TIMEOUT_SECONDS
+    retries = config.SYNC_RETRIES if retries is None else retries
+    abort = threading.Event()
+
+    with ThreadPoolExecutor(max_workers=concurrency, thread_name_prefix='sync-upload') as pool:
+        in_flight = set()
+        try:
+            for record in records:
+                if abort.is_set():
+                    yield record, None, None
+                    continue
+                in_flight.add(pool.submit(_upload_one, api_url, record, build_payload(record),
+                                          abort, timeout, retries, lane))
+                # 送信待ちをためすぎないよう、同時実行数の2倍までに抑える
+                while len(in_flight) >= concurrency * 2:
+                    done, in_flight = wait(in_flight, return_when=FIRST_COMPLETED)
+                    for future in done:
+                        result = future.result()
+                        if result[2] is not None:
+                            abort.set()
+                        yield result
+            while in_flight:
+                done, in_flight = wait(in_flight, return_when=FIRST_COMPLETED)
+                for future in done:
+                    result = future.result()
+                    if result[2] is not None:
+                        abort.set()
+                    yield result
+        finally:
+            # 呼び出し側がループを途中で抜けた場合も、残りの送信は始めない
+            abort.set()
@@ -1,19 +1,37 @@
 # field_app/views.py
+import asyncio
+import logging
 import subprocess
 import sys
+import time
+from pathlib import Path
+from urllib.parse import urlencode
 
 import requests
+from asgiref.sync import sync_to_async
 from django.conf import settings
-from django.contrib import messages
+from django.contrib import admin, messages
+from django.contrib.admin.views.decorators import staff_member_required
 from django.contrib.auth.decorators import login_required, user_passes_test  # ログイン必須にする
+from django.core.cache import cache
+from django.core.handlers.asgi import ASGIRequest
+from django.http import Http404, HttpResponse, HttpResponseForbidden, JsonResponse, HttpResponseBadRequest, StreamingHttpResponse
 from django.shortcuts import render, redirect, get_object_or_404
 from django.urls import reverse
+from django.utils import timezone
+from django.utils.dateparse import parse_datetime
 from django.views.decorators.http import require_POST
 
 import config
 from .forms import FieldReportForm, UnsyncedUserEditForm, FieldSignUpForm
-from .models import UnsyncedCheckin, UnsyncedFieldReport, UnsyncedUserRegistration
-from .utils import get_active_central_url
+from .models import DistributionItem, UnsyncedCheckin, UnsyncedFieldReport, UnsyncedUserRegistration
+from . import (checkin_journal, checkin_status, circuit_breaker, distribution_cache, media_cache, metrics,
+               name_search, peer_sync, profiling, sync_progress, tasks, user_index)
+from .circuit_breaker import CircuitOpenError
+from .utils import get_active_central_url, central_request, get_active_central_url_async, central_request_async
+
+logger = logging.getLogger('field_app.views')
+chat_logger = logging.getLogger('field_app.chat')
 
 
 @login_required  # ログインしていないとアクセスできないようにする
@@ -25,14 +43,73 @@ def home_view(request):
     unsynced_checkin_count = UnsyncedCheckin.objects.filter(is_synced=False).count()
     unsynced_report_count = UnsyncedFieldReport.objects.filter(is_synced=False).count()
 
+    # 定期実行の状態 (スケジューラが書き出したファイルから読むので、どのプロセスでも表示できる)
+    scheduler_status = tasks.read_status()
+    last_sync_time = None
+    if scheduler_status:
+        sync_job = next((job for job in scheduler_status['jobs'] if job['name'] == 'sync'), None)
+        if sync_job:
+            last_sync_time = sync_job['last_success']
+
     context = {
         'unsynced_checkin_count': unsynced_checkin_count,
         'unsynced_report_count': unsynced_report_count,
-        # 'last_sync_time': ... (最終同期時刻をどこかに保存するなら、それを取得)
+        'last_sync_time': last_sync_time,
+        'scheduler_status': scheduler_status,
+        # この画面を返したプロセスのブレーカーの状態 (ブレーカーはプロセスごとに持つ)
+        'circuit_states': circuit_breaker.states(),
     }
     return render(request, 'field_app/home.html', context)
 
 
+def metrics_view(request):
+    """
+    Prometheus からスクレイプされる /metrics エンドポイント。
+    値はプロセス内のカウンタから出力するため、スクレイプごとの COUNT クエリは発生しない。
+    """
+    if config.METRICS_ALLOWED_IPS and request.META.get('REMOTE_ADDR') not in config.METRICS_ALLOWED_IPS:
+        return HttpResponseForbidden()
+    return HttpResponse(metrics.render(), content_type='text/plain; version=0.0.4; charset=utf-8')
+
+
+@staff_member_required
+def profile_list_view(request):
+    """管理者が ?_profile=1 を付けて計測したリクエストの一覧 (profiling.py)"""
+    reports = [report for report in map(profiling.load, profiling.list_ids()) if report]
+    context = {
+        **admin.site.each_context(request),
+        'title': 'リクエストの計測結果',
+        'reports': reports,
+        'max_reports': config.PROFILING_MAX_REPORTS,
+    }
+    return render(request, 'admin/field_app/profiles.html', context)
+
+
+@staff_member_required
+def profile_detail_view(request, report_id):
+    """計測結果1件の詳細。?format=json で保存されている内容をそのまま返す"""
+    report = profiling.load(report_id)
+    if report is None:
+        raise Http404
+    if request.GET.get('format') == 'json':
+        return JsonResponse(report, json_dumps_params={'ensure_ascii': False})
+
+    # 同じSQL (N+1 など) をまとめ、合計時間の長い順に並べる
+    grouped = {}
+    for query in report['queries']:
+        group = grouped.setdefault(query['sql'], {'sql': query['sql'], 'count': 0, 'ms': 0.0})
+        group['count'] += 1
+        group['ms'] += query['ms']
+    context = {
+        **admin.site.each_context(request),
+        'title': f'計測結果: {report["method"]} {report["path"]}',
+        'report': report,
+        'query_groups': sorted(grouped.values(), key=lambda group: group['ms'], reverse=True),
+        'slowest_queries': sorted(report['queries'], key=lambda query: query['ms'], reverse=True)[:20],
+    }
+    return render(request, 'admin/field_app/profile_detail.html', context)
+
+
 @require_POST  # POSTリクエストのみを受け付ける
 @login_required
 def manual_sync_view(request):
@@ -40,6 +117,9 @@ def manual_sync_view(request):
     手動でのデータ同期をトリガーするビュー。
     バックグラウンドで `sync_data` 管理コマンドを実行する。
     """
+    if sync_progress.is_running(sync_progress.read()):
+        messages.info(request, "同期は既に実行中です。進み具合はこの画面に表示されます。")
+        return redirect('field_app:home')
     try:
         # 実行するコマンドを準備
         # sys.executable は現在実行中のPythonインタプリタのパス (/path/to/.venv/bin/python)
@@ -54,12 +134,50 @@ def manual_sync_view(request):
         messages.success(request, "データ同期処理を開始しました。完了まで数分かかる場合があります。")
 
     except Exception as e:
+        logger.exception('手動同期の開始に失敗しました')
         messages.error(request, f"同期処理の開始に失敗しました: {e}")
 
     # 処理の成否に関わらず、ホーム画面にリダイレクトする
     return redirect('field_app:home')
 
 
+@login_required
+async def sync_progress_stream_view(request):
+    """
+    同期の進み具合を Server-Sent Events で送り続ける (ホーム画面の進捗バー用)。
+    ASGI では非同期に待つので接続が増えてもスレッドを使わず、同期が行われていない間も
+    SYNC_PROGRESS_IDLE_SECONDS までは繋いだままにする。WSGI (runserver など) では1接続が
+    1スレッドを使うため、同期が行われていなければ現在の状態を1回送ってすぐに閉じ、実行中なら
+    終わるまで送り続ける (ブラウザは SYNC_PROGRESS_RETRY_MS 後に繋ぎ直す)。
+    """
+    # StreamingHttpResponse はサーバーと種類の違うイテレータを全て読み切ってから返すため、合わせて選ぶ
+    if isinstance(request, ASGIRequest):
+        stream = sync_progress.EventStream()
+
+        async def events():
+            yield stream.first()
+            while not stream.closed:
+                chunk = stream.step()
+                if chunk:
+                    yield chunk
+                await asyncio.sleep(config.SYNC_PROGRESS_POLL_SECONDS)
+    else:
+        stream = sync_progress.EventStream(idle_seconds=0)
+
+        def events():
+            yield stream.first()
+            while not stream.closed:
+                chunk = stream.step()
+                if chunk:
+                    yield chunk
+                time.sleep(config.SYNC_PROGRESS_POLL_SECONDS)
+
+    response = StreamingHttpResponse(events(), content_type='text/event-stream')
+    response['Cache-Control'] = 'no-cache'
+    response['X-Accel-Buffering'] = 'no'  # nginx などのプロキシでバッファさせない
+    return response
+
+
 # --- 避難所受付ビュー ---
 @login_required
 def shelter_checkin_view(request):
@@ -80,29 +198,48 @@ def shelter_checkin_view(request):
             messages.error(request, '無効な種別が指定されました。')
             return redirect('field_app:shelter_checkin')
 
-        # 連続入退所のチェック
-        # このユーザーの「最新の記録」を1件取得する
-        last_record = UnsyncedCheckin.objects.filter(username=username).order_by('-timestamp').first()
+        # 読み取ったIDが既知の避難者か、メモリ上のインデックスで確認する (DBへの問い合わせなし)
+        user_status, full_name = user_index.lookup(username)
+        if user_status is None and config.CHECKIN_UNKNOWN_USER_POLICY == 'reject':
+            messages.error(request, f'ID: {username} は登録されていません。QRコードを確認してください。')
+            return redirect('field_app:shelter_checkin')
+        display_name = f'{full_name} さん (ID: {username})' if full_name else f'ID: {username} さん'
 
-        if last_record and last_record.checkin_type == checkin_type:
+        # 連続入退所のチェック
+        # このユーザーの「最新の記録」の種別を取得する (アーカイブ済みの記録も含めた最後の入退所)
+        # (グループコミット中は、まだSQLiteに反映されていないジャーナル上の記録を優先する)
+        journal = checkin_journal.get_journal() if config.CHECKIN_GROUP_COMMIT else None
+        last_type = journal.pending_last_type(username) if journal else None
+        if last_type is None:
+            last_type = checkin_status.last_type(username)
+
+        if last_type == checkin_type:
             # 直前の記録と同じ種別だった場合、保存せずに警告を出す
             action_name = "入所" if checkin_type == 'checkin' else "退所"
             messages.warning(request,
-                                f'ID: {username} さんは既に「{action_name}」済みです。連続して同じ操作はできません。')
+                                f'{display_name}は既に「{action_name}」済みです。連続して同じ操作はできません。')
 
             # エラーではないので、リダイレクトして終了
             return redirect('field_app:shelter_checkin')
 
         # ローカルDBに一時保存
         try:
-            UnsyncedCheckin.objects.create(
-                username=username,
-                shelter_id=config.SHELTER_ID,
-                checkin_type=checkin_type,
-            )
+            if journal:
+                # ジャーナルに永続化された時点で記録完了とする (SQLiteへはまとめて反映)
+                journal.append(username=username, shelter_id=config.SHELTER_ID, checkin_type=checkin_type)
+            else:
+                UnsyncedCheckin.objects.create(
+                    username=username,
+                    shelter_id=config.SHELTER_ID,
+                    checkin_type=checkin_type,
+                )
             type_display = "入所" if checkin_type == 'checkin' else "退所"
-            messages.success(request, f'ID: {username} さんの「{type_display}」を記録しました。')
+            logger.debug('checkin recorded', extra={'username': username, 'checkin_type': checkin_type})
+            messages.success(request, f'{display_name}の「{type_display}」を記録しました。')
+            if user_status is None:
+                messages.warning(request, f'ID: {username} は未登録のIDです。次回の同期で確認されます。')
         except Exception as e:
+            logger.exception('チェックイン記録の保存に失敗しました')
             messages.error(request, f'データベースへの記録中にエラーが発生しました: {e}')
 
         return redirect('field_app:shelter_checkin')
@@ -117,26 +254,122 @@ def shelter_checkin_view(request):
     return render(request, 'field_app/shelter_checkin.html', context)
 
 
-def get_distribution_items():
-    """（ヘルパー関数）中央サーバーから配布物資のリストを取得する"""
+@login_required
+def checkin_lookup_view(request):
+    """
+    QRコードを読み取った直後に、画面側 (JavaScript) からIDを確認するためのAPI。
+    メモリ上のインデックスだけを見るため、DBへの問い合わせは発生しない。
+    """
+    username = request.GET.get('username', '')
+    user_status, full_name = user_index.lookup(username)
+    return JsonResponse({
+        'username': username,
+        'status': user_status or 'unknown',
+        'full_name': full_name or '',
+        'accept': user_status is not None or config.CHECKIN_UNKNOWN_USER_POLICY != 'reject',
+    })
+
+
+@login_required
+def name_search_view(request):
+    """
+    QRコードが無い避難者を氏名で探すAPI (受付・炊き出し確認の画面から、入力のたびに呼ばれる)。
+    氏名・ログインIDの一部で検索し、候補を返す (name_search.py)。
+    """
+    query = request.GET.get('q', '')[:50]
+    return JsonResponse({'query': query, 'results': name_search.search(query, limit=config.NAME_SEARCH_LIMIT)})
+
+
+def peer_checkins_view(request):
+    """
+    同じ避難所の他のラズパイ向けに、このデバイスで記録したチェックインを差分で返すAPI。
+    (ログインではなく、共有キーと避難所IDのヘッダで認証する)
+    """
+    if not peer_sync.is_authorized_peer(request):
+        return HttpResponseForbidden()
+
+    since = request.GET.get('since')
+    if since:
+        since = parse_datetime(since)
+        if since is None:
+            return HttpResponseBadRequest('invalid since')
+    try:
+        limit = min(int(request.GET.get('limit', config.PEER_BATCH_SIZE)), config.PEER_BATCH_SIZE)
+    except ValueError:
+        return HttpResponseBadRequest('invalid limit')
+
+    events, has_more = peer_sync.local_events_since(since, limit, request.GET.get('after_id'))
+    return JsonResponse({'device_id': config.DEVICE_ID, 'events': events, 'has_more': has_more})
+
+
+# ---------------------------------------------------------
+# 中央サーバーの応答を待つ画面 (炊き出し確認・チャット) は async ビューにしている。
+# asgi.py で動かすと、中央サーバーの応答待ちの間もワーカーが塞がらず、
+# 受付などのローカルだけで完結する画面が待たされない。
+# テンプレートの描画は (ユーザー情報の読み込みなどでDBに触れるため) sync_to_async で行う。
+#
+# 中央サーバーが落ちている間はサーキットブレーカーが送信をすぐに失敗させるので、
+# タイムアウトを待たずに、ローカルのマスタや前回取得した内容でオフライン表示にする。
+# ---------------------------------------------------------
+def _local_distribution_items():
+    """マスタデータ同期 (fetch_master_data) で保存済みの品目を、中央APIと同じ形で返す"""
+    return [{'id': str(item.id), 'name': item.name}
+            for item in DistributionItem.objects.order_by('name')]
+
+
+async def get_distribution_items(base_url=None):
+    """（ヘルパー関数）中央サーバーから配布物資のリストを取得する (取得できなければローカルのマスタ)"""
     try:
         # このAPIは別途作成する必要がある
-        response = requests.get(get_active_central_url() + "/api/distribution-items/", timeout=3)
+        base_url = base_url or await get_active_central_url_async()
+        response = await central_request_async('get', base_url + "/api/distribution-items/", timeout=3)
         if response.status_code == 200:
             return response.json().get('items', [])
-    except requests.exceptions.RequestException:
-        return []  # 失敗した場合は空のリストを返す
-    return []
+    except (requests.exceptions.RequestException, ValueError):
+        pass  # 接続できない・JSON でない応答 (中継機器のエラーページ等) はローカルのマスタで代替する
+    return await sync_to_async(_local_distribution_items)()
+
+
+async def _remember(key, value):
+    """中央サーバーから取得した内容を、オフライン時の表示用に保持する"""
+    await cache.aset(key, {'value': value, 'fetched_at': timezone.now()}, config.CENTRAL_FALLBACK_CACHE_SECONDS)
+
+
+async def _recall(key, default):
+    """_remember で保持した内容と取得日時を返す (無ければ default, None)"""
+    entry = await cache.aget(key)
+    if entry is None:
+        return default, None
+    return entry['value'], entry['fetched_at']
+
+
+def _offline_banner(central_url, cached_at=None):
+    """ブレーカーが開いている (または保持していた内容を表示している) 場合に、画面上部の表示内容を返す"""
+    breaker = circuit_breaker.breaker_for(central_url)
+    if breaker.state == circuit_breaker.CLOSED and cached_at is None:
+        return None
+    return {'retry_after': round(breaker.retry_after()), 'cached_at': cached_at}
 
 
 @login_required
-def food_distribution_view(request):
+async def food_distribution_view(request):
     context = {}
+    central_url = await get_active_central_url_async()
+
+    # 配布前に事前確認 (distribution_cache.prewarm) してあれば、中央サーバーに問い合わせずに判定する
+    # (その場合は物資リストもローカルのマスタを使い、スキャン1回ごとに中央サーバーとの往復を起こさない)
+    cached_result = None
+    if request.method == 'POST':
+        cached_result = await sync_to_async(distribution_cache.answer)(
+            request.POST.get('username'), request.POST.get('item_id'))
 
     # 中央サーバーから配布物資リストを取得
-    distribution_items = get_distribution_items()
+    if cached_result is not None:
+        distribution_items = await sync_to_async(_local_distribution_items)()
+    else:
+        distribution_items = await get_distribution_items(central_url)
     if not distribution_items:
-        messages.warning(request, "中央サーバーから配布物資リストを取得できませんでした。オフラインの可能性があります。")
+        messages.warning(request, "配布物資リストを取得できませんでした。マスタデータの同期を確認してください。")
 
     context['distribution_items'] = distribution_items
 
@@ -144,31 +377,46 @@ def food_distribution_view(request):
     if request.method == 'POST':
         username = request.POST.get('username')
         item_id = request.POST.get('item_id')
+        context['last_query'] = {'username': username, 'item_id': item_id}
 
-        # 中央サーバーのAPIに問い合わせ
-        try:
-            payload = {
-                'username': username,
-                'item_id': item_id,
-                'device_id': config.DEVICE_ID,
-                'action': 'record'  # 判定と記録を同時に行う
-            }
-            api_url = get_active_central_url() + config.API_BASE_PATH + 'check-distribution/'
-            response = requests.post(api_url, json=payload, timeout=5)
-
-            api_result = response.json()
-            context['api_result'] = api_result  # 結果をテンプレートに渡す
-            context['last_query'] = {'username': username, 'item_id': item_id}
-
-            if response.status_code == 200:
-                messages.success(request, api_result.get('message', '判定が完了しました。'))
+        if cached_result is not None:
+            context['api_result'] = cached_result
+            if cached_result['can_distribute']:
+                messages.success(request, cached_result['message'])
             else:
-                messages.error(request, api_result.get('message', '判定中にエラーが発生しました。'))
+                messages.error(request, cached_result['message'])
+        else:
+            # 中央サーバーのAPIに問い合わせ
+            try:
+                payload = {
+                    'username': username,
+                    'item_id': item_id,
+                    'device_id': config.DEVICE_ID,
+                    'action': 'record'  # 判定と記録を同時に行う
+                }
+                api_url = central_url + config.API_BASE_PATH + 'check-distribution/'
+                response = await central_request_async('post', api_url, json=payload, timeout=5)
+
+                api_result = response.json()
+                context['api_result'] = api_result  # 結果をテンプレートに渡す
 
-        except requests.exceptions.RequestException:
-            messages.error(request, "中央サーバーに接続できませんでした。")
+                if response.status_code == 200:
+                    # 受け取り済みになったので、後から事前確認の結果で二重に配布しないようにする
+                    await sync_to_async(distribution_cache.remember_recorded)(username, item_id)
+                    messages.success(request, api_result.get('message', '判定が完了しました。'))
+                else:
+                    messages.error(request, api_result.get('message', '判定中にエラーが発生しました。'))
 
-    return render(request, 'field_app/food_distribution.html', context)
+            except CircuitOpenError:
+                messages.error(request, "中央サーバーがオフラインのため、受け取り済みかを判定できません。")
+            except requests.exceptions.RequestException:
+                messages.error(request, "中央サーバーに接続できませんでした。")
+            except ValueError:
+                # JSON でない応答 (中継機器や認証画面のHTML等)。受け取り済みかは判定できていない
+                messages.error(request, "中央サーバーの応答を読み取れず、受け取り済みかを判定できませんでした。")
+
+    context['central_offline'] = _offline_banner(central_url)
+    return await sync_to_async(render)(request, 'field_app/food_distribution.html', context)
 
 
 @login_required
@@ -199,37 +447,36 @@ def field_report_view(request):
 
 
 @login_required
-def field_chat_view(request):
+async def field_chat_view(request):
     """
     現場チャット画面の表示（画像送信対応版）
     """
-    print(f"DEBUG: field_chat_view called. Method: {request.method}, User: {request.user.username}")
+    user = await request.auser()
+    chat_logger.debug('field_chat_view called', extra={'method': request.method, 'user': user.username})
     # 選択されているグループIDを取得 (デフォルトは 'all')
     selected_group_id = request.GET.get('group_id', 'all')
-    print(f"DEBUG: Selected group ID: {selected_group_id}")
 
     # ---------------------------------------------------------
     # 1. メッセージ送信処理 (POST)
     # ---------------------------------------------------------
     if request.method == 'POST':
-        print("DEBUG: Handling POST request for chat message.")
         group_id = request.POST.get('group_id')
 
         # 権限チェック: 全体連絡は管理者のみ
         if group_id == 'all':
-            if request.user.role not in ['admin', 'rescuer'] and not request.user.is_superuser:
+            if user.role not in ['admin', 'rescuer'] and not user.is_superuser:
                 messages.error(request, "全体連絡への送信権限がありません。")
-                print(f"DEBUG: Permission denied for user {request.user.username} to send to group 'all'.")
+                chat_logger.warning('全体連絡への送信を拒否しました', extra={'user': user.username})
                 return redirect(f"{reverse('field_app:field_chat')}?group_id={group_id}")
 
         message = request.POST.get('message', '')
         image_file = request.FILES.get('image')  # 画像ファイルを取得
-        print(f"DEBUG: Group ID: {group_id}, Message: '{message[:50]}...', Image file present: {bool(image_file)}")
+        chat_logger.debug('chat message received', extra={'group_id': group_id, 'message_length': len(message), 'has_image': bool(image_file)})
 
         # ★★★ 修正: メッセージ または 画像 があれば送信許可 ★★★
         if group_id and (message or image_file):
             try:
-                headers = {'X-User-Login-Id': request.user.username}
+                headers = {'X-User-Login-Id': user.username}
 
                 # ★★★ 修正: requests用のデータ構築 ★★★
                 # テキストデータは 'data' 引数に渡す辞書へ
@@ -241,30 +488,25 @@ def field_chat_view(request):
                 # ファイルデータは 'files' 引数に渡す辞書へ
                 files_payload = {}
                 if image_file:
-                    # {'フォームのフィールド名': ファイルオブジェクト}
-                    files_payload = {'image': image_file}
+                    # {'フォームのフィールド名': (ファイル名, 内容, Content-Type)}
+                    files_payload = {'image': (image_file.name, image_file.read(), image_file.content_type)}
 
-                api_url = get_active_central_url() + config.API_BASE_PATH + 'post-group-message/'
-                print(f"DEBUG: Sending chat message to API: {api_url}")
-                print(f"DEBUG: Headers: {headers}")
-                print(f"DEBUG: Data payload: {data_payload}")
-                print(f"DEBUG: Files payload keys: {files_payload.keys()}")
+                api_url = await get_active_central_url_async() + config.API_BASE_PATH + 'post-group-message/'
 
                 # ★★★ 修正: json=... ではなく data=... と files=... を使う ★★★
                 # これにより Content-Type が multipart/form-data に自動設定されます
-                response = requests.post(
+                response = await central_request_async(
+                    'post',
                     api_url,
                     headers=headers,
                     data=data_payload,
-                    files=files_payload,
+                    files=files_payload or None,
                     timeout=10,  # 画像送信を含むためタイムアウトを少し長めに
-                    verify=config.VERIFY_SSL # SSL検証設定を追加
                 )
-                print(f"DEBUG: Chat API response status code: {response.status_code}")
 
                 if response.status_code == 200:
                     messages.success(request, "送信しました。")
-                    print("DEBUG: Chat message sent successfully.")
+                    chat_logger.debug('chat message sent', extra={'group_id': group_id})
                 else:
                     # エラーレスポンスの解析
                     try:
@@ -272,16 +514,17 @@ def field_chat_view(request):
                     except ValueError:
                         error_msg = f"HTTP {response.status_code}"
                     messages.error(request, f"送信エラー: {error_msg}")
-                    print(f"DEBUG: Chat message send error: {error_msg}")
+                    chat_logger.warning('チャット送信エラー: %s', error_msg, extra={'status': response.status_code})
 
+            except CircuitOpenError:
+                messages.error(request, "中央サーバーがオフラインのため、メッセージを送信できませんでした。")
             except requests.exceptions.RequestException as e:
                 # エラー詳細をログに出すなどしても良い
-                print(f"DEBUG: Connection Error during chat message send: {e}")
+                chat_logger.warning('チャット送信時の接続エラー: %s', e)
                 messages.error(request, "サーバーに接続できず、メッセージを送信できませんでした。")
                 # 将来的なTodo: 未送信メッセージとしてローカルDBに保存するロジック
         else:
             messages.warning(request, "宛先グループと、メッセージまたは画像を入力してください。")
-            print("DEBUG: Missing group ID, message, or image file.")
 
         # 選択していたグループIDを維持してリダイレクト
         return redirect(f"{reverse('field_app:field_chat')}?group_id={group_id}")
@@ -290,24 +533,29 @@ def field_chat_view(request):
     # 2. グループリストの取得
     # ---------------------------------------------------------
     groups = []
-    print("DEBUG: Fetching group list.")
+    cached_at = None  # 保持していた内容で表示した場合の、その取得日時
+    central_url = await get_active_central_url_async()
+    headers = {'X-User-Login-Id': user.username}
+    groups_key = f'central:groups:{user.username}'
     try:
-        headers = {'X-User-Login-Id': request.user.username}
-        api_url = get_active_central_url() + config.API_BASE_PATH + 'get-user-groups/'
-        print(f"DEBUG: Group list API URL: {api_url}, Headers: {headers}")
-        response = requests.get(api_url, headers=headers, timeout=5, verify=config.VERIFY_SSL) # SSL検証設定を追加
+        api_url = central_url + config.API_BASE_PATH + 'get-user-groups/'
+        response = await central_request_async('get', api_url, headers=headers, timeout=5)
 
-        print(f"DEBUG: Group list API response status code: {response.status_code}")
         if response.status_code == 200:
             groups = response.json().get('groups', [])
-            print(f"DEBUG: Successfully fetched {len(groups)} groups.")
+            await _remember(groups_key, groups)
+            chat_logger.debug('fetched groups', extra={'count': len(groups)})
         else:
             messages.error(request, f"グループ情報の取得に失敗しました: {response.status_code}")
-            print(f"DEBUG: Failed to fetch groups: {response.status_code}, Response: {response.text}")
+            chat_logger.warning('グループ一覧の取得に失敗しました', extra={'status': response.status_code})
 
-    except requests.exceptions.RequestException as e:
-        print(f"DEBUG: Connection Error during group list fetch: {e}")
-        messages.error(request, "中央サーバーに接続できず、グループ情報を取得できませんでした。")
+    except CircuitOpenError:
+        groups, cached_at = await _recall(groups_key, [])
+    except (requests.exceptions.RequestException, ValueError) as e:  # ValueError: JSON でない応答
+        chat_logger.warning('グループ一覧取得時の接続エラー: %s', e)
+        groups, cached_at = await _recall(groups_key, [])
+        if cached_at is None:
+            messages.error(request, "中央サーバーに接続できず、グループ情報を取得できませんでした。")
 
     # ---------------------------------------------------------
     # 3. メッセージ履歴の取得
@@ -315,42 +563,91 @@ def field_chat_view(request):
     messages_history = []
 
     if selected_group_id:
-        print(f"DEBUG: Fetching message history for group: {selected_group_id}")
+        history_key = f'central:messages:{selected_group_id}:{user.username}'
         try:
-            headers = {'X-User-Login-Id': request.user.username}
-
             # URL構築: groups/all/messages/ または groups/1/messages/
-            api_url = f"{get_active_central_url()}{config.API_BASE_PATH}groups/{selected_group_id}/messages/"
-            print(f"DEBUG: Message history API URL: {api_url}, Headers: {headers}")
+            api_url = f"{central_url}{config.API_BASE_PATH}groups/{selected_group_id}/messages/"
 
-            response = requests.get(api_url, headers=headers, timeout=5, verify=config.VERIFY_SSL) # SSL検証設定を追加
-            print(f"DEBUG: Message history API response status code: {response.status_code}")
+            response = await central_request_async('get', api_url, endpoint='groups/<id>/messages/',
+                                                   headers=headers, timeout=5)
 
             if response.status_code == 200:
                 messages_history = response.json().get('messages', [])
-                print(f"DEBUG: Successfully fetched {len(messages_history)} messages for group {selected_group_id}.")
+                await _remember(history_key, messages_history)
+                chat_logger.debug('fetched message history', extra={'group_id': selected_group_id, 'count': len(messages_history)})
             else:
                 try:
                     error_msg = response.json().get('message', '取得失敗')
                 except ValueError:
                     error_msg = f"HTTP {response.status_code}"
                 messages.error(request, f"履歴取得エラー: {error_msg}")
-                print(f"DEBUG: Failed to fetch message history: {error_msg}, Response: {response.text}")
+                chat_logger.warning('メッセージ履歴の取得に失敗しました: %s', error_msg, extra={'status': response.status_code})
 
-        except requests.exceptions.RequestException as e:
-            print(f"DEBUG: Connection Error during message history fetch: {e}")
-            messages.error(request, "サーバーに接続できず、メッセージ履歴を取得できませんでした。")
+        except (requests.exceptions.RequestException, ValueError) as e:  # ValueError: JSON でない応答
+            messages_history, history_cached_at = await _recall(history_key, [])
+            cached_at = min(filter(None, (cached_at, history_cached_at)), default=None)
+            if not isinstance(e, CircuitOpenError):
+                chat_logger.warning('メッセージ履歴取得時の接続エラー: %s', e)
+                if history_cached_at is None:
+                    messages.error(request, "サーバーに接続できず、メッセージ履歴を取得できませんでした。")
+
+    # 画像はラズパイのキャッシュ経由で表示する (一覧ではサムネイル、タップで原寸)
+    for msg in messages_history:
+        if msg.get('image_url'):
+            msg['thumb_url'], msg['full_image_url'] = _chat_media_urls(msg['image_url'], central_url)
 
     context = {
         'groups': groups,
         'selected_group_id': selected_group_id,
         'messages_history': messages_history,
-        'central_server_url': get_active_central_url(),
-        'current_username': request.user.username,  # 自分の判定用
-        'current_fullname': request.user.full_name,  # 自分の判定用
+        'central_server_url': central_url,
+        'current_username': user.username,  # 自分の判定用
+        'current_fullname': user.full_name,  # 自分の判定用
+        'central_offline': _offline_banner(central_url, cached_at),
     }
-    print("DEBUG: Rendering field_chat.html with context.")
-    return render(request, 'field_app/field_chat.html', context)
+    return await sync_to_async(render)(request, 'field_app/field_chat.html', context)
+
+
+def _chat_media_urls(image_url, central_url):
+    """チャットの画像の (サムネイルのURL, 原寸のURL)。中央サーバー以外の画像は元のURLのまま"""
+    if media_cache.source_path(image_url) is None:
+        url = image_url if '://' in image_url else central_url.rstrip('/') + image_url
+        return url, url
+    base = f"{reverse('field_app:chat_media')}?{urlencode({'src': image_url})}"
+    return f'{base}&size={media_cache.THUMB}', base
+
+
+@login_required
+async def chat_media_view(request):
+    """
+    中央サーバー上のチャットの画像を、ラズパイのキャッシュから返す (media_cache.py)。
+    ?src=<image_url>&size=thumb で履歴の一覧用のサムネイルを返す。
+    """
+    path = media_cache.source_path(request.GET.get('src', ''))
+    if path is None:
+        return HttpResponseBadRequest('中継できない画像です。')
+    variant = media_cache.THUMB if request.GET.get('size') == media_cache.THUMB else media_cache.FULL
+
+    # 一度返した画像は変わらないので、ブラウザが持っていれば本文を返さない
+    etag = f'"{media_cache.cache_key(path)}-{variant}"'
+    if request.headers.get('If-None-Match') == etag:
+        response = HttpResponse(status=304)
+    else:
+        for attempt in range(2):  # 読む直前に LRU で消された場合は取り直す
+            try:
+                file_path, content_type = await media_cache.fetch(path, variant)
+                content = await sync_to_async(Path(file_path).read_bytes, thread_sensitive=False)()
+                break
+            except media_cache.MediaUnavailable as e:
+                chat_logger.warning('チャットの画像を返せませんでした: %s', e, extra={'path': path})
+                return HttpResponse(status=e.status)
+            except FileNotFoundError:
+                if attempt:
+                    raise
+        response = HttpResponse(content, content_type=content_type)
+    response['ETag'] = etag
+    response['Cache-Control'] = f'private, max-age={config.CHAT_MEDIA_BROWSER_MAX_AGE_SECONDS}'
+    return response
 
 
 def field_signup_view(request):
@@ -358,7 +655,7 @@ def field_signup_view(request):
         form = FieldSignUpForm(request.POST)
         if form.is_valid():
             # DBに保存（UnsyncedUserRegistrationモデル）
-            # フォームで定義した password フィールドの値は自動でモデルの password フィールドに入る
+            # パスワードはハッシュにしてモデルの password フィールドに入る (FieldSignUpForm.save)
             form.save()
 
             messages.success(request, '仮登録を受け付けました。管理者の承認（データ同期）をお待ちください。')
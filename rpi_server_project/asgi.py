@@ -13,4 +13,18 @@ from django.core.asgi import get_asgi_application
 
 os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'rpi_server_project.settings')
 
-application = get_asgi_application()
+django_application = get_asgi_application()
+
+from field_app.utils import use_shared_async_client  # noqa: E402
+
+
+async def application(scope, receive, send):
+    # このイベントループは ASGI サーバーが動かし続けるので、中央サーバーへの接続プールを共有する
+    use_shared_async_client()
+    await django_application(scope, receive, send)
+
+
+# 同期などの定期実行を、このプロセス内で開始する (config.SCHEDULER_ENABLED)
+from field_app import tasks  # noqa: E402
+
+tasks.start()
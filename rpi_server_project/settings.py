@@ -10,8 +10,12 @@ For the full list of settings and their values, see
 https://docs.djangoproject.com/en/5.2/ref/settings/
 """
 import os
+import sys
 from pathlib import Path
 
+import config
+from field_app import hashers
+
 # Build paths inside the project like this: BASE_DIR / 'subdir'.
 BASE_DIR = Path(__file__).resolve().parent.parent
 
@@ -41,6 +45,8 @@ INSTALLED_APPS = [
 ]
 
 MIDDLEWARE = [
+    # ビューごとの処理時間を計測するため、最も外側に置く
+    'field_app.middleware.ViewMetricsMiddleware',
     'django.middleware.security.SecurityMiddleware',
     'django.contrib.sessions.middleware.SessionMiddleware',
     'django.middleware.common.CommonMiddleware',
@@ -48,6 +54,8 @@ MIDDLEWARE = [
     'django.contrib.auth.middleware.AuthenticationMiddleware',
     'django.contrib.messages.middleware.MessageMiddleware',
     'django.middleware.clickjacking.XFrameOptionsMiddleware',
+    # 管理者が要求したリクエストだけを計測する (request.user を見るため認証より後に置く)
+    'field_app.middleware.ProfilingMiddleware',
 ]
 
 ROOT_URLCONF = 'rpi_server_project.urls'
@@ -77,10 +85,20 @@ WSGI_APPLICATION = 'rpi_server_project.wsgi.application'
 DATABASES = {
     'default': {
         'ENGINE': 'django.db.backends.sqlite3',
-        'NAME': BASE_DIR / 'db.sqlite3',
+        # 1台のPCで複数のインスタンスを動かす場合は、環境変数 FIELD_DB_PATH で別のファイルを指定する
+        'NAME': os.environ.get('FIELD_DB_PATH', BASE_DIR / 'db.sqlite3'),
     }
 }
 
+# マイグレーションファイルは各デバイスで makemigrations して作るためリポジトリには含めていない。
+# テスト実行時はモデル定義から直接テーブルを作成する
+if len(sys.argv) > 1 and sys.argv[1] == 'test':
+    MIGRATION_MODULES = {'field_app': None}
+
+
+# パスワードのハッシュ (config.PASSWORD_HASHER。この端末向けの強さにした方式を先頭に置く)
+PASSWORD_HASHERS = hashers.password_hashers()
+
 
 # Password validation
 # https://docs.djangoproject.com/en/5.2/ref/settings/#auth-password-validators
@@ -134,3 +152,56 @@ LOGOUT_REDIRECT_URL = 'field_app:login' # ログアウト後にリダイレク
 AUTH_USER_MODEL = 'field_app.User'
 
 
+# --- ログ設定 ---
+# 出力はキュー経由でバックグラウンドスレッドに渡し、RAM上でまとめてからファイルへ書き出す
+# (print で標準出力に書くと、systemd 配下ではそのまま journal への同期書き込みになるため)
+os.makedirs(config.LOG_DIR, exist_ok=True)
+
+# リクエスト・レコード単位で大量に出るログ。本番では config.LOG_HOT_PATH_DEBUG = False で止める
+_HOT_PATH_LEVEL = 'DEBUG' if config.LOG_HOT_PATH_DEBUG else 'INFO'
+
+LOGGING = {
+    'version': 1,
+    'disable_existing_loggers': False,
+    'formatters': {
+        'structured': {
+            '()': 'field_app.log_handlers.StructuredFormatter',
+        },
+        'console': {
+            'format': '[%(asctime)s] %(levelname)s %(name)s: %(message)s',
+        },
+    },
+    'handlers': {
+        'file': {
+            'class': 'field_app.log_handlers.QueueingBufferedFileHandler',
+            'filename': os.path.join(config.LOG_DIR, 'field_app.log'),
+            'max_bytes': config.LOG_MAX_BYTES,
+            'backup_count': config.LOG_BACKUP_COUNT,
+            'capacity': config.LOG_BUFFER_CAPACITY,
+            'flush_interval': config.LOG_FLUSH_INTERVAL_SECONDS,
+            'formatter': 'structured',
+        },
+        'console': {
+            'class': 'logging.StreamHandler',
+            'level': 'WARNING',
+            'formatter': 'console',
+        },
+    },
+    'loggers': {
+        'field_app': {
+            'handlers': ['file', 'console'],
+            'level': config.LOG_LEVEL,
+            'propagate': False,
+        },
+        # サブシステム別のロガー
+        'field_app.views': {'level': _HOT_PATH_LEVEL},
+        'field_app.chat': {'level': _HOT_PATH_LEVEL},
+        'field_app.sync': {'level': _HOT_PATH_LEVEL},
+        'field_app.master': {'level': _HOT_PATH_LEVEL},
+        'django': {
+            'handlers': ['file', 'console'],
+            'level': 'WARNING',
+            'propagate': False,
+        },
+    },
+}
@@ -14,3 +14,8 @@ from django.core.wsgi import get_wsgi_application
 os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'rpi_server_project.settings')
 
 application = get_wsgi_application()
+
+# 同期などの定期実行を、このプロセス内で開始する (config.SCHEDULER_ENABLED)
+from field_app import tasks  # noqa: E402
+
+tasks.start()